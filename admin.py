@@ -2,19 +2,53 @@ import streamlit as st
 import pandas as pd
 import mysql.connector
 import json
-from datetime import datetime
+import os
+from datetime import datetime, timedelta
+
+import admission
+import archive
+import cache
+import capacity
+import consolidate
+import db
+import metering
+import ops
+import pagination
+import placement
+import prefetch
+import queries
+import querystats
+import replica
+import sqlconsole
+import timeseries
 
 # ================= 数据库连接辅助 =================
 
 def get_connection(db_config):
-    """获取数据库连接"""
-    return mysql.connector.connect(**db_config)
+    """从共享连接池借出连接 (close() 即归还)"""
+    return db.get_connection(db_config)
+
+# 仪表盘读查询的缓存 TTL (秒)；写操作会按表名主动失效，TTL 只兜底其他进程的写入
+CACHE_TTL = {
+    "capacity": 10,
+    "pending": 3,
+    "active": 5,
+    "history": 10,
+    "all_instances": 5,
+    "balance_risk": 10,
+    "util_series": 30,
+}
+
+# 利用率历史图表的时间范围
+HISTORY_RANGES = {"6 小时": timedelta(hours=6), "24 小时": timedelta(days=1),
+                  "7 天": timedelta(days=7), "30 天": timedelta(days=30), "1 年": timedelta(days=365)}
 
 # ================= 核心逻辑函数 =================
 
 def approve_request(db_config, req_id, user_id, params):
     """
-    批准请求：调用存储过程 sp_create_instance 分配物理资源
+    批准请求：由放置引擎 (placement.py) 选出目标节点，
+    再通过存储过程 sp_create_instance_at 以 compare-and-set 方式分配物理资源
     """
     conn = get_connection(db_config)
     cursor = conn.cursor()
@@ -23,20 +57,8 @@ def approve_request(db_config, req_id, user_id, params):
         db_p = params.get('db_params', {})
         p_queue = params.get('queue')
         
-        # 参数列表：第一个参数改为 req_id (用户提交的那个ID)
-        args = [
-            req_id,  # <--- 传入现有的 Request ID
-            p_queue, 
-            db_p.get('req_cores', 1),
-            db_p.get('req_gpu_mem', 0),
-            db_p.get('req_ram', 1),
-            db_p.get('req_disk', 10),
-            0 
-        ]
-        
-        # 调用存储过程
-        result_args = cursor.callproc('sp_create_instance', args)
-        new_node_id = result_args[-1] 
+        engine = placement.get_engine(db_config)
+        new_node_id = engine.allocate(req_id, p_queue, db_p, conn=conn)
         
         if new_node_id and new_node_id > 0:
             # 更新状态为 approved
@@ -45,6 +67,8 @@ def approve_request(db_config, req_id, user_id, params):
                 (new_node_id, req_id)
             )
             conn.commit()
+            cache.invalidate(*ops.ALLOCATION_TABLES)
+            replica.note_write(db_config, ops.READ_SCOPE)
             st.toast(f" 审批成功！资源已分配，节点 ID: {new_node_id}")
             return True
         else:
@@ -58,6 +82,18 @@ def approve_request(db_config, req_id, user_id, params):
         cursor.close()
         conn.close()
 
+# ops.approve_requests 逐条结果的显示文字
+BATCH_RESULT_LABELS = {
+    "APPROVED": "已分配",
+    "NO_CAPACITY": "资源不足",
+    "CONFLICT": "并发冲突",
+    "NOT_PENDING": "已被处理",
+    "NOT_FOUND": "请求不存在",
+    "SQL_ERROR": "数据库错误",
+    "DEADLOCK": "死锁 / 锁等待超时 (整批已回滚)",
+    "INVALID_PARAMS": "参数解析失败",
+}
+
 def reject_request(db_config, req_id):
     """
     拒绝请求：不占用资源，直接标记为 rejected
@@ -67,6 +103,8 @@ def reject_request(db_config, req_id):
     try:
         cursor.execute("UPDATE requests SET status='rejected' WHERE request_id=%s", (req_id,))
         conn.commit()
+        cache.invalidate("requests")
+        replica.note_write(db_config, ops.READ_SCOPE)
         st.toast(f"已拒绝请求 {req_id}")
     except mysql.connector.Error as err:
         st.error(f"操作失败: {err}")
@@ -74,207 +112,467 @@ def reject_request(db_config, req_id):
         cursor.close()
         conn.close()
 
+RELEASE_RESULT_LABELS = {
+    "SUCCESS": "已释放",
+    "ALREADY_STOPPED": "已停止",
+    "NOT_FOUND": "实例不存在",
+    "SQL_ERROR": "数据库错误",
+}
+
+RELEASE_SCOPES = {"queue": "队列", "user": "用户", "npu": "物理 NPU"}
+
 def stop_instance(db_config, node_id, req_id, action_type):
     """
     停止实例：
     action_type='complete': 正常完成 (状态 completed)
     action_type='terminate': 强制终止 (状态 terminated)
-    两者都需要调用 sp_release_resource 释放物理硬件
+    两者都走 sp_release_batch 释放物理硬件
     """
-    conn = get_connection(db_config)
-    cursor = conn.cursor()
     try:
-        # 1. 调用存储过程释放物理资源 (归还核数、内存等)
-        try:
-            # 这里传入两个参数 [node_id, '']
-            # 第二个参数是 OUT p_result_status 的占位符
-            cursor.callproc('sp_release_resource', [node_id, ''])
-            
-        except mysql.connector.Error as e:
-            if e.errno == 1305: # PROCEDURE does not exist
-                st.error("错误：数据库中缺少存储过程 `sp_release_resource`，无法自动释放物理资源。请联系DBA。")
-                return False
-            else:
-                raise e
-        
-        # 2. 根据操作类型更新 requests 和 virtualcomputers 的状态
-        final_status = 'completed' if action_type == 'complete' else 'terminated'
-        
-        # 更新请求状态
-        cursor.execute("UPDATE requests SET status=%s, complete_time=NOW() WHERE request_id=%s", (final_status, req_id))
-        
-        # 更新虚拟机状态 (通常释放后虚拟机记录标记为 terminated 或 stopped)
-        # 注意：sp_release_resource 内部其实已经把 virtualcomputers 设为 terminated 了，
-        # 但为了双重保险或处理 action_type 差异，这里保留更新逻辑，但建议统一为 terminated
-        cursor.execute("UPDATE virtualcomputers SET status='terminated' WHERE node_id=%s", (node_id,))
-        
-        conn.commit()
-        
-        msg = "任务正常结束 (Completed)" if action_type == 'complete' else "任务已强制终止 (Terminated)"
-        st.toast(f"{msg} - 节点 {node_id} 资源已释放")
-        return True
-        
+        result_status = ops.release_nodes(db_config, [node_id], action_type)[0]["result"]
     except mysql.connector.Error as err:
-        st.error(f"释放资源失败: {err}")
+        if err.errno == 1305: # PROCEDURE does not exist
+            st.error("错误：数据库中缺少存储过程 `sp_release_batch`，无法自动释放物理资源。请先执行 migrate.py。")
+        else:
+            st.error(f"释放资源失败: {err}")
         return False
-    finally:
-        cursor.close()
-        conn.close()
+
+    if result_status != 'SUCCESS':
+        st.error(f"释放资源失败: 节点 {node_id} {RELEASE_RESULT_LABELS.get(result_status, result_status)}")
+        return False
+
+    msg = "任务正常结束 (Completed)" if action_type == 'complete' else "任务已强制终止 (Terminated)"
+    st.toast(f"{msg} - 节点 {node_id} 资源已释放")
+    return True
 
 # ================= 界面渲染主函数 =================
 
-def render_admin_dashboard(db_config):
+CONSOLE_ROW_CAP = 1000
+
+def _run_console(db_config, sql, timeout, row_cap, export_fmt=None):
+    """
+    执行高级查询：边读边显示前 row_cap 行；export_fmt 不为空时把全部结果 (至多 EXPORT_ROW_CAP 行、
+    EXPORT_BYTE_CAP 字节) 流式写入临时文件，不在内存中攒结果。执行期间点击 "取消" (或页面上任何组件) 会打断读取，
+    finally 中终止语句并丢弃连接。
+    """
+    st.button("取消", key="sql_cancel", help="终止正在执行的语句")
+    status, table = st.empty(), st.empty()
+    preview, writer, path, truncated, finished = [], None, None, None, False
+    run = sqlconsole.StatementRun(db_config, sql, timeout, replica_scope=ops.READ_SCOPE)
+    if run.on_replica:
+        st.caption(f"只读语句，在读副本 {run.db_config.get('host')}:{run.db_config.get('port', 3306)} 上执行")
+    try:
+        for rows in run.chunks():
+            if rows is not None:
+                if export_fmt:
+                    if writer is None:
+                        path = sqlconsole.new_export_path(export_fmt)
+                        writer = sqlconsole.open_writer(path, export_fmt, run.columns)
+                    writer.write(rows)
+                    if os.path.getsize(path) >= sqlconsole.EXPORT_BYTE_CAP:
+                        truncated = "bytes"
+                        break
+                if len(preview) < row_cap:
+                    preview.extend(rows[:row_cap - len(preview)])
+                    table.dataframe(pd.DataFrame(preview, columns=run.columns), use_container_width=True)
+                if run.rows_read >= (sqlconsole.EXPORT_ROW_CAP if export_fmt else row_cap):
+                    truncated = "rows"
+                    break
+            status.caption(f"执行中… {run.elapsed():.1f}s，已读取 {run.rows_read} 行")
+        finished = True
+    except sqlconsole.StatementTimeout as err:
+        status.empty()
+        st.error(str(err))
+        return
+    except mysql.connector.Error as err:
+        status.empty()
+        st.error(f"SQL 执行错误: {err}")
+        return
+    finally:
+        run.close()
+        if writer is not None:
+            writer.close()
+            if not finished:
+                os.remove(path)
+                path = None
+
+    status.empty()
+    if run.rowcount is not None:
+        # 任意 SQL 可能改动任意表，清空整个查询缓存
+        cache.invalidate()
+        replica.note_write(db_config, ops.READ_SCOPE)
+        st.success(f"执行成功，影响行数: {run.rowcount}")
+        return
+    if run.rows_read == 0:
+        st.info("查询成功，但未返回任何结果。")
+    elif truncated == "bytes":
+        st.warning(f"导出文件超过 {sqlconsole.EXPORT_BYTE_CAP // 2**20} MB (下载时需整个读入内存)，"
+                   f"只导出了前 {run.rows_read} 行 (显示前 {len(preview)} 行)，请缩小查询范围或分批导出。")
+    elif truncated:
+        cap = sqlconsole.EXPORT_ROW_CAP if export_fmt else row_cap
+        st.warning(f"结果超过 {cap} 行，只读取了前 {run.rows_read} 行 (显示前 {len(preview)} 行)。")
+    else:
+        st.success(f"查询成功，返回 {run.rows_read} 行 (显示前 {len(preview)} 行)。")
+
+    if export_fmt:
+        if writer is None and run.columns:
+            path = sqlconsole.new_export_path(export_fmt)
+            sqlconsole.open_writer(path, export_fmt, run.columns).close()
+        if path:
+            previous = st.session_state.get('sql_export')
+            if previous:
+                previous.remove()
+            # 会话结束时文件随 session_state 一起被回收 (见 sqlconsole.ExportFile)
+            st.session_state['sql_export'] = sqlconsole.ExportFile(path, export_fmt, run.rows_read)
+
+QUERY_STATS_COLUMNS = ["fingerprint", "calls", "total_ms", "avg_ms", "p95_ms", "p99_ms", "max_ms",
+                       "rows", "errors", "rollbacks", "lock_wait_ms"]
+
+def _query_stats_panel(cursor):
+    """本进程 (所有会话) 按语句指纹汇总的耗时，以及服务端按摘要统计的锁等待"""
+    stats = querystats.snapshot()
+    st.caption(f"统计起点: {querystats.since()}，共 {len(stats)} 类语句 (分位数为直方图估计)")
+    if stats:
+        df = pd.DataFrame(stats)[QUERY_STATS_COLUMNS]
+        c1, c2 = st.columns(2)
+        c1.markdown("**最慢 (p95)**")
+        c1.dataframe(df.sort_values("p95_ms", ascending=False).head(10), hide_index=True, use_container_width=True)
+        c2.markdown("**最频繁**")
+        c2.dataframe(df.sort_values("calls", ascending=False).head(10), hide_index=True, use_container_width=True)
+        st.markdown("**总耗时最多**")
+        st.dataframe(df.sort_values("total_ms", ascending=False).head(20), hide_index=True, use_container_width=True)
+
+    b1, b2, b3 = st.columns(3)
+    b1.download_button("导出 JSON", json.dumps(querystats.dump(), ensure_ascii=False, indent=2),
+                       file_name="query_stats.json", mime="application/json", use_container_width=True)
+    if b2.button("清零", use_container_width=True):
+        querystats.reset()
+        st.rerun()
+    if b3.button("服务端锁等待 Top 20", use_container_width=True):
+        try:
+            st.dataframe(pd.DataFrame(querystats.server_digests(cursor)), hide_index=True, use_container_width=True)
+        except mysql.connector.Error as err:
+            st.error(f"读取 performance_schema 失败: {err}")
+
+def _selection_grid(df, key, column_config=None):
+    """
+    单个 data_editor 表格 + 勾选列，替代逐行 container/按钮；返回被勾选的行。
+    行数增加只影响表格数据量，不增加组件数量。
+    """
+    select_all = st.checkbox("全选", key=f"{key}_all")
+    grid = df.copy()
+    grid.insert(0, "选择", select_all)
+    edited = st.data_editor(
+        grid,
+        key=key,
+        hide_index=True,
+        use_container_width=True,
+        disabled=[c for c in grid.columns if c != "选择"],
+        column_config=column_config,
+    )
+    return df[edited["选择"].to_numpy()]
+
+def _show_report(state_key, labels, title):
+    """显示上一次批量操作的结果 (批量操作结束后只 rerun 一次)"""
+    report = st.session_state.pop(state_key, None)
+    if not report:
+        return
+    report_df = pd.DataFrame(report)
+    summary = report_df['result'].map(lambda r: labels.get(r, r)).value_counts()
+    st.success(f"{title}：" + "，".join(f"{k} {v} 条" for k, v in summary.items()))
+    with st.expander("逐条结果"):
+        report_df['result'] = report_df['result'].map(lambda r: labels.get(r, r))
+        st.dataframe(report_df, use_container_width=True, hide_index=True)
+
+def _finish_bulk_action(grid_key, report_key=None, report=None):
+    """保存结果、清掉表格勾选状态后整页只重跑一次"""
+    if report_key is not None:
+        st.session_state[report_key] = report
+    st.session_state.pop(grid_key, None)
+    st.session_state.pop(f"{grid_key}_all", None)
+    st.rerun()
+
+HISTORY_STATUSES = ["All", "pending", "approved", "completed", "terminated", "rejected", "failed"]
+
+def submit_dashboard_queries(page, db_config, history_status="All", history_page=(pagination.DEFAULT_PAGE_SIZE, None),
+                             ttl=CACHE_TTL):
+    """把控制台各区块互不依赖的读查询提交给 prefetch.PageQueries 并行执行"""
+    page.submit("capacity", capacity.queue_capacity, ttl=ttl["capacity"])
+    page.submit("pending", cache.fetch_all, queries.SQL_PENDING, ttl=ttl["pending"], tags=("requests",))
+    page.submit("active", cache.fetch_all, queries.SQL_ACTIVE, ttl=ttl["active"],
+                tags=("requests", "users", "virtualcomputers"))
+    where, params = ([], []) if history_status == "All" else (["r.status = %s"], [history_status])
+    page_size, after = history_page
+    page.submit("history", pagination.fetch_page, queries.SQL_HISTORY, where, params,
+                key_cols=("r.request_id",), key_fields=("request_id",), after=after, page_size=page_size,
+                ttl=ttl["history"], tags=("requests", "users"))
+    page.submit("balance_risk", metering.risk_report, ttl=ttl["balance_risk"])
+    page.submit("all_instances", cache.fetch_all, queries.SQL_ALL_INSTANCES, ttl=ttl["all_instances"],
+                tags=("virtualcomputers", "requests", "users", "virtualcpu", "npus"))
+
+def render_admin_dashboard(db_config, vm_packages=None):
     """
-    管理员控制台主视图 - 由 fore.py 调用
+    管理员控制台主视图 - 由 fore.py 调用；vm_packages 用于碎片整理报表中的整机套餐可放数量
     """
     st.title("HPC 集群调度控制台")
     
     # 使用 Tabs 分隔功能区，界面更整洁
-    tab1, tab2, tab3 = st.tabs(["资源池监控", "调度管理 (排队/运行)", "全部请求监控"])
+    tab1, tab2, tab3, tab4 = st.tabs(["资源池监控", "调度管理 (排队/运行)", "全部请求监控", "余额风险"])
 
     conn = get_connection(db_config)
     if not conn:
         st.stop()
     cursor = conn.cursor(dictionary=True)
 
+    # 先把各区块的读查询一起提交，渲染到对应区块时再取结果；
+    # 全部请求监控的筛选 / 分页取控件在本次重跑的值 (控件在 Tab 3 中渲染)
+    history_status = st.session_state.get("history_status", "All")
+    history_key = f"history_page_{history_status}" + ("_archive" if st.session_state.get("history_archive") else "")
+    page = prefetch.PageQueries(db_config, scope=ops.READ_SCOPE)
+    submit_dashboard_queries(page, db_config, history_status, pagination.current(history_key))
+
     # --- Tab 1: 资源池监控 ---
     with tab1:
         st.subheader("物理资源池状态 (Physical Infrastructure)")
-        st.caption("实时监控 `npus` 和 `memory` 表的剩余容量")
+        st.caption("按队列汇总的剩余容量 (来自 `capacity_summary`，随每次分配 / 释放增量更新)")
         
+        capacity_df = pd.DataFrame(prefetch.section(page, "capacity", []))
         col1, col2 = st.columns(2)
         
         with col1:
             st.markdown("### 计算节点 (NPU/CPU)")
-            cursor.execute("""
-                SELECT queue_type, 
-                       COUNT(*) as total_nodes, 
-                       SUM(available_cores) as free_cores, 
-                       SUM(available_memory) as free_gpu_mem 
-                FROM npus GROUP BY queue_type
-            """)
-            npu_stats = pd.DataFrame(cursor.fetchall())
-            st.dataframe(npu_stats, use_container_width=True, hide_index=True)
+            if not capacity_df.empty:
+                st.dataframe(
+                    capacity_df[capacity_df['total_nodes'] > 0][
+                        ['queue_type', 'total_nodes', 'idle_nodes', 'full_nodes', 'fragmented_nodes',
+                         'free_cores', 'used_cores', 'free_gpu_mem', 'used_gpu_mem']],
+                    use_container_width=True, hide_index=True)
             
         with col2:
             st.markdown("### 内存池 (RAM)")
-            cursor.execute("""
-                SELECT queue_type, 
-                       SUM(available_size) as free_ram_gb 
-                FROM memory GROUP BY queue_type
-            """)
-            mem_stats = pd.DataFrame(cursor.fetchall())
-            st.dataframe(mem_stats, use_container_width=True, hide_index=True)
+            if not capacity_df.empty:
+                st.dataframe(
+                    capacity_df[capacity_df['mem_modules'] > 0][['queue_type', 'mem_modules', 'free_ram', 'used_ram']]
+                    .rename(columns={'free_ram': 'free_ram_gb', 'used_ram': 'used_ram_gb'}),
+                    use_container_width=True, hide_index=True)
+
+        st.markdown("### 利用率历史")
+        st.caption("timeseries.py 定时采样；时间范围越长读取的桶越粗 (原始 / 5 分钟 / 1 小时)，不扫原始样本")
+        if not capacity_df.empty:
+            h1, h2, h3 = st.columns(3)
+            hist_queue = h1.selectbox("队列", capacity_df['queue_type'].tolist(), key="util_queue")
+            hist_range = h2.selectbox("时间范围", list(HISTORY_RANGES), key="util_range")
+            hist_metric = h3.selectbox("指标", list(timeseries.METRICS), format_func=timeseries.METRICS.get,
+                                       key="util_metric")
+            points = pd.DataFrame(timeseries.series(
+                db_config, cursor, "queue", hist_queue, datetime.now() - HISTORY_RANGES[hist_range],
+                ttl=CACHE_TTL["util_series"]))
+            if points.empty:
+                st.info("暂无采样数据 (timeseries.py 尚未运行)。")
+            else:
+                points = points.set_index('bucket')
+                if hist_metric in ("cores", "gpu_mem", "ram"):
+                    total = points[f'{hist_metric}_total'].astype(float).where(lambda t: t > 0)
+                    chart = pd.DataFrame({
+                        "平均利用率 (%)": points[f'{hist_metric}_used_avg'].astype(float) / total * 100,
+                        "峰值利用率 (%)": points[f'{hist_metric}_used_max'].astype(float) / total * 100,
+                    })
+                else:
+                    chart = pd.DataFrame({
+                        "平均": points[f'{hist_metric}_avg'].astype(float),
+                        "峰值": points[f'{hist_metric}_max'].astype(float),
+                    })
+                st.line_chart(chart)
+
+        with st.expander("容量汇总对账"):
+            st.caption("全量重算 npus / memory 并与汇总表比对，发现漂移时用重算结果修正")
+            if st.button("立即对账"):
+                drift = capacity.reconcile(db_config, fix=True)
+                replica.note_write(db_config, ops.READ_SCOPE)
+                if drift:
+                    st.warning(f"发现 {len(drift)} 个槽位漂移，已修正")
+                    st.json(drift)
+                else:
+                    st.success("汇总表与明细一致")
+
+        with st.expander("碎片整理 (腾空整台节点)"):
+            st.caption("把部分占用节点上的实例迁到其他已在使用的节点，腾出可放整机套餐的空闲节点；"
+                       "先生成规划查看效果，再执行")
+            c1, c2, c3 = st.columns([2, 1, 1])
+            queues = capacity_df['queue_type'].tolist() if not capacity_df.empty else []
+            plan_queue = c1.selectbox("队列", ["All"] + queues, key="consolidate_queue")
+            max_moves = c2.number_input("每维度迁移上限", min_value=1, value=consolidate.MAX_MOVES, step=50,
+                                        key="consolidate_max_moves")
+            if c3.button("生成规划", key="consolidate_plan"):
+                st.session_state["consolidate_plans"] = consolidate.plan_from_db(
+                    db_config, None if plan_queue == "All" else plan_queue, int(max_moves), vm_packages)
+            plans = st.session_state.get("consolidate_plans")
+            if plans:
+                st.dataframe(pd.DataFrame([
+                    {"queue": q, "npu_moves": p["npu_moves"], "npu_freed": p["npu_freed"],
+                     "npu_fragmented": f"{p['npu_before']['fragmented']} → {p['npu_after']['fragmented']}",
+                     "memory_moves": p["memory_moves"], "memory_freed": p["memory_freed"],
+                     "memory_fragmented": f"{p['memory_before']['fragmented']} → {p['memory_after']['fragmented']}",
+                     "package": p.get("package"),
+                     "package_fits": f"{p.get('fits_before')} → {p.get('fits_after')}",
+                     "plan_ms": p["plan_ms"]}
+                    for q, p in consolidate.summary(plans).items()]), use_container_width=True, hide_index=True)
+                if st.button("执行规划", type="primary", key="consolidate_apply"):
+                    report = consolidate.apply(db_config, plans)
+                    replica.note_write(db_config, ops.READ_SCOPE)
+                    st.session_state.pop("consolidate_plans")
+                    applied = sum(r["moves"] for r in report if r["result"] == "APPLIED")
+                    stale = sum(1 for r in report if r["result"] == "STALE")
+                    st.success(f"已迁移 {applied} 个实例映射" + (f"，{stale} 个节点状态已变化、已跳过" if stale else ""))
+
+        with st.expander("数据库连接池状态"):
+            st.json(db.pool_metrics(db_config))
+        with st.expander("查询缓存状态"):
+            st.json(cache.stats())
+        with st.expander("申请提交准入状态"):
+            st.caption(f"每用户每分钟 {admission.RATE_PER_MINUTE} 次 (突发 {admission.BURST})，"
+                       f"排队上限 每用户 {admission.MAX_PENDING_PER_USER} / 每队列 {admission.MAX_PENDING_PER_QUEUE}，"
+                       f"{admission.DUPLICATE_WINDOW} 秒内同一套餐不重复受理；本进程的计数")
+            st.json(admission.stats(db_config))
+        with st.expander("读副本路由状态"):
+            routing = replica.stats(db_config)
+            if routing is None:
+                st.caption("未配置读副本 (fore.py 中的 REPLICA_CONFIG)，所有查询走主库")
+            else:
+                st.caption(f"仪表盘查询与高级查询中的只读语句优先走延迟不超过 {routing['max_lag']} 秒的副本，"
+                           "写操作后本控制台的读查询在副本追上之前走主库")
+                st.dataframe(pd.DataFrame(routing.pop("replicas")), use_container_width=True, hide_index=True)
+                st.json(routing)
+        with st.expander("查询耗时统计"):
+            _query_stats_panel(cursor)
 
     # --- Tab 2: 调度管理 (核心功能) ---
     with tab2:
         # 2.1 待审批队列
         st.subheader("1. 等待队列 (Pending)")
-        cursor.execute("SELECT * FROM requests WHERE status='pending' ORDER BY submit_time ASC")
-        pending_reqs = pd.DataFrame(cursor.fetchall())
+        pending_reqs = pd.DataFrame(prefetch.section(page, "pending", []))
         
+        _show_report('batch_report', BATCH_RESULT_LABELS, "批量审批完成")
+
         if pending_reqs.empty:
             st.info("暂无排队作业。")
         else:
-            for _, req in pending_reqs.iterrows():
-                with st.container(border=True):
-                    c1, c2, c3 = st.columns([5, 1, 1])
-                    
-                    # 解析参数用于显示
-                    try:
-                        params = json.loads(req['parameters'])
-                        spec_name = params.get('name', 'Unknown')
-                        queue_name = params.get('queue', 'Unknown')
-                        db_p = params.get('db_params', {})
-                        req_desc = f"CPU: {db_p.get('req_cores')}C | GPU: {db_p.get('req_gpu_mem')}G | RAM: {db_p.get('req_ram')}G"
-                    except:
-                        params = {}
-                        spec_name = "解析错误"
-                        queue_name = "-"
-                        req_desc = "-"
-
-                    with c1:
-                        st.markdown(f"**Req #{req['request_id']}** | 用户ID: `{req['user_id']}` | 提交时间: {req['submit_time']}")
-                        st.text(f"申请: {spec_name} ({queue_name})")
-                        st.caption(f"规格需求: {req_desc}")
-                    
-                    with c2:
-                        if st.button("通过", key=f"ok_{req['request_id']}", use_container_width=True):
-                            if approve_request(db_config, req['request_id'], req['user_id'], params):
-                                st.rerun()
-                    with c3:
-                        if st.button("拒绝", key=f"no_{req['request_id']}", use_container_width=True):
-                            reject_request(db_config, req['request_id'])
-                            st.rerun()
+            selected = _selection_grid(pending_reqs, "pending_grid", column_config={
+                "request_id": "ReqID",
+                "user_id": "用户ID",
+                "submit_time": st.column_config.DatetimeColumn("提交时间", format="D MMM, HH:mm"),
+                "spec_name": "申请规格",
+                "queue": "队列",
+                "req_cores": "CPU (核)",
+                "req_gpu_mem": "显存 (G)",
+                "req_ram": "内存 (G)",
+                "parameters": None,
+            })
+            
+            b1, b2, b3 = st.columns([1, 1, 2])
+            with b1:
+                if st.button(f"通过所选 ({len(selected)})", disabled=selected.empty, use_container_width=True):
+                    report = ops.approve_requests(db_config, list(zip(selected['request_id'], selected['parameters'])))
+                    _finish_bulk_action("pending_grid", 'batch_report', report)
+            with b2:
+                if st.button(f"拒绝所选 ({len(selected)})", disabled=selected.empty, use_container_width=True):
+                    rejected = ops.reject_requests(db_config, selected['request_id'].tolist())
+                    st.toast(f"已拒绝 {rejected} 条请求")
+                    _finish_bulk_action("pending_grid")
+            with b3:
+                q1, q2 = st.columns([1, 1])
+                queue_options = sorted(pending_reqs['queue'].dropna().unique().tolist())
+                batch_queue = q1.selectbox("按队列", queue_options, key="batch_queue", label_visibility="collapsed")
+                if q2.button("该队列放得下的全部通过", disabled=not batch_queue, use_container_width=True):
+                    _finish_bulk_action("pending_grid", 'batch_report', ops.approve_queue(db_config, batch_queue))
 
         st.divider()
 
         # 2.2 运行中实例管理
         st.subheader("2. 运行中实例 (Active Instances)")
-        # 关联 requests 和 virtualcomputers 表，获取正在运行的任务
-        # 逻辑：状态为 approved 且在 virtualcomputers 表中有对应记录
-        sql_active = """
-            SELECT r.request_id, u.user_name, r.submit_time, 
-                   vc.node_id, vc.node_name, vc.queue_name, vc.hourly_price
-            FROM requests r
-            JOIN users u ON r.user_id = u.user_id
-            JOIN virtualcomputers vc ON r.request_id = vc.request_id
-            WHERE r.status = 'approved'
-            ORDER BY r.submit_time DESC
-        """
-        cursor.execute(sql_active)
-        active_reqs = pd.DataFrame(cursor.fetchall())
+        active_reqs = pd.DataFrame(prefetch.section(page, "active", []))
+
+        _show_report('release_report', RELEASE_RESULT_LABELS, "批量释放完成")
 
         if active_reqs.empty:
             st.info("当前无运行中的实例。")
         else:
-            # 表头
-            h1, h2, h3, h4 = st.columns([1, 2, 2, 2])
-            h1.markdown("**ReqID**")
-            h2.markdown("**节点信息**")
-            h3.markdown("**用户/时间**")
-            h4.markdown("**操作**")
+            selected = _selection_grid(active_reqs, "active_grid", column_config={
+                "request_id": "ReqID",
+                "user_id": None,
+                "user_name": "用户",
+                "submit_time": st.column_config.DatetimeColumn("提交时间", format="D MMM, HH:mm"),
+                "node_id": "节点ID",
+                "node_name": "节点名",
+                "queue_name": "队列",
+                "hourly_price": st.column_config.NumberColumn("单价 (¥/时)", format="%.2f"),
+            })
+            nodes = list(zip(selected['node_id'], selected['request_id']))
             
-            for _, row in active_reqs.iterrows():
-                with st.container(border=True):
-                    c1, c2, c3, c4 = st.columns([1, 2, 2, 2])
-                    c1.text(f"#{row['request_id']}")
-                    c2.text(f"Node: {row['node_name']}\nID: {row['node_id']}")
-                    c3.text(f"User: {row['user_name']}\n{row['submit_time']}")
-                    
-                    with c4:
-                        b_col1, b_col2 = st.columns(2)
-                        with b_col1:
-                            # 正常完成：模拟用户作业结束
-                            if st.button("完成", key=f"fin_{row['request_id']}", help="释放资源，标记为 Completed"):
-                                if stop_instance(db_config, row['node_id'], row['request_id'], 'complete'):
-                                    st.rerun()
-                        with b_col2:
-                            # 强制终止：管理员强行回收
-                            if st.button("终止", key=f"kill_{row['request_id']}", type="primary", help="释放资源，标记为 Terminated"):
-                                if stop_instance(db_config, row['node_id'], row['request_id'], 'terminate'):
-                                    st.rerun()
+            b1, b2, _ = st.columns([1, 1, 2])
+            with b1:
+                # 正常完成：模拟用户作业结束
+                if st.button(f"完成所选 ({len(selected)})", disabled=selected.empty,
+                             help="释放资源，标记为 Completed", use_container_width=True):
+                    _finish_bulk_action("active_grid", 'release_report', ops.stop_instances(db_config, nodes, 'complete'))
+            with b2:
+                # 强制终止：管理员强行回收
+                if st.button(f"终止所选 ({len(selected)})", disabled=selected.empty, type="primary",
+                             help="释放资源，标记为 Terminated", use_container_width=True):
+                    _finish_bulk_action("active_grid", 'release_report', ops.stop_instances(db_config, nodes, 'terminate'))
+
+            # 按范围排空：一次选出范围内全部运行中实例，分批集合式释放
+            with st.expander("批量释放 (按队列 / 用户 / 物理 NPU)"):
+                d1, d2, d3 = st.columns([1, 2, 1])
+                scope = d1.radio("范围", list(RELEASE_SCOPES), format_func=RELEASE_SCOPES.get, key="drain_scope")
+                if scope == "queue":
+                    target = d2.selectbox("队列", sorted(active_reqs['queue_name'].dropna().unique().tolist()),
+                                          key="drain_queue")
+                    scope_args = {"queue": target}
+                elif scope == "user":
+                    users = active_reqs[['user_id', 'user_name']].drop_duplicates().sort_values('user_name')
+                    target = d2.selectbox("用户", users['user_id'].tolist(), key="drain_user",
+                                          format_func=dict(zip(users['user_id'], users['user_name'])).get)
+                    scope_args = {"user_id": target}
+                else:
+                    target = d2.text_input("NPU 序列号", key="drain_npu").strip() or None
+                    scope_args = {"npu_serial": target}
+                drain_action = d3.radio("操作", ["terminate", "complete"], key="drain_action",
+                                        format_func={"terminate": "终止", "complete": "完成"}.get)
+                confirmed = st.checkbox("确认释放该范围内的全部运行中实例", key="drain_confirm")
+                if st.button("执行批量释放", disabled=target is None or not confirmed, type="primary"):
+                    st.session_state.pop("drain_confirm", None)
+                    _finish_bulk_action("active_grid", 'release_report', ops.drain(db_config, drain_action, **scope_args))
 
     # --- Tab 3: 全量请求监视 ---
     with tab3:
         st.subheader("全部请求监控 (All History)")
         
         # 筛选器
-        filter_status = st.selectbox("按状态筛选", ["All", "pending", "approved", "completed", "terminated", "rejected"])
-        
-        base_sql = """
-            SELECT r.request_id, u.user_name, r.status, r.submit_time, r.complete_time, r.node_id
-            FROM requests r
-            LEFT JOIN users u ON r.user_id = u.user_id
-        """
+        f1, f2, f3 = st.columns([3, 1, 1])
+        with f1:
+            filter_status = st.selectbox("按状态筛选", HISTORY_STATUSES, key="history_status")
+        with f3:
+            with_archive = st.checkbox("包含归档", key="history_archive",
+                                       help="并入 archive.py 归档到 Parquet 的已结束请求")
         
-        if filter_status != "All":
-            base_sql += f" WHERE r.status = '{filter_status}'"
+        # 每个筛选条件各自维护一个游标栈 (键集分页，按 request_id 倒序)；这一页已在页首预取
+        page_key = f"history_page_{filter_status}" + ("_archive" if with_archive else "")
+        with f2:
+            page_size, after = pagination.page_size_selector(page_key)
         
-        base_sql += " ORDER BY r.request_id DESC LIMIT 50"
-        
-        cursor.execute(base_sql)
-        history_df = pd.DataFrame(cursor.fetchall())
+        rows, next_cursor = prefetch.section(page, "history", ([], None))
+        if with_archive:
+            archived = archive.read_history(None if filter_status == "All" else filter_status, after, page_size + 1)
+            if archived:
+                user_ids = sorted({r['user_id'] for r in archived})
+                cursor.execute(f"SELECT user_id, user_name FROM users WHERE user_id IN ({', '.join(['%s'] * len(user_ids))})",
+                               user_ids)
+                names = {u['user_id']: u['user_name'] for u in cursor.fetchall()}
+                for r in archived:
+                    r['user_name'] = names.get(r.pop('user_id'))
+            rows, next_cursor = archive.merge_page(rows, next_cursor, archived, ("request_id",), page_size)
+        history_df = pd.DataFrame(rows)
         
         if not history_df.empty:
             st.dataframe(
@@ -291,57 +589,70 @@ def render_admin_dashboard(db_config):
             )
         else:
             st.info("没有找到符合条件的记录。")
+        pagination.pager(page_key, next_cursor)
+
+    # --- Tab 4: 余额风险 (metering.py 每轮计量后刷新的 user_balance_risk) ---
+    with tab4:
+        st.subheader("余额风险用户")
+        risk_df = pd.DataFrame(prefetch.section(page, "balance_risk", []))
+
+        if not risk_df.empty:
+            st.caption(f"刷新时间: {risk_df['refreshed_at'].max()}；可用余额 = 余额 - 未付账单 - 尚未出账的用量")
+            st.dataframe(
+                risk_df.drop(columns=["refreshed_at"]),
+                use_container_width=True,
+                hide_index=True,
+                column_config={
+                    "user_id": "用户ID",
+                    "user_name": "用户",
+                    "balance": st.column_config.NumberColumn("余额", format="¥%.2f"),
+                    "unpaid_amount": st.column_config.NumberColumn("未付账单", format="¥%.2f"),
+                    "accrued_amount": st.column_config.NumberColumn("未出账用量", format="¥%.2f"),
+                    "available": st.column_config.NumberColumn("可用余额", format="¥%.2f"),
+                    "running_instances": "运行实例",
+                    "burn_rate": st.column_config.NumberColumn("每小时消耗", format="¥%.2f"),
+                    "hours_left": st.column_config.NumberColumn("预计剩余(h)", format="%.1f"),
+                    "exhausted_at": st.column_config.DatetimeColumn("预计耗尽", format="D MMM, HH:mm"),
+                    "risk_level": "风险等级",
+                }
+            )
+        else:
+            st.info("暂无风险用户 (或计量任务 metering.py 尚未运行)。")
     
     # 3. 查看所有运行实例
     st.markdown("---")
     st.subheader("全系统运行实例 (Virtual Computers)")
     
-    # 关联查询以显示更多信息
-    sql_all = """
-    SELECT vc.node_id, vc.node_name, vc.queue_name, vc.status, vc.hourly_price, 
-           u.user_name, np.npu_serial
-    FROM virtualcomputers vc
-    JOIN requests r ON vc.request_id = r.request_id
-    JOIN users u ON r.user_id = u.user_id
-    JOIN virtualcpu vcpu ON vc.vir_NPU_id = vcpu.vir_NPU_id
-    JOIN npus np ON vcpu.NPU_id = np.NPU_id
-    WHERE vc.status='running'
-    """
-    cursor.execute(sql_all)
-    all_instances = pd.DataFrame(cursor.fetchall())
+    all_instances = pd.DataFrame(prefetch.section(page, "all_instances", []))
     
     if not all_instances.empty:
         st.dataframe(all_instances, use_container_width=True)
     else:
         st.text("全系统无运行实例")
+    prefetch.timing_caption(page)
 
     # 4. 高级查询 (SQL)
     st.markdown("---")
     st.subheader("高级查询 (SQL)")
     
     sql_query = st.text_area("输入 SQL 语句", height=150, placeholder="SELECT * FROM users WHERE ...")
-    
-    if st.button("执行查询", type="primary"):
+    o1, o2, o3, o4 = st.columns(4)
+    timeout = o1.number_input("超时 (秒)", min_value=1, max_value=600, value=int(sqlconsole.DEFAULT_TIMEOUT))
+    row_cap = o2.number_input("显示行数上限", min_value=10, max_value=10000, value=CONSOLE_ROW_CAP, step=100)
+    export_fmt = o3.selectbox("导出文件", ["不导出", *sqlconsole.EXPORT_FORMATS])
+    o4.markdown("&nbsp;")
+    if o4.button("执行查询", type="primary", use_container_width=True):
         if sql_query.strip():
-            try:
-                cursor.execute(sql_query)
-                
-                if cursor.with_rows:
-                    result = cursor.fetchall()
-                    if result:
-                        df_result = pd.DataFrame(result)
-                        st.dataframe(df_result, use_container_width=True)
-                        st.success(f"查询成功，返回 {len(result)} 行。")
-                    else:
-                        st.info("查询成功，但未返回任何结果。")
-                else:
-                    conn.commit()
-                    st.success(f"执行成功，影响行数: {cursor.rowcount}")
-                    
-            except mysql.connector.Error as err:
-                st.error(f"SQL 执行错误: {err}")
+            _run_console(db_config, sql_query, timeout, row_cap,
+                         export_fmt if export_fmt in sqlconsole.EXPORT_FORMATS else None)
         else:
             st.warning("请输入 SQL 语句")
+
+    export = st.session_state.get('sql_export')
+    if export and os.path.exists(export.path):
+        with open(export.path, 'rb') as f:
+            st.download_button(f"下载结果 ({export.rows} 行, {export.fmt})", f,
+                               file_name=f"query_result.{export.fmt}", mime=sqlconsole.EXPORT_FORMATS[export.fmt])
         
     cursor.close()
     conn.close()
@@ -0,0 +1,207 @@
+import logging
+import threading
+import time
+
+import db
+import queries
+
+log = logging.getLogger("admission")
+
+# ================= 申请提交准入控制 =================
+#
+# user.submit_resource_request 原来每次点击都直接插入一条 pending 请求：连点、脚本都能刷出成千上万条，
+# 之后管理员页面每次重跑都要加载、绘制它们。提交前在这里依次检查：
+# - 重复提交：同一用户同一套餐在 DUPLICATE_WINDOW 秒内只受理一次 (连点 / 重跑)
+# - 超出队列能力：申请的核数 / 显存 / 内存超过该队列任一 online 节点的容量，永远无法分配，直接拒绝
+# - 排队上限：每个用户、每个队列的 pending 请求数
+# - 令牌桶限流：每个用户每分钟 RATE_PER_MINUTE 次，允许突发 BURST 次
+# 检查只读进程内存中的状态 (一把锁，无数据库访问)；pending 计数与节点容量每 SYNC_INTERVAL 秒
+# 从数据库同步一次 (由恰好遇到过期状态的提交顺带完成)，其间本进程受理的请求在内存中累加。
+# 审批 / 拒绝以及其他进程的提交要到下一次同步才反映出来，因此排队上限是软上限，误差不超过一个同步周期的提交量。
+
+ENABLED = True
+RATE_PER_MINUTE = 6
+BURST = 3
+MAX_PENDING_PER_USER = 10
+MAX_PENDING_PER_QUEUE = 500
+DUPLICATE_WINDOW = 30  # 秒
+SYNC_INTERVAL = 10     # 秒
+
+# 拒绝原因 -> 提示
+REASONS = {
+    "duplicate": "相同套餐刚刚提交过，请勿重复提交",
+    "capacity": "申请的规格超出该队列任一节点的容量，无法分配",
+    "user_pending": "您排队中的申请已达上限，请等待审批后再提交",
+    "queue_pending": "该队列排队中的申请已达上限，请稍后再试",
+    "rate_limited": "提交过于频繁，请稍后再试",
+}
+
+# 每个队列单台 online 节点的最大容量 (一个实例只能放在一个 NPU / 内存行上)
+SQL_NODE_MAX = """
+    SELECT queue_type, MAX(cores), MAX(NPU_memory) FROM npus WHERE status = 'online' GROUP BY queue_type
+"""
+SQL_MEMORY_MAX = """
+    SELECT queue_type, MAX(memory_size) FROM memory WHERE status = 'online' GROUP BY queue_type
+"""
+
+
+class Rejected(Exception):
+    """申请未被受理；reason 为 REASONS 的键，retry_after 为建议的重试等待秒数 (可能为 None)"""
+
+    def __init__(self, reason, retry_after=None):
+        super().__init__(REASONS[reason])
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def package_need(pkg_data):
+    """(核数, 显存, 内存)，与 sp_create_instance 的默认值一致"""
+    p = pkg_data['db_params']
+    return p.get('req_cores', 1), p.get('req_gpu_mem', 0), p.get('req_ram', 1)
+
+
+class Admission:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._synced_at = None
+        self._buckets = {}        # user_id -> (令牌数, 上次补充时刻)
+        self._recent = {}         # (user_id, package_key) -> 上次受理时刻
+        self._user_pending = {}
+        self._queue_pending = {}
+        self._node_max = {}       # queue -> (核数, 显存, 内存)；该队列没有 online 内存行时内存为 None
+        self._stats = {"admitted": 0, "syncs": 0, "sync_errors": 0, **{f"rejected_{r}": 0 for r in REASONS}}
+
+    def _reject(self, reason, retry_after=None):
+        self._stats[f"rejected_{reason}"] += 1
+        raise Rejected(reason, retry_after)
+
+    def admit(self, user_id, pkg_key, queue, need):
+        """通过则记入状态 (消耗令牌、计数 +1)，否则抛出 Rejected"""
+        now = time.monotonic()
+        with self._lock:
+            last = self._recent.get((user_id, pkg_key))
+            if last is not None and now - last < DUPLICATE_WINDOW:
+                self._reject("duplicate", round(DUPLICATE_WINDOW - (now - last), 1))
+            # 从未同步成功 (数据库不可用) 时不做这项检查
+            node_max = self._node_max.get(queue)
+            if self._node_max and (node_max is None or any(m is not None and n > m for n, m in zip(need, node_max))):
+                self._reject("capacity")
+            if self._user_pending.get(user_id, 0) >= MAX_PENDING_PER_USER:
+                self._reject("user_pending")
+            if self._queue_pending.get(queue, 0) >= MAX_PENDING_PER_QUEUE:
+                self._reject("queue_pending")
+            tokens, refilled = self._buckets.get(user_id, (BURST, now))
+            tokens = min(BURST, tokens + (now - refilled) * RATE_PER_MINUTE / 60)
+            if tokens < 1:
+                self._buckets[user_id] = (tokens, now)
+                self._reject("rate_limited", round((1 - tokens) * 60 / RATE_PER_MINUTE, 1))
+            self._buckets[user_id] = (tokens - 1, now)
+            self._recent[(user_id, pkg_key)] = now
+            self._user_pending[user_id] = self._user_pending.get(user_id, 0) + 1
+            self._queue_pending[queue] = self._queue_pending.get(queue, 0) + 1
+            self._stats["admitted"] += 1
+
+    def cancel(self, user_id, pkg_key, queue):
+        """受理后插入失败：撤回计数、重复提交标记并退还令牌"""
+        with self._lock:
+            self._recent.pop((user_id, pkg_key), None)
+            bucket = self._buckets.get(user_id)
+            if bucket is not None:
+                self._buckets[user_id] = (min(BURST, bucket[0] + 1), bucket[1])
+            if self._user_pending.get(user_id):
+                self._user_pending[user_id] -= 1
+            if self._queue_pending.get(queue):
+                self._queue_pending[queue] -= 1
+
+    def maybe_sync(self, db_config):
+        """状态过期时同步；首次同步前阻塞等待，之后其他线程正在同步时直接沿用旧状态"""
+        if self._synced_at is not None and time.monotonic() - self._synced_at < SYNC_INTERVAL:
+            return
+        if not self._sync_lock.acquire(blocking=self._synced_at is None):
+            return
+        try:
+            if self._synced_at is None or time.monotonic() - self._synced_at >= SYNC_INTERVAL:
+                self.sync(db_config)
+        finally:
+            self._sync_lock.release()
+
+    def sync(self, db_config):
+        conn = db.get_connection(db_config)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(queries.SQL_PENDING_COUNTS)
+            pending = cursor.fetchall()
+            cursor.execute(SQL_NODE_MAX)
+            npus = {q: (cores, gpu) for q, cores, gpu in cursor.fetchall()}
+            cursor.execute(SQL_MEMORY_MAX)
+            mems = {q: ram for q, ram in cursor.fetchall()}
+        except Exception:
+            # 数据库暂时不可用时沿用旧状态，下一个周期再试
+            log.warning("admission sync failed", exc_info=True)
+            with self._lock:
+                self._stats["sync_errors"] += 1
+                self._synced_at = time.monotonic()
+            return
+        finally:
+            cursor.close()
+            conn.close()
+
+        now = time.monotonic()
+        user_pending, queue_pending = {}, {}
+        with self._lock:
+            for user_id, queue, pkg_key, count, age in pending:
+                user_pending[user_id] = user_pending.get(user_id, 0) + count
+                queue_pending[queue] = queue_pending.get(queue, 0) + count
+                if age is not None and age < DUPLICATE_WINDOW:
+                    key = (user_id, pkg_key)
+                    self._recent[key] = max(self._recent.get(key, 0), now - age)
+            self._user_pending, self._queue_pending = user_pending, queue_pending
+            # 没有内存数据的队列不检查内存这一维 (按 0 处理会拒绝该队列的全部申请)
+            self._node_max = {q: (*npus[q], mems.get(q)) for q in npus}
+            # 清理已过期的重复标记与已补满的令牌桶，内存只与近期活跃用户数有关
+            self._recent = {k: t for k, t in self._recent.items() if now - t < DUPLICATE_WINDOW}
+            self._buckets = {u: (tokens, t) for u, (tokens, t) in self._buckets.items()
+                             if tokens + (now - t) * RATE_PER_MINUTE / 60 < BURST}
+            self._synced_at = now
+            self._stats["syncs"] += 1
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["tracked_users"] = len(self._buckets)
+            s["pending_users"] = len(self._user_pending)
+            s["pending_by_queue"] = dict(self._queue_pending)
+            s["synced_ago_s"] = round(time.monotonic() - self._synced_at, 1) if self._synced_at else None
+        return s
+
+
+_states = {}
+_states_lock = threading.Lock()
+
+
+def _state(db_config):
+    key = db.config_key(db_config)
+    with _states_lock:
+        if key not in _states:
+            _states[key] = Admission()
+        return _states[key]
+
+
+def admit(db_config, user_id, pkg_key, pkg_data):
+    """提交前检查，未通过时抛出 Rejected；ENABLED 为 False 时不检查"""
+    if not ENABLED:
+        return
+    state = _state(db_config)
+    state.maybe_sync(db_config)
+    state.admit(user_id, pkg_key, pkg_data['queue'], package_need(pkg_data))
+
+
+def cancel(db_config, user_id, pkg_key, pkg_data):
+    if ENABLED:
+        _state(db_config).cancel(user_id, pkg_key, pkg_data['queue'])
+
+
+def stats(db_config):
+    return _state(db_config).stats()
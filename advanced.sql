@@ -1,3 +1,4 @@
+-- 逐卡明细 (O(节点数)，需要联表)；只看按队列的利用率 / 碎片化时请用下文读取 v_queue_capacity 的汇总版本
 
 SELECT
     n.npu_serial AS `物理显卡序列号`,
@@ -70,26 +71,23 @@ ORDER BY 已分配核数 DESC: 把负载最重（分配出去核心最多）的
 “把所有物理显卡列出来，告诉我每块卡上有多少个虚拟核正在被使用，占了总核数的百分之多少，上面跑了几个虚拟机，以及这块卡现在每小时能给我赚多少钱？”
  
 
+-- 读 metering.py 每轮刷新的 user_balance_risk (迁移 0007)，不再五表联查。
+-- 阈值数值沿用原查询 (50000 / 5 小时)，但口径不同：原查询用 balance，这里用可用余额
+-- (余额 - 未付账单 - 尚未出账的用量)，并多出 exhausted 一级 (有运行实例且可用余额 <= 0)，
+-- 因此会比原查询更早、更多地报出用户；等级定义见 sp_refresh_balance_risk
 SELECT 
     u.user_name AS `用户名`,
-    u.balance AS `当前余额`,
-    SUM(vc.hourly_price) AS `烧钱速度(元/时)`,
-    ROUND(
-        CASE 
-            WHEN u.balance <= 0 THEN 0
-            ELSE u.balance / SUM(vc.hourly_price)
-        END, 1
-    ) AS `预计剩余时长(h)`,
-    GROUP_CONCAT(DISTINCT n.npu_serial SEPARATOR ', ') AS `占用物理NPU`
-FROM users u
-JOIN requests r ON u.user_id = r.user_id
-JOIN virtualcomputers vc ON r.request_id = vc.request_id
-JOIN virtualcpu vcpu ON vc.vir_NPU_id = vcpu.vir_NPU_id
-JOIN npus n ON vcpu.NPU_id = n.NPU_id
-WHERE vc.status = 'running' 
-GROUP BY u.user_id, u.user_name, u.balance
-HAVING `当前余额` < 50000 OR `预计剩余时长(h)` < 5
-ORDER BY `预计剩余时长(h)` ASC, `当前余额` ASC; 
+    ubr.balance AS `当前余额`,
+    ubr.available AS `可用余额`,
+    ubr.burn_rate AS `烧钱速度(元/时)`,
+    ubr.hours_left AS `预计剩余时长(h)`,
+    ubr.exhausted_at AS `预计耗尽时间`,
+    ubr.risk_level AS `风险等级`
+FROM user_balance_risk ubr
+JOIN users u ON u.user_id = ubr.user_id
+WHERE ubr.running_instances > 0
+  AND ubr.risk_level IN ('exhausted', 'critical', 'warning')
+ORDER BY ubr.hours_left ASC, ubr.available ASC;
 
  
 这条 SQL 语句的主要目的是生成一份 “高风险用户预警报告”。
@@ -122,57 +120,41 @@ OR
 
 ：“告诉我哪些用户正在跑任务，而且钱快不够用了（余额少于50000元或只能撑不到5小时），并把最危险的用户排在最前面。”
 
+5. 数据来源 (迁移 0007 起)
+原查询每次都要 users / requests / virtualcomputers / virtualcpu / npus 五表联查并按用户分组，无法每分钟运行。
+现在由 metering.py 周期调用 sp_meter_usage (为运行中实例分块出账) 和 sp_refresh_balance_risk，
+把每个用户的每小时消耗、可用余额 (余额 - 未付账单 - 尚未出账的用量)、预计耗尽时间和风险等级写入 user_balance_risk，
+这里只是按风险等级读这张表。可用余额扣除了未付账单，比原来只看 balance 更早发现欠费；
+需要查看某个用户占用了哪些物理 NPU 时，再针对该用户联表查询。
+
 
 
 
 
 SELECT
     queue_type AS `资源池`,
-    COUNT(*) AS `物理节点总数`,
+    total_nodes AS `物理节点总数`,
     -- 1. 完全空闲: 一点资源都没被用
-    SUM(
-        CASE
-            WHEN available_cores = cores THEN 1
-            ELSE 0
-        END
-    ) AS `完全空闲节点`,
+    idle_nodes AS `完全空闲节点`,
     -- 2. 完全满载: 一滴资源都不剩了
-    SUM(
-        CASE
-            WHEN available_cores = 0 THEN 1
-            ELSE 0
-        END
-    ) AS `完全满载节点`,
+    full_nodes AS `完全满载节点`,
     -- 3. 碎片状态: 用了一部分，还剩一部分
-    SUM(
-        CASE
-            WHEN available_cores > 0
-            AND available_cores < cores THEN 1
-            ELSE 0
-        END
-    ) AS `碎片化节点`,
+    fragmented_nodes AS `碎片化节点`,
     -- 4. 整体利用率指标
     CONCAT(
-        ROUND(
-            (
-                1 - SUM(available_cores) / SUM(cores)
-            ) * 100,
-            1
-        ),
+        ROUND(used_cores / NULLIF(total_cores, 0) * 100, 1),
         '%'
     ) AS `CPU整体利用率`,
     CONCAT(
-        ROUND(
-            (
-                1 - SUM(available_memory) / SUM(NPU_memory)
-            ) * 100,
-            1
-        ),
+        ROUND(used_gpu_mem / NULLIF(total_gpu_mem, 0) * 100, 1),
         '%'
-    ) AS `显存整体利用率`
-FROM npus
-GROUP BY
-    queue_type;
+    ) AS `显存整体利用率`,
+    CONCAT(
+        ROUND(used_ram / NULLIF(total_ram, 0) * 100, 1),
+        '%'
+    ) AS `内存整体利用率`
+FROM v_queue_capacity
+WHERE total_nodes > 0;
 
 -- =======================================================
 -- 复杂查询示例 4: 资源池健康度与碎片化分析 (Resource Health & Fragmentation)
@@ -190,4 +172,8 @@ GROUP BY
 --    运维重点关注“碎片化节点”，如果碎片太多，说明调度算法可能需要优化（如进行碎片整理或迁移）。
 -- 3. 整体利用率:
 --    - 公式: (1 - 剩余总量 / 物理总量) * 100%
---    - 这是一个宏观指标，反映了整个集群的繁忙程度。
\ No newline at end of file
+--    - 这是一个宏观指标，反映了整个集群的繁忙程度。
+-- 4. 数据来源 (迁移 0006 起):
+--    不再对 npus 全表 CASE WHEN 分箱统计，而是读 v_queue_capacity (对 capacity_summary 按队列求和)。
+--    分箱计数与剩余量由 npus / memory 上的触发器在每次分配 / 释放的同一事务内增量维护，
+--    查询代价只与队列数有关；口径与原来的全表统计一致，可用 CALL sp_capacity_reconcile(0) 核对。
\ No newline at end of file
@@ -0,0 +1,359 @@
+"""
+冷数据归档：把早于截止时间、已经结束且账单全部付清的请求搬到本地 Parquet 文件
+
+    python archive.py --host localhost --user root --password xxx --database cloud --older-than-days 180
+
+- requests / virtualcomputers / bills：一批请求一个事务，锁定后复核 (已结束、没有运行中的实例、
+  账单全部 paid)，写出归档文件，再按外键顺序删除：
+      bills -> requests.node_id 置空 (解开 requests <-> virtualcomputers 的外键环) -> virtualcomputers -> requests
+  归档文件先落盘再提交事务，提交失败时删除本批文件；进程在两者之间崩溃时只会重复归档，不会丢数据：
+  文件名取自本批的 request_id 范围，重跑同一批时覆盖原文件；批次组成变了留下的重复行在读取时按主键去重。
+  virtualcpu / virtualmemory / virtualvolume 行保留 (已是 released 状态，记录实例所在的物理设备)。
+- use_log (迁移 0010 按月分区)：整段早于截止月份的分区导出后 DROP PARTITION，并预建未来的月份分区。
+
+归档目录结构 <archive-dir>/<表名>/month=YYYY-MM/part-<批次>.parquet (按提交 / 创建时间所在月份；
+批次为 <最小 request_id>-<最大 request_id>，use_log 为 <分区名>-<块号>)，
+read_history() / read_bills() 供管理后台的历史页与用户账单页在需要时并入归档数据。
+"""
+import argparse
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import cache
+import db
+
+log = logging.getLogger("archive")
+
+ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive")
+ARCHIVE_BATCH = 2000
+PARTITIONS_AHEAD = 3
+CLOSED_STATUSES = ("completed", "terminated", "rejected", "failed")
+
+_TS = pa.timestamp("s")
+_MONEY = pa.decimal128(10, 2)
+
+# 每张表归档的列 (与 SELECT 列顺序一致) 及其类型；month 列决定文件所在的月份目录
+SCHEMAS = {
+    "requests": (pa.schema([
+        ("request_id", pa.int32()), ("user_id", pa.int32()), ("request_type", pa.string()),
+        ("status", pa.string()), ("node_id", pa.int32()), ("submit_time", _TS), ("complete_time", _TS),
+        ("parameters", pa.string()), ("error_message", pa.string()),
+    ]), "submit_time"),
+    "virtualcomputers": (pa.schema([
+        ("node_id", pa.int32()), ("request_id", pa.int32()), ("node_name", pa.int32()), ("queue_name", pa.string()),
+        ("vir_NPU_id", pa.int32()), ("vir_memory_id", pa.int32()), ("vir_volume_id", pa.int32()),
+        ("hourly_price", _MONEY), ("status", pa.string()), ("created_at", _TS), ("metered_until", _TS),
+    ]), "created_at"),
+    "bills": (pa.schema([
+        ("bill_id", pa.int32()), ("user_id", pa.int32()), ("request_id", pa.int32()), ("node_id", pa.int32()),
+        ("start_time", _TS), ("end_time", _TS), ("usage_hours", _MONEY), ("hourly_rate", _MONEY),
+        ("cost_amount", _MONEY), ("payment_status", pa.string()), ("created_at", _TS),
+    ]), "created_at"),
+    "use_log": (pa.schema([
+        ("log_id", pa.int32()), ("user_id", pa.int32()), ("action", pa.string()), ("details", pa.string()),
+        ("created_at", _TS),
+    ]), "created_at"),
+}
+
+# 读取归档时去重用的主键
+PRIMARY_KEYS = {"requests": "request_id", "virtualcomputers": "node_id", "bills": "bill_id", "use_log": "log_id"}
+
+# 候选请求 (不加锁)，之后按主键锁定并复核
+SQL_CANDIDATES = f"""
+    SELECT r.request_id FROM requests r
+    WHERE r.request_id > %s
+      AND r.status IN ({", ".join(f"'{s}'" for s in CLOSED_STATUSES)})
+      AND COALESCE(r.complete_time, r.submit_time) < %s
+      AND NOT EXISTS (SELECT 1 FROM bills b WHERE b.request_id = r.request_id AND b.payment_status <> 'paid')
+      AND NOT EXISTS (SELECT 1 FROM virtualcomputers vc WHERE vc.request_id = r.request_id AND vc.status = 'running')
+    ORDER BY r.request_id
+    LIMIT %s
+"""
+
+
+def _columns(table):
+    return ", ".join(SCHEMAS[table][0].names)
+
+
+def _placeholders(values):
+    return ", ".join(["%s"] * len(values))
+
+
+def _write(archive_dir, table, rows, batch_id):
+    """把一批行按月份写成 Parquet 文件，返回写出的文件路径列表"""
+    schema, month_col = SCHEMAS[table]
+    index = schema.names.index(month_col)
+    by_month = {}
+    for row in rows:
+        ts = row[index]
+        by_month.setdefault(ts.strftime("%Y-%m") if ts else "unknown", []).append(row)
+    paths = []
+    for month, month_rows in by_month.items():
+        directory = os.path.join(archive_dir, table, f"month={month}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"part-{batch_id}.parquet")
+        columns = [[row[i] for row in month_rows] for i in range(len(schema))]
+        pq.write_table(pa.Table.from_arrays([pa.array(c, type=f.type) for c, f in zip(columns, schema)],
+                                            schema=schema), path, compression="zstd")
+        paths.append(path)
+    return paths
+
+
+def _remove(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def archive_requests(db_config, cutoff, archive_dir=ARCHIVE_DIR, batch=ARCHIVE_BATCH, dry_run=False):
+    """归档早于 cutoff 的请求及其实例、账单，返回 {表名: 行数}"""
+    counts = {"requests": 0, "virtualcomputers": 0, "bills": 0}
+    last_id = 0
+    while True:
+        conn = db.get_connection(db_config)
+        cursor = conn.cursor()
+        paths = []
+        try:
+            # READ COMMITTED：锁定读只锁命中的行
+            conn.start_transaction(isolation_level="READ COMMITTED")
+            cursor.execute(SQL_CANDIDATES, (last_id, cutoff, int(batch)))
+            ids = [r[0] for r in cursor.fetchall()]
+            if not ids:
+                conn.rollback()
+                break
+            last_id = ids[-1]
+
+            cursor.execute(f"SELECT {_columns('requests')} FROM requests WHERE request_id IN ({_placeholders(ids)}) "
+                           "FOR UPDATE", ids)
+            requests = cursor.fetchall()
+            cursor.execute(f"SELECT {_columns('virtualcomputers')} FROM virtualcomputers "
+                           f"WHERE request_id IN ({_placeholders(ids)}) FOR UPDATE", ids)
+            instances = cursor.fetchall()
+            cursor.execute(f"SELECT {_columns('bills')} FROM bills WHERE request_id IN ({_placeholders(ids)}) "
+                           "FOR UPDATE", ids)
+            bills = cursor.fetchall()
+
+            # 锁定后复核，期间状态变化的请求本批跳过
+            status_at = SCHEMAS["requests"][0].names.index("status")
+            keep = {r[0] for r in requests if r[status_at] in CLOSED_STATUSES}
+            keep -= {vc[1] for vc in instances if vc[8] == 'running'}
+            keep -= {b[2] for b in bills if b[9] != 'paid'}
+            requests = [r for r in requests if r[0] in keep]
+            instances = [vc for vc in instances if vc[1] in keep]
+            bills = [b for b in bills if b[2] in keep]
+            if not keep or dry_run:
+                conn.rollback()
+                counts["requests"] += len(requests)
+                counts["virtualcomputers"] += len(instances)
+                counts["bills"] += len(bills)
+                continue
+
+            # 文件名由本批 id 范围决定：已提交批次的行都已删除，不会与之后的批次重名
+            ids = sorted(keep)
+            batch_id = f"{ids[0]}-{ids[-1]}"
+            paths += _write(archive_dir, "requests", requests, batch_id)
+            paths += _write(archive_dir, "virtualcomputers", instances, batch_id) if instances else []
+            paths += _write(archive_dir, "bills", bills, batch_id) if bills else []
+
+            ph = _placeholders(ids)
+            cursor.execute(f"DELETE FROM bills WHERE request_id IN ({ph})", ids)
+            cursor.execute(f"UPDATE requests SET node_id = NULL WHERE request_id IN ({ph}) AND node_id IS NOT NULL",
+                           ids)
+            cursor.execute(f"DELETE FROM virtualcomputers WHERE request_id IN ({ph})", ids)
+            cursor.execute(f"DELETE FROM requests WHERE request_id IN ({ph})", ids)
+            conn.commit()
+            paths = []
+            cache.invalidate("requests", "virtualcomputers", "bills")
+            counts["requests"] += len(requests)
+            counts["virtualcomputers"] += len(instances)
+            counts["bills"] += len(bills)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            _remove(paths)  # 只有未提交成功的批次会走到这里时 paths 非空
+            cursor.close()
+            conn.close()
+    return counts
+
+
+def use_log_partitions(cursor):
+    """[(分区名, 上界 datetime 或 None (MAXVALUE)), ...]，按上界排序"""
+    cursor.execute("""
+        SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'use_log' AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    """)
+    return [(name, None if desc == "MAXVALUE" else datetime.strptime(desc.strip("'"), "%Y-%m-%d"))
+            for name, desc in cursor.fetchall()]
+
+
+def archive_use_log(db_config, cutoff, archive_dir=ARCHIVE_DIR, dry_run=False):
+    """导出并删除上界不晚于 cutoff 的 use_log 分区，返回 {分区名: 行数}"""
+    done = {}
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        for name, upper in use_log_partitions(cursor):
+            if upper is None or upper > cutoff:
+                break
+            if dry_run:
+                cursor.execute(f"SELECT COUNT(*) FROM use_log PARTITION (`{name}`)")
+                done[name] = cursor.fetchone()[0]
+                continue
+            paths, rows = [], 0
+            try:
+                cursor.execute(f"SELECT {_columns('use_log')} FROM use_log PARTITION (`{name}`) ORDER BY log_id")
+                chunk_no = 0
+                while True:
+                    chunk = cursor.fetchmany(50000)
+                    if not chunk:
+                        break
+                    paths += _write(archive_dir, "use_log", chunk, f"{name}-{chunk_no}")
+                    rows += len(chunk)
+                    chunk_no += 1
+                cursor.execute(f"ALTER TABLE use_log DROP PARTITION `{name}`")
+            except Exception:
+                _remove(paths)
+                raise
+            done[name] = rows
+    finally:
+        cursor.close()
+        conn.close()
+    return done
+
+
+def add_partitions(db_config, ahead=PARTITIONS_AHEAD):
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        cursor.callproc('sp_use_log_add_partitions', [int(ahead)])
+    finally:
+        cursor.close()
+        conn.close()
+
+
+# ================= 读取归档 =================
+
+def _dataset(archive_dir, table):
+    path = os.path.join(archive_dir, table)
+    if not os.path.isdir(path):
+        return None
+    schema = SCHEMAS[table][0].append(pa.field("month", pa.string()))
+    return ds.dataset(path, format="parquet", partitioning="hive", schema=schema)
+
+
+def _keyset(key_cols, after):
+    """与 queries.keyset_condition 相同的倒序键集条件 (pyarrow 表达式)"""
+    expr = None
+    for i, col in enumerate(key_cols):
+        cond = ds.field(col) < after[i]
+        for prev, value in zip(key_cols[:i], after[:i]):
+            cond = cond & (ds.field(prev) == value)
+        expr = cond if expr is None else expr | cond
+    return expr
+
+
+def _read(archive_dir, table, filters, key_cols, after, limit, columns=None):
+    """
+    按倒序键读取至多 limit 行。归档在写文件与提交之间崩溃后重跑时，同一行可能出现在两个文件中，
+    按主键去重 (排序键都含主键，重复行排序后相邻)；columns 须包含主键
+    """
+    dataset = _dataset(archive_dir, table)
+    if dataset is None:
+        return []
+    expr = None
+    for cond in filters + ([_keyset(key_cols, after)] if after is not None else []):
+        expr = cond if expr is None else expr & cond
+    result = dataset.to_table(columns=columns, filter=expr)
+    result = result.sort_by([(c, "descending") for c in key_cols])
+    pk = PRIMARY_KEYS[table]
+    rows, last = [], None
+    for batch in result.to_batches():
+        for row in batch.to_pylist():
+            if row[pk] == last:
+                continue
+            last = row[pk]
+            rows.append(row)
+            if len(rows) >= limit:
+                return rows
+    return rows
+
+
+def read_history(status=None, after=None, limit=20, archive_dir=ARCHIVE_DIR):
+    """归档的请求，按 request_id 倒序；行格式同 queries.SQL_HISTORY，只是用 user_id 代替 user_name"""
+    filters = [ds.field("status") == status] if status else []
+    return _read(archive_dir, "requests", filters, ("request_id",), after, limit,
+                 ["request_id", "user_id", "status", "submit_time", "complete_time", "node_id"])
+
+
+def read_bills(user_id, after=None, limit=20, archive_dir=ARCHIVE_DIR):
+    """一个用户的归档账单，按 (created_at, bill_id) 倒序；行格式同 queries.SQL_BILLS"""
+    bills = _read(archive_dir, "bills", [ds.field("user_id") == int(user_id)], ("created_at", "bill_id"), after,
+                  limit, ["bill_id", "cost_amount", "payment_status", "usage_hours", "end_time", "created_at",
+                          "request_id", "node_id"])
+    if not bills:
+        return []
+    requests = {r["request_id"]: r for r in _read(
+        archive_dir, "requests", [ds.field("request_id").isin(list({b["request_id"] for b in bills}))],
+        ("request_id",), None, len(bills), ["request_id", "request_type", "status"])}
+    nodes = {n["node_id"]: n for n in _read(
+        archive_dir, "virtualcomputers", [ds.field("node_id").isin(list({b["node_id"] for b in bills}))],
+        ("node_id",), None, len(bills), ["node_id", "node_name"])}
+    for b in bills:
+        req = requests.get(b["request_id"], {})
+        b["request_type"] = req.get("request_type")
+        b["job_status"] = req.get("status")
+        b["node_name"] = nodes.get(b.pop("node_id"), {}).get("node_name")
+    return bills
+
+
+def merge_page(rows, next_cursor, archived, key_fields, page_size):
+    """
+    把一页在线数据与归档数据按倒序键合并成一页：rows/next_cursor 为 pagination.fetch_page 的结果，
+    archived 为同一游标之后的至多 page_size + 1 条归档行。返回 (rows, next_cursor)
+    """
+    merged = sorted(rows + archived, key=lambda r: tuple(r[f] for f in key_fields), reverse=True)
+    if len(merged) > page_size or next_cursor is not None:
+        merged = merged[:page_size]
+        return merged, tuple(merged[-1][f] for f in key_fields)
+    return merged, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--user", default="root")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--database", default="cloud")
+    parser.add_argument("--older-than-days", type=int, default=180, help="归档结束时间早于多少天之前的数据")
+    parser.add_argument("--archive-dir", default=ARCHIVE_DIR)
+    parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH)
+    parser.add_argument("--dry-run", action="store_true", help="只统计可归档的行数")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    db_config = {"host": args.host, "user": args.user, "password": args.password,
+                 "database": args.database, "charset": "utf8mb4", "collation": "utf8mb4_0900_ai_ci"}
+    cutoff = datetime.now() - timedelta(days=args.older_than_days)
+    if not args.dry_run:
+        add_partitions(db_config)
+    result = {
+        "cutoff": cutoff.strftime("%Y-%m-%d %H:%M:%S"),
+        "dry_run": args.dry_run,
+        "requests": archive_requests(db_config, cutoff, args.archive_dir, args.batch_size, args.dry_run),
+        "use_log_partitions": archive_use_log(db_config, cutoff, args.archive_dir, args.dry_run),
+    }
+    print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+碎片整理规划 (consolidate.plan) 的规模与效果
+
+离线模式 (默认，无需数据库)：
+    python bench/bench_consolidate.py --nodes 1000 5000 20000 --max-instances 5
+    每个规模生成一个队列：NPU 节点 96 核 / 640G 显存、内存模块 1024G，每台节点随机放 0 ~ --max-instances 个小套餐
+    (与 sp_init_mock_load 的小套餐同比例)，记录规划耗时、迁移数、腾空节点数与整机套餐可放数量的变化。
+
+在线模式 (连接真实 MySQL，只规划不执行)：
+    python bench/bench_consolidate.py --db --host localhost --user root --password xxx --database cloud
+    读取当前库的状态，输出各队列的规划报表与读取 / 规划耗时。
+
+输出为一行 JSON。
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import consolidate
+import db
+import packages
+from common import add_db_arguments, db_config_from_args
+
+NPU_CAPACITY = (96, 640)
+MEM_CAPACITY = (1024,)
+# (核数, 显存, 内存)
+SMALL_PACKAGES = ((4, 40, 64), (8, 80, 128), (16, 160, 256), (32, 320, 512))
+FULL_NODE = ("full_node", 96, 640, 512)
+
+
+def synthetic_state(nodes, max_instances, seed):
+    rng = random.Random(seed)
+    dims = {dim: {"bins": {}, "items": {}} for dim in consolidate.DIMENSIONS}
+    item_id = 0
+    for b in range(nodes):
+        for dim, cap in (("npu", NPU_CAPACITY), ("memory", MEM_CAPACITY)):
+            free, items = list(cap), []
+            for _ in range(rng.randrange(max_instances + 1)):
+                pkg = rng.choice(SMALL_PACKAGES)
+                size = pkg[:2] if dim == "npu" else pkg[2:]
+                if all(f >= s for f, s in zip(free, size)):
+                    item_id += 1
+                    items.append((item_id, item_id, size))
+                    free = [f - s for f, s in zip(free, size)]
+            dims[dim]["bins"][b] = (cap, tuple(free))
+            if items:
+                dims[dim]["items"][b] = items
+    return {"synthetic": dims}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--max-instances", type=int, default=5, help="每台节点最多放几个小套餐")
+    parser.add_argument("--max-moves", type=int, default=10 ** 6, help="离线模式默认不限迁移数")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--db", action="store_true", help="连接真实 MySQL，规划当前库")
+    add_db_arguments(parser)
+    args = parser.parse_args()
+
+    if args.db:
+        conn = db.get_connection(db_config_from_args(args))
+        cursor = conn.cursor()
+        try:
+            t0 = time.perf_counter()
+            state = consolidate.load_state(cursor)
+            load_ms = round((time.perf_counter() - t0) * 1000, 1)
+        finally:
+            cursor.close()
+            conn.close()
+        plans = consolidate.plan(state, args.max_moves, packages.VM_PACKAGES)
+        print(json.dumps({"mode": "db", "load_ms": load_ms, "plan": consolidate.summary(plans)},
+                         ensure_ascii=False, default=str))
+        return
+
+    results = {}
+    for nodes in args.nodes:
+        state = synthetic_state(nodes, args.max_instances, args.seed)
+        synthetic_packages = {"bench": {FULL_NODE[0]: {"queue": "synthetic", "db_params": {
+            "req_cores": FULL_NODE[1], "req_gpu_mem": FULL_NODE[2], "req_ram": FULL_NODE[3]}}}}
+        results[nodes] = consolidate.summary(consolidate.plan(state, args.max_moves, synthetic_packages))["synthetic"]
+    print(json.dumps({"mode": "offline", "results": results}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
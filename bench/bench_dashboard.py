@@ -0,0 +1,79 @@
+"""
+仪表盘页面数据加载耗时：各区块读查询串行执行 vs prefetch 并行执行
+
+    python bench/bench_dashboard.py --host localhost --user root --password xxx --database cloud \\
+        --rounds 50 --page admin --user-id 1
+
+每轮先清空查询缓存 (模拟缓存过期 / 数据刚被写过)，再用 admin.submit_dashboard_queries /
+user.submit_dashboard_queries 提交与页面相同的一组查询，等全部结果就绪，记录页面数据加载时间
+(PageQueries.summary 的 elapsed_ms)。串行模式即改动前页面在一个游标上依次执行的耗时。
+--ttl-zero 时所有查询不写缓存，避免同一轮内重复的查询互相命中。
+
+输出为一行 JSON：两种模式的 p50/p95/p99 页面耗时、单条查询耗时合计与加速比。
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import admin
+import cache
+import prefetch
+import user
+from common import add_db_arguments, db_config_from_args, latency_summary
+
+# 在 Streamlit 运行时之外调用 st.* 会对每次调用打警告，压测时屏蔽
+for _name in list(logging.root.manager.loggerDict):
+    if _name.startswith("streamlit"):
+        logging.getLogger(_name).setLevel(logging.ERROR)
+
+
+def run(db_config, page_name, user_id, rounds, parallel, ttl_zero):
+    elapsed, serial, failed = [], [], 0
+    for _ in range(rounds):
+        cache.invalidate()
+        page = prefetch.PageQueries(db_config, parallel=parallel)
+        if page_name == "admin":
+            ttl = {k: 0 for k in admin.CACHE_TTL} if ttl_zero else admin.CACHE_TTL
+            admin.submit_dashboard_queries(page, db_config, ttl=ttl)
+        else:
+            ttl = {k: 0 for k in user.CACHE_TTL} if ttl_zero else user.CACHE_TTL
+            user.submit_dashboard_queries(page, db_config, user_id, ttl=ttl)
+        summary = page.summary()
+        elapsed.append(summary["elapsed_ms"] / 1000)
+        serial.append(summary["serial_ms"] / 1000)
+        failed += len(summary["failed"])
+    return {"page": latency_summary(elapsed), "sum_of_queries": latency_summary(serial), "failed": failed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_db_arguments(parser)
+    parser.add_argument("--page", choices=("admin", "user"), default="admin")
+    parser.add_argument("--user-id", type=int, default=1, help="--page user 时渲染哪个用户的页面")
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--ttl-zero", action="store_true", help="查询结果不写缓存")
+    args = parser.parse_args()
+
+    db_config = db_config_from_args(args)
+    # 预热连接池与线程池，不计入结果
+    run(db_config, args.page, args.user_id, 2, True, args.ttl_zero)
+    serial = run(db_config, args.page, args.user_id, args.rounds, False, args.ttl_zero)
+    parallel = run(db_config, args.page, args.user_id, args.rounds, True, args.ttl_zero)
+    speedup = (serial["page"]["p50_ms"] / parallel["page"]["p50_ms"]
+               if serial["page"]["p50_ms"] and parallel["page"]["p50_ms"] else None)
+    print(json.dumps({
+        "page": args.page,
+        "rounds": args.rounds,
+        "workers": prefetch.WORKERS,
+        "serial": serial,
+        "parallel": parallel,
+        "p50_speedup": round(speedup, 2) if speedup else None,
+    }, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+全生命周期并发压测：提交 -> 审批 -> 运行 -> 释放 -> 支付
+
+    python bench/bench_lifecycle.py --host localhost --user root --password xxx --database cloud \\
+        --users 200 --workers 32 --jobs 2000 --arrival-rate 50 --mix v100_std=3,a100_ultra=1,cpu_general=6
+
+与 sp_init_mock_load (库内串行、每个用户最多一个实例) 不同，这里直接调用应用本身的代码路径：
+user.submit_resource_request、admin.approve_request、admin.stop_instance、user.pay_bill，
+由多个工作线程共享进程级连接池并发执行，行为与多个 Streamlit 会话同时操作一致。
+
+- 到达过程：--arrival-rate > 0 时为开环泊松到达 (作业按计划时间进入队列，端到端延迟包含排队时间)；
+  为 0 时为闭环，工作线程做完一个马上取下一个
+- 每个作业随机选用户、按 --mix 权重选套餐 (键为 packages.VM_PACKAGES 中的套餐名)，
+  实例运行 --hold-ms 区间内的随机时长后按 --terminate-ratio 强制终止或正常完成，再支付账单
+- 压测用户 bench_user_NNNN 首次运行时创建，余额每次重置为足够大
+
+输出为一行 JSON：各阶段吞吐与 p50/p95/p99 延迟、分配失败率、各类失败数、数据库错误 (按 errno)、
+InnoDB 行锁等待 / 死锁计数增量，连接池与放置引擎统计，以及按语句指纹的耗时统计 (querystats)。
+请在导入 init.sql 并执行过 migrate.py up 的测试库上运行。
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mysql.connector
+
+import admin
+import admission
+import db
+import packages
+import placement
+import querystats
+import user
+from common import (LOCK_ERRNOS, add_db_arguments, db_config_from_args, latency_summary, lock_counter_delta,
+                    server_lock_counters)
+
+# 在 Streamlit 运行时之外调用 st.* 会对每次调用打警告，压测时屏蔽
+for _name in list(logging.root.manager.loggerDict):
+    if _name.startswith("streamlit"):
+        logging.getLogger(_name).setLevel(logging.ERROR)
+
+# 压测按预定的到达过程提交，每个用户远超页面上的提交频率，不经过准入控制
+admission.ENABLED = False
+
+PHASES = ("submit", "approve", "release", "pay")
+BENCH_BALANCE = 10000000
+PACKAGES = {key: (category, pkg) for category, pkgs in packages.VM_PACKAGES.items() for key, pkg in pkgs.items()}
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        key, _, weight = part.partition("=")
+        if key not in PACKAGES:
+            raise SystemExit(f"未知套餐 {key}，可选: {', '.join(PACKAGES)}")
+        mix[key] = float(weight or 1)
+    return mix
+
+
+def setup_users(db_config, count):
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        cursor.executemany("""
+            INSERT INTO users (user_name, user_password, email, balance) VALUES (%s, 'bench', %s, %s)
+            ON DUPLICATE KEY UPDATE balance = VALUES(balance)
+        """, [(f"bench_user_{i:04d}", f"bench_user_{i:04d}@example.invalid", BENCH_BALANCE) for i in range(count)])
+        conn.commit()
+        cursor.execute("SELECT user_id FROM users WHERE user_name LIKE 'bench\\_user\\_%' ORDER BY user_name LIMIT %s",
+                       (count,))
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+        conn.close()
+
+
+class Recorder:
+    """线程安全的结果汇总"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {phase: [] for phase in PHASES}
+        self.end_to_end = []
+        self.queue_delay = []
+        self.counts = {"jobs": 0, "completed": 0, "allocation_failures": 0,
+                       "release_failures": 0, "pay_failures": 0, "missing_bills": 0}
+        self.errors = {}
+
+    def timed(self, phase, fn, *args):
+        t0 = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - t0
+        with self.lock:
+            self.latency[phase].append(elapsed)
+        return result
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def error(self, err):
+        key = LOCK_ERRNOS.get(getattr(err, "errno", None), f"errno_{getattr(err, 'errno', None)}")
+        with self.lock:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+
+def fetch_one(db_config, sql, params):
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def run_job(db_config, job, rec):
+    user_id, pkg_key, hold, action = job["user_id"], job["package"], job["hold"], job["action"]
+    category, pkg = PACKAGES[pkg_key]
+    params = user.request_params(pkg_key, pkg, category)
+
+    req_id = rec.timed("submit", user.submit_resource_request, db_config, user_id, pkg_key, pkg, category)
+    if not rec.timed("approve", admin.approve_request, db_config, req_id, user_id, params):
+        rec.count("allocation_failures")
+        admin.reject_request(db_config, req_id)
+        return
+
+    node_id = fetch_one(db_config, "SELECT node_id FROM requests WHERE request_id=%s", (req_id,))[0]
+    time.sleep(hold)
+
+    if not rec.timed("release", admin.stop_instance, db_config, node_id, req_id, action):
+        rec.count("release_failures")
+        return
+
+    bill = fetch_one(db_config, "SELECT bill_id, cost_amount FROM bills WHERE request_id=%s", (req_id,))
+    if bill is None:
+        rec.count("missing_bills")
+    elif not rec.timed("pay", user.pay_bill, db_config, user_id, bill[0], bill[1]):
+        rec.count("pay_failures")
+    rec.count("completed")
+
+
+def worker(db_config, jobs, rec):
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        start = time.perf_counter()
+        if job["arrival"] is None:  # 闭环：没有计划到达时间，从开始处理时计时
+            job["arrival"] = start
+        with rec.lock:
+            rec.queue_delay.append(start - job["arrival"])
+            rec.counts["jobs"] += 1
+        try:
+            run_job(db_config, job, rec)
+        except mysql.connector.Error as err:
+            rec.error(err)
+        with rec.lock:
+            rec.end_to_end.append(time.perf_counter() - job["arrival"])
+
+
+def make_jobs(args, user_ids, mix):
+    rnd = random.Random(args.seed)
+    keys, weights = zip(*mix.items())
+    hold_min, hold_max = args.hold_ms
+    offset = 0.0
+    for _ in range(args.jobs):
+        if args.arrival_rate > 0:
+            offset += rnd.expovariate(args.arrival_rate)
+        yield offset, {
+            "user_id": rnd.choice(user_ids),
+            "package": rnd.choices(keys, weights)[0],
+            "hold": rnd.uniform(hold_min, hold_max) / 1000.0,
+            "action": "terminate" if rnd.random() < args.terminate_ratio else "complete",
+        }
+
+
+def run(db_config, args):
+    mix = parse_mix(args.mix)
+    user_ids = setup_users(db_config, args.users)
+    placement.get_engine(db_config).reload()
+
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        before = server_lock_counters(cursor)
+    finally:
+        cursor.close()
+        conn.close()
+
+    rec = Recorder()
+    jobs = queue.Queue()
+    threads = [threading.Thread(target=worker, args=(db_config, jobs, rec)) for _ in range(args.workers)]
+    for t in threads:
+        t.start()
+
+    t0 = time.perf_counter()
+    for offset, job in make_jobs(args, user_ids, mix):
+        delay = t0 + offset - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        job["arrival"] = t0 + offset if args.arrival_rate > 0 else None
+        jobs.put(job)
+    for _ in threads:
+        jobs.put(None)
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        after = server_lock_counters(cursor)
+    finally:
+        cursor.close()
+        conn.close()
+
+    approvals = len(rec.latency["approve"])
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "lifecycles_per_sec": round(rec.counts["completed"] / elapsed, 2) if elapsed else None,
+        "phases": {phase: {**latency_summary(values), "per_sec": round(len(values) / elapsed, 2) if elapsed else None}
+                   for phase, values in rec.latency.items()},
+        "end_to_end": latency_summary(rec.end_to_end),
+        "queue_delay": latency_summary(rec.queue_delay),
+        "allocation_failure_rate": round(rec.counts["allocation_failures"] / approvals, 4) if approvals else None,
+        "counts": rec.counts,
+        "errors": rec.errors,
+        **lock_counter_delta(before, after),
+        "pool": db.pool_metrics(db_config),
+        "placement": placement.get_engine(db_config).stats,
+        "queries": querystats.dump(args.top_queries)["statements"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_db_arguments(parser)
+    parser.add_argument("--users", type=int, default=50, help="参与压测的用户数")
+    parser.add_argument("--workers", type=int, default=16, help="并发工作线程数")
+    parser.add_argument("--jobs", type=int, default=500, help="作业总数 (每个作业走完整个生命周期)")
+    parser.add_argument("--arrival-rate", type=float, default=0.0, help="每秒到达的作业数 (泊松)，0 为闭环")
+    parser.add_argument("--mix", default="v100_std=3,a100_ultra=1,cpu_general=6", help="套餐=权重，逗号分隔")
+    parser.add_argument("--hold-ms", type=float, nargs=2, default=(50.0, 500.0), metavar=("MIN", "MAX"),
+                        help="实例运行时长区间 (毫秒)")
+    parser.add_argument("--terminate-ratio", type=float, default=0.1, help="强制终止 (而非正常完成) 的比例")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--top-queries", type=int, default=20, help="结果中保留总耗时最多的语句数")
+    parser.add_argument("--query-stats", default=None, metavar="PATH", help="把完整的语句统计另存为 JSON")
+    args = parser.parse_args()
+
+    db_config = db_config_from_args(args)
+    db.configure(pool_size=args.workers + 2)
+
+    result = run(db_config, args)
+    if args.query_stats:
+        querystats.write(args.query_stats)
+    print(json.dumps({
+        "users": args.users, "workers": args.workers, "jobs": args.jobs, "arrival_rate": args.arrival_rate,
+        "mix": parse_mix(args.mix), "seed": args.seed, "results": result,
+    }, ensure_ascii=False, default=str))
+
+
+if __name__ == "__main__":
+    main()
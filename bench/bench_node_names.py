@@ -0,0 +1,197 @@
+"""
+node_name 分配：旧的 FLOOR(RAND() * 900000 + 100000) vs 号段分配 sp_next_node_name (迁移 0012)
+
+离线模式 (默认，无需数据库)：
+    python bench/bench_node_names.py --instances 100000 --allocators 8 --rollback-ratio 0.05
+    在内存中回放 --instances 次实例创建 (不释放，即最坏情况下全部名称同时存活)：
+    随机方案逐次抽号，撞上已有名称即记一次 "撞号回滚" 并重抽；
+    号段方案由 --allocators 个分配者交错取号，按 --rollback-ratio 随机回滚 (号码作废)，校验提交的名称无重复。
+
+在线模式 (连接真实 MySQL，请使用已执行 migrate.py up 的测试库)：
+    python bench/bench_node_names.py --db --host localhost --user root --password xxx --database cloud \\
+        --instances 100000 --workers 8
+    建一张与 virtualcomputers.node_name 同样带唯一索引的临时表 bench_node_names，预先放入现有全部 node_name，
+    再由 --workers 个线程各自在事务中取号并插入，撞号 (errno 1062) 计为撞号回滚；两种方案各跑一轮，结束后删表。
+
+输出为一行 JSON：各方案的撞号回滚次数 (及按实例数分段的累计)、重复名称数与吞吐。
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mysql.connector
+
+import db
+from common import add_db_arguments, db_config_from_args
+
+BLOCK_SIZE = 100          # 与迁移 0012 一致
+FIRST_NAME = 1000000      # 号段方案的起始名称 (空库)
+MILESTONES = (1000, 10000, 100000, 1000000)
+
+
+# ================= 离线模式 =================
+
+def offline_random(instances, seed):
+    rng = random.Random(seed)
+    names, aborts, checkpoints = set(), 0, {}
+    while len(names) < instances:
+        if len(names) >= 900000:
+            # 6 位数用完，之后每次都会撞号
+            checkpoints["exhausted_at"] = len(names)
+            break
+        name = rng.randrange(100000, 1000000)
+        if name in names:
+            aborts += 1
+            continue
+        names.add(name)
+        if len(names) in MILESTONES:
+            checkpoints[str(len(names))] = aborts
+    return {"aborts": aborts, "aborts_by_instances": checkpoints, "created": len(names)}
+
+
+def offline_blocks(instances, allocators, rollback_ratio, seed):
+    rng = random.Random(seed)
+    next_block = FIRST_NAME // BLOCK_SIZE
+    sessions = [None] * allocators  # [next, last]
+    names, duplicates, rolled_back, blocks = set(), 0, 0, 0
+    while len(names) < instances:
+        i = rng.randrange(allocators)
+        if sessions[i] is None or sessions[i][0] > sessions[i][1]:
+            sessions[i] = [next_block * BLOCK_SIZE, next_block * BLOCK_SIZE + BLOCK_SIZE - 1]
+            next_block += 1
+            blocks += 1
+        name = sessions[i][0]
+        sessions[i][0] += 1
+        if rng.random() < rollback_ratio:
+            rolled_back += 1
+            continue
+        if name in names:
+            duplicates += 1
+        names.add(name)
+    return {"aborts": duplicates, "duplicates": duplicates, "created": len(names), "rolled_back": rolled_back,
+            "blocks": blocks, "max_name": max(names) if names else None}
+
+
+# ================= 在线模式 =================
+
+SCRATCH_DDL = """
+    CREATE TABLE bench_node_names (
+      node_name int NOT NULL,
+      UNIQUE INDEX node_name (node_name)
+    ) ENGINE = InnoDB
+"""
+
+
+def _worker(db_config, scheme, count, rollback_ratio, seed, out):
+    rng = random.Random(seed)
+    aborts = rolled_back = created = 0
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        while created < count:
+            conn.start_transaction()
+            try:
+                if scheme == "random":
+                    cursor.execute("INSERT INTO bench_node_names (node_name) VALUES (FLOOR(RAND() * 900000 + 100000))")
+                else:
+                    name = cursor.callproc('sp_next_node_name', [0])[0]
+                    cursor.execute("INSERT INTO bench_node_names (node_name) VALUES (%s)", (name,))
+            except mysql.connector.Error as err:
+                conn.rollback()
+                if err.errno != 1062:
+                    raise
+                aborts += 1
+                continue
+            if rng.random() < rollback_ratio:
+                conn.rollback()
+                rolled_back += 1
+            else:
+                conn.commit()
+                created += 1
+    finally:
+        cursor.close()
+        conn.close()
+    out.append({"aborts": aborts, "rolled_back": rolled_back, "created": created})
+
+
+def run_db(db_config, scheme, instances, workers, rollback_ratio, seed):
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("DROP TABLE IF EXISTS bench_node_names")
+        cursor.execute(SCRATCH_DDL)
+        cursor.execute("INSERT INTO bench_node_names (node_name) SELECT node_name FROM virtualcomputers")
+        existing = cursor.rowcount
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+    results, threads = [], []
+    started = time.perf_counter()
+    per_worker = [instances // workers + (1 if i < instances % workers else 0) for i in range(workers)]
+    for i, count in enumerate(per_worker):
+        t = threading.Thread(target=_worker, args=(db_config, scheme, count, rollback_ratio, seed + i, results))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT COUNT(*), COUNT(DISTINCT node_name) FROM bench_node_names")
+        total, distinct = cursor.fetchone()
+        cursor.execute("DROP TABLE bench_node_names")
+    finally:
+        cursor.close()
+        conn.close()
+    created = sum(r["created"] for r in results)
+    return {
+        "existing_names": existing,
+        "created": created,
+        "aborts": sum(r["aborts"] for r in results),
+        "rolled_back": sum(r["rolled_back"] for r in results),
+        "duplicates": total - distinct,
+        "workers_finished": len(results),
+        "per_sec": round(created / elapsed, 1) if elapsed else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--instances", type=int, default=100000)
+    parser.add_argument("--allocators", type=int, default=8, help="离线模式的分配者 (连接) 数")
+    parser.add_argument("--rollback-ratio", type=float, default=0.05, help="取号后事务因其他原因回滚的比例")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--db", action="store_true", help="连接真实 MySQL 运行在线模式")
+    add_db_arguments(parser)
+    parser.add_argument("--workers", type=int, default=8, help="在线模式的并发线程数")
+    args = parser.parse_args()
+
+    if args.db:
+        db_config = db_config_from_args(args)
+        db.configure(pool_size=max(args.workers + 1, db.POOL_SETTINGS["pool_size"]))
+        results = {scheme: run_db(db_config, scheme, args.instances, args.workers, args.rollback_ratio, args.seed)
+                   for scheme in ("random", "blocks")}
+        print(json.dumps({"mode": "db", "instances": args.instances, "workers": args.workers, "results": results},
+                         ensure_ascii=False))
+        return
+
+    results = {
+        "random": offline_random(args.instances, args.seed),
+        "blocks": offline_blocks(args.instances, args.allocators, args.rollback_ratio, args.seed),
+    }
+    print(json.dumps({"mode": "offline", "instances": args.instances, "allocators": args.allocators,
+                      "results": results}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
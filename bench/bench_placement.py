@@ -0,0 +1,285 @@
+"""
+放置策略基准测试：旧的首次适配 (sp_create_instance) vs 放置引擎 best-fit / worst-fit
+
+离线模式 (默认，无需数据库)：
+    python bench/bench_placement.py --steps 20000 --seed 42
+    在 init.sql 9.2 节定义的物理资源池模型上回放同一条随机的 分配/释放 序列，
+    比较决策吞吐、分配失败数 (其中有多少是 "总量够但被碎片挡住")、碎片化节点数
+    以及还能放下多少个整机套餐。
+
+在线模式 (连接真实 MySQL，请使用刚导入 init.sql 并执行过 migrate.py up 的测试库)：
+    python bench/bench_placement.py --db --host localhost --user root --password xxx --database cloud --count 300
+    依次用 sp_create_instance 和放置引擎各分配 count 个实例，报告提交吞吐和碎片报表，
+    每轮结束后用 sp_release_resource 释放本轮创建的实例，使两轮从相同状态开始。
+
+输出为一行 JSON，便于跨版本对比。
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import placement
+from common import add_db_arguments, db_config_from_args
+
+# 与 init.sql 9.2 节保持一致
+POOL = {
+    "gpu_v100": {"nodes": 51, "cores": 24, "gpu_mem": 128, "ram": 512},
+    "gpuB": {"nodes": 11, "cores": 96, "gpu_mem": 640, "ram": 1024},
+    "cpu_6126": {"nodes": 101, "cores": 24, "gpu_mem": 0, "ram": 192},
+}
+
+# 队列被选中的概率与各队列的套餐分布 (整机套餐来自 packages.VM_PACKAGES，小套餐来自 sp_init_mock_load)
+QUEUE_WEIGHTS = {"gpu_v100": 0.3, "gpuB": 0.1, "cpu_6126": 0.6}
+PACKAGES = {
+    "gpu_v100": [((24, 32, 512), 0.3), ((4, 16, 32), 0.7)],
+    "gpuB": [((96, 640, 1024), 0.3), ((12, 80, 128), 0.7)],
+    "cpu_6126": [((24, 0, 192), 0.3), ((2, 0, 4), 0.7)],
+}
+# 每个队列最大的套餐，用来衡量 "还能放下几个整机套餐"
+FULL_NODE_PACKAGE = {q: max(p for p, _ in pkgs) for q, pkgs in PACKAGES.items()}
+
+
+# ================= 离线模型 =================
+
+class PoolModel:
+    """物理资源池的内存模型：npu 与 memory 行各自独立编号，与 init.sql 一致"""
+
+    def __init__(self):
+        self.npus = {}  # npu_id -> [queue, cores, free_cores, gpu_mem, free_gpu_mem]
+        self.mems = {}  # mem_id -> [queue, size, free_size]
+        npu_id = mem_id = 0
+        for queue, spec in POOL.items():
+            for _ in range(spec["nodes"]):
+                npu_id += 1
+                mem_id += 1
+                self.npus[npu_id] = [queue, spec["cores"], spec["cores"], spec["gpu_mem"], spec["gpu_mem"]]
+                self.mems[mem_id] = [queue, spec["ram"], spec["ram"]]
+
+    def total_free(self, queue):
+        cores = sum(n[2] for n in self.npus.values() if n[0] == queue)
+        gpu = sum(n[4] for n in self.npus.values() if n[0] == queue)
+        ram = sum(m[2] for m in self.mems.values() if m[0] == queue)
+        return cores, gpu, ram
+
+    def fragmentation(self):
+        """与 advanced.sql 碎片化报表同口径：空闲 / 满载 / 碎片化节点数"""
+        report = {}
+        for queue in POOL:
+            nodes = [n for n in self.npus.values() if n[0] == queue]
+            cores, gpu, ram = FULL_NODE_PACKAGE[queue]
+            free_mem = sorted((m[2] for m in self.mems.values() if m[0] == queue), reverse=True)
+            fit_npu = sum(1 for n in nodes if n[2] >= cores and n[4] >= gpu)
+            fit_mem = sum(1 for m in free_mem if m >= ram)
+            report[queue] = {
+                "idle": sum(1 for n in nodes if n[2] == n[1]),
+                "full": sum(1 for n in nodes if n[2] == 0),
+                "fragmented": sum(1 for n in nodes if 0 < n[2] < n[1]),
+                "full_node_packages_fit": min(fit_npu, fit_mem),
+            }
+        return report
+
+
+class FirstFitChooser:
+    """
+    模拟 sp_create_instance：沿基线索引 idx_npu_queue (queue_type, NPU_id) 顺序取第一条满足条件的行。
+    (迁移 0004 之后改走 idx_npu_alloc，扫描顺序随 available_cores 变化)
+    """
+
+    name = "first_fit (sp_create_instance)"
+
+    def __init__(self, model):
+        self.model = model
+        self.npu_order = {q: sorted(i for i, n in model.npus.items() if n[0] == q) for q in POOL}
+        self.mem_order = {q: sorted(i for i, m in model.mems.items() if m[0] == q) for q in POOL}
+
+    def choose(self, queue, cores, gpu, ram):
+        npu_id = next((i for i in self.npu_order[queue]
+                       if self.model.npus[i][2] >= cores and self.model.npus[i][4] >= gpu), None)
+        mem_id = next((i for i in self.mem_order[queue] if self.model.mems[i][2] >= ram), None)
+        if npu_id is None or mem_id is None:
+            return None
+        return npu_id, mem_id
+
+    def released(self, queue, npu_id, mem_id):
+        pass
+
+
+class IndexChooser:
+    """放置引擎的 CapacityIndex"""
+
+    def __init__(self, model, policy):
+        self.name = f"{policy} (placement engine)"
+        self.model = model
+        self.policy = policy
+        self.index = placement.CapacityIndex()
+        self.index.load(
+            [(i, n[0], n[2], n[4], "online") for i, n in model.npus.items()],
+            [(i, m[0], m[2], "online") for i, m in model.mems.items()],
+        )
+
+    def choose(self, queue, cores, gpu, ram):
+        pick = self.index.choose(queue, cores, gpu, ram, self.policy)
+        if pick is None:
+            return None
+        return pick[0], pick[3]
+
+    def released(self, queue, npu_id, mem_id):
+        n = self.model.npus[npu_id]
+        self.index.update_npu(queue, npu_id, n[2], n[4])
+        self.index.update_mem(queue, mem_id, self.model.mems[mem_id][2])
+
+
+def make_trace(steps, seed, release_ratio):
+    rnd = random.Random(seed)
+    queues, weights = zip(*QUEUE_WEIGHTS.items())
+    trace = []
+    for _ in range(steps):
+        if rnd.random() < release_ratio:
+            trace.append(("release", rnd.random()))
+        else:
+            queue = rnd.choices(queues, weights)[0]
+            pkgs, pw = zip(*PACKAGES[queue])
+            trace.append(("alloc", queue, rnd.choices(pkgs, pw)[0]))
+    return trace
+
+
+def run_offline(chooser_factory, trace):
+    model = PoolModel()
+    chooser = chooser_factory(model)
+    live = []
+    stats = {"allocations": 0, "failures": 0, "fragmentation_failures": 0, "releases": 0}
+    decide_time = 0.0
+
+    for op in trace:
+        if op[0] == "release":
+            if not live:
+                continue
+            queue, npu_id, mem_id, (cores, gpu, ram) = live.pop(int(op[1] * len(live)))
+            n = model.npus[npu_id]
+            n[2] += cores
+            n[4] += gpu
+            model.mems[mem_id][2] += ram
+            chooser.released(queue, npu_id, mem_id)
+            stats["releases"] += 1
+            continue
+
+        _, queue, (cores, gpu, ram) = op
+        t0 = time.perf_counter()
+        pick = chooser.choose(queue, cores, gpu, ram)
+        decide_time += time.perf_counter() - t0
+        if pick is None:
+            stats["failures"] += 1
+            free_cores, free_gpu, free_ram = model.total_free(queue)
+            if free_cores >= cores and free_gpu >= gpu and free_ram >= ram:
+                stats["fragmentation_failures"] += 1
+            continue
+        npu_id, mem_id = pick
+        n = model.npus[npu_id]
+        n[2] -= cores
+        n[4] -= gpu
+        model.mems[mem_id][2] -= ram
+        live.append((queue, npu_id, mem_id, (cores, gpu, ram)))
+        stats["allocations"] += 1
+
+    decisions = stats["allocations"] + stats["failures"]
+    stats["decisions_per_sec"] = round(decisions / decide_time) if decide_time else None
+    stats["fragmentation"] = model.fragmentation()
+    stats["fragmented_nodes_total"] = sum(r["fragmented"] for r in stats["fragmentation"].values())
+    return chooser.name, stats
+
+
+# ================= 在线模式 =================
+
+FRAGMENTATION_SQL = """
+    SELECT queue_type,
+           SUM(CASE WHEN available_cores = cores THEN 1 ELSE 0 END) AS idle,
+           SUM(CASE WHEN available_cores = 0 THEN 1 ELSE 0 END) AS full,
+           SUM(CASE WHEN available_cores > 0 AND available_cores < cores THEN 1 ELSE 0 END) AS fragmented
+    FROM npus GROUP BY queue_type
+"""
+
+
+def run_db(db_config, count, seed, policy):
+    import db
+
+    trace = [op for op in make_trace(count * 3, seed, 0.0) if op[0] == "alloc"][:count]
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    results = {}
+    try:
+        for mode in ("first_fit (sp_create_instance)", f"{policy} (placement engine)"):
+            engine = placement.PlacementEngine(db_config, policy=policy)
+            engine.reload()
+            created = []
+            failures = 0
+            t0 = time.perf_counter()
+            for _, queue, (cores, gpu, ram) in trace:
+                cursor.execute(
+                    "INSERT INTO requests (user_id, request_type, status, parameters) VALUES (2, 'bench_placement', 'pending', '{}')")
+                req_id = cursor.lastrowid
+                conn.commit()
+                if mode.startswith("first_fit"):
+                    node_id = cursor.callproc('sp_create_instance', [req_id, queue, cores, gpu, ram, 10, 0])[-1]
+                else:
+                    node_id = engine.allocate(req_id, queue,
+                                              {"req_cores": cores, "req_gpu_mem": gpu, "req_ram": ram, "req_disk": 10},
+                                              conn=conn)
+                if node_id and node_id > 0:
+                    created.append(node_id)
+                else:
+                    failures += 1
+            elapsed = time.perf_counter() - t0
+
+            cursor.execute(FRAGMENTATION_SQL)
+            frag = {row[0]: {"idle": int(row[1]), "full": int(row[2]), "fragmented": int(row[3])} for row in cursor.fetchall()}
+            results[mode] = {
+                "allocations": len(created),
+                "failures": failures,
+                "allocations_per_sec": round(count / elapsed, 1),
+                "fragmentation": frag,
+                "engine_stats": engine.stats if not mode.startswith("first_fit") else None,
+            }
+            for node_id in created:
+                cursor.callproc('sp_release_resource', [node_id, ''])
+            conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--steps", type=int, default=20000, help="离线模式的操作数")
+    parser.add_argument("--release-ratio", type=float, default=0.45, help="离线模式中释放操作的比例")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--db", action="store_true", help="连接真实 MySQL 运行在线模式")
+    add_db_arguments(parser)
+    parser.add_argument("--count", type=int, default=300, help="在线模式每轮分配的实例数")
+    parser.add_argument("--policy", default=placement.BEST_FIT, choices=placement.POLICIES)
+    args = parser.parse_args()
+
+    if args.db:
+        db_config = db_config_from_args(args)
+        print(json.dumps({"mode": "db", "count": args.count, "results": run_db(db_config, args.count, args.seed, args.policy)},
+                         ensure_ascii=False))
+        return
+
+    trace = make_trace(args.steps, args.seed, args.release_ratio)
+    factories = [
+        FirstFitChooser,
+        lambda m: IndexChooser(m, placement.BEST_FIT),
+        lambda m: IndexChooser(m, placement.WORST_FIT),
+    ]
+    results = dict(run_offline(f, trace) for f in factories)
+    print(json.dumps({"mode": "offline", "nodes": sum(p["nodes"] for p in POOL.values()),
+                      "steps": args.steps, "seed": args.seed, "results": results}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
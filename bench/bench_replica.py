@@ -0,0 +1,173 @@
+"""
+读副本路由 (replica.py)：报表负载隔离、读己之写与故障回退
+
+需要两个本地 MySQL 实例：主库与一个已配置好复制的副本 (均导入 init.sql 并执行过 migrate.py up，副本账号需 REPLICATION CLIENT 权限)：
+
+    python bench/bench_replica.py --host 127.0.0.1 --port 3306 --replica-port 3307 --user root --password xxx \\
+        --database cloud --duration 30 --report-threads 4 --workers 8 --rounds 200
+
+- isolation：--report-threads 个线程循环执行 advanced.sql 的逐卡明细报表，同时 --workers 个线程跑
+  提交 -> 审批 -> 释放 (与 bench_lifecycle.py 相同的代码路径)。报表先全部走主库、再走副本，各 --duration 秒，
+  对比两种情况下审批 / 释放的延迟与吞吐
+- read_your_writes：--rounds 次 "提交申请后立即读回"，带 scope 的读应当一次都读不到旧数据
+  (刚写过时走主库，副本追上后走副本)；不带 scope 的读作对照，统计读到旧数据的次数
+- fallback：登记一个不可达的副本 (--dead-port) 后执行 --rounds 次读，全部应成功 (回退到主库)
+
+输出为一行 JSON。会写入压测用户与申请，请在测试库上运行。
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import ops
+import replica
+import user
+from bench_lifecycle import PACKAGES, Recorder, run_job, setup_users
+from common import add_db_arguments, db_config_from_args, latency_summary
+
+# advanced.sql 的逐卡明细：npus x virtualcpu x virtualcomputers 联表聚合
+REPORT_SQL = """
+    SELECT n.npu_serial, n.queue_type, n.cores,
+           COALESCE(SUM(vcpu.virtual_cores), 0) AS allocated_cores,
+           COUNT(vm.node_id) AS running, COALESCE(SUM(vm.hourly_price), 0) AS hourly_revenue
+    FROM npus n
+    LEFT JOIN virtualcpu vcpu ON n.NPU_id = vcpu.NPU_id AND vcpu.status = 'allocated'
+    LEFT JOIN virtualcomputers vm ON vcpu.vir_NPU_id = vm.vir_NPU_id AND vm.status = 'running'
+    GROUP BY n.NPU_id, n.npu_serial, n.queue_type, n.cores
+    ORDER BY allocated_cores DESC
+"""
+
+SQL_REQUEST_STATUS = "SELECT status FROM requests WHERE request_id = %s"
+
+
+def _fetch(sql, params=()):
+    def work(source_config, conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            return cursor.fetchall(), source_config
+        finally:
+            cursor.close()
+    return work
+
+
+def isolation(db_config, replicas, args, user_ids):
+    stop = threading.Event()
+    rec = Recorder()
+    reports = []
+    reports_lock = threading.Lock()
+
+    def report_loop():
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            replica.read(db_config, None, _fetch(REPORT_SQL))
+            with reports_lock:
+                reports.append(time.perf_counter() - t0)
+
+    def alloc_loop(i):
+        n = 0
+        while not stop.is_set():
+            n += 1
+            job = {"user_id": user_ids[(i + n) % len(user_ids)], "package": args.package,
+                   "hold": 0, "action": "complete"}
+            try:
+                run_job(db_config, job, rec)
+            except Exception as err:
+                rec.error(err)
+
+    replica.configure(db_config, replicas, args.max_lag)
+    threads = [threading.Thread(target=report_loop) for _ in range(args.report_threads)]
+    threads += [threading.Thread(target=alloc_loop, args=(i,)) for i in range(args.workers)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    return {
+        "reports": {**latency_summary(reports), "per_sec": round(len(reports) / elapsed, 2)},
+        "approve": {**latency_summary(rec.latency["approve"]),
+                    "per_sec": round(len(rec.latency["approve"]) / elapsed, 2)},
+        "release": latency_summary(rec.latency["release"]),
+        "errors": rec.errors,
+        "routing": replica.stats(db_config),
+    }
+
+
+def read_your_writes(db_config, replicas, args, user_id):
+    replica.configure(db_config, replicas, args.max_lag)
+    category, pkg = PACKAGES[args.package]
+    result = {"rounds": args.rounds, "scoped_stale": 0, "scoped_on_replica": 0,
+              "unscoped_stale": 0, "unscoped_on_replica": 0}
+    req_ids = []
+    try:
+        for _ in range(args.rounds):
+            req_id = user.submit_resource_request(db_config, user_id, args.package, pkg, category)
+            req_ids.append(req_id)
+            for scope, prefix in ((user_id, "scoped"), (None, "unscoped")):
+                rows, source = replica.read(db_config, scope, _fetch(SQL_REQUEST_STATUS, (req_id,)))
+                result[f"{prefix}_stale"] += not rows
+                result[f"{prefix}_on_replica"] += source is not db_config
+            time.sleep(args.round_gap_ms / 1000)
+    finally:
+        ops.reject_requests(db_config, req_ids)
+    result["routing"] = replica.stats(db_config)
+    return result
+
+
+def fallback(db_config, args):
+    replica.configure(db_config, [{"port": args.dead_port}], args.max_lag)
+    ok = 0
+    t0 = time.perf_counter()
+    for _ in range(args.rounds):
+        rows, source = replica.read(db_config, None, _fetch("SELECT 1"))
+        ok += bool(rows) and source is db_config
+    return {"rounds": args.rounds, "served_by_primary": ok, "elapsed_s": round(time.perf_counter() - t0, 3),
+            "routing": replica.stats(db_config)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_db_arguments(parser)
+    parser.add_argument("--replica-host", default=None, help="默认与 --host 相同")
+    parser.add_argument("--replica-port", type=int, default=3307)
+    parser.add_argument("--dead-port", type=int, default=3399, help="fallback 阶段登记的不可达副本端口")
+    parser.add_argument("--max-lag", type=float, default=replica.MAX_LAG)
+    parser.add_argument("--duration", type=float, default=30.0, help="isolation 每种模式的秒数")
+    parser.add_argument("--report-threads", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--package", default="cpu_general", choices=sorted(PACKAGES))
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--round-gap-ms", type=float, default=20.0, help="read_your_writes 每轮间隔")
+    parser.add_argument("--phases", nargs="+", choices=("isolation", "read_your_writes", "fallback"),
+                        default=["isolation", "read_your_writes", "fallback"])
+    args = parser.parse_args()
+
+    db_config = db_config_from_args(args)
+    replicas = [{"host": args.replica_host or args.host, "port": args.replica_port}]
+    user_ids = setup_users(db_config, max(args.workers, 1))
+
+    result = {}
+    if "isolation" in args.phases:
+        result["isolation"] = {
+            "reports_on_primary": isolation(db_config, [], args, user_ids),
+            "reports_on_replica": isolation(db_config, replicas, args, user_ids),
+        }
+    if "read_your_writes" in args.phases:
+        result["read_your_writes"] = read_your_writes(db_config, replicas, args, user_ids[0])
+    if "fallback" in args.phases:
+        result["fallback"] = fallback(db_config, args)
+    result["pool"] = db.pool_metrics()
+    print(json.dumps(result, ensure_ascii=False, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+存储热点行争用基准测试：旧布局 (每卷 1 行) vs 分片布局 (每卷 N 个分片)
+
+    python bench/bench_storage_contention.py --host localhost --user root --password xxx --database cloud \\
+        --threads-per-queue 4 --cycles 200 --shards 16
+
+每个工作线程在自己的队列上循环执行 "提交请求 -> 分配 -> 释放"。
+旧布局通过 sp_reshard_storage(1) 还原成与改造前一致的单行热点，新布局为 sp_reshard_storage(shards)，
+两轮使用完全相同的线程数和循环次数。默认通过放置引擎分配 (--path engine)，
+使 npus / memory 行分散，测到的主要是存储行上的争用；--path legacy 则走原 sp_create_instance。
+
+每轮结束后校验：各卷 分片剩余合计 + 已分配卷大小 == size_gb，即总容量仍被精确约束。
+输出为一行 JSON。请在导入 init.sql 并执行过 migrate.py up 的测试库上运行。
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mysql.connector
+
+import db
+import placement
+from common import (LOCK_ERRNOS, add_db_arguments, db_config_from_args, latency_summary, lock_counter_delta,
+                    server_lock_counters)
+
+# 每个队列使用的小规格套餐 (核, 显存, 内存, 磁盘)，保证多线程同时持有实例时资源充足
+QUEUE_PACKAGES = {
+    "gpu_v100": (4, 16, 32, 100),
+    "gpuB": (12, 80, 128, 500),
+    "cpu_6126": (2, 0, 4, 50),
+}
+
+
+def capacity_check(cursor):
+    cursor.execute("""
+        SELECT v.volume_id, v.size_gb,
+               (SELECT COALESCE(SUM(s.available_size), 0) FROM storage_shards s WHERE s.volume_id = v.volume_id) AS free_gb,
+               (SELECT COALESCE(SUM(vv.virtual_size), 0) FROM virtualvolume vv
+                 WHERE vv.volume_id = v.volume_id AND vv.status = 'allocated') AS used_gb
+        FROM storagevolume v
+    """)
+    rows = cursor.fetchall()
+    return all(int(free) + int(used) == int(size) for _, size, free, used in rows)
+
+
+def worker(db_config, queue, cycles, path, engine, out, barrier):
+    cores, gpu, ram, disk = QUEUE_PACKAGES[queue]
+    db_params = {"req_cores": cores, "req_gpu_mem": gpu, "req_ram": ram, "req_disk": disk}
+    stats = {"create": [], "release": [], "failures": 0, "errors": {}}
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    barrier.wait()
+    try:
+        for _ in range(cycles):
+            try:
+                cursor.execute(
+                    "INSERT INTO requests (user_id, request_type, status, parameters) VALUES (2, 'bench_storage', 'pending', '{}')")
+                req_id = cursor.lastrowid
+                conn.commit()
+
+                t0 = time.perf_counter()
+                if path == "engine":
+                    node_id = engine.allocate(req_id, queue, db_params, conn=conn)
+                else:
+                    node_id = cursor.callproc('sp_create_instance', [req_id, queue, cores, gpu, ram, disk, 0])[-1]
+                stats["create"].append(time.perf_counter() - t0)
+                if not node_id or node_id <= 0:
+                    stats["failures"] += 1
+                    continue
+
+                t0 = time.perf_counter()
+                cursor.callproc('sp_release_resource', [node_id, ''])
+                stats["release"].append(time.perf_counter() - t0)
+            except mysql.connector.Error as err:
+                conn.rollback()
+                key = LOCK_ERRNOS.get(err.errno, f"errno_{err.errno}")
+                stats["errors"][key] = stats["errors"].get(key, 0) + 1
+    finally:
+        cursor.close()
+        conn.close()
+    out.append(stats)
+
+
+def run_layout(db_config, shards, args):
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        cursor.callproc('sp_reshard_storage', [shards])
+        before = server_lock_counters(cursor)
+    finally:
+        cursor.close()
+        conn.close()
+
+    engine = placement.PlacementEngine(db_config, policy=placement.WORST_FIT)
+    if args.path == "engine":
+        engine.reload()
+
+    queues = args.queues.split(",")
+    threads, out = [], []
+    barrier = threading.Barrier(len(queues) * args.threads_per_queue + 1)
+    for queue in queues:
+        for _ in range(args.threads_per_queue):
+            t = threading.Thread(target=worker, args=(db_config, queue, args.cycles, args.path, engine, out, barrier))
+            t.start()
+            threads.append(t)
+    barrier.wait()
+    t0 = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        after = server_lock_counters(cursor)
+        exact = capacity_check(cursor)
+    finally:
+        cursor.close()
+        conn.close()
+
+    creates = [v for s in out for v in s["create"]]
+    releases = [v for s in out for v in s["release"]]
+    errors = {}
+    for s in out:
+        for k, v in s["errors"].items():
+            errors[k] = errors.get(k, 0) + v
+    return {
+        "shards_per_volume": shards,
+        "threads": len(threads),
+        "elapsed_s": round(elapsed, 3),
+        "cycles_per_sec": round(len(releases) / elapsed, 1) if elapsed else None,
+        "create": latency_summary(creates),
+        "release": latency_summary(releases),
+        "allocation_failures": sum(s["failures"] for s in out),
+        "errors": errors,
+        **lock_counter_delta(before, after),
+        "capacity_exact": exact,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_db_arguments(parser)
+    parser.add_argument("--threads-per-queue", type=int, default=4)
+    parser.add_argument("--cycles", type=int, default=200, help="每个线程的 分配+释放 循环次数")
+    parser.add_argument("--shards", type=int, default=16, help="新布局每个存储卷的分片数")
+    parser.add_argument("--queues", default=",".join(QUEUE_PACKAGES))
+    parser.add_argument("--path", choices=("engine", "legacy"), default="engine")
+    args = parser.parse_args()
+
+    db_config = db_config_from_args(args)
+    threads = len(args.queues.split(",")) * args.threads_per_queue
+    db.configure(pool_size=threads + 2)
+
+    results = {
+        "old_layout": run_layout(db_config, 1, args),
+        "new_layout": run_layout(db_config, args.shards, args),
+    }
+    print(json.dumps({"path": args.path, "cycles_per_thread": args.cycles, "results": results}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
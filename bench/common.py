@@ -0,0 +1,51 @@
+"""基准测试脚本共用的小工具：命令行数据库参数、延迟分位数、InnoDB 锁计数器"""
+import math
+
+LOCK_ERRNOS = {1205: "lock_wait_timeouts", 1213: "deadlocks"}
+
+
+def add_db_arguments(parser):
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=3306)
+    parser.add_argument("--user", default="root")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--database", default="cloud")
+
+
+def db_config_from_args(args):
+    return {"host": args.host, "port": args.port, "user": args.user, "password": args.password,
+            "database": args.database, "charset": "utf8mb4", "collation": "utf8mb4_0900_ai_ci"}
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, math.ceil(pct / 100.0 * len(values)) - 1))
+    return values[k]
+
+
+def latency_summary(values):
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 2) if values else None,
+        "p95_ms": round(percentile(values, 95) * 1000, 2) if values else None,
+        "p99_ms": round(percentile(values, 99) * 1000, 2) if values else None,
+    }
+
+
+def server_lock_counters(cursor):
+    cursor.execute("SHOW GLOBAL STATUS WHERE Variable_name IN ('Innodb_row_lock_waits', 'Innodb_row_lock_time')")
+    counters = {name: int(value) for name, value in cursor.fetchall()}
+    cursor.execute("SELECT COUNT FROM information_schema.INNODB_METRICS WHERE NAME = 'lock_deadlocks'")
+    row = cursor.fetchone()
+    counters["lock_deadlocks"] = int(row[0]) if row else 0
+    return counters
+
+
+def lock_counter_delta(before, after):
+    return {
+        "row_lock_waits": after["Innodb_row_lock_waits"] - before["Innodb_row_lock_waits"],
+        "row_lock_time_ms": after["Innodb_row_lock_time"] - before["Innodb_row_lock_time"],
+        "deadlocks": after["lock_deadlocks"] - before["lock_deadlocks"],
+    }
@@ -0,0 +1,135 @@
+import threading
+import time
+from collections import OrderedDict
+
+import db
+
+# ================= 查询结果缓存 =================
+#
+# Streamlit 每次按钮点击都会整页重跑，仪表盘上的聚合/联表查询在数据没变时也会被反复执行。
+# 这里提供一个进程级 (所有会话共享) 的 TTL + LRU 缓存：
+# - 每条查询有自己的 TTL，到期自动失效
+# - 每条缓存项带若干 "表标签"，写操作按表调用 invalidate() 立即失效相关查询
+# - 条目数与单条行数都有上限，内存有界
+# 注意：缓存的是 fetchall() 的原始行列表，调用方只读，不要原地修改。
+# 其他进程 (如后台调度器) 的写入无法通知到这里，依赖 TTL 兜底。
+
+MAX_ENTRIES = 512       # 最多缓存的查询结果数，超出按 LRU 淘汰
+MAX_ENTRY_ROWS = 20000  # 单个结果超过该行数不缓存
+
+
+class TTLCache:
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_entry_rows=MAX_ENTRY_ROWS):
+        self.max_entries = max_entries
+        self.max_entry_rows = max_entry_rows
+        self._data = OrderedDict()  # key -> (expires_at, value, tags)
+        self._lock = threading.Lock()
+        self._generation = 0  # 每次失效 +1，用于丢弃失效前已开始加载的结果
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0, "uncacheable": 0}
+
+    def get(self, key):
+        """返回 (命中?, 值)"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._data.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return True, entry[1]
+                del self._data[key]
+                self._stats["expirations"] += 1
+            self._stats["misses"] += 1
+            return False, None
+
+    def put(self, key, value, ttl, tags=(), generation=None):
+        if ttl <= 0:
+            return
+        if isinstance(value, list) and len(value) > self.max_entry_rows:
+            with self._lock:
+                self._stats["uncacheable"] += 1
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                # 加载期间发生过写操作失效，结果可能已过时
+                return
+            self._data[key] = (time.monotonic() + ttl, value, frozenset(tags))
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def get_or_load(self, key, loader, ttl, tags=()):
+        hit, value = self.get(key)
+        if hit:
+            return value
+        with self._lock:
+            generation = self._generation
+        value = loader()
+        self.put(key, value, ttl, tags, generation)
+        return value
+
+    def invalidate(self, *tags):
+        """删除所有带有任一给定标签的缓存项；不传标签则清空"""
+        with self._lock:
+            self._generation += 1
+            if not tags:
+                removed = len(self._data)
+                self._data.clear()
+            else:
+                tags = set(tags)
+                stale = [k for k, (_, _, t) in self._data.items() if t & tags]
+                for k in stale:
+                    del self._data[k]
+                removed = len(stale)
+            self._stats["invalidations"] += removed
+        return removed
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["entries"] = len(self._data)
+        lookups = s["hits"] + s["misses"]
+        s["hit_ratio"] = round(s["hits"] / lookups, 3) if lookups else 0.0
+        return s
+
+
+_cache = TTLCache()
+
+
+def fetch_all(db_config, cursor, sql, params=None, ttl=5.0, tags=()):
+    """
+    带缓存的 cursor.execute + fetchall。
+    tags 为该查询读到的表名，写这些表的函数会调用 invalidate(表名) 使其失效。
+    """
+    # 游标类型 (元组 / 字典行) 决定结果的形状；querystats 包装的游标取其内部游标的类型
+    raw = getattr(cursor, "_raw", cursor)
+    key = (db.config_key(db_config), type(raw).__name__, " ".join(sql.split()), tuple(params) if params else ())
+
+    def load():
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    return _cache.get_or_load(key, load, ttl, tags)
+
+
+def fetch_one(db_config, cursor, sql, params=None, ttl=5.0, tags=()):
+    rows = fetch_all(db_config, cursor, sql, params, ttl, tags)
+    return rows[0] if rows else None
+
+
+def get_or_load(db_config, name, loader, ttl=5.0, tags=()):
+    """
+    缓存任意加载结果 (如由多条查询组装的快照)，name 区分不同的结果；
+    不是行列表的结果不受 MAX_ENTRY_ROWS 限制，调用方同样只读
+    """
+    return _cache.get_or_load((db.config_key(db_config), name), loader, ttl, tags)
+
+
+def invalidate(*tags):
+    return _cache.invalidate(*tags)
+
+
+def stats():
+    return _cache.stats()
@@ -0,0 +1,80 @@
+"""
+容量汇总表 (capacity_summary，迁移 0006) 的读取与对账
+
+    python capacity.py --host localhost --user root --password xxx --database cloud --interval 300
+
+汇总表只统计 status = 'online' 的节点 (迁移 0018)，由 npus / memory 上的触发器随每次分配 / 释放 / 上下线增量更新；
+对账任务定期调用 sp_capacity_reconcile 全量重算并比对，发现漂移时记录日志并 (默认) 用重算结果修正。输出为每轮一行 JSON。
+"""
+import argparse
+import json
+import logging
+import time
+
+import cache
+import db
+
+log = logging.getLogger("capacity")
+
+# 每个队列一行：总量 / 剩余 / 已用 以及 空闲 / 满载 / 碎片化节点数，代价 O(队列数)
+SQL_QUEUE_CAPACITY = """
+    SELECT queue_type, total_nodes, idle_nodes, full_nodes, fragmented_nodes,
+           total_cores, free_cores, used_cores, total_gpu_mem, free_gpu_mem, used_gpu_mem,
+           mem_modules, total_ram, free_ram, used_ram
+    FROM v_queue_capacity
+    ORDER BY queue_type
+"""
+
+RECONCILE_INTERVAL = 300
+
+
+def queue_capacity(db_config, cursor, ttl=10.0):
+    """资源池监控使用的按队列汇总 (需配合 dictionary=True 的游标)"""
+    return cache.fetch_all(db_config, cursor, SQL_QUEUE_CAPACITY, ttl=ttl, tags=("npus", "memory"))
+
+
+def reconcile(db_config, fix=True):
+    """全量重算并与汇总表比对，返回漂移 [{'queue_type', 'slot', 'expected', 'actual'}, ...]"""
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        cursor.callproc('sp_capacity_reconcile', [1 if fix else 0])
+        drift = [
+            {"queue_type": q, "slot": slot,
+             "expected": json.loads(expected) if expected else None,
+             "actual": json.loads(actual) if actual else None}
+            for result in cursor.stored_results() for q, slot, expected, actual in result.fetchall()
+        ]
+    finally:
+        cursor.close()
+        conn.close()
+    if drift and fix:
+        cache.invalidate("npus", "memory")
+    return drift
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--user", default="root")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--database", default="cloud")
+    parser.add_argument("--interval", type=float, default=RECONCILE_INTERVAL, help="对账间隔 (秒)，0 表示只运行一次")
+    parser.add_argument("--no-fix", action="store_true", help="只报告漂移，不修正")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    db_config = {"host": args.host, "user": args.user, "password": args.password,
+                 "database": args.database, "charset": "utf8mb4", "collation": "utf8mb4_0900_ai_ci"}
+    while True:
+        drift = reconcile(db_config, fix=not args.no_fix)
+        if drift:
+            log.warning("capacity_summary drift in %d slot(s)%s", len(drift), "" if args.no_fix else ", fixed")
+        print(json.dumps({"at": time.strftime("%Y-%m-%d %H:%M:%S"), "drift": drift}, ensure_ascii=False), flush=True)
+        if args.interval <= 0:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import numpy as np
+
+import cache
+
+# ================= 套餐目录的实时可用量 =================
+#
+# packages.VM_PACKAGES 是静态的，"资源申请" 页上的套餐即使当前没有任何节点放得下也照常可提交，
+# 直到管理员审批时 sp_create_instance 分配失败用户才知道。这里估算每个套餐此刻还能再放几个：
+# - NPU：每台 online 节点能放 min(剩余核数 // 核数, 剩余显存 // 显存) 个，按队列求和
+# - 内存：每个 online 内存行能放 剩余量 // 内存 个，按队列求和
+# - 磁盘：存储卷不分队列，每个 online 卷 (各分片之和，见 v_storage_capacity) 能放 剩余量 // 磁盘 个
+# 三者取最小。各维度独立计算 (与分配时逐个选行一致)，多个实例同时挤占同一节点的情况不考虑，是上界估计。
+#
+# 快照是三张表剩余量的 NumPy 数组，整体放进查询缓存 (按表标签随分配 / 释放失效)；
+# 估算对每个队列做一次 节点 x 套餐 的广播整除，不逐节点查询，几万个节点也只是毫秒级。
+
+SNAPSHOT_TTL = 10
+
+SQL_NPU_FREE = "SELECT queue_type, available_cores, available_memory FROM npus WHERE status = 'online'"
+SQL_MEMORY_FREE = "SELECT queue_type, available_size FROM memory WHERE status = 'online'"
+SQL_STORAGE_FREE = "SELECT available_size FROM v_storage_capacity WHERE status = 'online'"
+
+# 限制因素 -> 提示
+LIMITS = {"cores": "CPU 核数", "gpu_mem": "显存", "ram": "内存", "disk": "磁盘"}
+
+
+def _rows(cursor, sql):
+    cursor.execute(sql)
+    rows = cursor.fetchall()
+    # prefetch 提供的是 dictionary=True 的游标
+    return [tuple(r.values()) if isinstance(r, dict) else r for r in rows]
+
+
+def _by_queue(rows):
+    """[(queue, v1, v2, ...), ...] -> {queue: int64 数组 (行数, 列数)}"""
+    if not rows:
+        return {}
+    queues = np.array([r[0] for r in rows])
+    values = np.array([r[1:] for r in rows], dtype=np.int64)
+    names, inverse = np.unique(queues, return_inverse=True)
+    return {name: values[inverse == i] for i, name in enumerate(names)}
+
+
+def load_snapshot(cursor):
+    npus = _by_queue(_rows(cursor, SQL_NPU_FREE))
+    memory = _by_queue(_rows(cursor, SQL_MEMORY_FREE))
+    disk = np.array([r[0] for r in _rows(cursor, SQL_STORAGE_FREE)], dtype=np.int64)
+    return {"npus": npus, "memory": memory, "disk": disk}
+
+
+def snapshot(db_config, cursor, ttl=SNAPSHOT_TTL):
+    """剩余量快照 (带缓存)，签名与 cache.fetch_all 一致，可直接交给 prefetch"""
+    return cache.get_or_load(db_config, "catalog_snapshot", lambda: load_snapshot(cursor), ttl,
+                             tags=("npus", "memory", "storagevolume"))
+
+
+def _need(packages, field, default):
+    return np.array([p['db_params'].get(field, default) for p in packages], dtype=np.int64)
+
+
+def estimates(snap, vm_packages):
+    """
+    {套餐键: {"fits": 还能放几个, "limited_by": LIMITS 的键 (fits 为 0 时), "by_dim": {维度: 个数}}}
+    """
+    flat = [(key, pkg) for pkgs in vm_packages.values() for key, pkg in pkgs.items()]
+    result = {}
+    disk_free = snap["disk"]
+    for queue in sorted({pkg['queue'] for _, pkg in flat}):
+        keys = [key for key, pkg in flat if pkg['queue'] == queue]
+        pkgs = [pkg for key, pkg in flat if pkg['queue'] == queue]
+        cores, gpu = _need(pkgs, 'req_cores', 1), _need(pkgs, 'req_gpu_mem', 0)
+        ram, disk = _need(pkgs, 'req_ram', 1), _need(pkgs, 'req_disk', 0)
+
+        npu = snap["npus"].get(queue, np.zeros((0, 2), dtype=np.int64))
+        by_cores = npu[:, :1] // np.maximum(cores, 1)
+        # 不要求显存的套餐不受显存限制
+        by_gpu = np.where(gpu > 0, npu[:, 1:2] // np.maximum(gpu, 1), by_cores)
+        per_node = np.minimum(by_cores, by_gpu)
+        fits = {
+            "cores": by_cores.sum(axis=0),
+            "gpu_mem": per_node.sum(axis=0),
+            "ram": (snap["memory"].get(queue, np.zeros((0, 1), dtype=np.int64))[:, :1]
+                    // np.maximum(ram, 1)).sum(axis=0),
+            "disk": np.where(disk > 0, (disk_free[:, None] // np.maximum(disk, 1)).sum(axis=0), np.iinfo(np.int64).max),
+        }
+        for j, key in enumerate(keys):
+            by_dim = {dim: int(v[j]) for dim, v in fits.items()}
+            total = min(by_dim.values())
+            result[key] = {
+                "fits": total,
+                "limited_by": min(by_dim, key=by_dim.get) if total == 0 else None,
+                "by_dim": by_dim,
+            }
+    return result
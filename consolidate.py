@@ -0,0 +1,403 @@
+"""
+物理节点碎片整理 (consolidation) 规划与执行
+
+    python consolidate.py --host localhost --user root --password xxx --database cloud plan --max-moves 200
+    python consolidate.py ... apply --max-moves 200 --queue gpuB
+
+advanced.sql 的碎片化报表只能看到 "碎片化节点"：用了一部分的节点，整机套餐 (如 a100_ultra 的 96 核 / 640G 显存)
+放不下，即便队列的剩余总量足够。这里读取 npus / memory 与仍在运行的实例的 virtualcpu / virtualmemory 映射，
+算出一组尽量少的实例迁移，腾空整台节点：
+
+- 源节点按 (实例数, 已用量) 从小到大逐个尝试腾空：它的实例从大到小，best-fit 放到其他已在使用的节点上
+  (不占用本来就空闲的节点)，全部放得下才采纳，否则撤销；接收过迁入的节点不再作为源节点，避免来回搬。
+  总迁移数不超过 max_moves
+- NPU (核数 + 显存，virtualcpu.NPU_id) 与内存 (virtualmemory.memory_id) 两个维度分别规划
+- 节点上有不属于运行实例的占用 (已用量与映射合计不一致) 时无法腾空，跳过
+- 规划结果附带模拟效果：碎片化 / 空闲节点数、按队列最大的整机套餐还能再放几个
+
+执行 (apply) 按源节点成组、每 batch_nodes 组一个事务：先锁实例行 (与释放的加锁顺序一致，
+避免释放在迁移中途按旧映射归还容量)，再锁物理行与映射行并复核，复核不过的组跳过 (STALE)，
+其余组批量改写映射、按节点汇总调整剩余量 (capacity_summary 由触发器同步)，并为实例所属用户写 use_log。
+"""
+import argparse
+import json
+import logging
+import time
+from bisect import bisect_left, insort
+from itertools import islice
+
+import cache
+import db
+import packages
+
+log = logging.getLogger("consolidate")
+
+MAX_MOVES = 200
+APPLY_BATCH_NODES = 20
+
+# 两个维度的表结构：物理行 (bins) 与映射行 (items)
+DIMENSIONS = {
+    "npu": {
+        "bins": "npus", "bin_id": "NPU_id", "capacity": ("cores", "NPU_memory"),
+        "free": ("available_cores", "available_memory"),
+        "items": "virtualcpu", "item_id": "vir_NPU_id", "size": ("virtual_cores", "virtual_memory"),
+        "vc_col": "vir_NPU_id",
+    },
+    "memory": {
+        "bins": "memory", "bin_id": "memory_id", "capacity": ("memory_size",), "free": ("available_size",),
+        "items": "virtualmemory", "item_id": "vir_memory_id", "size": ("virtual_size",),
+        "vc_col": "vir_memory_id",
+    },
+}
+
+
+def full_node_packages(vm_packages):
+    """每个队列最大的套餐 (按核数)：{queue: (名称, 核数, 显存, 内存)}；vm_packages 即 packages.VM_PACKAGES"""
+    packages = {}
+    for pkgs in (vm_packages or {}).values():
+        for key, pkg in pkgs.items():
+            p = pkg['db_params']
+            size = (p.get('req_cores', 1), p.get('req_gpu_mem', 0), p.get('req_ram', 1))
+            if pkg['queue'] not in packages or size > packages[pkg['queue']][1:]:
+                packages[pkg['queue']] = (key, *size)
+    return packages
+
+
+# ================= 读取当前状态 =================
+
+def load_state(cursor, queue=None):
+    """
+    {queue: {dim: {"bins": {bin_id: (容量, 剩余)}, "items": {bin_id: [(item_id, node_id, 大小), ...]}}}}
+    只包含 online 的物理行与运行中实例的映射
+    """
+    state = {}
+    for dim, d in DIMENSIONS.items():
+        where, args = ("AND queue_type = %s", (queue,)) if queue else ("", ())
+        cursor.execute(f"""
+            SELECT {d['bin_id']}, queue_type, {', '.join(d['capacity'])}, {', '.join(d['free'])}
+            FROM {d['bins']} WHERE status = 'online' {where}
+        """, args)
+        n = len(d['capacity'])
+        owner = {}
+        for row in cursor.fetchall():
+            bin_id, q = row[0], row[1]
+            state.setdefault(q, {k: {"bins": {}, "items": {}} for k in DIMENSIONS})
+            state[q][dim]["bins"][bin_id] = (tuple(row[2:2 + n]), tuple(row[2 + n:]))
+            owner[bin_id] = q
+        cursor.execute(f"""
+            SELECT i.{d['item_id']}, i.{d['bin_id']}, vc.node_id, {', '.join('i.' + c for c in d['size'])}
+            FROM {d['items']} i
+            JOIN virtualcomputers vc ON vc.{d['vc_col']} = i.{d['item_id']}
+            WHERE i.status = 'allocated' AND vc.status = 'running'
+        """)
+        for row in cursor.fetchall():
+            q = owner.get(row[1])
+            if q is not None:
+                state[q][dim]["items"].setdefault(row[1], []).append((row[0], row[2], tuple(row[3:])))
+    return state
+
+
+# ================= 规划 =================
+
+def _fits(free, size):
+    return all(f >= s for f, s in zip(free, size))
+
+
+def _sub(a, b):
+    return tuple(x - y for x, y in zip(a, b))
+
+
+def _add(a, b):
+    return tuple(x + y for x, y in zip(a, b))
+
+
+class _FreeIndex:
+    """
+    best-fit 索引：按首维剩余量分桶，桶内按其余维度 (NPU 为显存) 排序。
+    best_fit 从放得下的最小首维桶开始，每桶一次 bisect，返回首维剩余最小、其次次维剩余最小的行；
+    剩余量的不同取值远少于节点数，规划后期大量放不下的尝试也不必扫描全部节点
+    """
+
+    def __init__(self):
+        self.firsts = []   # 有行的首维剩余量，升序
+        self.buckets = {}  # 首维剩余量 -> [(其余维度..., bin_id), ...] 升序
+        self.free = {}
+
+    def set(self, bin_id, free):
+        self.drop(bin_id)
+        self.free[bin_id] = free
+        bucket = self.buckets.get(free[0])
+        if bucket is None:
+            bucket = self.buckets[free[0]] = []
+            insort(self.firsts, free[0])
+        insort(bucket, (*free[1:], bin_id))
+
+    def drop(self, bin_id):
+        old = self.free.pop(bin_id, None)
+        if old is None:
+            return
+        bucket = self.buckets[old[0]]
+        del bucket[bisect_left(bucket, (*old[1:], bin_id))]
+        if not bucket:
+            del self.buckets[old[0]]
+            del self.firsts[bisect_left(self.firsts, old[0])]
+
+    def best_fit(self, size):
+        rest = tuple(size[1:])
+        for first in islice(self.firsts, bisect_left(self.firsts, size[0]), None):
+            bucket = self.buckets[first]
+            # 最多两维：桶内按次维排序，bisect 之后的第一个即放得下
+            j = bisect_left(bucket, rest)
+            if j < len(bucket):
+                return bucket[j][-1]
+        return None
+
+
+def plan_dimension(bins, items, max_moves=MAX_MOVES):
+    """
+    bins: {bin_id: (容量, 剩余)}；items: {bin_id: [(item_id, node_id, 大小), ...]}
+    返回 (moves, freed, free_after)：moves 为 [(item_id, node_id, 源, 目标, 大小), ...]，按源节点成组
+    """
+    free = {b: f for b, (_, f) in bins.items()}
+    used = {b: _sub(cap, f) for b, (cap, f) in bins.items()}
+    in_use = [b for b in bins if any(used[b])]
+
+    index = _FreeIndex()
+    for b in in_use:
+        index.set(b, free[b])
+
+    # 只有已用量完全由运行实例构成的节点才可能腾空
+    sources = [b for b in in_use
+               if items.get(b) and _add_all(s for _, _, s in items[b]) == used[b] and any(free[b])]
+    sources.sort(key=lambda b: (len(items[b]), used[b], b))
+
+    moves, freed, received = [], [], set()
+    for src in sources:
+        if src in received:
+            continue
+        group = sorted(items[src], key=lambda it: it[2], reverse=True)
+        if len(moves) + len(group) > max_moves:
+            break
+        index.drop(src)
+        tentative = []
+        for item_id, node_id, size in group:
+            dst = index.best_fit(size)
+            if dst is None:
+                break
+            tentative.append((item_id, node_id, src, dst, size))
+            index.set(dst, _sub(index.free[dst], size))
+        if len(tentative) < len(group):
+            for _, _, _, dst, size in tentative:
+                index.set(dst, _add(index.free[dst], size))
+            index.set(src, free[src])
+            continue
+        for move in tentative:
+            received.add(move[3])
+        moves.extend(tentative)
+        freed.append(src)
+
+    free_after = dict(free)
+    for _, _, src, dst, size in moves:
+        free_after[src] = _add(free_after[src], size)
+        free_after[dst] = _sub(free_after[dst], size)
+    return moves, freed, free_after
+
+
+def _add_all(sizes):
+    total = None
+    for s in sizes:
+        total = s if total is None else _add(total, s)
+    return total
+
+
+def fragmentation(bins, free=None):
+    """{'idle', 'full', 'fragmented'}：与 v_queue_capacity 的口径一致 (按首维)"""
+    counts = {"idle": 0, "full": 0, "fragmented": 0}
+    for b, (cap, f) in bins.items():
+        f = free[b] if free is not None else f
+        if f[0] >= cap[0]:
+            counts["idle"] += 1
+        elif f[0] <= 0:
+            counts["full"] += 1
+        else:
+            counts["fragmented"] += 1
+    return counts
+
+
+def package_fits(npu_free, mem_free, package):
+    """还能放下几个 package (核数, 显存, 内存)：每台节点放得下的个数之和，NPU 与内存取较小者"""
+    _, cores, gpu_mem, ram = package
+    npu = sum(min(f[0] // cores if cores else 10 ** 9, f[1] // gpu_mem if gpu_mem else 10 ** 9)
+              for f in npu_free.values())
+    mem = sum(f[0] // ram for f in mem_free.values()) if ram else npu
+    return min(npu, mem)
+
+
+def plan(state, max_moves=MAX_MOVES, vm_packages=None):
+    """
+    按队列规划，返回 {queue: {...报表..., "moves": {dim: [...]}}}；
+    max_moves 为每个队列、每个维度的迁移上限，给出 vm_packages 时附带整机套餐可放数量
+    """
+    packages = full_node_packages(vm_packages)
+    result = {}
+    for q, dims in state.items():
+        t0 = time.perf_counter()
+        report = {"moves": {}}
+        free_before, free_after = {}, {}
+        for dim in DIMENSIONS:
+            bins, items = dims[dim]["bins"], dims[dim]["items"]
+            moves, freed, after = plan_dimension(bins, items, max_moves)
+            report["moves"][dim] = moves
+            report[f"{dim}_moves"] = len(moves)
+            report[f"{dim}_freed"] = freed
+            report[f"{dim}_before"] = fragmentation(bins)
+            report[f"{dim}_after"] = fragmentation(bins, after)
+            free_before[dim] = {b: f for b, (_, f) in bins.items()}
+            free_after[dim] = after
+        package = packages.get(q)
+        if package:
+            report["package"] = package[0]
+            report["fits_before"] = package_fits(free_before["npu"], free_before["memory"], package)
+            report["fits_after"] = package_fits(free_after["npu"], free_after["memory"], package)
+        report["plan_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        result[q] = report
+    return result
+
+
+def summary(plans):
+    """去掉迁移明细、腾空节点只计数的报表，供界面 / 命令行输出"""
+    return {q: {k: len(v) if k.endswith("_freed") else v for k, v in p.items() if k != "moves"}
+            for q, p in plans.items()}
+
+
+# ================= 执行 =================
+
+def _groups(moves):
+    """按源节点成组 (一台节点的迁移要么全部执行，要么全部跳过)"""
+    groups = {}
+    for move in moves:
+        groups.setdefault(move[2], []).append(move)
+    return list(groups.values())
+
+
+def _apply_batch(conn, cursor, dim, groups):
+    d = DIMENSIONS[dim]
+    moves = [m for g in groups for m in g]
+    node_ids = sorted({m[1] for m in moves})
+    bin_ids = sorted({m[2] for m in moves} | {m[3] for m in moves})
+    item_ids = sorted(m[0] for m in moves)
+
+    def ph(values):
+        return ", ".join(["%s"] * len(values))
+
+    conn.start_transaction(isolation_level="READ COMMITTED")
+    cursor.execute(f"SELECT node_id, status FROM virtualcomputers WHERE node_id IN ({ph(node_ids)}) "
+                   "ORDER BY node_id FOR UPDATE", node_ids)
+    running = {r[0] for r in cursor.fetchall() if r[1] == 'running'}
+    cursor.execute(f"SELECT {d['bin_id']}, {', '.join(d['free'])}, status FROM {d['bins']} "
+                   f"WHERE {d['bin_id']} IN ({ph(bin_ids)}) ORDER BY {d['bin_id']} FOR UPDATE", bin_ids)
+    free = {r[0]: tuple(r[1:-1]) for r in cursor.fetchall() if r[-1] == 'online'}
+    cursor.execute(f"SELECT {d['item_id']}, {d['bin_id']}, {', '.join(d['size'])}, status FROM {d['items']} "
+                   f"WHERE {d['item_id']} IN ({ph(item_ids)}) FOR UPDATE", item_ids)
+    current = {r[0]: (r[1], tuple(r[2:-1])) for r in cursor.fetchall() if r[-1] == 'allocated'}
+
+    results, applied = [], []
+    for group in groups:
+        src = group[0][2]
+        ok = src in free and all(
+            m[1] in running and current.get(m[0]) == (src, m[4]) and m[3] in free for m in group)
+        trial = dict(free)
+        if ok:
+            for _, _, _, dst, size in group:
+                trial[dst] = _sub(trial[dst], size)
+                trial[src] = _add(trial[src], size)
+            ok = all(min(f) >= 0 for f in trial.values())
+        if ok:
+            free = trial
+            applied.extend(group)
+        results.append({"dimension": dim, "source": src, "moves": len(group), "result": "APPLIED" if ok else "STALE"})
+
+    if applied:
+        cursor.executemany(f"UPDATE {d['items']} SET {d['bin_id']} = %s WHERE {d['item_id']} = %s",
+                           [(m[3], m[0]) for m in applied])
+        deltas = {}
+        for _, _, src, dst, size in applied:
+            zero = tuple(0 for _ in size)
+            deltas[src] = _add(deltas.get(src, zero), size)
+            deltas[dst] = _sub(deltas.get(dst, zero), size)
+        sets = ", ".join(f"{c} = {c} + %s" for c in d['free'])
+        cursor.executemany(f"UPDATE {d['bins']} SET {sets} WHERE {d['bin_id']} = %s",
+                           [(*delta, b) for b, delta in sorted(deltas.items())])
+        cursor.executemany("""
+            INSERT INTO use_log (user_id, action, details)
+            SELECT r.user_id, 'consolidate', %s
+            FROM virtualcomputers vc JOIN requests r ON r.request_id = vc.request_id
+            WHERE vc.node_id = %s
+        """, [(f"NodeID:{m[1]} {d['bins']} {m[2]}->{m[3]}", m[1]) for m in applied])
+    conn.commit()
+    return results
+
+
+def apply(db_config, plans, batch_nodes=APPLY_BATCH_NODES):
+    """执行 plan() 的结果，返回逐组结果 [{'queue', 'dimension', 'source', 'moves', 'result'}, ...]"""
+    report = []
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        for q, p in plans.items():
+            for dim, moves in p["moves"].items():
+                groups = _groups(moves)
+                for i in range(0, len(groups), batch_nodes):
+                    try:
+                        results = _apply_batch(conn, cursor, dim, groups[i:i + batch_nodes])
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    report.extend({"queue": q, **r} for r in results)
+                    log.info("%s %s: %d groups applied, %d stale", q, dim,
+                             sum(r["result"] == "APPLIED" for r in results),
+                             sum(r["result"] == "STALE" for r in results))
+    finally:
+        cursor.close()
+        conn.close()
+        cache.invalidate("npus", "memory", "virtualcpu", "virtualmemory", "use_log")
+    return report
+
+
+def plan_from_db(db_config, queue=None, max_moves=MAX_MOVES, vm_packages=None):
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        state = load_state(cursor, queue)
+    finally:
+        cursor.close()
+        conn.close()
+    return plan(state, max_moves, vm_packages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--user", default="root")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--database", default="cloud")
+    parser.add_argument("--queue", default=None, help="只处理一个队列")
+    parser.add_argument("--max-moves", type=int, default=MAX_MOVES, help="每个队列、每个维度的迁移上限")
+    parser.add_argument("--batch-nodes", type=int, default=APPLY_BATCH_NODES, help="执行时每个事务腾空的节点数")
+    parser.add_argument("command", choices=("plan", "apply"))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    db_config = {"host": args.host, "user": args.user, "password": args.password,
+                 "database": args.database, "charset": "utf8mb4", "collation": "utf8mb4_0900_ai_ci"}
+    plans = plan_from_db(db_config, args.queue, args.max_moves, packages.VM_PACKAGES)
+    result = {"plan": summary(plans)}
+    if args.command == "apply":
+        applied = apply(db_config, plans, args.batch_nodes)
+        result["applied"] = sum(r["moves"] for r in applied if r["result"] == "APPLIED")
+        result["stale_groups"] = sum(1 for r in applied if r["result"] == "STALE")
+    print(json.dumps(result, ensure_ascii=False, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import mysql.connector
+from mysql.connector import Error
+from mysql.connector.errors import PoolError
+
+import querystats
+
+# ================= 连接池配置 =================
+
+# 进程级默认参数，可在 fore.py 中通过 configure() 覆盖
+POOL_SETTINGS = {
+    "pool_size": 8,               # 每个 DB_CONFIG 最多保持的物理连接数
+    "checkout_timeout": 10.0,     # 连接全部被占用时最长等待秒数
+    "health_check_interval": 5.0  # 空闲超过该秒数的连接在借出前先 ping 一次 (0 表示每次都检查)
+}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def config_key(db_config):
+    """把 DB_CONFIG 字典转换为可哈希的连接池键"""
+    return tuple(sorted((k, str(v)) for k, v in db_config.items()))
+
+
+# ================= 连接池实现 =================
+
+class PooledConnection:
+    """
+    借出的连接代理：行为与 mysql.connector 连接一致，
+    但 close() 不会真正断开，而是归还给连接池。
+    """
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+        self._last_fingerprint = None  # 最近执行的语句，rollback() 计在它上面
+
+    def __getattr__(self, name):
+        if self._raw is None:
+            raise PoolError("连接已归还连接池，不能继续使用")
+        return getattr(self._raw, name)
+
+    def cursor(self, *args, **kwargs):
+        """游标经 querystats 计时 (见 querystats.py)"""
+        if self._raw is None:
+            raise PoolError("连接已归还连接池，不能继续使用")
+        return querystats.wrap_cursor(self._raw.cursor(*args, **kwargs), self)
+
+    def rollback(self):
+        if self._raw is None:
+            raise PoolError("连接已归还连接池，不能继续使用")
+        querystats.record_rollback(self._last_fingerprint)
+        return self._raw.rollback()
+
+    def close(self):
+        if self._raw is not None:
+            raw, self._raw = self._raw, None
+            self._pool.release(raw)
+
+    def discard(self):
+        """连接状态不可信时直接丢弃，不再放回池中"""
+        if self._raw is not None:
+            raw, self._raw = self._raw, None
+            self._pool.release(raw, discard=True)
+
+    def __del__(self):
+        # 兜底：st.rerun()/st.stop() 以异常方式跳出渲染函数时，确保连接仍能回到池中
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class ConnectionPool:
+    """
+    线程安全的 MySQL 连接池：
+    - 空闲连接按 LIFO 复用，尽量命中最近仍然存活的连接
+    - 借出前对空闲较久的连接做 ping 健康检查，失效则自动重建
+    - 归还时回滚未提交事务，避免下一个使用者看到旧的一致性快照
+    """
+
+    def __init__(self, db_config, pool_size=8, checkout_timeout=10.0, health_check_interval=5.0):
+        if pool_size < 1:
+            raise ValueError("pool_size 必须 >= 1")
+        self.db_config = dict(db_config)
+        self.pool_size = pool_size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+
+        self._idle = deque()  # 元素: (raw_conn, last_used_monotonic)
+        self._open = 0        # 当前存活(空闲 + 借出)的物理连接数
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,        # 成功借出次数
+            "waits": 0,            # 因池满而需要等待的借出次数
+            "wait_time_total": 0.0,
+            "timeouts": 0,         # 等待超时次数
+            "created": 0,          # 新建物理连接次数
+            "reconnects": 0,       # 健康检查失败后重建次数
+            "discarded": 0,        # 因异常被丢弃的连接数
+        }
+
+    def _connect(self):
+        raw = mysql.connector.connect(**self.db_config)
+        with self._cond:
+            self._stats["created"] += 1
+        return raw
+
+    def _ensure_healthy(self, raw, last_used):
+        if time.monotonic() - last_used < self.health_check_interval:
+            return raw
+        try:
+            raw.ping(reconnect=False)
+            return raw
+        except Error:
+            try:
+                raw.close()
+            except Error:
+                pass
+            with self._cond:
+                self._stats["reconnects"] += 1
+            return self._connect()
+
+    def acquire(self, timeout=None):
+        timeout = self.checkout_timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        waited = False
+        raw, last_used = None, None
+
+        with self._cond:
+            while True:
+                if self._idle:
+                    raw, last_used = self._idle.pop()
+                    break
+                if self._open < self.pool_size:
+                    # 先占位，真正的 connect() 放到锁外执行
+                    self._open += 1
+                    break
+                if not waited:
+                    waited = True
+                    self._stats["waits"] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolError(f"连接池已耗尽 (pool_size={self.pool_size})，等待 {timeout:.1f}s 超时")
+                self._cond.wait(remaining)
+
+        try:
+            if raw is None:
+                raw = self._connect()
+            else:
+                raw = self._ensure_healthy(raw, last_used)
+        except Error:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._stats["checkouts"] += 1
+            if waited:
+                self._stats["wait_time_total"] += time.monotonic() - start
+        return PooledConnection(self, raw)
+
+    def release(self, raw, discard=False):
+        if not discard:
+            try:
+                # 结束遗留事务；即便只做过 SELECT，也要释放 REPEATABLE READ 快照
+                raw.rollback()
+            except Error:
+                discard = True
+
+        if discard:
+            try:
+                raw.close()
+            except Error:
+                pass
+
+        with self._cond:
+            if discard:
+                self._open -= 1
+                self._stats["discarded"] += 1
+            else:
+                self._idle.append((raw, time.monotonic()))
+            self._cond.notify()
+
+    def close_all(self):
+        """关闭所有空闲连接 (借出中的连接在归还后照常入池)"""
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+            self._open -= len(idle)
+        for raw, _ in idle:
+            try:
+                raw.close()
+            except Error:
+                pass
+
+    def metrics(self):
+        with self._cond:
+            m = dict(self._stats)
+            m["pool_size"] = self.pool_size
+            m["open"] = self._open
+            m["idle"] = len(self._idle)
+            m["in_use"] = self._open - len(self._idle)
+        m["avg_wait_ms"] = round(m["wait_time_total"] / m["waits"] * 1000, 2) if m["waits"] else 0.0
+        return m
+
+
+# ================= 模块级接口 =================
+
+def configure(**settings):
+    """更新连接池参数；只影响之后新建的连接池"""
+    unknown = set(settings) - set(POOL_SETTINGS)
+    if unknown:
+        raise ValueError(f"未知的连接池参数: {', '.join(sorted(unknown))}")
+    POOL_SETTINGS.update(settings)
+
+
+def get_pool(db_config):
+    key = config_key(db_config)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(db_config, **POOL_SETTINGS)
+                _pools[key] = pool
+    return pool
+
+
+def get_connection(db_config):
+    """从进程级连接池借出连接，调用方使用完毕后 close() 即归还"""
+    return get_pool(db_config).acquire()
+
+
+@contextmanager
+def connection(db_config):
+    """
+    上下文管理器形式：
+        with db.connection(DB_CONFIG) as conn:
+            ...
+    退出时自动归还；未 commit 的修改会被回滚。
+    """
+    conn = get_connection(db_config)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def pool_metrics(db_config=None):
+    """返回连接池指标；不传 db_config 时返回所有连接池 {host/database: metrics}"""
+    if db_config is not None:
+        return get_pool(db_config).metrics()
+    with _pools_lock:
+        pools = list(_pools.values())
+    return {f"{p.db_config.get('host')}/{p.db_config.get('database')}": p.metrics() for p in pools}
@@ -1,11 +1,13 @@
 import streamlit as st
 import pandas as pd
-import mysql.connector
 from mysql.connector import Error
 
 # 导入拆分后的模块
+import db
+import replica
 import user as user_view
 import admin as admin_view
+from packages import VM_PACKAGES
 
 # ================= 1. 配置与常量定义 =================
 
@@ -21,45 +23,28 @@ DB_CONFIG = {
     "collation": "utf8mb4_0900_ai_ci"
 }
 
-# 硬件节点配置 - 必须与 init.sql 中的资源池匹配
-VM_PACKAGES = {
-    "gpu": {
-        "v100_std": {
-            "name": "V100 标准计算节点",
-            "queue": "gpu_v100", 
-            "desc": "适用于深度学习训练，单卡独占",
-            "specs": {"显卡": "V100 32GB", "CPU": "24 Cores", "内存": "512 GB", "磁盘": "200 GB"},
-            "db_params": {"req_cores": 24, "req_gpu_mem": 32, "req_ram": 512, "req_disk": 200},
-            "price": 15.0
-        },
-        "a100_ultra": {
-            "name": "A100 高性能集群",
-            "queue": "gpuB",
-            "desc": "全节点独占，超大显存模型训练",
-            "specs": {"显卡": "A100 80GB x 8", "CPU": "96 Cores", "内存": "1 TB", "磁盘": "2 TB"},
-            "db_params": {"req_cores": 96, "req_gpu_mem": 640, "req_ram": 1024, "req_disk": 2000},
-            "price": 50.0
-        }
-    },
-    "cpu": {
-        "cpu_general": {
-            "name": "通用计算节点 (6126)",
-            "queue": "cpu_6126",
-            "specs": {"CPU": "Xeon 6126 (24核)", "内存": "192 GB", "磁盘": "100 GB"},
-            "db_params": {"req_cores": 24, "req_gpu_mem": 0, "req_ram": 192, "req_disk": 100},
-            "price": 3.0
-        }
-    }
+# 连接池配置 - 所有模块共享同一个进程级连接池
+POOL_CONFIG = {
+    "pool_size": 8,
+    "checkout_timeout": 10.0,
+    "health_check_interval": 5.0
 }
+db.configure(**POOL_CONFIG)
+
+# 读副本配置 - 仪表盘与报表的只读查询分流到副本，写操作 / 存储过程 / 刚写过数据的会话仍走主库；
+# replicas 为空时全部走主库。每项只写与 DB_CONFIG 不同的参数，例如 [{"host": "10.0.0.2"}, {"port": 3307}]
+REPLICA_CONFIG = {
+    "replicas": [],
+    "max_lag": 5.0  # 秒，延迟超过该值的副本不参与分流
+}
+replica.configure(DB_CONFIG, **REPLICA_CONFIG)
 
 # ================= 2. 数据库连接辅助 =================
 
 def get_connection():
-    """获取 MySQL 数据库连接"""
+    """从共享连接池获取 MySQL 数据库连接"""
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        if conn.is_connected():
-            return conn
+        return db.get_connection(DB_CONFIG)
     except Error as e:
         st.error(f"数据库连接失败: {e}")
         return None
@@ -98,7 +83,7 @@ def main():
 
     # 3. 路由分发
     if current_user['role'] == 'admin':
-        admin_view.render_admin_dashboard(DB_CONFIG)
+        admin_view.render_admin_dashboard(DB_CONFIG, VM_PACKAGES)
     else:
         user_view.render_user_dashboard(DB_CONFIG, current_user, VM_PACKAGES)
 
@@ -6,6 +6,8 @@
  File Encoding         : 65001
  
  Description: Cloud Resource Management - Large Scale Simulation Data
+
+ 本文件为基线结构 (迁移版本 0)，导入后执行 python migrate.py ... up 应用 migrations/ 下的增量变更
 */
 
 CREATE DATABASE IF NOT EXISTS `cloud`;
@@ -0,0 +1,157 @@
+"""
+周期计量计费 + 用户余额风险表 (迁移 0007)
+
+    python metering.py --host localhost --user root --password xxx --database cloud \\
+        --interval 60 --chunk 1000 --on-exhausted flag
+
+每轮：
+- sp_meter_usage：集合式地为所有 running 实例结算 (上次计量截止, 当前整点] 的用量 (迁移 0016)，按 node_id 分块，
+  每块一个事务批量写入 unpaid 账单并推进 virtualcomputers.metered_until；每个实例每小时至多一张计量账单，
+  同一小时内的后续轮次不出账；释放实例时 sp_release_resource 只对 metered_until 之后的部分出最后一张账单
+- sp_refresh_balance_risk：重建 user_balance_risk (每小时消耗、可用余额、预计耗尽时间、风险等级)，
+  风险报表与管理后台直接读这张表
+- 可用余额耗尽 (risk_level = 'exhausted') 的用户：
+  flag       把 users.status 置为 'overdrawn'，恢复后改回 'active'
+  terminate  同上，并终止其全部运行中实例 (与管理后台 "终止所选" 相同的路径)
+  none       只计量与刷新
+输出为每轮一行 JSON。
+"""
+import argparse
+import json
+import logging
+import time
+
+import cache
+import db
+import ops
+
+log = logging.getLogger("metering")
+
+METER_INTERVAL = 60
+METER_CHUNK = 1000
+EXHAUSTED_POLICIES = ("none", "flag", "terminate")
+
+# 风险报表：每个有运行实例或未付账单的用户一行，最危险的在前
+SQL_RISK_REPORT = """
+    SELECT ubr.user_id, u.user_name, ubr.balance, ubr.unpaid_amount, ubr.accrued_amount, ubr.available,
+           ubr.running_instances, ubr.burn_rate, ubr.hours_left, ubr.exhausted_at, ubr.risk_level, ubr.refreshed_at
+    FROM user_balance_risk ubr
+    JOIN users u ON u.user_id = ubr.user_id
+    WHERE ubr.risk_level IN ('exhausted', 'critical', 'warning')
+    ORDER BY FIELD(ubr.risk_level, 'exhausted', 'critical', 'warning'), ubr.hours_left
+"""
+
+SQL_EXHAUSTED_NODES = """
+    SELECT vc.node_id, vc.request_id
+    FROM user_balance_risk ubr
+    JOIN requests r ON r.user_id = ubr.user_id
+    JOIN virtualcomputers vc ON vc.request_id = r.request_id
+    WHERE ubr.risk_level = 'exhausted' AND vc.status = 'running'
+"""
+
+
+def meter(db_config, chunk=METER_CHUNK):
+    """结算一轮用量，返回 (出账实例数, 金额)；另一个计量进程正在运行时返回 (-1, 0)"""
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        _, instances, amount = cursor.callproc('sp_meter_usage', [int(chunk), 0, 0])
+    finally:
+        cursor.close()
+        conn.close()
+    if instances and instances > 0:
+        cache.invalidate("bills", "virtualcomputers")
+    return instances, amount
+
+
+def refresh_risk(db_config):
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        cursor.callproc('sp_refresh_balance_risk')
+    finally:
+        cursor.close()
+        conn.close()
+    cache.invalidate("user_balance_risk")
+
+
+def risk_report(db_config, cursor, ttl=10.0):
+    """余额风险列表 (需配合 dictionary=True 的游标)"""
+    return cache.fetch_all(db_config, cursor, SQL_RISK_REPORT, ttl=ttl, tags=("user_balance_risk", "users"))
+
+
+def enforce(db_config, policy="flag"):
+    """按策略处理可用余额耗尽的用户，返回 {'flagged', 'restored', 'terminated'}"""
+    summary = {"flagged": 0, "restored": 0, "terminated": 0}
+    if policy == "none":
+        return summary
+
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            UPDATE users u JOIN user_balance_risk ubr ON ubr.user_id = u.user_id
+            SET u.status = 'overdrawn'
+            WHERE ubr.risk_level = 'exhausted' AND u.status = 'active'
+        """)
+        summary["flagged"] = cursor.rowcount
+        cursor.execute("""
+            UPDATE users u LEFT JOIN user_balance_risk ubr ON ubr.user_id = u.user_id
+            SET u.status = 'active'
+            WHERE u.status = 'overdrawn' AND (ubr.user_id IS NULL OR ubr.risk_level <> 'exhausted')
+        """)
+        summary["restored"] = cursor.rowcount
+        conn.commit()
+        nodes = []
+        if policy == "terminate":
+            cursor.execute(SQL_EXHAUSTED_NODES)
+            nodes = cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.close()
+    if summary["flagged"] or summary["restored"]:
+        cache.invalidate("users")
+
+    if nodes:
+        report = ops.stop_instances(db_config, nodes, "terminate")
+        summary["terminated"] = sum(1 for item in report if item["result"] == "SUCCESS")
+        for item in report:
+            if item["result"] != "SUCCESS":
+                log.warning("terminate node %s: %s", item["node_id"], item["result"])
+    return summary
+
+
+def run_once(db_config, chunk=METER_CHUNK, policy="flag"):
+    instances, amount = meter(db_config, chunk)
+    if instances == -1:
+        log.info("another metering run holds the lock, skipped")
+        return {"skipped": True}
+    refresh_risk(db_config)
+    return {"instances": instances, "amount": amount, **enforce(db_config, policy)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--user", default="root")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--database", default="cloud")
+    parser.add_argument("--interval", type=float, default=METER_INTERVAL, help="计量间隔 (秒)，0 表示只运行一次")
+    parser.add_argument("--chunk", type=int, default=METER_CHUNK, help="每个事务结算的实例数")
+    parser.add_argument("--on-exhausted", choices=EXHAUSTED_POLICIES, default="flag")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    db_config = {"host": args.host, "user": args.user, "password": args.password,
+                 "database": args.database, "charset": "utf8mb4", "collation": "utf8mb4_0900_ai_ci"}
+    while True:
+        result = run_once(db_config, args.chunk, args.on_exhausted)
+        print(json.dumps({"at": time.strftime("%Y-%m-%d %H:%M:%S"), **result}, ensure_ascii=False, default=str),
+              flush=True)
+        if args.interval <= 0:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+"""
+数据库版本化迁移 + 固定查询的 EXPLAIN 回归检查
+
+init.sql 是基线 (版本 0)；之后的结构变更以 migrations/NNNN_说明.sql 的形式按编号顺序追加，
+已执行的版本记录在 schema_migrations 表中。迁移文件与 init.sql 写法一致，可以使用 DELIMITER 定义存储过程。
+init.sql 本身不再修改，任何结构变更都新增迁移文件，这样按原 init.sql 建的库也能直接 up；
+init.sql 开头会 DROP 业务表，重新导入前请先重建数据库 (DROP DATABASE)，否则 schema_migrations 会与实际结构不符。
+
+    python migrate.py --host localhost --user root --password xxx --database cloud up
+    python migrate.py ... status
+    python migrate.py ... check --scale 200000
+
+check 对仪表盘 / 分配器的固定查询逐条 EXPLAIN，任何一张表出现全表扫描 (type=ALL)
+或 Using filesort 即判定失败并以非 0 退出。表很小时优化器本来就会选择全表扫描，
+因此 --scale N 会先临时插入 N 条合成请求 (及对应的用户、实例、账单、离线节点) 并 ANALYZE，
+检查结束后删除；请在测试库上运行。
+"""
+import argparse
+import hashlib
+import os
+import re
+import sys
+
+import db
+import queries
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATION_FILE = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+SCHEMA_MIGRATIONS_DDL = """
+    CREATE TABLE IF NOT EXISTS `schema_migrations` (
+      `version` int NOT NULL,
+      `name` varchar(255) NOT NULL,
+      `checksum` char(64) NOT NULL,
+      `applied_at` datetime NULL DEFAULT CURRENT_TIMESTAMP,
+      PRIMARY KEY (`version`)
+    ) ENGINE = InnoDB CHARACTER SET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci
+"""
+
+
+# ================= 迁移 =================
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    """按版本号返回 [(version, name, path, checksum), ...]"""
+    migrations = []
+    for filename in sorted(os.listdir(directory)):
+        m = MIGRATION_FILE.match(filename)
+        if not m:
+            continue
+        path = os.path.join(directory, filename)
+        with open(path, "rb") as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        migrations.append((int(m.group(1)), m.group(2), path, checksum))
+    versions = [v for v, _, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError("migrations/ 中存在重复的版本号")
+    return migrations
+
+
+def split_statements(text):
+    """按当前分隔符切分语句，支持 DELIMITER 指令 (mysql 客户端语法，服务端不认识)"""
+    statements, buf, delimiter = [], [], ";"
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.upper().startswith("DELIMITER "):
+            delimiter = stripped.split(None, 1)[1]
+            continue
+        buf.append(line)
+        if stripped.endswith(delimiter):
+            buf[-1] = line.rstrip()[:-len(delimiter)]
+            statements.append("\n".join(buf))
+            buf = []
+    statements.append("\n".join(buf))
+
+    def has_code(stmt):
+        code = re.sub(r"/\*.*?\*/", "", stmt, flags=re.S)
+        return any(l.strip() and not l.strip().startswith("--") for l in code.splitlines())
+
+    return [s.strip() for s in statements if has_code(s)]
+
+
+def applied_versions(cursor):
+    cursor.execute(SCHEMA_MIGRATIONS_DDL)
+    cursor.execute("SELECT version, name, checksum, applied_at FROM schema_migrations ORDER BY version")
+    return {row[0]: row for row in cursor.fetchall()}
+
+
+def migrate(db_config, target=None):
+    """
+    执行所有未执行的迁移 (或执行到 target 版本为止)，返回本次执行的版本列表。
+    MySQL 的 DDL 会隐式提交，单个迁移中途失败时已执行的语句不会回滚，修复后需手工处理再重跑。
+    """
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    done = []
+    try:
+        applied = applied_versions(cursor)
+        for version, name, path, checksum in load_migrations():
+            if target is not None and version > target:
+                break
+            if version in applied:
+                if applied[version][2] != checksum:
+                    raise ValueError(f"迁移 {version:04d}_{name} 执行后被修改过，请新增迁移而不是改旧文件")
+                continue
+            with open(path, encoding="utf-8") as f:
+                for stmt in split_statements(f.read()):
+                    cursor.execute(stmt)
+                    if cursor.with_rows:
+                        cursor.fetchall()
+            cursor.execute("INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                           (version, name, checksum))
+            conn.commit()
+            done.append(version)
+    finally:
+        cursor.close()
+        conn.close()
+    return done
+
+
+def status(db_config):
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        applied = applied_versions(cursor)
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    report = []
+    for version, name, _, checksum in load_migrations():
+        row = applied.get(version)
+        if row is None:
+            state = "pending"
+        else:
+            state = "applied" if row[2] == checksum else "modified"
+        report.append((version, name, state, row[3] if row else None))
+    return report
+
+
+# ================= EXPLAIN 回归检查 =================
+
+SCALE_MARKER = "explain_check"
+
+
+def fixed_queries(user_id):
+    """项目中的固定查询：[(名称, sql, 参数), ...]；分页查询同时检查首页和带游标的后续页"""
+    history_keys = ("r.request_id",)
+    bill_keys = ("b.created_at", "b.bill_id")
+    checks = [
+        ("pending_queue", queries.SQL_PENDING, ()),
+        ("admission_pending", queries.SQL_PENDING_COUNTS, ()),
+        ("active_instances", queries.SQL_ACTIVE, ()),
+        ("all_instances", queries.SQL_ALL_INSTANCES, ()),
+        ("unpaid_total", queries.SQL_UNPAID_TOTAL, (user_id,)),
+        ("balance_risk", queries.SQL_BALANCE_RISK, (user_id,)),
+        # 与 sp_allocate_instance 中的首次适配查询一致
+        ("allocator_npu", """
+            SELECT NPU_id, hourly_rate FROM npus
+            WHERE queue_type = %s AND available_cores >= %s AND available_memory >= %s AND status = 'online' LIMIT 1
+        """, ("gpu_v100", 4, 16)),
+        ("allocator_memory", """
+            SELECT memory_id FROM memory
+            WHERE queue_type = %s AND available_size >= %s AND status = 'online' LIMIT 1
+        """, ("gpu_v100", 32)),
+        ("scheduler_claim", queries.SQL_CLAIM, ("gpu_v100", 20)),  # scheduler.CLAIM_BATCH 的默认值
+        ("util_series", queries.SQL_UTIL_SERIES, (3600, "queue", "gpu_v100", "2000-01-01", "2999-01-01")),
+    ]
+    for suffix, after in (("", None), ("_next_page", (2 ** 31 - 1,))):
+        checks.append(("history_all" + suffix, *queries.page_sql(
+            queries.SQL_HISTORY, [], [], history_keys, after, queries.DEFAULT_PAGE_SIZE)))
+        checks.append(("history_by_status" + suffix, *queries.page_sql(
+            queries.SQL_HISTORY, ["r.status = %s"], ["completed"], history_keys, after, queries.DEFAULT_PAGE_SIZE)))
+        checks.append(("user_jobs" + suffix, *queries.page_sql(
+            queries.SQL_JOBS, ["r.user_id = %s"], [user_id], history_keys, after, queries.DEFAULT_PAGE_SIZE)))
+    bill_after = ("2999-01-01 00:00:00", 2 ** 31 - 1)
+    for suffix, after in (("", None), ("_next_page", bill_after)):
+        checks.append(("user_bills" + suffix, *queries.page_sql(
+            queries.SQL_BILLS, ["b.user_id = %s"], [user_id], bill_keys, after, queries.DEFAULT_PAGE_SIZE)))
+    return checks
+
+
+def plan_problems(plan_rows):
+    """EXPLAIN 结果中的问题：全表扫描 / filesort"""
+    problems = []
+    for row in plan_rows:
+        table = row.get("table") or ""
+        if table.startswith("<"):  # <derivedN> / <union...> 等内部临时表
+            continue
+        extra = row.get("Extra") or ""
+        if row.get("type") == "ALL":
+            problems.append(f"{table}: 全表扫描 (rows={row.get('rows')})")
+        if "Using filesort" in extra:
+            problems.append(f"{table}: Using filesort")
+    return problems
+
+
+def _seq(n):
+    return f"WITH RECURSIVE seq (n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < {int(n)})"
+
+
+def scale_dataset(cursor, rows):
+    """插入 rows 条合成请求及关联数据，状态分布接近线上：大部分已结束，少量排队 / 运行中"""
+    users = max(rows // 50, 10)
+    nodes = max(rows // 100, 10)
+    cursor.execute("SET SESSION cte_max_recursion_depth = %s", (max(rows, users, nodes) + 1,))
+    cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
+    cursor.execute(f"""
+        INSERT INTO users (user_name, user_password, email)
+        {_seq(users)}
+        SELECT CONCAT('{SCALE_MARKER}_', n), 'x', CONCAT('{SCALE_MARKER}_', n, '@example.invalid') FROM seq
+    """)
+    cursor.execute(f"SELECT MIN(user_id) FROM users WHERE user_name LIKE '{SCALE_MARKER}\\_%'")
+    first_user = cursor.fetchone()[0]
+    cursor.execute(f"""
+        INSERT INTO requests (user_id, request_type, status, submit_time, complete_time, parameters)
+        {_seq(rows)}
+        SELECT {int(first_user)} + n % {users}, '{SCALE_MARKER}', st.status,
+               NOW() - INTERVAL ({rows} - n) MINUTE,
+               IF(st.status IN ('completed', 'terminated'), NOW() - INTERVAL ({rows} - n) MINUTE + INTERVAL 1 HOUR, NULL),
+               JSON_OBJECT('queue', ELT(1 + n % 3, 'gpu_v100', 'gpuB', 'cpu_6126'))
+        FROM (SELECT n, CASE WHEN n % 100 = 0 THEN 'pending'
+                             WHEN n % 100 = 1 THEN 'approved'
+                             WHEN n % 100 < 5 THEN 'terminated'
+                             WHEN n % 100 < 8 THEN 'rejected'
+                             ELSE 'completed' END AS status
+              FROM seq) st
+    """)
+    cursor.execute(f"""
+        INSERT INTO virtualcomputers (request_id, node_name, queue_name, vir_NPU_id, vir_memory_id, vir_volume_id,
+                                      hourly_price, status)
+        SELECT request_id, 1000000000 + request_id, JSON_UNQUOTE(JSON_EXTRACT(parameters, '$.queue')), 0, 0, 0, 1.00,
+               IF(status = 'approved', 'running', 'terminated')
+        FROM requests WHERE request_type = '{SCALE_MARKER}' AND status IN ('approved', 'completed', 'terminated')
+    """)
+    cursor.execute(f"""
+        INSERT INTO bills (user_id, request_id, node_id, start_time, end_time, hourly_rate, cost_amount,
+                           payment_status, created_at)
+        SELECT r.user_id, r.request_id, vc.node_id, r.submit_time, r.complete_time, 1.00, 1.00,
+               IF(r.request_id % 10 = 0, 'unpaid', 'paid'), r.complete_time
+        FROM requests r JOIN virtualcomputers vc ON vc.request_id = r.request_id
+        WHERE r.request_type = '{SCALE_MARKER}' AND r.status IN ('completed', 'terminated')
+    """)
+    # 离线节点：不参与分配，只让 npus / memory 的规模接近大集群
+    cursor.execute(f"""
+        INSERT INTO npus (npu_serial, queue_type, cores, available_cores, NPU_memory, available_memory, status)
+        {_seq(nodes)}
+        SELECT CONCAT('{SCALE_MARKER}_', n), ELT(1 + n % 3, 'gpu_v100', 'gpuB', 'cpu_6126'), 24, n % 25, 128, 64, 'offline'
+        FROM seq
+    """)
+    cursor.execute(f"""
+        INSERT INTO memory (memory_name, queue_type, memory_size, available_size, status)
+        {_seq(nodes)}
+        SELECT CONCAT('{SCALE_MARKER}_', n), ELT(1 + n % 3, 'gpu_v100', 'gpuB', 'cpu_6126'), 512, n % 513, 'offline'
+        FROM seq
+    """)
+    cursor.execute("SET FOREIGN_KEY_CHECKS = 1")
+
+
+def drop_scaled_dataset(cursor):
+    cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
+    cursor.execute(f"""
+        DELETE b FROM bills b JOIN requests r ON b.request_id = r.request_id WHERE r.request_type = '{SCALE_MARKER}'
+    """)
+    cursor.execute(f"""
+        DELETE vc FROM virtualcomputers vc JOIN requests r ON vc.request_id = r.request_id
+        WHERE r.request_type = '{SCALE_MARKER}'
+    """)
+    cursor.execute(f"DELETE FROM requests WHERE request_type = '{SCALE_MARKER}'")
+    cursor.execute(f"DELETE FROM users WHERE user_name LIKE '{SCALE_MARKER}\\_%'")
+    cursor.execute(f"DELETE FROM npus WHERE npu_serial LIKE '{SCALE_MARKER}\\_%'")
+    cursor.execute(f"DELETE FROM memory WHERE memory_name LIKE '{SCALE_MARKER}\\_%'")
+    cursor.execute("SET FOREIGN_KEY_CHECKS = 1")
+
+
+def analyze(cursor):
+    cursor.execute("ANALYZE TABLE users, requests, virtualcomputers, bills, npus, memory")
+    cursor.fetchall()
+
+
+def explain_check(db_config, user_id=2, scale=0, keep=False):
+    """返回 [(名称, 问题列表, 执行计划), ...]"""
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor(dictionary=True)
+    results = []
+    try:
+        if scale:
+            scale_dataset(cursor, scale)
+            conn.commit()
+            analyze(cursor)
+        try:
+            for name, sql, params in fixed_queries(user_id):
+                cursor.execute("EXPLAIN " + sql, params)
+                plan = cursor.fetchall()
+                results.append((name, plan_problems(plan), plan))
+        finally:
+            if scale and not keep:
+                drop_scaled_dataset(cursor)
+                conn.commit()
+                analyze(cursor)
+    finally:
+        cursor.close()
+        conn.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--user", default="root")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--database", default="cloud")
+    sub = parser.add_subparsers(dest="command", required=True)
+    up = sub.add_parser("up", help="执行未执行的迁移")
+    up.add_argument("--to", type=int, default=None, help="只执行到该版本")
+    sub.add_parser("status", help="列出各迁移的执行状态")
+    check = sub.add_parser("check", help="对固定查询运行 EXPLAIN")
+    check.add_argument("--scale", type=int, default=0, help="临时插入的合成请求数，0 表示直接用现有数据")
+    check.add_argument("--keep", action="store_true", help="检查结束后保留合成数据")
+    check.add_argument("--user-id", type=int, default=2, help="按用户过滤的查询使用的 user_id")
+    args = parser.parse_args()
+
+    db_config = {"host": args.host, "user": args.user, "password": args.password,
+                 "database": args.database, "charset": "utf8mb4", "collation": "utf8mb4_0900_ai_ci"}
+
+    if args.command == "up":
+        done = migrate(db_config, args.to)
+        print("已执行: " + ", ".join(f"{v:04d}" for v in done) if done else "已是最新版本")
+    elif args.command == "status":
+        for version, name, state, applied_at in status(db_config):
+            print(f"{version:04d}  {name:<40} {state:<9} {applied_at or ''}")
+    else:
+        failed = 0
+        for name, problems, plan in explain_check(db_config, args.user_id, args.scale, args.keep):
+            print(f"{'FAIL' if problems else 'OK  '}  {name}")
+            for row in plan:
+                print(f"      {row.get('table')}: type={row.get('type')} key={row.get('key')} "
+                      f"rows={row.get('rows')} extra={row.get('Extra') or ''}")
+            for p in problems:
+                print(f"      !! {p}")
+            failed += bool(problems)
+        if failed:
+            print(f"{failed} 条查询的执行计划退化")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
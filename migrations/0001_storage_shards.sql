@@ -0,0 +1,240 @@
+-- =======================================================
+-- 0001 存储容量分片
+-- =======================================================
+-- storagevolume 只有两行，所有队列的建机 / 释放都在这两行上串行。把每个卷的剩余容量拆成
+-- storage_shards 中的若干行，分配 / 释放只锁其中一行；各分片之和即卷的真实剩余量 (v_storage_capacity)。
+-- virtualvolume.shard_no 记录分配时的分片，释放时按原分片归还。
+-- 末尾按 storagevolume.available_size 把已有的卷拆成 16 个分片 (已有的卷映射都挂到 0 号分片上)。
+
+DROP PROCEDURE IF EXISTS `sp_storage_reserve`;
+DROP PROCEDURE IF EXISTS `sp_reshard_storage`;
+DROP PROCEDURE IF EXISTS `sp_release_resource`;
+DROP VIEW IF EXISTS `v_storage_capacity`;
+DROP TABLE IF EXISTS `storage_shards`;
+
+-- 存储容量分片：每个存储卷的剩余容量拆成若干互不相关的行，
+-- 分配/释放只锁其中一行，避免所有队列的建机/释放都串行在两行 storagevolume 上。
+-- 各分片之和即卷的真实剩余量 (见视图 v_storage_capacity)；
+-- storagevolume.available_size 只在 sp_reshard_storage 重新分片时同步一次。
+CREATE TABLE `storage_shards` (
+  `volume_id` int NOT NULL,
+  `shard_no` int NOT NULL,
+  `available_size` int NOT NULL,
+  PRIMARY KEY (`volume_id`, `shard_no`),
+  CONSTRAINT `storage_shards_ibfk_1` FOREIGN KEY (`volume_id`) REFERENCES `storagevolume` (`volume_id`)
+) ENGINE = InnoDB CHARACTER SET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci;
+
+CREATE VIEW `v_storage_capacity` AS
+SELECT v.volume_id, v.volume_name, v.volume_type, v.size_gb,
+       COALESCE(SUM(s.available_size), v.available_size) AS available_size,
+       COUNT(s.shard_no) AS shard_count, v.status
+FROM storagevolume v
+LEFT JOIN storage_shards s ON s.volume_id = v.volume_id
+GROUP BY v.volume_id, v.volume_name, v.volume_type, v.size_gb, v.available_size, v.status;
+
+ALTER TABLE `virtualvolume` ADD COLUMN `shard_no` int NOT NULL DEFAULT 0 AFTER `virtual_size`;
+
+DELIMITER $$
+
+-- 存储容量预留 (不含事务控制)：从某个存储卷的一个分片中扣减 p_req_disk
+--     1. 先按 (队列, 连接) 散列出的起点轮询分片，用 FOR UPDATE SKIP LOCKED 逐行按主键加锁，
+--        被其他事务占用的分片直接跳过，不等待
+--     2. 没有空闲且放得下的分片时 (都被占用，或余量分散在多个分片上)，锁住该卷全部分片，
+--        必要时把余量集中到一个分片后再扣减 —— 总容量始终精确受限
+--     找不到时 p_vol_id 为 NULL
+CREATE PROCEDURE `sp_storage_reserve`(
+    IN p_req_disk INT,
+    IN p_queue_name VARCHAR(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci,
+    OUT p_vol_id INT,
+    OUT p_shard_no INT
+)
+BEGIN
+    DECLARE v_vol INT DEFAULT 0;
+    DECLARE v_next INT;
+    DECLARE v_n INT;
+    DECLARE v_total BIGINT;
+    DECLARE v_start INT;
+    DECLARE v_k INT;
+    DECLARE v_shard INT;
+    DECLARE v_snap INT;
+    DECLARE v_avail INT;
+
+    SET p_vol_id = NULL;
+    SET p_shard_no = NULL;
+
+    vol_loop: LOOP
+        SET v_next = NULL;
+        SELECT MIN(volume_id) INTO v_next FROM storagevolume WHERE volume_id > v_vol AND status = 'online';
+        IF v_next IS NULL THEN
+            LEAVE vol_loop;
+        END IF;
+        SET v_vol = v_next;
+
+        -- 一致性读，不加锁：粗略判断该卷是否有可能放得下
+        SELECT COUNT(*), COALESCE(SUM(available_size), 0) INTO v_n, v_total FROM storage_shards WHERE volume_id = v_vol;
+
+        IF v_n > 0 AND v_total >= p_req_disk THEN
+            -- 1. 非阻塞路径
+            SET v_start = MOD(CRC32(CONCAT(p_queue_name, ':', CONNECTION_ID())), v_n);
+            SET v_k = 0;
+            WHILE v_k < v_n AND p_vol_id IS NULL DO
+                SET v_shard = MOD(v_start + v_k, v_n);
+                SET v_snap = NULL;
+                SELECT available_size INTO v_snap FROM storage_shards WHERE volume_id = v_vol AND shard_no = v_shard;
+                IF v_snap >= p_req_disk THEN
+                    SET v_avail = NULL;
+                    SELECT MAX(available_size) INTO v_avail FROM storage_shards
+                    WHERE volume_id = v_vol AND shard_no = v_shard FOR UPDATE SKIP LOCKED;
+                    IF v_avail >= p_req_disk THEN
+                        SET p_vol_id = v_vol;
+                        SET p_shard_no = v_shard;
+                    END IF;
+                END IF;
+                SET v_k = v_k + 1;
+            END WHILE;
+
+            -- 2. 阻塞路径：锁住该卷全部分片，按精确合计判断
+            IF p_vol_id IS NULL THEN
+                SELECT SUM(available_size) INTO v_total FROM storage_shards WHERE volume_id = v_vol FOR UPDATE;
+                IF v_total >= p_req_disk THEN
+                    SELECT shard_no, available_size INTO v_shard, v_avail FROM storage_shards
+                    WHERE volume_id = v_vol ORDER BY available_size DESC, shard_no LIMIT 1;
+                    IF v_avail < p_req_disk THEN
+                        -- 余量分散：集中到一个分片 (之后的释放会按原分片归还，逐渐重新摊开)
+                        UPDATE storage_shards SET available_size = IF(shard_no = v_shard, v_total, 0) WHERE volume_id = v_vol;
+                    END IF;
+                    SET p_vol_id = v_vol;
+                    SET p_shard_no = v_shard;
+                END IF;
+            END IF;
+        END IF;
+
+        IF p_vol_id IS NOT NULL THEN
+            UPDATE storage_shards SET available_size = available_size - p_req_disk
+            WHERE volume_id = p_vol_id AND shard_no = p_shard_no;
+            LEAVE vol_loop;
+        END IF;
+    END LOOP;
+END$$
+
+-- 重新分片：把每个卷当前的剩余容量平均拆成 p_shards 个分片 (p_shards = 1 即旧的单热点行布局)
+CREATE PROCEDURE `sp_reshard_storage`(
+    IN p_shards INT
+)
+BEGIN
+    DECLARE v_total BIGINT;
+
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    IF p_shards IS NULL OR p_shards < 1 THEN
+        SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'p_shards must be >= 1';
+    END IF;
+
+    START TRANSACTION;
+
+    -- 锁住全部分片，期间分配/释放等待
+    SELECT SUM(available_size) INTO v_total FROM storage_shards FOR UPDATE;
+
+    -- 已有分片的卷：以分片合计为准同步回 storagevolume
+    UPDATE storagevolume v
+    JOIN (SELECT volume_id, SUM(available_size) AS avail FROM storage_shards GROUP BY volume_id) s
+      ON s.volume_id = v.volume_id
+    SET v.available_size = s.avail;
+
+    DELETE FROM storage_shards;
+
+    INSERT INTO storage_shards (volume_id, shard_no, available_size)
+    WITH RECURSIVE seq AS (SELECT 0 AS n UNION ALL SELECT n + 1 FROM seq WHERE n < p_shards - 1)
+    SELECT v.volume_id, seq.n,
+           FLOOR(v.available_size / p_shards) + IF(seq.n < MOD(v.available_size, p_shards), 1, 0)
+    FROM storagevolume v CROSS JOIN seq;
+
+    -- 仍在使用的卷映射改挂到新分片上 (分片容量可互换，只需保证归还时落在存在的行上)
+    UPDATE virtualvolume SET shard_no = MOD(shard_no, p_shards) WHERE status = 'allocated';
+
+    COMMIT;
+END$$
+
+-- 释放资源：与 init.sql 中的版本相同，只是容量归还到分配时的分片
+CREATE PROCEDURE `sp_release_resource`(
+    IN p_node_id INT,
+    OUT p_result_status VARCHAR(50)
+)
+BEGIN
+    DECLARE v_req_id INT;
+    DECLARE v_user_id INT;
+    DECLARE v_vir_npu_id INT;
+    DECLARE v_vir_mem_id INT;
+    DECLARE v_vir_vol_id INT;
+    DECLARE v_phy_npu_id INT;
+    DECLARE v_phy_mem_id INT;
+    DECLARE v_phy_vol_id INT;
+    DECLARE v_phy_shard_no INT;
+    DECLARE v_cores_used INT;
+    DECLARE v_gpu_mem_used INT;
+    DECLARE v_ram_used INT;
+    DECLARE v_disk_used INT;
+    DECLARE v_start_time DATETIME;
+    DECLARE v_hourly_price DECIMAL(10, 2);
+    DECLARE v_current_status VARCHAR(50);
+
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        SET p_result_status = 'SQL_ERROR';
+    END;
+
+    START TRANSACTION;
+
+    SELECT request_id, vir_NPU_id, vir_memory_id, vir_volume_id, created_at, hourly_price, status
+    INTO v_req_id, v_vir_npu_id, v_vir_mem_id, v_vir_vol_id, v_start_time, v_hourly_price, v_current_status
+    FROM virtualcomputers WHERE node_id = p_node_id FOR UPDATE;
+
+    IF v_current_status IS NULL THEN
+        SET p_result_status = 'NOT_FOUND';
+        ROLLBACK;
+    ELSEIF v_current_status != 'running' THEN
+        SET p_result_status = 'ALREADY_STOPPED';
+        ROLLBACK;
+    ELSE
+        SELECT user_id INTO v_user_id FROM requests WHERE request_id = v_req_id;
+
+        SELECT NPU_id, virtual_cores, virtual_memory INTO v_phy_npu_id, v_cores_used, v_gpu_mem_used
+        FROM virtualcpu WHERE vir_NPU_id = v_vir_npu_id;
+
+        SELECT memory_id, virtual_size INTO v_phy_mem_id, v_ram_used
+        FROM virtualmemory WHERE vir_memory_id = v_vir_mem_id;
+
+        SELECT volume_id, shard_no, virtual_size INTO v_phy_vol_id, v_phy_shard_no, v_disk_used
+        FROM virtualvolume WHERE vir_volume_id = v_vir_vol_id;
+
+        UPDATE npus SET available_cores = available_cores + v_cores_used, available_memory = available_memory + v_gpu_mem_used WHERE NPU_id = v_phy_npu_id;
+        UPDATE memory SET available_size = available_size + v_ram_used WHERE memory_id = v_phy_mem_id;
+        -- 归还到分配时的分片，只锁这一行
+        UPDATE storage_shards SET available_size = available_size + v_disk_used
+        WHERE volume_id = v_phy_vol_id AND shard_no = v_phy_shard_no;
+
+        UPDATE virtualcpu SET status = 'released' WHERE vir_NPU_id = v_vir_npu_id;
+        UPDATE virtualmemory SET status = 'released' WHERE vir_memory_id = v_vir_mem_id;
+        UPDATE virtualvolume SET status = 'released' WHERE vir_volume_id = v_vir_vol_id;
+        UPDATE virtualcomputers SET status = 'terminated' WHERE node_id = p_node_id;
+        UPDATE requests SET status = 'completed', complete_time = NOW() WHERE request_id = v_req_id;
+
+        INSERT INTO bills (user_id, request_id, node_id, start_time, end_time, hourly_rate, cost_amount, payment_status)
+        VALUES (v_user_id, v_req_id, p_node_id, v_start_time, NOW(), v_hourly_price, (TIMESTAMPDIFF(SECOND, v_start_time, NOW()) / 3600.0) * v_hourly_price, 'unpaid');
+
+        INSERT INTO use_log (user_id, action, details)
+        VALUES (v_user_id, 'release_resource', CONCAT('NodeID:', p_node_id, ' resources released. Bill generated.'));
+
+        SET p_result_status = 'SUCCESS';
+        COMMIT;
+    END IF;
+END$$
+
+DELIMITER ;
+
+CALL sp_reshard_storage(16);
@@ -0,0 +1,289 @@
+-- =======================================================
+-- 0002 分配过程拆分、指定目标行分配与批量审批
+-- =======================================================
+-- 原 sp_create_instance 把选点、扣减、建虚拟层映射和事务控制写在一起。拆成不含事务控制的
+-- sp_bind_instance / sp_allocate_instance / sp_allocate_at，由单条 (sp_create_instance、
+-- sp_create_instance_at) 与批量 (sp_approve_batch) 入口各自控制事务；存储一律经 sp_storage_reserve (0001) 扣减。
+
+DROP PROCEDURE IF EXISTS `sp_bind_instance`;
+DROP PROCEDURE IF EXISTS `sp_allocate_instance`;
+DROP PROCEDURE IF EXISTS `sp_allocate_at`;
+DROP PROCEDURE IF EXISTS `sp_create_instance`;
+DROP PROCEDURE IF EXISTS `sp_create_instance_at`;
+DROP PROCEDURE IF EXISTS `sp_approve_batch`;
+
+DELIMITER $$
+
+-- 实例绑定：物理资源已扣减后，写入虚拟层映射、实例与日志 (不含事务控制)
+CREATE PROCEDURE `sp_bind_instance`(
+    IN p_existing_req_id INT,
+    IN p_queue_name VARCHAR(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci,
+    IN p_npu_id INT,
+    IN p_mem_id INT,
+    IN p_vol_id INT,
+    IN p_shard_no INT,
+    IN p_req_cores INT,
+    IN p_req_gpu_mem INT,
+    IN p_req_ram INT,
+    IN p_req_disk INT,
+    IN p_price DECIMAL(10,2),
+    OUT p_node_id INT
+)
+BEGIN
+    DECLARE v_vir_npu INT;
+    DECLARE v_vir_mem INT;
+    DECLARE v_vir_vol INT;
+
+    INSERT INTO virtualcpu (NPU_id, virtual_cores, virtual_memory) VALUES (p_npu_id, p_req_cores, p_req_gpu_mem);
+    SET v_vir_npu = LAST_INSERT_ID();
+
+    INSERT INTO virtualmemory (memory_id, virtual_size) VALUES (p_mem_id, p_req_ram);
+    SET v_vir_mem = LAST_INSERT_ID();
+
+    INSERT INTO virtualvolume (volume_id, virtual_size, shard_no) VALUES (p_vol_id, p_req_disk, p_shard_no);
+    SET v_vir_vol = LAST_INSERT_ID();
+
+    INSERT INTO virtualcomputers (request_id, node_name, queue_name, vir_NPU_id, vir_memory_id, vir_volume_id, hourly_price, status)
+    VALUES (p_existing_req_id, FLOOR(RAND() * 900000 + 100000), p_queue_name, v_vir_npu, v_vir_mem, v_vir_vol, p_price, 'running');
+    SET p_node_id = LAST_INSERT_ID();
+
+    INSERT INTO use_log (user_id, action, details)
+    VALUES ((SELECT user_id FROM requests WHERE request_id = p_existing_req_id), 'create_success', CONCAT('NodeID:', p_node_id, ' Created'));
+END$$
+
+-- 分配核心逻辑 (首次适配，不含事务控制，由调用方负责 START TRANSACTION / COMMIT)
+--     供 sp_create_instance (单条) 与 sp_approve_batch (批量) 共用
+CREATE PROCEDURE `sp_allocate_instance`(
+    IN p_existing_req_id INT,
+    IN p_queue_name VARCHAR(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci,
+    IN p_req_cores INT,
+    IN p_req_gpu_mem INT,
+    IN p_req_ram INT,
+    IN p_req_disk INT,
+    OUT p_node_id INT
+)
+BEGIN
+    DECLARE v_npu_id INT DEFAULT NULL;
+    DECLARE v_mem_id INT DEFAULT NULL;
+    DECLARE v_vol_id INT DEFAULT NULL;
+    DECLARE v_shard_no INT DEFAULT NULL;
+    DECLARE v_price DECIMAL(10,2);
+
+    SELECT NPU_id, hourly_rate INTO v_npu_id, v_price FROM npus
+    WHERE queue_type = p_queue_name AND available_cores >= p_req_cores AND available_memory >= p_req_gpu_mem AND status = 'online' LIMIT 1 FOR UPDATE;
+
+    SELECT memory_id INTO v_mem_id FROM memory
+    WHERE queue_type = p_queue_name AND available_size >= p_req_ram AND status = 'online' LIMIT 1 FOR UPDATE;
+
+    IF v_npu_id IS NOT NULL AND v_mem_id IS NOT NULL THEN
+        CALL sp_storage_reserve(p_req_disk, p_queue_name, v_vol_id, v_shard_no);
+    END IF;
+
+    IF v_npu_id IS NULL OR v_mem_id IS NULL OR v_vol_id IS NULL THEN
+        SET p_node_id = -1;
+    ELSE
+        UPDATE npus SET available_cores = available_cores - p_req_cores, available_memory = available_memory - p_req_gpu_mem WHERE NPU_id = v_npu_id;
+        UPDATE memory SET available_size = available_size - p_req_ram WHERE memory_id = v_mem_id;
+
+        CALL sp_bind_instance(p_existing_req_id, p_queue_name, v_npu_id, v_mem_id, v_vol_id, v_shard_no,
+                              p_req_cores, p_req_gpu_mem, p_req_ram, p_req_disk, v_price, p_node_id);
+    END IF;
+END$$
+
+-- 指定目标行的分配 (乐观并发，不含事务控制)
+--     目标 NPU / 内存行由应用层放置引擎 (placement.py) 选出，这里以 compare-and-set 方式扣减：
+--     只有当行上的剩余量仍等于引擎看到的快照值时才更新成功，否则不加任何锁等待直接返回冲突。
+--     p_node_id: >0 成功; -1 存储不足; -2 NPU 行已变化; -3 内存行已变化
+CREATE PROCEDURE `sp_allocate_at`(
+    IN p_existing_req_id INT,
+    IN p_queue_name VARCHAR(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci,
+    IN p_req_cores INT,
+    IN p_req_gpu_mem INT,
+    IN p_req_ram INT,
+    IN p_req_disk INT,
+    IN p_npu_id INT,
+    IN p_expect_cores INT,
+    IN p_expect_gpu_mem INT,
+    IN p_mem_id INT,
+    IN p_expect_ram INT,
+    OUT p_node_id INT
+)
+BEGIN
+    DECLARE v_vol_id INT DEFAULT NULL;
+    DECLARE v_shard_no INT DEFAULT NULL;
+    DECLARE v_price DECIMAL(10,2);
+
+    UPDATE npus SET available_cores = available_cores - p_req_cores, available_memory = available_memory - p_req_gpu_mem
+    WHERE NPU_id = p_npu_id AND queue_type = p_queue_name AND status = 'online'
+      AND available_cores = p_expect_cores AND available_memory = p_expect_gpu_mem
+      AND available_cores >= p_req_cores AND available_memory >= p_req_gpu_mem;
+
+    IF ROW_COUNT() = 0 THEN
+        SET p_node_id = -2;
+    ELSE
+        UPDATE memory SET available_size = available_size - p_req_ram
+        WHERE memory_id = p_mem_id AND queue_type = p_queue_name AND status = 'online'
+          AND available_size = p_expect_ram AND available_size >= p_req_ram;
+
+        IF ROW_COUNT() = 0 THEN
+            UPDATE npus SET available_cores = available_cores + p_req_cores, available_memory = available_memory + p_req_gpu_mem WHERE NPU_id = p_npu_id;
+            SET p_node_id = -3;
+        ELSE
+            CALL sp_storage_reserve(p_req_disk, p_queue_name, v_vol_id, v_shard_no);
+
+            IF v_vol_id IS NULL THEN
+                UPDATE npus SET available_cores = available_cores + p_req_cores, available_memory = available_memory + p_req_gpu_mem WHERE NPU_id = p_npu_id;
+                UPDATE memory SET available_size = available_size + p_req_ram WHERE memory_id = p_mem_id;
+                SET p_node_id = -1;
+            ELSE
+                SELECT hourly_rate INTO v_price FROM npus WHERE NPU_id = p_npu_id;
+                CALL sp_bind_instance(p_existing_req_id, p_queue_name, p_npu_id, p_mem_id, v_vol_id, v_shard_no,
+                                      p_req_cores, p_req_gpu_mem, p_req_ram, p_req_disk, v_price, p_node_id);
+            END IF;
+        END IF;
+    END IF;
+END$$
+
+-- 单条分配 (保持原有接口，自带事务)
+CREATE PROCEDURE `sp_create_instance`(
+    IN p_existing_req_id INT,
+    IN p_queue_name VARCHAR(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci,
+    IN p_req_cores INT,
+    IN p_req_gpu_mem INT,
+    IN p_req_ram INT,
+    IN p_req_disk INT,
+    OUT p_node_id INT
+)
+BEGIN
+    START TRANSACTION;
+    CALL sp_allocate_instance(p_existing_req_id, p_queue_name, p_req_cores, p_req_gpu_mem, p_req_ram, p_req_disk, p_node_id);
+    IF p_node_id > 0 THEN
+        COMMIT;
+    ELSE
+        ROLLBACK;
+    END IF;
+END$$
+
+-- 单条指定目标行分配 (自带事务，供放置引擎调用)
+CREATE PROCEDURE `sp_create_instance_at`(
+    IN p_existing_req_id INT,
+    IN p_queue_name VARCHAR(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci,
+    IN p_req_cores INT,
+    IN p_req_gpu_mem INT,
+    IN p_req_ram INT,
+    IN p_req_disk INT,
+    IN p_npu_id INT,
+    IN p_expect_cores INT,
+    IN p_expect_gpu_mem INT,
+    IN p_mem_id INT,
+    IN p_expect_ram INT,
+    OUT p_node_id INT
+)
+BEGIN
+    START TRANSACTION;
+    CALL sp_allocate_at(p_existing_req_id, p_queue_name, p_req_cores, p_req_gpu_mem, p_req_ram, p_req_disk,
+                        p_npu_id, p_expect_cores, p_expect_gpu_mem, p_mem_id, p_expect_ram, p_node_id);
+    IF p_node_id > 0 THEN
+        COMMIT;
+    ELSE
+        ROLLBACK;
+    END IF;
+END$$
+
+-- 批量审批：一次调用、一个事务内完成多条 pending 请求的分配与状态更新
+--     p_items: JSON 数组 [{"request_id":1,"queue":"gpu_v100","cores":24,"gpu_mem":32,"ram":512,"disk":200}, ...]
+--     元素可附带放置引擎选出的目标行 (npu_id/expect_cores/expect_gpu_mem/mem_id/expect_ram)，
+--     此时走 sp_allocate_at 的 compare-and-set 路径，否则走 sp_allocate_instance 首次适配
+--     每条请求使用 SAVEPOINT 隔离，单条失败不影响同批其他请求
+--     返回结果集: request_id, result (APPROVED / NO_CAPACITY / CONFLICT / NOT_PENDING / NOT_FOUND / SQL_ERROR), node_id
+CREATE PROCEDURE `sp_approve_batch`(
+    IN p_items JSON
+)
+BEGIN
+    DECLARE v_i INT DEFAULT 0;
+    DECLARE v_n INT DEFAULT 0;
+    DECLARE v_req_id INT;
+    DECLARE v_queue VARCHAR(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci;
+    DECLARE v_cores INT;
+    DECLARE v_gpu_mem INT;
+    DECLARE v_ram INT;
+    DECLARE v_disk INT;
+    DECLARE v_status VARCHAR(50);
+    DECLARE v_node_id INT;
+    DECLARE v_npu_id INT;
+    DECLARE v_item_error INT DEFAULT 0;
+
+    DECLARE CONTINUE HANDLER FOR SQLEXCEPTION SET v_item_error = 1;
+
+    DROP TEMPORARY TABLE IF EXISTS `tmp_batch_result`;
+    CREATE TEMPORARY TABLE `tmp_batch_result` (
+        `seq` INT NOT NULL,
+        `request_id` INT NULL,
+        `result` VARCHAR(20) NOT NULL,
+        `node_id` INT NULL,
+        PRIMARY KEY (`seq`)
+    );
+
+    SET v_n = JSON_LENGTH(p_items);
+
+    START TRANSACTION;
+
+    WHILE v_i < v_n DO
+        SET v_req_id  = JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].request_id'));
+        SET v_queue   = JSON_UNQUOTE(JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].queue')));
+        SET v_cores   = COALESCE(JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].cores')), 1);
+        SET v_gpu_mem = COALESCE(JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].gpu_mem')), 0);
+        SET v_ram     = COALESCE(JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].ram')), 1);
+        SET v_disk    = COALESCE(JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].disk')), 10);
+        SET v_npu_id  = JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].npu_id'));
+        SET v_status = NULL;
+        SET v_node_id = -1;
+        SET v_item_error = 0;
+
+        SAVEPOINT batch_item;
+
+        -- 锁住请求行，避免两个管理员同时审批同一条请求
+        SELECT status INTO v_status FROM requests WHERE request_id = v_req_id FOR UPDATE;
+
+        IF v_status IS NULL THEN
+            INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'NOT_FOUND', NULL);
+        ELSEIF v_status != 'pending' THEN
+            INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'NOT_PENDING', NULL);
+        ELSE
+            IF v_npu_id IS NULL THEN
+                CALL sp_allocate_instance(v_req_id, v_queue, v_cores, v_gpu_mem, v_ram, v_disk, v_node_id);
+            ELSE
+                CALL sp_allocate_at(v_req_id, v_queue, v_cores, v_gpu_mem, v_ram, v_disk,
+                                    v_npu_id,
+                                    JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].expect_cores')),
+                                    JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].expect_gpu_mem')),
+                                    JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].mem_id')),
+                                    JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].expect_ram')),
+                                    v_node_id);
+            END IF;
+            IF v_item_error = 0 AND v_node_id > 0 THEN
+                UPDATE requests SET status = 'approved', node_id = v_node_id WHERE request_id = v_req_id;
+            END IF;
+
+            IF v_item_error = 1 THEN
+                ROLLBACK TO SAVEPOINT batch_item;
+                INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'SQL_ERROR', NULL);
+            ELSEIF v_node_id > 0 THEN
+                INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'APPROVED', v_node_id);
+            ELSEIF v_node_id IN (-2, -3) THEN
+                INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'CONFLICT', NULL);
+            ELSE
+                INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'NO_CAPACITY', NULL);
+            END IF;
+        END IF;
+
+        SET v_i = v_i + 1;
+    END WHILE;
+
+    COMMIT;
+
+    SELECT request_id, result, node_id FROM tmp_batch_result ORDER BY seq;
+    DROP TEMPORARY TABLE `tmp_batch_result`;
+END$$
+
+DELIMITER ;
@@ -0,0 +1,15 @@
+-- =======================================================
+-- 0003 键集分页的索引
+-- =======================================================
+-- 请求历史按 request_id 倒序翻页 (可按用户或状态过滤)，账单按 (created_at, bill_id) 倒序翻页：
+-- 过滤列在前、排序键在后，翻页条件 "key < 游标" 直接在索引上范围扫描，不需要 filesort。
+-- 原 idx_req_user / idx_bill_user 是新索引的前缀 (外键仍由新索引支撑)，在同一条语句中替换。
+
+ALTER TABLE `requests`
+  DROP INDEX `idx_req_user`,
+  ADD INDEX `idx_req_user`(`user_id`, `request_id`),
+  ADD INDEX `idx_req_status`(`status`, `request_id`);
+
+ALTER TABLE `bills`
+  DROP INDEX `idx_bill_user`,
+  ADD INDEX `idx_bill_user_created`(`user_id`, `created_at`, `bill_id`);
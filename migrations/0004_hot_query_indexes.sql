@@ -0,0 +1,21 @@
+-- =======================================================
+-- 0004 热点查询的复合索引
+-- =======================================================
+-- 排队作业 WHERE status='pending' ORDER BY submit_time、运行中作业 WHERE status='approved' ORDER BY submit_time DESC：
+-- (status, submit_time) 上按索引顺序读取，无需 filesort
+ALTER TABLE `requests` ADD INDEX `idx_req_status_submit`(`status`, `submit_time`);
+
+-- 全系统运行实例 WHERE vc.status='running'
+ALTER TABLE `virtualcomputers` ADD INDEX `idx_vc_status`(`status`);
+
+-- 分配器 WHERE queue_type=? AND status='online' AND available_cores>=?：等值列在前，范围列在后。
+-- 原 idx_npu_queue / idx_mem_queue 是新索引的前缀，一并删除
+ALTER TABLE `npus`
+  ADD INDEX `idx_npu_alloc`(`queue_type`, `status`, `available_cores`),
+  DROP INDEX `idx_npu_queue`;
+
+ALTER TABLE `memory`
+  ADD INDEX `idx_mem_alloc`(`queue_type`, `status`, `available_size`),
+  DROP INDEX `idx_mem_queue`;
+
+-- 账单按用户、创建时间倒序的 idx_bill_user_created (user_id, created_at, bill_id) 已在 0003 中
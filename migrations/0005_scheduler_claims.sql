@@ -0,0 +1,13 @@
+-- =======================================================
+-- 0005 后台调度器 (scheduler.py) 领取 pending 请求所需的列与索引
+-- =======================================================
+-- req_queue: 从 parameters 中展开的目标队列 (存储生成列)，按队列领取时可以走索引，
+--            不必对每行执行 JSON_EXTRACT
+-- sched_not_before: 领取租约 / 退避截止时间；在此之前其他调度进程不会再领取该请求。
+--            调度进程崩溃时租约到期后自动可被重新领取
+-- sched_attempts: 已尝试分配的次数，用于计算指数退避
+ALTER TABLE `requests`
+  ADD COLUMN `req_queue` varchar(100) GENERATED ALWAYS AS (JSON_UNQUOTE(JSON_EXTRACT(`parameters`, '$.queue'))) STORED,
+  ADD COLUMN `sched_not_before` datetime NULL DEFAULT NULL,
+  ADD COLUMN `sched_attempts` int NOT NULL DEFAULT 0,
+  ADD INDEX `idx_req_sched`(`status`, `req_queue`, `submit_time`);
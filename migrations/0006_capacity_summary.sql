@@ -0,0 +1,267 @@
+-- =======================================================
+-- 0006 按队列增量维护的容量汇总表
+-- =======================================================
+-- 资源池监控与 advanced.sql 的利用率 / 碎片化报表原本每次都对 npus / memory 全表 GROUP BY。
+-- capacity_summary 保存每个队列的 总量 / 剩余量 / 空闲·满载·碎片化节点数，
+-- 由 npus / memory 上的触发器在同一事务内按增量更新，因此 sp_create_instance、sp_create_instance_at、
+-- sp_approve_batch、sp_release_resource 以及任何手工 UPDATE 都会随分配 / 释放一起提交或回滚。
+--
+-- 为避免每个队列只有一行而重新形成热点行 (参见 storage_shards)，每个队列拆成 16 个槽位，
+-- 节点按 id % 16 落到槽位上；读取时按队列对 16 个槽位求和 (v_queue_capacity)，代价与节点数无关。
+-- sp_capacity_reconcile 重新全量计算并与汇总表比对，返回漂移并可选择修正。
+
+DROP VIEW IF EXISTS `v_queue_capacity`;
+DROP VIEW IF EXISTS `v_capacity_truth`;
+DROP TRIGGER IF EXISTS `trg_npus_capsum_ins`;
+DROP TRIGGER IF EXISTS `trg_npus_capsum_upd`;
+DROP TRIGGER IF EXISTS `trg_npus_capsum_del`;
+DROP TRIGGER IF EXISTS `trg_memory_capsum_ins`;
+DROP TRIGGER IF EXISTS `trg_memory_capsum_upd`;
+DROP TRIGGER IF EXISTS `trg_memory_capsum_del`;
+DROP PROCEDURE IF EXISTS `sp_capsum_apply`;
+DROP PROCEDURE IF EXISTS `sp_capacity_reconcile`;
+DROP TABLE IF EXISTS `capacity_summary`;
+
+CREATE TABLE `capacity_summary` (
+  `queue_type` varchar(100) NOT NULL,
+  `slot` int NOT NULL,
+  `nodes` int NOT NULL DEFAULT 0,
+  `idle_nodes` int NOT NULL DEFAULT 0,
+  `full_nodes` int NOT NULL DEFAULT 0,
+  `fragmented_nodes` int NOT NULL DEFAULT 0,
+  `total_cores` int NOT NULL DEFAULT 0,
+  `free_cores` int NOT NULL DEFAULT 0,
+  `total_gpu_mem` int NOT NULL DEFAULT 0,
+  `free_gpu_mem` int NOT NULL DEFAULT 0,
+  `mem_modules` int NOT NULL DEFAULT 0,
+  `total_ram` int NOT NULL DEFAULT 0,
+  `free_ram` int NOT NULL DEFAULT 0,
+  PRIMARY KEY (`queue_type`, `slot`)
+) ENGINE = InnoDB CHARACTER SET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci;
+
+CREATE VIEW `v_queue_capacity` AS
+SELECT queue_type,
+       SUM(nodes) AS total_nodes,
+       SUM(idle_nodes) AS idle_nodes,
+       SUM(full_nodes) AS full_nodes,
+       SUM(fragmented_nodes) AS fragmented_nodes,
+       SUM(total_cores) AS total_cores,
+       SUM(free_cores) AS free_cores,
+       SUM(total_cores - free_cores) AS used_cores,
+       SUM(total_gpu_mem) AS total_gpu_mem,
+       SUM(free_gpu_mem) AS free_gpu_mem,
+       SUM(total_gpu_mem - free_gpu_mem) AS used_gpu_mem,
+       SUM(mem_modules) AS mem_modules,
+       SUM(total_ram) AS total_ram,
+       SUM(free_ram) AS free_ram,
+       SUM(total_ram - free_ram) AS used_ram
+FROM capacity_summary
+GROUP BY queue_type;
+
+-- 直接从 npus / memory 全量计算的结果，仅用于首次填充和对账
+CREATE VIEW `v_capacity_truth` AS
+SELECT queue_type, slot,
+       SUM(nodes) AS nodes, SUM(idle_nodes) AS idle_nodes, SUM(full_nodes) AS full_nodes,
+       SUM(fragmented_nodes) AS fragmented_nodes,
+       SUM(total_cores) AS total_cores, SUM(free_cores) AS free_cores,
+       SUM(total_gpu_mem) AS total_gpu_mem, SUM(free_gpu_mem) AS free_gpu_mem,
+       SUM(mem_modules) AS mem_modules, SUM(total_ram) AS total_ram, SUM(free_ram) AS free_ram
+FROM (
+    SELECT queue_type, NPU_id % 16 AS slot, 1 AS nodes,
+           available_cores = cores AS idle_nodes, available_cores = 0 AS full_nodes,
+           available_cores > 0 AND available_cores < cores AS fragmented_nodes,
+           cores AS total_cores, available_cores AS free_cores,
+           NPU_memory AS total_gpu_mem, available_memory AS free_gpu_mem,
+           0 AS mem_modules, 0 AS total_ram, 0 AS free_ram
+    FROM npus
+    UNION ALL
+    SELECT COALESCE(queue_type, ''), memory_id % 16, 0, 0, 0, 0, 0, 0, 0, 0, 1, memory_size, available_size
+    FROM memory
+) t
+GROUP BY queue_type, slot;
+
+DELIMITER $$
+
+-- 把一组增量累加到 (队列, 槽位) 上，行不存在时创建
+CREATE PROCEDURE `sp_capsum_apply`(
+    IN p_queue VARCHAR(100), IN p_slot INT,
+    IN p_nodes INT, IN p_idle INT, IN p_full INT, IN p_frag INT,
+    IN p_cores INT, IN p_free_cores INT, IN p_gpu INT, IN p_free_gpu INT,
+    IN p_modules INT, IN p_ram INT, IN p_free_ram INT
+)
+BEGIN
+    INSERT INTO capacity_summary (queue_type, slot, nodes, idle_nodes, full_nodes, fragmented_nodes,
+                                  total_cores, free_cores, total_gpu_mem, free_gpu_mem,
+                                  mem_modules, total_ram, free_ram)
+    VALUES (COALESCE(p_queue, ''), p_slot, p_nodes, p_idle, p_full, p_frag,
+            p_cores, p_free_cores, p_gpu, p_free_gpu, p_modules, p_ram, p_free_ram) AS d
+    ON DUPLICATE KEY UPDATE
+        nodes = capacity_summary.nodes + d.nodes,
+        idle_nodes = capacity_summary.idle_nodes + d.idle_nodes,
+        full_nodes = capacity_summary.full_nodes + d.full_nodes,
+        fragmented_nodes = capacity_summary.fragmented_nodes + d.fragmented_nodes,
+        total_cores = capacity_summary.total_cores + d.total_cores,
+        free_cores = capacity_summary.free_cores + d.free_cores,
+        total_gpu_mem = capacity_summary.total_gpu_mem + d.total_gpu_mem,
+        free_gpu_mem = capacity_summary.free_gpu_mem + d.free_gpu_mem,
+        mem_modules = capacity_summary.mem_modules + d.mem_modules,
+        total_ram = capacity_summary.total_ram + d.total_ram,
+        free_ram = capacity_summary.free_ram + d.free_ram;
+END$$
+
+-- 节点分类与 advanced.sql 碎片化报表同口径：
+-- 空闲 available_cores = cores，满载 available_cores = 0，碎片化 0 < available_cores < cores
+CREATE TRIGGER `trg_npus_capsum_ins` AFTER INSERT ON `npus` FOR EACH ROW
+BEGIN
+    CALL sp_capsum_apply(NEW.queue_type, NEW.NPU_id % 16, 1,
+        NEW.available_cores = NEW.cores, NEW.available_cores = 0,
+        NEW.available_cores > 0 AND NEW.available_cores < NEW.cores,
+        NEW.cores, NEW.available_cores, NEW.NPU_memory, NEW.available_memory, 0, 0, 0);
+END$$
+
+CREATE TRIGGER `trg_npus_capsum_del` AFTER DELETE ON `npus` FOR EACH ROW
+BEGIN
+    CALL sp_capsum_apply(OLD.queue_type, OLD.NPU_id % 16, -1,
+        -(OLD.available_cores = OLD.cores), -(OLD.available_cores = 0),
+        -(OLD.available_cores > 0 AND OLD.available_cores < OLD.cores),
+        -OLD.cores, -OLD.available_cores, -OLD.NPU_memory, -OLD.available_memory, 0, 0, 0);
+END$$
+
+CREATE TRIGGER `trg_npus_capsum_upd` AFTER UPDATE ON `npus` FOR EACH ROW
+BEGIN
+    IF NEW.queue_type = OLD.queue_type THEN
+        -- 只改 status / hourly_rate 等列时不碰汇总行
+        IF NEW.available_cores <> OLD.available_cores OR NEW.cores <> OLD.cores
+           OR NEW.available_memory <> OLD.available_memory OR NEW.NPU_memory <> OLD.NPU_memory THEN
+            CALL sp_capsum_apply(NEW.queue_type, NEW.NPU_id % 16, 0,
+                (NEW.available_cores = NEW.cores) - (OLD.available_cores = OLD.cores),
+                (NEW.available_cores = 0) - (OLD.available_cores = 0),
+                (NEW.available_cores > 0 AND NEW.available_cores < NEW.cores)
+                    - (OLD.available_cores > 0 AND OLD.available_cores < OLD.cores),
+                NEW.cores - OLD.cores, NEW.available_cores - OLD.available_cores,
+                NEW.NPU_memory - OLD.NPU_memory, NEW.available_memory - OLD.available_memory, 0, 0, 0);
+        END IF;
+    ELSE
+        CALL sp_capsum_apply(OLD.queue_type, OLD.NPU_id % 16, -1,
+            -(OLD.available_cores = OLD.cores), -(OLD.available_cores = 0),
+            -(OLD.available_cores > 0 AND OLD.available_cores < OLD.cores),
+            -OLD.cores, -OLD.available_cores, -OLD.NPU_memory, -OLD.available_memory, 0, 0, 0);
+        CALL sp_capsum_apply(NEW.queue_type, NEW.NPU_id % 16, 1,
+            NEW.available_cores = NEW.cores, NEW.available_cores = 0,
+            NEW.available_cores > 0 AND NEW.available_cores < NEW.cores,
+            NEW.cores, NEW.available_cores, NEW.NPU_memory, NEW.available_memory, 0, 0, 0);
+    END IF;
+END$$
+
+CREATE TRIGGER `trg_memory_capsum_ins` AFTER INSERT ON `memory` FOR EACH ROW
+BEGIN
+    CALL sp_capsum_apply(NEW.queue_type, NEW.memory_id % 16, 0, 0, 0, 0, 0, 0, 0, 0,
+        1, NEW.memory_size, NEW.available_size);
+END$$
+
+CREATE TRIGGER `trg_memory_capsum_del` AFTER DELETE ON `memory` FOR EACH ROW
+BEGIN
+    CALL sp_capsum_apply(OLD.queue_type, OLD.memory_id % 16, 0, 0, 0, 0, 0, 0, 0, 0,
+        -1, -OLD.memory_size, -OLD.available_size);
+END$$
+
+CREATE TRIGGER `trg_memory_capsum_upd` AFTER UPDATE ON `memory` FOR EACH ROW
+BEGIN
+    IF NEW.queue_type <=> OLD.queue_type THEN
+        IF NEW.available_size <> OLD.available_size OR NEW.memory_size <> OLD.memory_size THEN
+            CALL sp_capsum_apply(NEW.queue_type, NEW.memory_id % 16, 0, 0, 0, 0, 0, 0, 0, 0,
+                0, NEW.memory_size - OLD.memory_size, NEW.available_size - OLD.available_size);
+        END IF;
+    ELSE
+        CALL sp_capsum_apply(OLD.queue_type, OLD.memory_id % 16, 0, 0, 0, 0, 0, 0, 0, 0,
+            -1, -OLD.memory_size, -OLD.available_size);
+        CALL sp_capsum_apply(NEW.queue_type, NEW.memory_id % 16, 0, 0, 0, 0, 0, 0, 0, 0,
+            1, NEW.memory_size, NEW.available_size);
+    END IF;
+END$$
+
+-- =======================================================
+-- 对账：全量重算并与汇总表逐槽位比对
+-- =======================================================
+-- 返回结果集 (queue_type, slot, expected, actual)，expected / actual 为 JSON；p_fix = 1 时用重算结果覆盖汇总表。
+-- 先对全部汇总行加锁，再在 READ COMMITTED 下读取 npus / memory：
+-- 已经写过汇总行的分配事务必然已提交 (其改动在本次读取中可见)，
+-- 尚未写汇总行的事务会等待本过程提交后再把增量叠加上去，两者都不会被重复计算或遗漏。
+CREATE PROCEDURE `sp_capacity_reconcile`(IN p_fix TINYINT)
+BEGIN
+    DECLARE v_locked INT;
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    DROP TEMPORARY TABLE IF EXISTS `tmp_capacity_truth`;
+    DROP TEMPORARY TABLE IF EXISTS `tmp_capacity_drift`;
+    CREATE TEMPORARY TABLE `tmp_capacity_drift` (
+        `queue_type` varchar(100) NOT NULL,
+        `slot` int NOT NULL,
+        `expected` json NULL,
+        `actual` json NULL
+    );
+
+    SET TRANSACTION ISOLATION LEVEL READ COMMITTED;
+    START TRANSACTION;
+    SELECT COUNT(*) INTO v_locked FROM capacity_summary FOR UPDATE;
+
+    CREATE TEMPORARY TABLE `tmp_capacity_truth` AS SELECT * FROM v_capacity_truth;
+
+    -- 重算有而汇总表缺失或不一致的槽位
+    INSERT INTO tmp_capacity_drift (queue_type, slot, expected, actual)
+    SELECT t.queue_type, t.slot,
+           JSON_OBJECT('nodes', t.nodes, 'idle_nodes', t.idle_nodes, 'full_nodes', t.full_nodes,
+                       'fragmented_nodes', t.fragmented_nodes, 'total_cores', t.total_cores, 'free_cores', t.free_cores,
+                       'total_gpu_mem', t.total_gpu_mem, 'free_gpu_mem', t.free_gpu_mem,
+                       'mem_modules', t.mem_modules, 'total_ram', t.total_ram, 'free_ram', t.free_ram),
+           IF(s.queue_type IS NULL, NULL,
+              JSON_OBJECT('nodes', s.nodes, 'idle_nodes', s.idle_nodes, 'full_nodes', s.full_nodes,
+                          'fragmented_nodes', s.fragmented_nodes, 'total_cores', s.total_cores, 'free_cores', s.free_cores,
+                          'total_gpu_mem', s.total_gpu_mem, 'free_gpu_mem', s.free_gpu_mem,
+                          'mem_modules', s.mem_modules, 'total_ram', s.total_ram, 'free_ram', s.free_ram))
+    FROM tmp_capacity_truth t
+    LEFT JOIN capacity_summary s ON s.queue_type = t.queue_type AND s.slot = t.slot
+    WHERE s.queue_type IS NULL
+       OR (t.nodes, t.idle_nodes, t.full_nodes, t.fragmented_nodes, t.total_cores, t.free_cores,
+           t.total_gpu_mem, t.free_gpu_mem, t.mem_modules, t.total_ram, t.free_ram)
+          <> (s.nodes, s.idle_nodes, s.full_nodes, s.fragmented_nodes, s.total_cores, s.free_cores,
+              s.total_gpu_mem, s.free_gpu_mem, s.mem_modules, s.total_ram, s.free_ram);
+
+    -- 汇总表中多出来的非零槽位 (对应的节点已不存在)
+    INSERT INTO tmp_capacity_drift (queue_type, slot, expected, actual)
+    SELECT s.queue_type, s.slot, NULL,
+           JSON_OBJECT('nodes', s.nodes, 'total_cores', s.total_cores, 'free_cores', s.free_cores,
+                       'mem_modules', s.mem_modules, 'total_ram', s.total_ram, 'free_ram', s.free_ram)
+    FROM capacity_summary s
+    WHERE (s.nodes <> 0 OR s.mem_modules <> 0 OR s.total_cores <> 0 OR s.free_cores <> 0
+           OR s.total_gpu_mem <> 0 OR s.free_gpu_mem <> 0 OR s.total_ram <> 0 OR s.free_ram <> 0)
+      AND NOT EXISTS (SELECT 1 FROM tmp_capacity_truth t WHERE t.queue_type = s.queue_type AND t.slot = s.slot);
+
+    IF p_fix = 1 THEN
+        DELETE FROM capacity_summary;
+        INSERT INTO capacity_summary (queue_type, slot, nodes, idle_nodes, full_nodes, fragmented_nodes,
+                                      total_cores, free_cores, total_gpu_mem, free_gpu_mem,
+                                      mem_modules, total_ram, free_ram)
+        SELECT queue_type, slot, nodes, idle_nodes, full_nodes, fragmented_nodes,
+               total_cores, free_cores, total_gpu_mem, free_gpu_mem, mem_modules, total_ram, free_ram
+        FROM tmp_capacity_truth;
+    END IF;
+    COMMIT;
+
+    SELECT queue_type, slot, expected, actual FROM tmp_capacity_drift ORDER BY queue_type, slot;
+    DROP TEMPORARY TABLE IF EXISTS `tmp_capacity_truth`;
+END$$
+
+DELIMITER ;
+
+-- 首次填充 (之后由触发器增量维护)
+INSERT INTO capacity_summary (queue_type, slot, nodes, idle_nodes, full_nodes, fragmented_nodes,
+                              total_cores, free_cores, total_gpu_mem, free_gpu_mem,
+                              mem_modules, total_ram, free_ram)
+SELECT queue_type, slot, nodes, idle_nodes, full_nodes, fragmented_nodes,
+       total_cores, free_cores, total_gpu_mem, free_gpu_mem, mem_modules, total_ram, free_ram
+FROM v_capacity_truth;
@@ -0,0 +1,274 @@
+-- =======================================================
+-- 0007 周期计量计费 + 用户余额风险表
+-- =======================================================
+-- 原来只有 sp_release_resource 在实例结束时按 (NOW() - created_at) * hourly_price 出一张账单，
+-- 长期运行的实例在结束前产生的费用完全不可见。
+--
+-- sp_meter_usage: 按 node_id 分块、集合式地为所有 running 实例计量 (上次截止时间, NOW()] 的用量，
+--     每块一个事务：批量写入 bills 并推进 virtualcomputers.metered_until。
+--     sp_release_resource 改为从 metered_until 开始计费，两者不会重复计费。
+-- user_balance_risk: 每个有运行实例或未付账单的用户一行 (消耗速度、可用余额、预计耗尽时间、风险等级)，
+--     由 sp_refresh_balance_risk 在每轮计量后整表刷新；风险报表与仪表盘直接读这张表，不再五表联查。
+
+DROP PROCEDURE IF EXISTS `sp_meter_usage`;
+DROP PROCEDURE IF EXISTS `sp_refresh_balance_risk`;
+DROP PROCEDURE IF EXISTS `sp_release_resource`;
+DROP TABLE IF EXISTS `user_balance_risk`;
+
+ALTER TABLE `virtualcomputers` ADD COLUMN `metered_until` datetime NULL DEFAULT NULL;
+-- 风险表刷新按用户汇总未付账单
+ALTER TABLE `bills` ADD INDEX `idx_bill_unpaid`(`payment_status`, `user_id`, `cost_amount`);
+
+CREATE TABLE `user_balance_risk` (
+  `user_id` int NOT NULL,
+  `balance` decimal(12, 2) NOT NULL,
+  `unpaid_amount` decimal(12, 2) NOT NULL DEFAULT 0.00,
+  `accrued_amount` decimal(12, 2) NOT NULL DEFAULT 0.00,
+  `available` decimal(12, 2) NOT NULL,
+  `running_instances` int NOT NULL DEFAULT 0,
+  `burn_rate` decimal(12, 2) NOT NULL DEFAULT 0.00,
+  `hours_left` decimal(12, 1) NULL DEFAULT NULL,
+  `exhausted_at` datetime NULL DEFAULT NULL,
+  `risk_level` varchar(20) NOT NULL,
+  `refreshed_at` datetime NOT NULL,
+  PRIMARY KEY (`user_id`),
+  INDEX `idx_risk_level`(`risk_level`, `hours_left`)
+) ENGINE = InnoDB CHARACTER SET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci;
+
+DELIMITER $$
+
+-- =======================================================
+-- 计量：p_chunk 个实例一个事务；p_instances 返回出账实例数 (-1 表示已有其他计量在运行)
+-- =======================================================
+-- 每块先在 READ COMMITTED 下无锁读出候选实例，再用 UPDATE ... WHERE status='running' 加锁推进 metered_until：
+-- 在读取之后被释放的实例不会被更新，随即从本块中剔除，其费用由 sp_release_resource 从旧的 metered_until 计起。
+-- 全局只允许一个计量在运行 (GET_LOCK)。
+CREATE PROCEDURE `sp_meter_usage`(
+    IN p_chunk INT,
+    OUT p_instances INT,
+    OUT p_amount DECIMAL(14, 2)
+)
+BEGIN
+    DECLARE v_now DATETIME DEFAULT NOW();
+    DECLARE v_lo INT DEFAULT 0;
+    DECLARE v_hi INT;
+    DECLARE v_amount DECIMAL(14, 2);
+
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        DO RELEASE_LOCK('sp_meter_usage');
+        RESIGNAL;
+    END;
+
+    SET p_instances = 0;
+    SET p_amount = 0;
+
+    IF GET_LOCK('sp_meter_usage', 0) = 1 THEN
+        DROP TEMPORARY TABLE IF EXISTS `tmp_meter`;
+        CREATE TEMPORARY TABLE `tmp_meter` (
+            `node_id` INT NOT NULL,
+            `request_id` INT NOT NULL,
+            `user_id` INT NOT NULL,
+            `start_time` DATETIME NOT NULL,
+            `hourly_price` DECIMAL(10, 2) NOT NULL,
+            PRIMARY KEY (`node_id`)
+        );
+
+        chunk_loop: LOOP
+            SET TRANSACTION ISOLATION LEVEL READ COMMITTED;
+            START TRANSACTION;
+            DELETE FROM tmp_meter;
+
+            INSERT INTO tmp_meter (node_id, request_id, user_id, start_time, hourly_price)
+            SELECT vc.node_id, vc.request_id, r.user_id, COALESCE(vc.metered_until, vc.created_at), vc.hourly_price
+            FROM virtualcomputers vc
+            JOIN requests r ON r.request_id = vc.request_id
+            WHERE vc.status = 'running' AND vc.node_id > v_lo
+            ORDER BY vc.node_id
+            LIMIT p_chunk;
+
+            IF ROW_COUNT() = 0 THEN
+                COMMIT;
+                LEAVE chunk_loop;
+            END IF;
+            SELECT MAX(node_id) INTO v_hi FROM tmp_meter;
+
+            UPDATE virtualcomputers vc
+            JOIN tmp_meter t ON vc.node_id = t.node_id
+            SET vc.metered_until = v_now
+            WHERE vc.status = 'running' AND t.start_time < v_now;
+
+            -- 读取之后已被释放的实例
+            DELETE t FROM tmp_meter t
+            JOIN virtualcomputers vc ON vc.node_id = t.node_id
+            WHERE vc.status <> 'running';
+
+            INSERT INTO bills (user_id, request_id, node_id, start_time, end_time, hourly_rate, cost_amount, payment_status)
+            SELECT user_id, request_id, node_id, start_time, v_now, hourly_price,
+                   (TIMESTAMPDIFF(SECOND, start_time, v_now) / 3600.0) * hourly_price, 'unpaid'
+            FROM tmp_meter
+            WHERE start_time < v_now;
+            SET p_instances = p_instances + ROW_COUNT();
+
+            SELECT COALESCE(SUM(ROUND((TIMESTAMPDIFF(SECOND, start_time, v_now) / 3600.0) * hourly_price, 2)), 0)
+            INTO v_amount FROM tmp_meter WHERE start_time < v_now;
+            SET p_amount = p_amount + v_amount;
+
+            COMMIT;
+            SET v_lo = v_hi;
+        END LOOP;
+
+        DROP TEMPORARY TABLE IF EXISTS `tmp_meter`;
+        DO RELEASE_LOCK('sp_meter_usage');
+    ELSE
+        SET p_instances = -1;
+    END IF;
+END$$
+
+-- =======================================================
+-- 余额风险表整表刷新
+-- =======================================================
+-- available = 余额 - 未付账单 - 上次计量后尚未出账的费用；hours_left = available / 每小时消耗。
+-- 风险等级 (阈值与 advanced.sql 原高风险用户报表一致)：
+--   exhausted  有运行实例且 available <= 0
+--   critical   预计 5 小时内耗尽
+--   warning    available < 50000
+--   ok         其他
+CREATE PROCEDURE `sp_refresh_balance_risk`()
+BEGIN
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    SET TRANSACTION ISOLATION LEVEL READ COMMITTED;
+    START TRANSACTION;
+    DELETE FROM user_balance_risk;
+
+    INSERT INTO user_balance_risk (user_id, balance, unpaid_amount, accrued_amount, available, running_instances,
+                                   burn_rate, hours_left, exhausted_at, risk_level, refreshed_at)
+    SELECT user_id, balance, unpaid, accrued, available, running, burn,
+           hours_left,
+           IF(burn > 0, NOW() + INTERVAL ROUND(GREATEST(available, 0) / burn * 3600) SECOND, NULL),
+           CASE
+               WHEN running > 0 AND available <= 0 THEN 'exhausted'
+               WHEN hours_left < 5 THEN 'critical'
+               WHEN available < 50000 THEN 'warning'
+               ELSE 'ok'
+           END,
+           NOW()
+    FROM (
+        SELECT u.user_id, u.balance,
+               COALESCE(b.unpaid, 0) AS unpaid,
+               COALESCE(run.accrued, 0) AS accrued,
+               u.balance - COALESCE(b.unpaid, 0) - COALESCE(run.accrued, 0) AS available,
+               COALESCE(run.running, 0) AS running,
+               COALESCE(run.burn, 0) AS burn,
+               IF(COALESCE(run.burn, 0) > 0,
+                  GREATEST(u.balance - COALESCE(b.unpaid, 0) - COALESCE(run.accrued, 0), 0) / run.burn,
+                  NULL) AS hours_left
+        FROM users u
+        LEFT JOIN (
+            SELECT r.user_id, COUNT(*) AS running, SUM(vc.hourly_price) AS burn,
+                   SUM(TIMESTAMPDIFF(SECOND, COALESCE(vc.metered_until, vc.created_at), NOW()) / 3600.0 * vc.hourly_price) AS accrued
+            FROM virtualcomputers vc
+            JOIN requests r ON r.request_id = vc.request_id
+            WHERE vc.status = 'running'
+            GROUP BY r.user_id
+        ) run ON run.user_id = u.user_id
+        LEFT JOIN (
+            -- 与用户页 "待支付总额" 口径一致：异常终止任务的账单由管理员核实，不计入
+            SELECT bl.user_id, SUM(bl.cost_amount) AS unpaid
+            FROM bills bl
+            JOIN requests rq ON rq.request_id = bl.request_id
+            WHERE bl.payment_status = 'unpaid' AND rq.status != 'terminated'
+            GROUP BY bl.user_id
+        ) b ON b.user_id = u.user_id
+        WHERE run.running > 0 OR b.unpaid > 0
+    ) t;
+
+    COMMIT;
+END$$
+
+-- =======================================================
+-- 释放资源：与 0001 中的版本相同，只是计费起点改为 metered_until
+-- =======================================================
+CREATE PROCEDURE `sp_release_resource`(
+    IN p_node_id INT,
+    OUT p_result_status VARCHAR(50)
+)
+BEGIN
+    DECLARE v_req_id INT;
+    DECLARE v_user_id INT;
+    DECLARE v_vir_npu_id INT;
+    DECLARE v_vir_mem_id INT;
+    DECLARE v_vir_vol_id INT;
+    DECLARE v_phy_npu_id INT;
+    DECLARE v_phy_mem_id INT;
+    DECLARE v_phy_vol_id INT;
+    DECLARE v_phy_shard_no INT;
+    DECLARE v_cores_used INT;
+    DECLARE v_gpu_mem_used INT;
+    DECLARE v_ram_used INT;
+    DECLARE v_disk_used INT;
+    DECLARE v_start_time DATETIME;
+    DECLARE v_hourly_price DECIMAL(10, 2);
+    DECLARE v_current_status VARCHAR(50);
+    
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        SET p_result_status = 'SQL_ERROR';
+    END;
+
+    START TRANSACTION;
+
+    -- 计费起点：上次计量截止的时间 (sp_meter_usage 已出过账单的部分不再重复计费)
+    SELECT request_id, vir_NPU_id, vir_memory_id, vir_volume_id, COALESCE(metered_until, created_at), hourly_price, status
+    INTO v_req_id, v_vir_npu_id, v_vir_mem_id, v_vir_vol_id, v_start_time, v_hourly_price, v_current_status
+    FROM virtualcomputers WHERE node_id = p_node_id FOR UPDATE;
+
+    IF v_current_status IS NULL THEN
+        SET p_result_status = 'NOT_FOUND';
+        ROLLBACK;
+    ELSEIF v_current_status != 'running' THEN
+        SET p_result_status = 'ALREADY_STOPPED';
+        ROLLBACK;
+    ELSE
+        SELECT user_id INTO v_user_id FROM requests WHERE request_id = v_req_id;
+
+        SELECT NPU_id, virtual_cores, virtual_memory INTO v_phy_npu_id, v_cores_used, v_gpu_mem_used
+        FROM virtualcpu WHERE vir_NPU_id = v_vir_npu_id;
+        
+        SELECT memory_id, virtual_size INTO v_phy_mem_id, v_ram_used
+        FROM virtualmemory WHERE vir_memory_id = v_vir_mem_id;
+        
+        SELECT volume_id, shard_no, virtual_size INTO v_phy_vol_id, v_phy_shard_no, v_disk_used
+        FROM virtualvolume WHERE vir_volume_id = v_vir_vol_id;
+
+        UPDATE npus SET available_cores = available_cores + v_cores_used, available_memory = available_memory + v_gpu_mem_used WHERE NPU_id = v_phy_npu_id;
+        UPDATE memory SET available_size = available_size + v_ram_used WHERE memory_id = v_phy_mem_id;
+        -- 归还到分配时的分片，只锁这一行
+        UPDATE storage_shards SET available_size = available_size + v_disk_used
+        WHERE volume_id = v_phy_vol_id AND shard_no = v_phy_shard_no;
+
+        UPDATE virtualcpu SET status = 'released' WHERE vir_NPU_id = v_vir_npu_id;
+        UPDATE virtualmemory SET status = 'released' WHERE vir_memory_id = v_vir_mem_id;
+        UPDATE virtualvolume SET status = 'released' WHERE vir_volume_id = v_vir_vol_id;
+        UPDATE virtualcomputers SET status = 'terminated' WHERE node_id = p_node_id;
+        UPDATE requests SET status = 'completed', complete_time = NOW() WHERE request_id = v_req_id;
+
+        INSERT INTO bills (user_id, request_id, node_id, start_time, end_time, hourly_rate, cost_amount, payment_status)
+        VALUES (v_user_id, v_req_id, p_node_id, v_start_time, NOW(), v_hourly_price, (TIMESTAMPDIFF(SECOND, v_start_time, NOW()) / 3600.0) * v_hourly_price, 'unpaid');
+
+        INSERT INTO use_log (user_id, action, details) 
+        VALUES (v_user_id, 'release_resource', CONCAT('NodeID:', p_node_id, ' resources released. Bill generated.'));
+
+        SET p_result_status = 'SUCCESS';
+        COMMIT;
+    END IF;
+END$$
+
+DELIMITER ;
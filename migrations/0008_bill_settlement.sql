@@ -0,0 +1,123 @@
+-- =======================================================
+-- 0008 按用户维护的待支付汇总
+-- =======================================================
+-- 用户页的 "待支付总额" 原来每次都对该用户全部 unpaid 账单联 requests 求和。
+-- user_bill_summary 每个用户一行，由 bills / requests 上的触发器在同一事务内增量维护：
+--   unpaid_*    可由用户支付的账单 (所属任务不是 terminated)
+--   disputed_*  异常终止任务的账单 (需管理员核实，用户页不可支付)
+-- 任务被标记为 terminated (或从 terminated 改回) 时，由 requests 触发器把该任务的未付账单在两类之间移动。
+
+DROP TRIGGER IF EXISTS `trg_bills_billsum_ins`;
+DROP TRIGGER IF EXISTS `trg_bills_billsum_upd`;
+DROP TRIGGER IF EXISTS `trg_bills_billsum_del`;
+DROP TRIGGER IF EXISTS `trg_requests_billsum_upd`;
+DROP PROCEDURE IF EXISTS `sp_billsum_apply`;
+DROP TABLE IF EXISTS `user_bill_summary`;
+
+CREATE TABLE `user_bill_summary` (
+  `user_id` int NOT NULL,
+  `unpaid_bills` int NOT NULL DEFAULT 0,
+  `unpaid_amount` decimal(14, 2) NOT NULL DEFAULT 0.00,
+  `disputed_bills` int NOT NULL DEFAULT 0,
+  `disputed_amount` decimal(14, 2) NOT NULL DEFAULT 0.00,
+  PRIMARY KEY (`user_id`)
+) ENGINE = InnoDB CHARACTER SET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci;
+
+DELIMITER $$
+
+-- 把一组增量累加到用户行上，行不存在时创建
+CREATE PROCEDURE `sp_billsum_apply`(
+    IN p_user_id INT,
+    IN p_unpaid_bills INT, IN p_unpaid_amount DECIMAL(14, 2),
+    IN p_disputed_bills INT, IN p_disputed_amount DECIMAL(14, 2)
+)
+BEGIN
+    INSERT INTO user_bill_summary (user_id, unpaid_bills, unpaid_amount, disputed_bills, disputed_amount)
+    VALUES (p_user_id, p_unpaid_bills, p_unpaid_amount, p_disputed_bills, p_disputed_amount) AS d
+    ON DUPLICATE KEY UPDATE
+        unpaid_bills = user_bill_summary.unpaid_bills + d.unpaid_bills,
+        unpaid_amount = user_bill_summary.unpaid_amount + d.unpaid_amount,
+        disputed_bills = user_bill_summary.disputed_bills + d.disputed_bills,
+        disputed_amount = user_bill_summary.disputed_amount + d.disputed_amount;
+END$$
+
+CREATE TRIGGER `trg_bills_billsum_ins` AFTER INSERT ON `bills` FOR EACH ROW
+BEGIN
+    DECLARE v_terminated BOOLEAN;
+    IF NEW.payment_status = 'unpaid' THEN
+        SELECT status = 'terminated' INTO v_terminated FROM requests WHERE request_id = NEW.request_id;
+        IF v_terminated THEN
+            CALL sp_billsum_apply(NEW.user_id, 0, 0, 1, NEW.cost_amount);
+        ELSE
+            CALL sp_billsum_apply(NEW.user_id, 1, NEW.cost_amount, 0, 0);
+        END IF;
+    END IF;
+END$$
+
+CREATE TRIGGER `trg_bills_billsum_del` AFTER DELETE ON `bills` FOR EACH ROW
+BEGIN
+    DECLARE v_terminated BOOLEAN;
+    IF OLD.payment_status = 'unpaid' THEN
+        SELECT status = 'terminated' INTO v_terminated FROM requests WHERE request_id = OLD.request_id;
+        IF v_terminated THEN
+            CALL sp_billsum_apply(OLD.user_id, 0, 0, -1, -OLD.cost_amount);
+        ELSE
+            CALL sp_billsum_apply(OLD.user_id, -1, -OLD.cost_amount, 0, 0);
+        END IF;
+    END IF;
+END$$
+
+CREATE TRIGGER `trg_bills_billsum_upd` AFTER UPDATE ON `bills` FOR EACH ROW
+BEGIN
+    DECLARE v_terminated BOOLEAN;
+    -- 只有影响汇总的列变化时才碰汇总行 (支付时 unpaid -> paid)
+    IF NOT (NEW.payment_status <=> OLD.payment_status) OR NEW.cost_amount <> OLD.cost_amount
+       OR NEW.user_id <> OLD.user_id OR NEW.request_id <> OLD.request_id THEN
+        IF OLD.payment_status = 'unpaid' THEN
+            SELECT status = 'terminated' INTO v_terminated FROM requests WHERE request_id = OLD.request_id;
+            IF v_terminated THEN
+                CALL sp_billsum_apply(OLD.user_id, 0, 0, -1, -OLD.cost_amount);
+            ELSE
+                CALL sp_billsum_apply(OLD.user_id, -1, -OLD.cost_amount, 0, 0);
+            END IF;
+        END IF;
+        IF NEW.payment_status = 'unpaid' THEN
+            SELECT status = 'terminated' INTO v_terminated FROM requests WHERE request_id = NEW.request_id;
+            IF v_terminated THEN
+                CALL sp_billsum_apply(NEW.user_id, 0, 0, 1, NEW.cost_amount);
+            ELSE
+                CALL sp_billsum_apply(NEW.user_id, 1, NEW.cost_amount, 0, 0);
+            END IF;
+        END IF;
+    END IF;
+END$$
+
+CREATE TRIGGER `trg_requests_billsum_upd` AFTER UPDATE ON `requests` FOR EACH ROW
+BEGIN
+    DECLARE v_bills INT;
+    DECLARE v_amount DECIMAL(14, 2);
+    IF (NEW.status = 'terminated') <> (OLD.status = 'terminated') THEN
+        -- 走 idx_bill_req；一个任务只有释放时的一张账单加上周期计量出的若干张
+        SELECT COUNT(*), COALESCE(SUM(cost_amount), 0) INTO v_bills, v_amount
+        FROM bills WHERE request_id = NEW.request_id AND payment_status = 'unpaid';
+        IF v_bills > 0 THEN
+            IF NEW.status = 'terminated' THEN
+                CALL sp_billsum_apply(NEW.user_id, -v_bills, -v_amount, v_bills, v_amount);
+            ELSE
+                CALL sp_billsum_apply(NEW.user_id, v_bills, v_amount, -v_bills, -v_amount);
+            END IF;
+        END IF;
+    END IF;
+END$$
+
+DELIMITER ;
+
+-- 初始填充
+INSERT INTO user_bill_summary (user_id, unpaid_bills, unpaid_amount, disputed_bills, disputed_amount)
+SELECT b.user_id,
+       SUM(r.status != 'terminated'), SUM(IF(r.status != 'terminated', b.cost_amount, 0)),
+       SUM(r.status = 'terminated'), SUM(IF(r.status = 'terminated', b.cost_amount, 0))
+FROM bills b
+JOIN requests r ON r.request_id = b.request_id
+WHERE b.payment_status = 'unpaid'
+GROUP BY b.user_id;
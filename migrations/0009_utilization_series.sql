@@ -0,0 +1,143 @@
+-- =======================================================
+-- 0009 利用率时间序列 (原始采样 -> 5 分钟 -> 1 小时)
+-- =======================================================
+-- util_series 一张表存三种精度，resolution 为桶宽 (秒)，0 表示原始采样：
+--   scope = 'queue'  entity = 队列名        (核数 / 显存 / 内存 / 运行实例数 / 每小时营收)
+--   scope = 'npu'    entity = NPU_id       (核数 / 显存 / 运行实例数 / 每小时营收，无内存)
+-- 每个指标存 桶内求和 + 桶内最大值，samples 为桶内原始采样数，平均值 = sum / samples；
+-- 汇总时只需再求和，平均值在任意精度上都精确。容量 (*_total) 取桶内最大值。
+--
+-- sp_util_sample:  采一次原始样本，桶按采样间隔取整，多个采样进程同时运行也只写入一份 (INSERT IGNORE)。
+-- sp_util_rollup:  把已经结束的桶从低精度汇总到高精度，util_rollup_state 记录每个精度已汇总到的时间；
+--                  高精度桶整桶重算后覆盖写入，重复执行结果相同。
+-- 过期数据的删除由 timeseries.py 按保留策略分批执行。
+
+DROP PROCEDURE IF EXISTS `sp_util_sample`;
+DROP PROCEDURE IF EXISTS `sp_util_rollup`;
+DROP TABLE IF EXISTS `util_rollup_state`;
+DROP TABLE IF EXISTS `util_series`;
+
+CREATE TABLE `util_series` (
+  `resolution` int NOT NULL,
+  `scope` varchar(10) NOT NULL,
+  `entity` varchar(100) NOT NULL,
+  `bucket` datetime NOT NULL,
+  `samples` int NOT NULL,
+  `cores_total` int NOT NULL,
+  `cores_used_sum` bigint NOT NULL,
+  `cores_used_max` int NOT NULL,
+  `gpu_mem_total` int NOT NULL,
+  `gpu_mem_used_sum` bigint NOT NULL,
+  `gpu_mem_used_max` int NOT NULL,
+  `ram_total` int NOT NULL,
+  `ram_used_sum` bigint NOT NULL,
+  `ram_used_max` int NOT NULL,
+  `instances_sum` bigint NOT NULL,
+  `instances_max` int NOT NULL,
+  `revenue_sum` decimal(16, 2) NOT NULL,
+  `revenue_max` decimal(12, 2) NOT NULL,
+  PRIMARY KEY (`resolution`, `scope`, `entity`, `bucket`),
+  -- 汇总与按保留期删除按 (精度, 时间) 扫描
+  INDEX `idx_util_res_bucket`(`resolution`, `bucket`)
+) ENGINE = InnoDB CHARACTER SET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci;
+
+CREATE TABLE `util_rollup_state` (
+  `resolution` int NOT NULL,
+  `rolled_until` datetime NOT NULL,
+  PRIMARY KEY (`resolution`)
+) ENGINE = InnoDB CHARACTER SET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci;
+
+DELIMITER $$
+
+CREATE PROCEDURE `sp_util_sample`(IN p_interval INT)
+BEGIN
+    DECLARE v_bucket DATETIME DEFAULT FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP() / p_interval) * p_interval);
+
+    -- 按队列：容量来自触发器维护的 capacity_summary，运行实例 / 营收走 idx_vc_status
+    INSERT IGNORE INTO util_series (resolution, scope, entity, bucket, samples,
+        cores_total, cores_used_sum, cores_used_max, gpu_mem_total, gpu_mem_used_sum, gpu_mem_used_max,
+        ram_total, ram_used_sum, ram_used_max, instances_sum, instances_max, revenue_sum, revenue_max)
+    SELECT 0, 'queue', q.queue_type, v_bucket, 1,
+           q.total_cores, q.used_cores, q.used_cores, q.total_gpu_mem, q.used_gpu_mem, q.used_gpu_mem,
+           q.total_ram, q.used_ram, q.used_ram,
+           COALESCE(run.instances, 0), COALESCE(run.instances, 0), COALESCE(run.revenue, 0), COALESCE(run.revenue, 0)
+    FROM v_queue_capacity q
+    LEFT JOIN (
+        SELECT queue_name, COUNT(*) AS instances, SUM(hourly_price) AS revenue
+        FROM virtualcomputers WHERE status = 'running'
+        GROUP BY queue_name
+    ) run ON run.queue_name = q.queue_type;
+
+    -- 按物理 NPU
+    INSERT IGNORE INTO util_series (resolution, scope, entity, bucket, samples,
+        cores_total, cores_used_sum, cores_used_max, gpu_mem_total, gpu_mem_used_sum, gpu_mem_used_max,
+        ram_total, ram_used_sum, ram_used_max, instances_sum, instances_max, revenue_sum, revenue_max)
+    SELECT 0, 'npu', n.NPU_id, v_bucket, 1,
+           n.cores, n.cores - n.available_cores, n.cores - n.available_cores,
+           n.NPU_memory, n.NPU_memory - n.available_memory, n.NPU_memory - n.available_memory,
+           0, 0, 0,
+           COALESCE(run.instances, 0), COALESCE(run.instances, 0), COALESCE(run.revenue, 0), COALESCE(run.revenue, 0)
+    FROM npus n
+    LEFT JOIN (
+        SELECT vcpu.NPU_id, COUNT(*) AS instances, SUM(vc.hourly_price) AS revenue
+        FROM virtualcomputers vc
+        JOIN virtualcpu vcpu ON vcpu.vir_NPU_id = vc.vir_NPU_id
+        WHERE vc.status = 'running'
+        GROUP BY vcpu.NPU_id
+    ) run ON run.NPU_id = n.NPU_id;
+END$$
+
+-- 把 p_src 精度中已结束的 p_dst 桶汇总到 p_dst 精度
+-- 上界：p_dst 桶在当前时间之前结束，且 (p_src 不是原始采样时) 不超过 p_src 自己已汇总到的位置
+CREATE PROCEDURE `sp_util_rollup`(IN p_src INT, IN p_dst INT, OUT p_rows INT)
+BEGIN
+    DECLARE v_from DATETIME;
+    DECLARE v_until DATETIME DEFAULT FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP() / p_dst) * p_dst);
+    DECLARE v_src_until DATETIME;
+
+    SELECT rolled_until INTO v_from FROM util_rollup_state WHERE resolution = p_dst;
+    IF v_from IS NULL THEN
+        SELECT FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(MIN(bucket)) / p_dst) * p_dst) INTO v_from
+        FROM util_series WHERE resolution = p_src;
+    END IF;
+    IF p_src > 0 THEN
+        SELECT rolled_until INTO v_src_until FROM util_rollup_state WHERE resolution = p_src;
+        SET v_until = LEAST(v_until, FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(COALESCE(v_src_until, v_from)) / p_dst) * p_dst));
+    END IF;
+
+    SET p_rows = 0;
+    IF v_from IS NOT NULL AND v_from < v_until THEN
+        INSERT INTO util_series (resolution, scope, entity, bucket, samples,
+            cores_total, cores_used_sum, cores_used_max, gpu_mem_total, gpu_mem_used_sum, gpu_mem_used_max,
+            ram_total, ram_used_sum, ram_used_max, instances_sum, instances_max, revenue_sum, revenue_max)
+        SELECT * FROM (
+            SELECT p_dst AS resolution, scope, entity,
+                   FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(bucket) / p_dst) * p_dst) AS dst_bucket,
+                   SUM(samples) AS samples,
+                   MAX(cores_total) AS cores_total, SUM(cores_used_sum) AS cores_used_sum,
+                   MAX(cores_used_max) AS cores_used_max,
+                   MAX(gpu_mem_total) AS gpu_mem_total, SUM(gpu_mem_used_sum) AS gpu_mem_used_sum,
+                   MAX(gpu_mem_used_max) AS gpu_mem_used_max,
+                   MAX(ram_total) AS ram_total, SUM(ram_used_sum) AS ram_used_sum, MAX(ram_used_max) AS ram_used_max,
+                   SUM(instances_sum) AS instances_sum, MAX(instances_max) AS instances_max,
+                   SUM(revenue_sum) AS revenue_sum, MAX(revenue_max) AS revenue_max
+            FROM util_series
+            WHERE resolution = p_src AND bucket >= v_from AND bucket < v_until
+            GROUP BY scope, entity, dst_bucket
+        ) AS d
+        ON DUPLICATE KEY UPDATE
+            samples = d.samples,
+            cores_total = d.cores_total, cores_used_sum = d.cores_used_sum, cores_used_max = d.cores_used_max,
+            gpu_mem_total = d.gpu_mem_total, gpu_mem_used_sum = d.gpu_mem_used_sum,
+            gpu_mem_used_max = d.gpu_mem_used_max,
+            ram_total = d.ram_total, ram_used_sum = d.ram_used_sum, ram_used_max = d.ram_used_max,
+            instances_sum = d.instances_sum, instances_max = d.instances_max,
+            revenue_sum = d.revenue_sum, revenue_max = d.revenue_max;
+        SET p_rows = ROW_COUNT();
+
+        INSERT INTO util_rollup_state (resolution, rolled_until) VALUES (p_dst, v_until) AS s
+        ON DUPLICATE KEY UPDATE rolled_until = GREATEST(util_rollup_state.rolled_until, s.rolled_until);
+    END IF;
+END$$
+
+DELIMITER ;
@@ -0,0 +1,62 @@
+-- =======================================================
+-- 0010 use_log 按月分区 (配合 archive.py 冷数据归档)
+-- =======================================================
+-- use_log 只追加、按时间整段过期，适合 RANGE COLUMNS(created_at) 按月分区：
+-- 归档时把整个月份分区导出为 Parquet 后 DROP PARTITION，不用逐行 DELETE。
+--
+-- 外键：InnoDB 分区表不支持外键，原 use_log_ibfk_1 (user_id -> users, ON DELETE CASCADE) 删除，
+-- 改由 users 上的 AFTER DELETE 触发器清理该用户的日志。
+-- 分区键必须包含在主键中，主键改为 (log_id, created_at)，created_at 改为 NOT NULL。
+--
+-- requests / bills / virtualcomputers 之间互有外键 (含 requests.node_id <-> virtualcomputers 的环)，
+-- 分区需要拆掉整张外键网，因此这三张表不分区，由 archive.py 按外键顺序整组搬到归档文件 (冷热分离)。
+
+DROP PROCEDURE IF EXISTS `sp_use_log_add_partitions`;
+DROP TRIGGER IF EXISTS `trg_users_use_log_del`;
+
+ALTER TABLE `use_log` DROP FOREIGN KEY `use_log_ibfk_1`;
+UPDATE `use_log` SET `created_at` = '1970-01-01 00:00:00' WHERE `created_at` IS NULL;
+ALTER TABLE `use_log`
+  MODIFY `created_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  DROP PRIMARY KEY,
+  ADD PRIMARY KEY (`log_id`, `created_at`);
+
+-- p_old 收纳 2026 年以前的全部日志；之后每月一个分区 pYYYYMM，由 sp_use_log_add_partitions 预建
+ALTER TABLE `use_log` PARTITION BY RANGE COLUMNS(`created_at`) (
+  PARTITION `p_old` VALUES LESS THAN ('2026-01-01'),
+  PARTITION `p_future` VALUES LESS THAN (MAXVALUE)
+);
+
+DELIMITER $$
+
+-- 从 p_future 中切出月份分区，直到覆盖当前月之后 p_ahead 个月 (archive.py 每轮调用)
+CREATE PROCEDURE `sp_use_log_add_partitions`(IN p_ahead INT)
+BEGIN
+    DECLARE v_next DATE;
+    DECLARE v_until DATE DEFAULT DATE_ADD(DATE_FORMAT(CURDATE(), '%Y-%m-01'), INTERVAL p_ahead + 1 MONTH);
+
+    SELECT CAST(TRIM(BOTH '''' FROM MAX(PARTITION_DESCRIPTION)) AS DATE) INTO v_next
+    FROM information_schema.PARTITIONS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'use_log' AND PARTITION_NAME <> 'p_future';
+
+    WHILE v_next < v_until DO
+        SET @ddl = CONCAT('ALTER TABLE use_log REORGANIZE PARTITION p_future INTO (',
+                          'PARTITION p', DATE_FORMAT(v_next, '%Y%m'),
+                          ' VALUES LESS THAN (''', DATE_ADD(v_next, INTERVAL 1 MONTH), '''), ',
+                          'PARTITION p_future VALUES LESS THAN (MAXVALUE))');
+        PREPARE stmt FROM @ddl;
+        EXECUTE stmt;
+        DEALLOCATE PREPARE stmt;
+        SET v_next = DATE_ADD(v_next, INTERVAL 1 MONTH);
+    END WHILE;
+END$$
+
+-- 代替原外键的 ON DELETE CASCADE
+CREATE TRIGGER `trg_users_use_log_del` AFTER DELETE ON `users` FOR EACH ROW
+BEGIN
+    DELETE FROM use_log WHERE user_id = OLD.user_id;
+END$$
+
+DELIMITER ;
+
+CALL sp_use_log_add_partitions(3);
@@ -0,0 +1,143 @@
+-- =======================================================
+-- 0011 集合式批量释放
+-- =======================================================
+-- 原来管理后台逐个节点调用 sp_release_resource，再补两条 UPDATE (requests / virtualcomputers 状态) 并提交，
+-- 每个节点 4 次往返；排空一个队列或终止一个用户的全部实例要逐条点击。
+--
+-- sp_release_batch: 一次调用、一个事务释放一批节点：
+--     锁定 virtualcomputers 行 -> 逐节点判定结果 -> 按物理 NPU / 内存 / 存储分片汇总后各一条 UPDATE 归还容量
+--     -> 虚拟资源置 released、实例置 terminated、请求置 p_final_status -> 批量写账单与 use_log。
+--     计费与 sp_release_resource 一致 (从 metered_until 起算)。
+--     capacity_summary (0006) 与 user_bill_summary (0008) 由各自的触发器随本事务一起维护。
+
+DROP PROCEDURE IF EXISTS `sp_release_batch`;
+
+DELIMITER $$
+
+-- p_nodes: JSON 数组 [node_id, ...]；p_final_status: 'completed' / 'terminated'
+-- 返回结果集: node_id, request_id, result (SUCCESS / ALREADY_STOPPED / NOT_FOUND)；出错时整批回滚并抛出
+CREATE PROCEDURE `sp_release_batch`(
+    IN p_nodes JSON,
+    IN p_final_status VARCHAR(50)
+)
+BEGIN
+    DECLARE v_now DATETIME DEFAULT NOW();
+    DECLARE v_locked INT;
+
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        DROP TEMPORARY TABLE IF EXISTS `tmp_release`;
+        DROP TEMPORARY TABLE IF EXISTS `tmp_release_work`;
+        RESIGNAL;
+    END;
+
+    IF p_final_status NOT IN ('completed', 'terminated') THEN
+        SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'p_final_status must be completed or terminated';
+    END IF;
+
+    DROP TEMPORARY TABLE IF EXISTS `tmp_release`;
+    CREATE TEMPORARY TABLE `tmp_release` (
+        `node_id` INT NOT NULL,
+        `request_id` INT NULL,
+        `result` VARCHAR(20) NULL,
+        PRIMARY KEY (`node_id`)
+    );
+    DROP TEMPORARY TABLE IF EXISTS `tmp_release_work`;
+    CREATE TEMPORARY TABLE `tmp_release_work` (
+        `node_id` INT NOT NULL,
+        `request_id` INT NOT NULL,
+        `user_id` INT NOT NULL,
+        `start_time` DATETIME NOT NULL,
+        `hourly_price` DECIMAL(10, 2) NOT NULL,
+        `vir_NPU_id` INT NOT NULL,
+        `NPU_id` INT NOT NULL,
+        `cores` INT NOT NULL,
+        `gpu_mem` INT NOT NULL,
+        `vir_memory_id` INT NOT NULL,
+        `memory_id` INT NOT NULL,
+        `ram` INT NOT NULL,
+        `vir_volume_id` INT NOT NULL,
+        `volume_id` INT NOT NULL,
+        `shard_no` INT NOT NULL,
+        `disk` INT NOT NULL,
+        PRIMARY KEY (`node_id`)
+    );
+
+    INSERT IGNORE INTO tmp_release (node_id)
+    SELECT jt.node_id FROM JSON_TABLE(p_nodes, '$[*]' COLUMNS (`node_id` INT PATH '$')) jt
+    WHERE jt.node_id IS NOT NULL;
+
+    -- READ COMMITTED：锁定读之后的普通读取能看到已锁定行的最新值，也不加间隙锁
+    SET TRANSACTION ISOLATION LEVEL READ COMMITTED;
+    START TRANSACTION;
+
+    -- 先锁住全部实例行 (与 sp_release_resource 相同：先实例、后物理资源)
+    SELECT COUNT(*) INTO v_locked
+    FROM tmp_release t
+    JOIN virtualcomputers vc ON vc.node_id = t.node_id
+    FOR UPDATE OF vc;
+
+    UPDATE tmp_release t
+    LEFT JOIN virtualcomputers vc ON vc.node_id = t.node_id
+    SET t.request_id = vc.request_id,
+        t.result = CASE
+            WHEN vc.node_id IS NULL THEN 'NOT_FOUND'
+            WHEN vc.status <> 'running' THEN 'ALREADY_STOPPED'
+            ELSE 'SUCCESS'
+        END;
+
+    INSERT INTO tmp_release_work
+    SELECT vc.node_id, vc.request_id, r.user_id, COALESCE(vc.metered_until, vc.created_at), vc.hourly_price,
+           vcpu.vir_NPU_id, vcpu.NPU_id, vcpu.virtual_cores, vcpu.virtual_memory,
+           vm.vir_memory_id, vm.memory_id, vm.virtual_size,
+           vv.vir_volume_id, vv.volume_id, vv.shard_no, vv.virtual_size
+    FROM tmp_release t
+    JOIN virtualcomputers vc ON vc.node_id = t.node_id
+    JOIN requests r ON r.request_id = vc.request_id
+    JOIN virtualcpu vcpu ON vcpu.vir_NPU_id = vc.vir_NPU_id
+    JOIN virtualmemory vm ON vm.vir_memory_id = vc.vir_memory_id
+    JOIN virtualvolume vv ON vv.vir_volume_id = vc.vir_volume_id
+    WHERE t.result = 'SUCCESS';
+
+    -- 归还容量：每个物理行一条更新，按主键顺序加锁
+    UPDATE npus n
+    JOIN (SELECT NPU_id, SUM(cores) AS cores, SUM(gpu_mem) AS gpu_mem
+          FROM tmp_release_work GROUP BY NPU_id) w ON w.NPU_id = n.NPU_id
+    SET n.available_cores = n.available_cores + w.cores,
+        n.available_memory = n.available_memory + w.gpu_mem;
+
+    UPDATE memory m
+    JOIN (SELECT memory_id, SUM(ram) AS ram FROM tmp_release_work GROUP BY memory_id) w ON w.memory_id = m.memory_id
+    SET m.available_size = m.available_size + w.ram;
+
+    UPDATE storage_shards s
+    JOIN (SELECT volume_id, shard_no, SUM(disk) AS disk
+          FROM tmp_release_work GROUP BY volume_id, shard_no) w
+      ON w.volume_id = s.volume_id AND w.shard_no = s.shard_no
+    SET s.available_size = s.available_size + w.disk;
+
+    UPDATE virtualcpu v JOIN tmp_release_work w ON w.vir_NPU_id = v.vir_NPU_id SET v.status = 'released';
+    UPDATE virtualmemory v JOIN tmp_release_work w ON w.vir_memory_id = v.vir_memory_id SET v.status = 'released';
+    UPDATE virtualvolume v JOIN tmp_release_work w ON w.vir_volume_id = v.vir_volume_id SET v.status = 'released';
+    UPDATE virtualcomputers vc JOIN tmp_release_work w ON w.node_id = vc.node_id SET vc.status = 'terminated';
+    UPDATE requests r JOIN tmp_release_work w ON w.request_id = r.request_id
+    SET r.status = p_final_status, r.complete_time = v_now;
+
+    INSERT INTO bills (user_id, request_id, node_id, start_time, end_time, hourly_rate, cost_amount, payment_status)
+    SELECT user_id, request_id, node_id, start_time, v_now, hourly_price,
+           (TIMESTAMPDIFF(SECOND, start_time, v_now) / 3600.0) * hourly_price, 'unpaid'
+    FROM tmp_release_work;
+
+    INSERT INTO use_log (user_id, action, details)
+    SELECT user_id, 'release_resource', CONCAT('NodeID:', node_id, ' resources released. Bill generated.')
+    FROM tmp_release_work;
+
+    COMMIT;
+
+    SELECT node_id, request_id, result FROM tmp_release ORDER BY node_id;
+    DROP TEMPORARY TABLE `tmp_release`;
+    DROP TEMPORARY TABLE `tmp_release_work`;
+END$$
+
+DELIMITER ;
@@ -0,0 +1,91 @@
+-- =======================================================
+-- 0012 node_name 号段分配 (替换 FLOOR(RAND() * 900000 + 100000))
+-- =======================================================
+-- 原来 sp_bind_instance 随机取一个 6 位数作为 node_name (唯一索引)。按生日界，实例数到一千左右就很可能撞号，
+-- 一旦撞号整个分配事务回滚，而此前物理资源行已经加锁，负载越高无谓的锁等待和失败越多。
+--
+-- 号段分配：node_name_blocks 的自增主键就是号段号，号段 k 覆盖 [k * 100, k * 100 + 99]。
+-- 每个连接 (分配者) 用会话变量 @node_name_next / @node_name_last 记住手里的号段，用完再取下一段：
+-- - 取号段是一次自增 INSERT，自增值在语句结束时即释放自增锁 (innodb_autoinc_lock_mode = 2)，
+--   不同连接之间没有行锁竞争，号段本身不会被任何其他连接拿到
+-- - 事务回滚只会留下空号 (自增值不回收)，不会重复；连接被重置时丢掉剩余号码，同样只是空号
+-- - 只要没有其他途径直接写 node_name，分配出的名称不会冲突
+--
+-- 已有数据：旧的随机名称都是 6 位数，保持不变 (用户已经看到的节点名不改)；
+-- 号段从 max(1000000, 现有最大 node_name + 1) 所在的号段开始，新名称为 7 位数起的递增编号。
+
+DROP PROCEDURE IF EXISTS `sp_next_node_name`;
+DROP PROCEDURE IF EXISTS `sp_bind_instance`;
+DROP TABLE IF EXISTS `node_name_blocks`;
+
+CREATE TABLE `node_name_blocks` (
+  `block_id` int NOT NULL AUTO_INCREMENT,
+  `connection_id` bigint NOT NULL,
+  `allocated_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`block_id`)
+) ENGINE = InnoDB CHARACTER SET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci;
+
+-- 起始号段：越过全部现有名称
+SELECT CEIL(GREATEST(1000000, COALESCE(MAX(node_name), 0) + 1) / 100) INTO @node_name_first_block FROM virtualcomputers;
+SET @node_name_sql = CONCAT('ALTER TABLE `node_name_blocks` AUTO_INCREMENT = ', @node_name_first_block);
+PREPARE node_name_stmt FROM @node_name_sql;
+EXECUTE node_name_stmt;
+DEALLOCATE PREPARE node_name_stmt;
+SET @node_name_first_block = NULL, @node_name_sql = NULL;
+
+DELIMITER $$
+
+-- 下一个 node_name：当前连接号段内递增，号段用完时取新号段
+CREATE PROCEDURE `sp_next_node_name`(
+    OUT p_name INT
+)
+BEGIN
+    IF @node_name_next IS NULL OR @node_name_next > @node_name_last THEN
+        INSERT INTO node_name_blocks (connection_id) VALUES (CONNECTION_ID());
+        SET @node_name_next = LAST_INSERT_ID() * 100;
+        SET @node_name_last = @node_name_next + 99;
+    END IF;
+    SET p_name = @node_name_next;
+    SET @node_name_next = @node_name_next + 1;
+END$$
+
+-- 与 0002 中的版本相同，只是 node_name 改由 sp_next_node_name 分配
+CREATE PROCEDURE `sp_bind_instance`(
+    IN p_existing_req_id INT,
+    IN p_queue_name VARCHAR(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci,
+    IN p_npu_id INT,
+    IN p_mem_id INT,
+    IN p_vol_id INT,
+    IN p_shard_no INT,
+    IN p_req_cores INT,
+    IN p_req_gpu_mem INT,
+    IN p_req_ram INT,
+    IN p_req_disk INT,
+    IN p_price DECIMAL(10,2),
+    OUT p_node_id INT
+)
+BEGIN
+    DECLARE v_vir_npu INT;
+    DECLARE v_vir_mem INT;
+    DECLARE v_vir_vol INT;
+    DECLARE v_node_name INT;
+
+    INSERT INTO virtualcpu (NPU_id, virtual_cores, virtual_memory) VALUES (p_npu_id, p_req_cores, p_req_gpu_mem);
+    SET v_vir_npu = LAST_INSERT_ID();
+
+    INSERT INTO virtualmemory (memory_id, virtual_size) VALUES (p_mem_id, p_req_ram);
+    SET v_vir_mem = LAST_INSERT_ID();
+
+    INSERT INTO virtualvolume (volume_id, virtual_size, shard_no) VALUES (p_vol_id, p_req_disk, p_shard_no);
+    SET v_vir_vol = LAST_INSERT_ID();
+
+    CALL sp_next_node_name(v_node_name);
+    INSERT INTO virtualcomputers (request_id, node_name, queue_name, vir_NPU_id, vir_memory_id, vir_volume_id, hourly_price, status)
+    VALUES (p_existing_req_id, v_node_name, p_queue_name, v_vir_npu, v_vir_mem, v_vir_vol, p_price, 'running');
+    SET p_node_id = LAST_INSERT_ID();
+
+    INSERT INTO use_log (user_id, action, details)
+    VALUES ((SELECT user_id FROM requests WHERE request_id = p_existing_req_id), 'create_success', CONCAT('NodeID:', p_node_id, ' Created'));
+END$$
+
+DELIMITER ;
@@ -0,0 +1,134 @@
+-- =======================================================
+-- 0013 批量审批遇到死锁 / 锁等待超时时整批回滚
+-- =======================================================
+-- 原 sp_approve_batch 用 CONTINUE HANDLER + ROLLBACK TO SAVEPOINT 隔离单条请求的失败，
+-- 前提是出错时只有这一条的语句被撤销。死锁 (1213) 时 InnoDB 回滚的是整个事务，保存点已不存在：
+-- ROLLBACK TO 本身报错，而此前已写入 tmp_batch_result 的 APPROVED 实际上都被回滚了，
+-- 循环还会在一个新的隐式事务里继续处理剩下的请求。
+-- 锁等待超时 (1205) 同样按整批处理 (innodb_rollback_on_timeout 打开时也是整个事务回滚)。
+--
+-- 现在处理器用 GET DIAGNOSTICS 记下错误号；遇到 1213 / 1205 时立即 ROLLBACK、停止循环，
+-- 本批每条请求都报告为 DEADLOCK (均未分配)，由调用方 (admin.approve_requests) 刷新索引后整批重试。
+-- 其他错误仍按单条 SQL_ERROR 处理。
+
+DROP PROCEDURE IF EXISTS `sp_approve_batch`;
+
+DELIMITER $$
+
+-- 返回结果集: request_id, result (APPROVED / NO_CAPACITY / CONFLICT / NOT_PENDING / NOT_FOUND / SQL_ERROR / DEADLOCK), node_id
+CREATE PROCEDURE `sp_approve_batch`(
+    IN p_items JSON
+)
+BEGIN
+    DECLARE v_i INT DEFAULT 0;
+    DECLARE v_n INT DEFAULT 0;
+    DECLARE v_req_id INT;
+    DECLARE v_queue VARCHAR(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci;
+    DECLARE v_cores INT;
+    DECLARE v_gpu_mem INT;
+    DECLARE v_ram INT;
+    DECLARE v_disk INT;
+    DECLARE v_status VARCHAR(50);
+    DECLARE v_node_id INT;
+    DECLARE v_npu_id INT;
+    DECLARE v_item_error INT DEFAULT 0;
+    DECLARE v_errno INT DEFAULT 0;
+    DECLARE v_aborted INT DEFAULT 0;
+
+    DECLARE CONTINUE HANDLER FOR SQLEXCEPTION
+    BEGIN
+        GET DIAGNOSTICS CONDITION 1 v_errno = MYSQL_ERRNO;
+        SET v_item_error = 1;
+    END;
+
+    DROP TEMPORARY TABLE IF EXISTS `tmp_batch_result`;
+    CREATE TEMPORARY TABLE `tmp_batch_result` (
+        `seq` INT NOT NULL,
+        `request_id` INT NULL,
+        `result` VARCHAR(20) NOT NULL,
+        `node_id` INT NULL,
+        PRIMARY KEY (`seq`)
+    );
+
+    SET v_n = JSON_LENGTH(p_items);
+
+    START TRANSACTION;
+
+    batch_loop: WHILE v_i < v_n DO
+        SET v_req_id  = JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].request_id'));
+        SET v_queue   = JSON_UNQUOTE(JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].queue')));
+        SET v_cores   = COALESCE(JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].cores')), 1);
+        SET v_gpu_mem = COALESCE(JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].gpu_mem')), 0);
+        SET v_ram     = COALESCE(JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].ram')), 1);
+        SET v_disk    = COALESCE(JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].disk')), 10);
+        SET v_npu_id  = JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].npu_id'));
+        SET v_status = NULL;
+        SET v_node_id = -1;
+        SET v_item_error = 0;
+        SET v_errno = 0;
+
+        SAVEPOINT batch_item;
+
+        -- 锁住请求行，避免两个管理员同时审批同一条请求
+        SELECT status INTO v_status FROM requests WHERE request_id = v_req_id FOR UPDATE;
+
+        IF v_item_error = 0 AND v_status IS NOT NULL AND v_status = 'pending' THEN
+            IF v_npu_id IS NULL THEN
+                CALL sp_allocate_instance(v_req_id, v_queue, v_cores, v_gpu_mem, v_ram, v_disk, v_node_id);
+            ELSE
+                CALL sp_allocate_at(v_req_id, v_queue, v_cores, v_gpu_mem, v_ram, v_disk,
+                                    v_npu_id,
+                                    JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].expect_cores')),
+                                    JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].expect_gpu_mem')),
+                                    JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].mem_id')),
+                                    JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].expect_ram')),
+                                    v_node_id);
+            END IF;
+            IF v_item_error = 0 AND v_node_id > 0 THEN
+                UPDATE requests SET status = 'approved', node_id = v_node_id WHERE request_id = v_req_id;
+            END IF;
+        END IF;
+
+        -- 死锁 / 锁等待超时：整个事务已经 (或应当) 回滚，保存点不可用，放弃整批
+        IF v_errno IN (1213, 1205) THEN
+            SET v_aborted = 1;
+            LEAVE batch_loop;
+        END IF;
+
+        IF v_item_error = 1 THEN
+            ROLLBACK TO SAVEPOINT batch_item;
+            INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'SQL_ERROR', NULL);
+        ELSEIF v_status IS NULL THEN
+            INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'NOT_FOUND', NULL);
+        ELSEIF v_status != 'pending' THEN
+            INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'NOT_PENDING', NULL);
+        ELSEIF v_node_id > 0 THEN
+            INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'APPROVED', v_node_id);
+        ELSEIF v_node_id IN (-2, -3) THEN
+            INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'CONFLICT', NULL);
+        ELSE
+            INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'NO_CAPACITY', NULL);
+        END IF;
+
+        SET v_i = v_i + 1;
+    END WHILE;
+
+    IF v_aborted = 1 THEN
+        ROLLBACK;
+        -- 此前记下的结果一律作废，整批报告为未分配
+        DELETE FROM tmp_batch_result;
+        SET v_i = 0;
+        WHILE v_i < v_n DO
+            INSERT INTO tmp_batch_result
+            VALUES (v_i, JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].request_id')), 'DEADLOCK', NULL);
+            SET v_i = v_i + 1;
+        END WHILE;
+    ELSE
+        COMMIT;
+    END IF;
+
+    SELECT request_id, result, node_id FROM tmp_batch_result ORDER BY seq;
+    DROP TEMPORARY TABLE `tmp_batch_result`;
+END$$
+
+DELIMITER ;
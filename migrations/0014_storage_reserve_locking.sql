@@ -0,0 +1,102 @@
+-- =======================================================
+-- 0014 sp_storage_reserve 的加锁修正
+-- =======================================================
+-- 1. 阻塞路径锁住整卷分片后，选分片用的是普通 SELECT：REPEATABLE READ 下读到的是事务快照而不是
+--    刚锁住的当前值，v_avail 可能通过检查而真实分片不够，跳过集中余量后扣减把 available_size 减成负数。
+--    现在选分片也用 FOR UPDATE (当前读)，扣减附带 available_size >= p_req_disk 并检查 ROW_COUNT()。
+-- 2. 非阻塞路径锁住的分片若当前值其实放不下 (一致性读的快照说放得下，但刚被别的事务扣减过)，锁并不会释放；
+--    之后再进入阻塞路径等待整卷的锁，两个分配者各持一个分片、互等对方的分片即死锁。
+--    现在加锁读 (FOR UPDATE SKIP LOCKED，不带容量条件) 返回 NULL 表示被他人占用而跳过、未加锁；
+--    返回了值却放不下表示本事务已持有该行的锁 (v_held)。只要持有过这样的锁就不再进入任何卷的阻塞路径：
+--    继续尝试其他分片，都不行时按放不下返回 (p_vol_id 为 NULL)，由调用方稍后重试，而不是去等锁。
+
+DROP PROCEDURE IF EXISTS `sp_storage_reserve`;
+
+DELIMITER $$
+
+-- 从某个存储卷的一个分片中扣减 p_req_disk (不含事务控制)；找不到时 p_vol_id 为 NULL
+CREATE PROCEDURE `sp_storage_reserve`(
+    IN p_req_disk INT,
+    IN p_queue_name VARCHAR(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci,
+    OUT p_vol_id INT,
+    OUT p_shard_no INT
+)
+BEGIN
+    DECLARE v_vol INT DEFAULT 0;
+    DECLARE v_next INT;
+    DECLARE v_n INT;
+    DECLARE v_total BIGINT;
+    DECLARE v_start INT;
+    DECLARE v_k INT;
+    DECLARE v_shard INT;
+    DECLARE v_snap INT;
+    DECLARE v_avail INT;
+    DECLARE v_held INT DEFAULT 0;
+
+    SET p_vol_id = NULL;
+    SET p_shard_no = NULL;
+
+    vol_loop: LOOP
+        SET v_next = NULL;
+        SELECT MIN(volume_id) INTO v_next FROM storagevolume WHERE volume_id > v_vol AND status = 'online';
+        IF v_next IS NULL THEN
+            LEAVE vol_loop;
+        END IF;
+        SET v_vol = v_next;
+
+        -- 一致性读，不加锁：粗略判断该卷是否有可能放得下
+        SELECT COUNT(*), COALESCE(SUM(available_size), 0) INTO v_n, v_total FROM storage_shards WHERE volume_id = v_vol;
+
+        IF v_n > 0 AND v_total >= p_req_disk THEN
+            -- 1. 非阻塞路径
+            SET v_start = MOD(CRC32(CONCAT(p_queue_name, ':', CONNECTION_ID())), v_n);
+            SET v_k = 0;
+            WHILE v_k < v_n AND p_vol_id IS NULL DO
+                SET v_shard = MOD(v_start + v_k, v_n);
+                SET v_snap = NULL;
+                SELECT available_size INTO v_snap FROM storage_shards WHERE volume_id = v_vol AND shard_no = v_shard;
+                IF v_snap >= p_req_disk THEN
+                    SET v_avail = NULL;
+                    SELECT MAX(available_size) INTO v_avail FROM storage_shards
+                    WHERE volume_id = v_vol AND shard_no = v_shard FOR UPDATE SKIP LOCKED;
+                    IF v_avail >= p_req_disk THEN
+                        SET p_vol_id = v_vol;
+                        SET p_shard_no = v_shard;
+                    ELSEIF v_avail IS NOT NULL THEN
+                        -- 锁住了但放不下：这把锁会保留到事务结束
+                        SET v_held = 1;
+                    END IF;
+                END IF;
+                SET v_k = v_k + 1;
+            END WHILE;
+
+            -- 2. 阻塞路径：锁住该卷全部分片，按精确合计判断；已持有分片锁时不等待，避免互等
+            IF p_vol_id IS NULL AND v_held = 0 THEN
+                SELECT SUM(available_size) INTO v_total FROM storage_shards WHERE volume_id = v_vol FOR UPDATE;
+                IF v_total >= p_req_disk THEN
+                    SELECT shard_no, available_size INTO v_shard, v_avail FROM storage_shards
+                    WHERE volume_id = v_vol ORDER BY available_size DESC, shard_no LIMIT 1 FOR UPDATE;
+                    IF v_avail < p_req_disk THEN
+                        -- 余量分散：集中到一个分片 (之后的释放会按原分片归还，逐渐重新摊开)
+                        UPDATE storage_shards SET available_size = IF(shard_no = v_shard, v_total, 0) WHERE volume_id = v_vol;
+                    END IF;
+                    SET p_vol_id = v_vol;
+                    SET p_shard_no = v_shard;
+                END IF;
+            END IF;
+        END IF;
+
+        IF p_vol_id IS NOT NULL THEN
+            UPDATE storage_shards SET available_size = available_size - p_req_disk
+            WHERE volume_id = p_vol_id AND shard_no = p_shard_no AND available_size >= p_req_disk;
+            IF ROW_COUNT() = 1 THEN
+                LEAVE vol_loop;
+            END IF;
+            -- 不应发生 (分片已被本事务锁住并复核过)；保险起见不扣成负数，换下一个卷
+            SET p_vol_id = NULL;
+            SET p_shard_no = NULL;
+        END IF;
+    END LOOP;
+END$$
+
+DELIMITER ;
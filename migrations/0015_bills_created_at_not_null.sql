@@ -0,0 +1,12 @@
+-- =======================================================
+-- 0015 bills.created_at 改为 NOT NULL
+-- =======================================================
+-- 账单分页按 (created_at, bill_id) 做 keyset：created_at 为 NULL 的行在 "created_at < ?" 条件下
+-- 永远不成立，翻页时会被整批跳过；按 created_at 归档时也不会被任何时间窗口选中。
+-- 存储过程写账单时从不显式写 NULL，历史上的 NULL 只可能来自手工或外部导入的数据，
+-- 用账单的 end_time 回填 (结算时刻，与正常写入的 created_at 最接近)。
+
+UPDATE `bills` SET `created_at` = `end_time` WHERE `created_at` IS NULL;
+
+ALTER TABLE `bills`
+  MODIFY `created_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP;
@@ -0,0 +1,101 @@
+-- =======================================================
+-- 0016 计量按整点出账
+-- =======================================================
+-- 0007 的 sp_meter_usage 每轮 (默认 60 秒) 为每个运行中实例各写一张账单，
+-- 一个实例每天 1440 张，bills 与账单分页、结算、归档都随之膨胀。
+-- 改为按整点出账：每轮只结算到当前整点 (v_bound)，计量起点早于 v_bound 的实例出一张 (起点, v_bound] 的账单，
+-- 同一小时内的后续轮次不再出账。每个实例每小时至多一张计量账单 (第一张从创建时刻到下一个整点)。
+-- 整点之后尚未出账的用量仍由 sp_refresh_balance_risk 按 metered_until 计入 accrued，
+-- 释放时 sp_release_resource / sp_release_batch 从 metered_until 出最后一张账单，不会漏计或重复计费。
+
+DROP PROCEDURE IF EXISTS `sp_meter_usage`;
+
+DELIMITER $$
+
+-- p_chunk 个实例一个事务；p_instances 返回出账实例数 (-1 表示已有其他计量在运行)
+-- 加锁与剔除已释放实例的方式与 0007 相同，只是截止时间由 NOW() 改为当前整点。
+CREATE PROCEDURE `sp_meter_usage`(
+    IN p_chunk INT,
+    OUT p_instances INT,
+    OUT p_amount DECIMAL(14, 2)
+)
+BEGIN
+    DECLARE v_bound DATETIME DEFAULT DATE_FORMAT(NOW(), '%Y-%m-%d %H:00:00');
+    DECLARE v_lo INT DEFAULT 0;
+    DECLARE v_hi INT;
+    DECLARE v_amount DECIMAL(14, 2);
+
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        DO RELEASE_LOCK('sp_meter_usage');
+        RESIGNAL;
+    END;
+
+    SET p_instances = 0;
+    SET p_amount = 0;
+
+    IF GET_LOCK('sp_meter_usage', 0) = 1 THEN
+        DROP TEMPORARY TABLE IF EXISTS `tmp_meter`;
+        CREATE TEMPORARY TABLE `tmp_meter` (
+            `node_id` INT NOT NULL,
+            `request_id` INT NOT NULL,
+            `user_id` INT NOT NULL,
+            `start_time` DATETIME NOT NULL,
+            `hourly_price` DECIMAL(10, 2) NOT NULL,
+            PRIMARY KEY (`node_id`)
+        );
+
+        chunk_loop: LOOP
+            SET TRANSACTION ISOLATION LEVEL READ COMMITTED;
+            START TRANSACTION;
+            DELETE FROM tmp_meter;
+
+            -- 本小时已经出过账的实例 (起点 >= v_bound) 直接跳过
+            INSERT INTO tmp_meter (node_id, request_id, user_id, start_time, hourly_price)
+            SELECT vc.node_id, vc.request_id, r.user_id, COALESCE(vc.metered_until, vc.created_at), vc.hourly_price
+            FROM virtualcomputers vc
+            JOIN requests r ON r.request_id = vc.request_id
+            WHERE vc.status = 'running' AND vc.node_id > v_lo
+              AND COALESCE(vc.metered_until, vc.created_at) < v_bound
+            ORDER BY vc.node_id
+            LIMIT p_chunk;
+
+            IF ROW_COUNT() = 0 THEN
+                COMMIT;
+                LEAVE chunk_loop;
+            END IF;
+            SELECT MAX(node_id) INTO v_hi FROM tmp_meter;
+
+            UPDATE virtualcomputers vc
+            JOIN tmp_meter t ON vc.node_id = t.node_id
+            SET vc.metered_until = v_bound
+            WHERE vc.status = 'running';
+
+            -- 读取之后已被释放的实例
+            DELETE t FROM tmp_meter t
+            JOIN virtualcomputers vc ON vc.node_id = t.node_id
+            WHERE vc.status <> 'running';
+
+            INSERT INTO bills (user_id, request_id, node_id, start_time, end_time, hourly_rate, cost_amount, payment_status)
+            SELECT user_id, request_id, node_id, start_time, v_bound, hourly_price,
+                   (TIMESTAMPDIFF(SECOND, start_time, v_bound) / 3600.0) * hourly_price, 'unpaid'
+            FROM tmp_meter;
+            SET p_instances = p_instances + ROW_COUNT();
+
+            SELECT COALESCE(SUM(ROUND((TIMESTAMPDIFF(SECOND, start_time, v_bound) / 3600.0) * hourly_price, 2)), 0)
+            INTO v_amount FROM tmp_meter;
+            SET p_amount = p_amount + v_amount;
+
+            COMMIT;
+            SET v_lo = v_hi;
+        END LOOP;
+
+        DROP TEMPORARY TABLE IF EXISTS `tmp_meter`;
+        DO RELEASE_LOCK('sp_meter_usage');
+    ELSE
+        SET p_instances = -1;
+    END IF;
+END$$
+
+DELIMITER ;
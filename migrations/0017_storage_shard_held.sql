@@ -0,0 +1,285 @@
+-- =======================================================
+-- 0017 分片锁按整个事务计算
+-- =======================================================
+-- 0014 的 v_held 只记录本次 CALL 内拿到的分片锁。sp_approve_batch 在一个事务里为多达 50 条请求
+-- 逐条调用 sp_storage_reserve，前面几条扣减成功时锁住的分片会一直保留到 COMMIT，
+-- 后面某条进入阻塞路径等待另一个卷 (或同一卷其他分片) 的锁时，仍可能与另一个批次互等而死锁。
+-- 扣减成功锁住的分片、阻塞路径锁住却放不下的整卷同样没有计入 v_held。
+--
+-- 现在用会话变量 @storage_shard_held 记录"本事务已持有分片锁"：开启事务的入口在 START TRANSACTION
+-- 前后清零，sp_storage_reserve 每拿到一把分片锁就置 1，并以它作为 v_held 的初值。
+-- 持有分片锁之后不再进入任何卷的阻塞路径；放不下时按 NO_CAPACITY 返回，由调用方稍后重试。
+
+DROP PROCEDURE IF EXISTS `sp_storage_reserve`;
+DROP PROCEDURE IF EXISTS `sp_create_instance`;
+DROP PROCEDURE IF EXISTS `sp_create_instance_at`;
+DROP PROCEDURE IF EXISTS `sp_approve_batch`;
+
+DELIMITER $$
+
+-- 从某个存储卷的一个分片中扣减 p_req_disk (不含事务控制)；找不到时 p_vol_id 为 NULL
+-- 保证：一个事务只有在尚未持有任何分片锁时才会等待分片锁 (阻塞路径)；持有之后只用 SKIP LOCKED 试探。
+--     分片锁之间因此不会形成等待环。"尚未持有"以会话变量 @storage_shard_held 为准，
+--     由开启事务的入口 (sp_create_instance / sp_create_instance_at / sp_approve_batch) 在 START TRANSACTION
+--     时清零，这里每拿到一把分片锁就置 1 (ROLLBACK TO SAVEPOINT 不释放行锁，所以不清零)。
+--     不保证与 npus / memory / requests 行锁之间不成环：那类死锁仍由 InnoDB 检测，sp_approve_batch 整批重试 (0013)。
+CREATE PROCEDURE `sp_storage_reserve`(
+    IN p_req_disk INT,
+    IN p_queue_name VARCHAR(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci,
+    OUT p_vol_id INT,
+    OUT p_shard_no INT
+)
+BEGIN
+    DECLARE v_vol INT DEFAULT 0;
+    DECLARE v_next INT;
+    DECLARE v_n INT;
+    DECLARE v_total BIGINT;
+    DECLARE v_start INT;
+    DECLARE v_k INT;
+    DECLARE v_shard INT;
+    DECLARE v_snap INT;
+    DECLARE v_avail INT;
+    DECLARE v_held INT DEFAULT COALESCE(@storage_shard_held, 0);
+
+    SET p_vol_id = NULL;
+    SET p_shard_no = NULL;
+
+    vol_loop: LOOP
+        SET v_next = NULL;
+        SELECT MIN(volume_id) INTO v_next FROM storagevolume WHERE volume_id > v_vol AND status = 'online';
+        IF v_next IS NULL THEN
+            LEAVE vol_loop;
+        END IF;
+        SET v_vol = v_next;
+
+        -- 一致性读，不加锁：粗略判断该卷是否有可能放得下
+        SELECT COUNT(*), COALESCE(SUM(available_size), 0) INTO v_n, v_total FROM storage_shards WHERE volume_id = v_vol;
+
+        IF v_n > 0 AND v_total >= p_req_disk THEN
+            -- 1. 非阻塞路径
+            SET v_start = MOD(CRC32(CONCAT(p_queue_name, ':', CONNECTION_ID())), v_n);
+            SET v_k = 0;
+            WHILE v_k < v_n AND p_vol_id IS NULL DO
+                SET v_shard = MOD(v_start + v_k, v_n);
+                SET v_snap = NULL;
+                SELECT available_size INTO v_snap FROM storage_shards WHERE volume_id = v_vol AND shard_no = v_shard;
+                IF v_snap >= p_req_disk THEN
+                    SET v_avail = NULL;
+                    SELECT MAX(available_size) INTO v_avail FROM storage_shards
+                    WHERE volume_id = v_vol AND shard_no = v_shard FOR UPDATE SKIP LOCKED;
+                    IF v_avail IS NOT NULL THEN
+                        -- 锁住了 (无论放不放得下)：这把锁会保留到事务结束
+                        SET v_held = 1;
+                        SET @storage_shard_held = 1;
+                    END IF;
+                    IF v_avail >= p_req_disk THEN
+                        SET p_vol_id = v_vol;
+                        SET p_shard_no = v_shard;
+                    END IF;
+                END IF;
+                SET v_k = v_k + 1;
+            END WHILE;
+
+            -- 2. 阻塞路径：锁住该卷全部分片，按精确合计判断；本事务已持有分片锁 (含同一事务中
+            --    之前的 CALL) 时不等待，避免互等
+            IF p_vol_id IS NULL AND v_held = 0 THEN
+                SELECT SUM(available_size) INTO v_total FROM storage_shards WHERE volume_id = v_vol FOR UPDATE;
+                -- 放不下也保留着整卷的锁，之后的卷只走非阻塞路径
+                SET v_held = 1;
+                SET @storage_shard_held = 1;
+                IF v_total >= p_req_disk THEN
+                    SELECT shard_no, available_size INTO v_shard, v_avail FROM storage_shards
+                    WHERE volume_id = v_vol ORDER BY available_size DESC, shard_no LIMIT 1 FOR UPDATE;
+                    IF v_avail < p_req_disk THEN
+                        -- 余量分散：集中到一个分片 (之后的释放会按原分片归还，逐渐重新摊开)
+                        UPDATE storage_shards SET available_size = IF(shard_no = v_shard, v_total, 0) WHERE volume_id = v_vol;
+                    END IF;
+                    SET p_vol_id = v_vol;
+                    SET p_shard_no = v_shard;
+                END IF;
+            END IF;
+        END IF;
+
+        IF p_vol_id IS NOT NULL THEN
+            UPDATE storage_shards SET available_size = available_size - p_req_disk
+            WHERE volume_id = p_vol_id AND shard_no = p_shard_no AND available_size >= p_req_disk;
+            IF ROW_COUNT() = 1 THEN
+                LEAVE vol_loop;
+            END IF;
+            -- 不应发生 (分片已被本事务锁住并复核过)；保险起见不扣成负数，换下一个卷
+            SET p_vol_id = NULL;
+            SET p_shard_no = NULL;
+        END IF;
+    END LOOP;
+END$$
+
+-- 单条分配 (保持原有接口，自带事务)
+CREATE PROCEDURE `sp_create_instance`(
+    IN p_existing_req_id INT,
+    IN p_queue_name VARCHAR(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci,
+    IN p_req_cores INT,
+    IN p_req_gpu_mem INT,
+    IN p_req_ram INT,
+    IN p_req_disk INT,
+    OUT p_node_id INT
+)
+BEGIN
+    SET @storage_shard_held = 0;
+    START TRANSACTION;
+    CALL sp_allocate_instance(p_existing_req_id, p_queue_name, p_req_cores, p_req_gpu_mem, p_req_ram, p_req_disk, p_node_id);
+    IF p_node_id > 0 THEN
+        COMMIT;
+    ELSE
+        ROLLBACK;
+    END IF;
+    SET @storage_shard_held = 0;
+END$$
+
+-- 单条指定目标行分配 (自带事务，供放置引擎调用)
+CREATE PROCEDURE `sp_create_instance_at`(
+    IN p_existing_req_id INT,
+    IN p_queue_name VARCHAR(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci,
+    IN p_req_cores INT,
+    IN p_req_gpu_mem INT,
+    IN p_req_ram INT,
+    IN p_req_disk INT,
+    IN p_npu_id INT,
+    IN p_expect_cores INT,
+    IN p_expect_gpu_mem INT,
+    IN p_mem_id INT,
+    IN p_expect_ram INT,
+    OUT p_node_id INT
+)
+BEGIN
+    SET @storage_shard_held = 0;
+    START TRANSACTION;
+    CALL sp_allocate_at(p_existing_req_id, p_queue_name, p_req_cores, p_req_gpu_mem, p_req_ram, p_req_disk,
+                        p_npu_id, p_expect_cores, p_expect_gpu_mem, p_mem_id, p_expect_ram, p_node_id);
+    IF p_node_id > 0 THEN
+        COMMIT;
+    ELSE
+        ROLLBACK;
+    END IF;
+    SET @storage_shard_held = 0;
+END$$
+
+-- 批量审批：与 0013 相同，只是在事务开始与结束时清零 @storage_shard_held
+-- 返回结果集: request_id, result (APPROVED / NO_CAPACITY / CONFLICT / NOT_PENDING / NOT_FOUND / SQL_ERROR / DEADLOCK), node_id
+CREATE PROCEDURE `sp_approve_batch`(
+    IN p_items JSON
+)
+BEGIN
+    DECLARE v_i INT DEFAULT 0;
+    DECLARE v_n INT DEFAULT 0;
+    DECLARE v_req_id INT;
+    DECLARE v_queue VARCHAR(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci;
+    DECLARE v_cores INT;
+    DECLARE v_gpu_mem INT;
+    DECLARE v_ram INT;
+    DECLARE v_disk INT;
+    DECLARE v_status VARCHAR(50);
+    DECLARE v_node_id INT;
+    DECLARE v_npu_id INT;
+    DECLARE v_item_error INT DEFAULT 0;
+    DECLARE v_errno INT DEFAULT 0;
+    DECLARE v_aborted INT DEFAULT 0;
+
+    DECLARE CONTINUE HANDLER FOR SQLEXCEPTION
+    BEGIN
+        GET DIAGNOSTICS CONDITION 1 v_errno = MYSQL_ERRNO;
+        SET v_item_error = 1;
+    END;
+
+    DROP TEMPORARY TABLE IF EXISTS `tmp_batch_result`;
+    CREATE TEMPORARY TABLE `tmp_batch_result` (
+        `seq` INT NOT NULL,
+        `request_id` INT NULL,
+        `result` VARCHAR(20) NOT NULL,
+        `node_id` INT NULL,
+        PRIMARY KEY (`seq`)
+    );
+
+    SET v_n = JSON_LENGTH(p_items);
+
+    SET @storage_shard_held = 0;
+    START TRANSACTION;
+
+    batch_loop: WHILE v_i < v_n DO
+        SET v_req_id  = JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].request_id'));
+        SET v_queue   = JSON_UNQUOTE(JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].queue')));
+        SET v_cores   = COALESCE(JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].cores')), 1);
+        SET v_gpu_mem = COALESCE(JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].gpu_mem')), 0);
+        SET v_ram     = COALESCE(JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].ram')), 1);
+        SET v_disk    = COALESCE(JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].disk')), 10);
+        SET v_npu_id  = JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].npu_id'));
+        SET v_status = NULL;
+        SET v_node_id = -1;
+        SET v_item_error = 0;
+        SET v_errno = 0;
+
+        SAVEPOINT batch_item;
+
+        -- 锁住请求行，避免两个管理员同时审批同一条请求
+        SELECT status INTO v_status FROM requests WHERE request_id = v_req_id FOR UPDATE;
+
+        IF v_item_error = 0 AND v_status IS NOT NULL AND v_status = 'pending' THEN
+            IF v_npu_id IS NULL THEN
+                CALL sp_allocate_instance(v_req_id, v_queue, v_cores, v_gpu_mem, v_ram, v_disk, v_node_id);
+            ELSE
+                CALL sp_allocate_at(v_req_id, v_queue, v_cores, v_gpu_mem, v_ram, v_disk,
+                                    v_npu_id,
+                                    JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].expect_cores')),
+                                    JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].expect_gpu_mem')),
+                                    JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].mem_id')),
+                                    JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].expect_ram')),
+                                    v_node_id);
+            END IF;
+            IF v_item_error = 0 AND v_node_id > 0 THEN
+                UPDATE requests SET status = 'approved', node_id = v_node_id WHERE request_id = v_req_id;
+            END IF;
+        END IF;
+
+        -- 死锁 / 锁等待超时：整个事务已经 (或应当) 回滚，保存点不可用，放弃整批
+        IF v_errno IN (1213, 1205) THEN
+            SET v_aborted = 1;
+            LEAVE batch_loop;
+        END IF;
+
+        IF v_item_error = 1 THEN
+            ROLLBACK TO SAVEPOINT batch_item;
+            INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'SQL_ERROR', NULL);
+        ELSEIF v_status IS NULL THEN
+            INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'NOT_FOUND', NULL);
+        ELSEIF v_status != 'pending' THEN
+            INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'NOT_PENDING', NULL);
+        ELSEIF v_node_id > 0 THEN
+            INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'APPROVED', v_node_id);
+        ELSEIF v_node_id IN (-2, -3) THEN
+            INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'CONFLICT', NULL);
+        ELSE
+            INSERT INTO tmp_batch_result VALUES (v_i, v_req_id, 'NO_CAPACITY', NULL);
+        END IF;
+
+        SET v_i = v_i + 1;
+    END WHILE;
+
+    IF v_aborted = 1 THEN
+        ROLLBACK;
+        -- 此前记下的结果一律作废，整批报告为未分配
+        DELETE FROM tmp_batch_result;
+        SET v_i = 0;
+        WHILE v_i < v_n DO
+            INSERT INTO tmp_batch_result
+            VALUES (v_i, JSON_EXTRACT(p_items, CONCAT('$[', v_i, '].request_id')), 'DEADLOCK', NULL);
+            SET v_i = v_i + 1;
+        END WHILE;
+    ELSE
+        COMMIT;
+    END IF;
+    SET @storage_shard_held = 0;
+
+    SELECT request_id, result, node_id FROM tmp_batch_result ORDER BY seq;
+    DROP TEMPORARY TABLE `tmp_batch_result`;
+END$$
+
+DELIMITER ;
@@ -0,0 +1,141 @@
+-- =======================================================
+-- 0018 容量汇总只统计 online 节点
+-- =======================================================
+-- 0006 的 v_capacity_truth 与 npus / memory 触发器不看 status：下线 (offline / maintenance) 的节点
+-- 仍计入总量与剩余量，而分配过程只在 status = 'online' 的行上选点，监控看到的剩余容量实际上分不出去。
+-- 现在重算视图只取 online 行；触发器把 status 的变化与 queue_type 的变化同样处理为
+-- "从旧 (队列, 状态) 减去、再加到新 (队列, 状态)"，只有 online 的一侧真正计入汇总。
+-- 最后按新口径重建汇总表 (与 0006 的首次填充相同)。
+
+DROP VIEW IF EXISTS `v_capacity_truth`;
+DROP TRIGGER IF EXISTS `trg_npus_capsum_ins`;
+DROP TRIGGER IF EXISTS `trg_npus_capsum_upd`;
+DROP TRIGGER IF EXISTS `trg_npus_capsum_del`;
+DROP TRIGGER IF EXISTS `trg_memory_capsum_ins`;
+DROP TRIGGER IF EXISTS `trg_memory_capsum_upd`;
+DROP TRIGGER IF EXISTS `trg_memory_capsum_del`;
+
+-- 直接从 npus / memory 全量计算的结果 (只含 online 行)，用于填充和对账
+CREATE VIEW `v_capacity_truth` AS
+SELECT queue_type, slot,
+       SUM(nodes) AS nodes, SUM(idle_nodes) AS idle_nodes, SUM(full_nodes) AS full_nodes,
+       SUM(fragmented_nodes) AS fragmented_nodes,
+       SUM(total_cores) AS total_cores, SUM(free_cores) AS free_cores,
+       SUM(total_gpu_mem) AS total_gpu_mem, SUM(free_gpu_mem) AS free_gpu_mem,
+       SUM(mem_modules) AS mem_modules, SUM(total_ram) AS total_ram, SUM(free_ram) AS free_ram
+FROM (
+    SELECT queue_type, NPU_id % 16 AS slot, 1 AS nodes,
+           available_cores = cores AS idle_nodes, available_cores = 0 AS full_nodes,
+           available_cores > 0 AND available_cores < cores AS fragmented_nodes,
+           cores AS total_cores, available_cores AS free_cores,
+           NPU_memory AS total_gpu_mem, available_memory AS free_gpu_mem,
+           0 AS mem_modules, 0 AS total_ram, 0 AS free_ram
+    FROM npus
+    WHERE status = 'online'
+    UNION ALL
+    SELECT COALESCE(queue_type, ''), memory_id % 16, 0, 0, 0, 0, 0, 0, 0, 0, 1, memory_size, available_size
+    FROM memory
+    WHERE status = 'online'
+) t
+GROUP BY queue_type, slot;
+
+DELIMITER $$
+
+CREATE TRIGGER `trg_npus_capsum_ins` AFTER INSERT ON `npus` FOR EACH ROW
+BEGIN
+    IF NEW.status = 'online' THEN
+        CALL sp_capsum_apply(NEW.queue_type, NEW.NPU_id % 16, 1,
+            NEW.available_cores = NEW.cores, NEW.available_cores = 0,
+            NEW.available_cores > 0 AND NEW.available_cores < NEW.cores,
+            NEW.cores, NEW.available_cores, NEW.NPU_memory, NEW.available_memory, 0, 0, 0);
+    END IF;
+END$$
+
+CREATE TRIGGER `trg_npus_capsum_del` AFTER DELETE ON `npus` FOR EACH ROW
+BEGIN
+    IF OLD.status = 'online' THEN
+        CALL sp_capsum_apply(OLD.queue_type, OLD.NPU_id % 16, -1,
+            -(OLD.available_cores = OLD.cores), -(OLD.available_cores = 0),
+            -(OLD.available_cores > 0 AND OLD.available_cores < OLD.cores),
+            -OLD.cores, -OLD.available_cores, -OLD.NPU_memory, -OLD.available_memory, 0, 0, 0);
+    END IF;
+END$$
+
+CREATE TRIGGER `trg_npus_capsum_upd` AFTER UPDATE ON `npus` FOR EACH ROW
+BEGIN
+    IF NEW.queue_type = OLD.queue_type AND NEW.status <=> OLD.status THEN
+        -- 只改 hourly_rate 等列，或节点不在线时不碰汇总行
+        IF NEW.status = 'online'
+           AND (NEW.available_cores <> OLD.available_cores OR NEW.cores <> OLD.cores
+                OR NEW.available_memory <> OLD.available_memory OR NEW.NPU_memory <> OLD.NPU_memory) THEN
+            CALL sp_capsum_apply(NEW.queue_type, NEW.NPU_id % 16, 0,
+                (NEW.available_cores = NEW.cores) - (OLD.available_cores = OLD.cores),
+                (NEW.available_cores = 0) - (OLD.available_cores = 0),
+                (NEW.available_cores > 0 AND NEW.available_cores < NEW.cores)
+                    - (OLD.available_cores > 0 AND OLD.available_cores < OLD.cores),
+                NEW.cores - OLD.cores, NEW.available_cores - OLD.available_cores,
+                NEW.NPU_memory - OLD.NPU_memory, NEW.available_memory - OLD.available_memory, 0, 0, 0);
+        END IF;
+    ELSE
+        -- 换队列或上下线：先减旧、再加新
+        IF OLD.status = 'online' THEN
+            CALL sp_capsum_apply(OLD.queue_type, OLD.NPU_id % 16, -1,
+                -(OLD.available_cores = OLD.cores), -(OLD.available_cores = 0),
+                -(OLD.available_cores > 0 AND OLD.available_cores < OLD.cores),
+                -OLD.cores, -OLD.available_cores, -OLD.NPU_memory, -OLD.available_memory, 0, 0, 0);
+        END IF;
+        IF NEW.status = 'online' THEN
+            CALL sp_capsum_apply(NEW.queue_type, NEW.NPU_id % 16, 1,
+                NEW.available_cores = NEW.cores, NEW.available_cores = 0,
+                NEW.available_cores > 0 AND NEW.available_cores < NEW.cores,
+                NEW.cores, NEW.available_cores, NEW.NPU_memory, NEW.available_memory, 0, 0, 0);
+        END IF;
+    END IF;
+END$$
+
+CREATE TRIGGER `trg_memory_capsum_ins` AFTER INSERT ON `memory` FOR EACH ROW
+BEGIN
+    IF NEW.status = 'online' THEN
+        CALL sp_capsum_apply(NEW.queue_type, NEW.memory_id % 16, 0, 0, 0, 0, 0, 0, 0, 0,
+            1, NEW.memory_size, NEW.available_size);
+    END IF;
+END$$
+
+CREATE TRIGGER `trg_memory_capsum_del` AFTER DELETE ON `memory` FOR EACH ROW
+BEGIN
+    IF OLD.status = 'online' THEN
+        CALL sp_capsum_apply(OLD.queue_type, OLD.memory_id % 16, 0, 0, 0, 0, 0, 0, 0, 0,
+            -1, -OLD.memory_size, -OLD.available_size);
+    END IF;
+END$$
+
+CREATE TRIGGER `trg_memory_capsum_upd` AFTER UPDATE ON `memory` FOR EACH ROW
+BEGIN
+    IF NEW.queue_type <=> OLD.queue_type AND NEW.status <=> OLD.status THEN
+        IF NEW.status = 'online'
+           AND (NEW.available_size <> OLD.available_size OR NEW.memory_size <> OLD.memory_size) THEN
+            CALL sp_capsum_apply(NEW.queue_type, NEW.memory_id % 16, 0, 0, 0, 0, 0, 0, 0, 0,
+                0, NEW.memory_size - OLD.memory_size, NEW.available_size - OLD.available_size);
+        END IF;
+    ELSE
+        IF OLD.status = 'online' THEN
+            CALL sp_capsum_apply(OLD.queue_type, OLD.memory_id % 16, 0, 0, 0, 0, 0, 0, 0, 0,
+                -1, -OLD.memory_size, -OLD.available_size);
+        END IF;
+        IF NEW.status = 'online' THEN
+            CALL sp_capsum_apply(NEW.queue_type, NEW.memory_id % 16, 0, 0, 0, 0, 0, 0, 0, 0,
+                1, NEW.memory_size, NEW.available_size);
+        END IF;
+    END IF;
+END$$
+
+DELIMITER ;
+
+-- 按新口径重建 (之后由触发器增量维护；期间若有并发分配，sp_capacity_reconcile 会修正)
+DELETE FROM capacity_summary;
+INSERT INTO capacity_summary (queue_type, slot, nodes, idle_nodes, full_nodes, fragmented_nodes,
+                              total_cores, free_cores, total_gpu_mem, free_gpu_mem,
+                              mem_modules, total_ram, free_ram)
+SELECT queue_type, slot, nodes, idle_nodes, full_nodes, fragmented_nodes,
+       total_cores, free_cores, total_gpu_mem, free_gpu_mem, mem_modules, total_ram, free_ram
+FROM v_capacity_truth;
@@ -0,0 +1,130 @@
+-- =======================================================
+-- 0019 运行中任务的计量账单在释放前不可支付
+-- =======================================================
+-- 0016 起计量任务为运行中的实例按整点出账，这些账单与释放时的账单一样是 unpaid，
+-- user.settle_bills 会把它们一并结清，与用户页 "只有在任务完成后，用户才能支付账单" 的规则矛盾。
+-- 现在未付账单按所属任务的状态分三类：
+--   unpaid_*    可由用户支付 (任务已结束且不是 terminated)
+--   accruing_*  任务仍在运行 (approved)，释放后转为 unpaid
+--   disputed_*  异常终止任务的账单 (需管理员核实)
+-- 结算只锁定第一类 (queries.SQL_PAYABLE_BILLS)。sp_release_resource / sp_release_batch 把请求改为 completed / terminated 时，
+-- requests 触发器在同一事务内把该任务已出的未付账单从 accruing 移到对应类别，随后出的最后一张账单直接按新状态计入。
+
+DROP TRIGGER IF EXISTS `trg_bills_billsum_ins`;
+DROP TRIGGER IF EXISTS `trg_bills_billsum_upd`;
+DROP TRIGGER IF EXISTS `trg_bills_billsum_del`;
+DROP TRIGGER IF EXISTS `trg_requests_billsum_upd`;
+DROP PROCEDURE IF EXISTS `sp_billsum_apply`;
+DROP PROCEDURE IF EXISTS `sp_billsum_add`;
+
+ALTER TABLE `user_bill_summary`
+  ADD COLUMN `accruing_bills` int NOT NULL DEFAULT 0 AFTER `unpaid_amount`,
+  ADD COLUMN `accruing_amount` decimal(14, 2) NOT NULL DEFAULT 0.00 AFTER `accruing_bills`;
+
+DELIMITER $$
+
+-- 把一组增量累加到用户行上，行不存在时创建
+CREATE PROCEDURE `sp_billsum_apply`(
+    IN p_user_id INT,
+    IN p_unpaid_bills INT, IN p_unpaid_amount DECIMAL(14, 2),
+    IN p_accruing_bills INT, IN p_accruing_amount DECIMAL(14, 2),
+    IN p_disputed_bills INT, IN p_disputed_amount DECIMAL(14, 2)
+)
+BEGIN
+    INSERT INTO user_bill_summary (user_id, unpaid_bills, unpaid_amount, accruing_bills, accruing_amount,
+                                   disputed_bills, disputed_amount)
+    VALUES (p_user_id, p_unpaid_bills, p_unpaid_amount, p_accruing_bills, p_accruing_amount,
+            p_disputed_bills, p_disputed_amount) AS d
+    ON DUPLICATE KEY UPDATE
+        unpaid_bills = user_bill_summary.unpaid_bills + d.unpaid_bills,
+        unpaid_amount = user_bill_summary.unpaid_amount + d.unpaid_amount,
+        accruing_bills = user_bill_summary.accruing_bills + d.accruing_bills,
+        accruing_amount = user_bill_summary.accruing_amount + d.accruing_amount,
+        disputed_bills = user_bill_summary.disputed_bills + d.disputed_bills,
+        disputed_amount = user_bill_summary.disputed_amount + d.disputed_amount;
+END$$
+
+-- 按任务状态把 p_bills 张、共 p_amount 的未付账单计入 (负数为移出) 对应类别
+CREATE PROCEDURE `sp_billsum_add`(
+    IN p_user_id INT,
+    IN p_request_status VARCHAR(50),
+    IN p_bills INT,
+    IN p_amount DECIMAL(14, 2)
+)
+BEGIN
+    IF p_request_status = 'terminated' THEN
+        CALL sp_billsum_apply(p_user_id, 0, 0, 0, 0, p_bills, p_amount);
+    ELSEIF p_request_status = 'approved' THEN
+        CALL sp_billsum_apply(p_user_id, 0, 0, p_bills, p_amount, 0, 0);
+    ELSE
+        CALL sp_billsum_apply(p_user_id, p_bills, p_amount, 0, 0, 0, 0);
+    END IF;
+END$$
+
+CREATE TRIGGER `trg_bills_billsum_ins` AFTER INSERT ON `bills` FOR EACH ROW
+BEGIN
+    DECLARE v_status VARCHAR(50);
+    IF NEW.payment_status = 'unpaid' THEN
+        SELECT status INTO v_status FROM requests WHERE request_id = NEW.request_id;
+        CALL sp_billsum_add(NEW.user_id, v_status, 1, NEW.cost_amount);
+    END IF;
+END$$
+
+CREATE TRIGGER `trg_bills_billsum_del` AFTER DELETE ON `bills` FOR EACH ROW
+BEGIN
+    DECLARE v_status VARCHAR(50);
+    IF OLD.payment_status = 'unpaid' THEN
+        SELECT status INTO v_status FROM requests WHERE request_id = OLD.request_id;
+        CALL sp_billsum_add(OLD.user_id, v_status, -1, -OLD.cost_amount);
+    END IF;
+END$$
+
+CREATE TRIGGER `trg_bills_billsum_upd` AFTER UPDATE ON `bills` FOR EACH ROW
+BEGIN
+    DECLARE v_status VARCHAR(50);
+    -- 只有影响汇总的列变化时才碰汇总行 (支付时 unpaid -> paid)
+    IF NOT (NEW.payment_status <=> OLD.payment_status) OR NEW.cost_amount <> OLD.cost_amount
+       OR NEW.user_id <> OLD.user_id OR NEW.request_id <> OLD.request_id THEN
+        IF OLD.payment_status = 'unpaid' THEN
+            SELECT status INTO v_status FROM requests WHERE request_id = OLD.request_id;
+            CALL sp_billsum_add(OLD.user_id, v_status, -1, -OLD.cost_amount);
+        END IF;
+        IF NEW.payment_status = 'unpaid' THEN
+            SELECT status INTO v_status FROM requests WHERE request_id = NEW.request_id;
+            CALL sp_billsum_add(NEW.user_id, v_status, 1, NEW.cost_amount);
+        END IF;
+    END IF;
+END$$
+
+CREATE TRIGGER `trg_requests_billsum_upd` AFTER UPDATE ON `requests` FOR EACH ROW
+BEGIN
+    DECLARE v_bills INT;
+    DECLARE v_amount DECIMAL(14, 2);
+    -- 类别变化时 (运行中 -> 已结束 / 异常终止，或反向) 把该任务的未付账单整体移过去
+    IF (NEW.status = 'terminated') <> (OLD.status = 'terminated')
+       OR (NEW.status = 'approved') <> (OLD.status = 'approved') THEN
+        -- 走 idx_bill_req；一个任务只有释放时的一张账单加上按小时计量出的若干张
+        SELECT COUNT(*), COALESCE(SUM(cost_amount), 0) INTO v_bills, v_amount
+        FROM bills WHERE request_id = NEW.request_id AND payment_status = 'unpaid';
+        IF v_bills > 0 THEN
+            CALL sp_billsum_add(OLD.user_id, OLD.status, -v_bills, -v_amount);
+            CALL sp_billsum_add(NEW.user_id, NEW.status, v_bills, v_amount);
+        END IF;
+    END IF;
+END$$
+
+DELIMITER ;
+
+-- 按新的分类重建
+DELETE FROM user_bill_summary;
+INSERT INTO user_bill_summary (user_id, unpaid_bills, unpaid_amount, accruing_bills, accruing_amount,
+                               disputed_bills, disputed_amount)
+SELECT b.user_id,
+       SUM(r.status NOT IN ('approved', 'terminated')),
+       SUM(IF(r.status NOT IN ('approved', 'terminated'), b.cost_amount, 0)),
+       SUM(r.status = 'approved'), SUM(IF(r.status = 'approved', b.cost_amount, 0)),
+       SUM(r.status = 'terminated'), SUM(IF(r.status = 'terminated', b.cost_amount, 0))
+FROM bills b
+JOIN requests r ON r.request_id = b.request_id
+WHERE b.payment_status = 'unpaid'
+GROUP BY b.user_id;
@@ -0,0 +1,252 @@
+import json
+
+from mysql.connector import Error
+
+import cache
+import db
+import placement
+import replica
+
+# ================= 审批与释放 =================
+#
+# 批量审批 / 批量释放的核心逻辑，不依赖 Streamlit：管理后台 (admin.py)、
+# 后台调度器 (scheduler.py) 与计量进程 (metering.py) 共用同一条路径。
+# 逐条操作并在页面上提示结果的 approve_request / stop_instance 等仍在 admin.py。
+
+# 分配 / 释放会改动的表
+ALLOCATION_TABLES = ("npus", "memory", "storagevolume", "requests", "virtualcomputers")
+
+# 管理员写操作之后，控制台的读查询在副本追上之前回到主库 (见 replica.py)
+READ_SCOPE = "admin"
+
+# 批量审批每次存储过程调用处理的请求数 (即每个事务的大小)
+BATCH_APPROVE_SIZE = 50
+
+
+def parse_params(raw):
+    """解析 requests.parameters (JSON 字符串)；失败时返回 None"""
+    if isinstance(raw, dict):
+        return raw
+    try:
+        return json.loads(raw)
+    except (TypeError, ValueError):
+        return None
+
+
+def _batch_item(req_id, params):
+    """把请求参数转换为 sp_approve_batch 所需的 JSON 元素；参数不合法时返回 None"""
+    if not isinstance(params, dict) or not params.get('queue'):
+        return None
+    db_p = params.get('db_params', {})
+    return {
+        "request_id": int(req_id),
+        "queue": params.get('queue'),
+        "cores": db_p.get('req_cores', 1),
+        "gpu_mem": db_p.get('req_gpu_mem', 0),
+        "ram": db_p.get('req_ram', 1),
+        "disk": db_p.get('req_disk', 10),
+    }
+
+
+def approve_requests(db_config, reqs, batch_size=BATCH_APPROVE_SIZE):
+    """
+    批量批准：reqs 为 [(req_id, params), ...]，params 可以是 dict 或 JSON 字符串。
+    放置引擎先在内存中为每条请求选好目标节点，再每 batch_size 条调用一次
+    sp_approve_batch (一次往返、一个事务)；CAS 冲突的请求、以及因死锁 / 锁等待超时整批回滚的请求
+    刷新索引后进入下一轮重试。
+    返回逐条结果 [{'request_id', 'result', 'node_id'}, ...]，顺序与输入一致。
+    """
+    results = {}
+    order = []
+    items = []
+    for req_id, params in reqs:
+        req_id = int(req_id)
+        order.append(req_id)
+        params = parse_params(params)
+        item = _batch_item(req_id, params)
+        if item is None:
+            results[req_id] = {"request_id": req_id, "result": "INVALID_PARAMS", "node_id": None}
+        else:
+            items.append((item, params.get('db_params', {})))
+
+    if not items:
+        return [results[r] for r in order]
+
+    engine = placement.get_engine(db_config)
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        for attempt in range(placement.MAX_CAS_RETRIES + 1):
+            retry = []
+            for i in range(0, len(items), batch_size):
+                chunk = items[i:i + batch_size]
+                planned = {}
+                for item, db_p in chunk:
+                    # 去掉上一轮的目标行，重新选
+                    for k in ("npu_id", "expect_cores", "expect_gpu_mem", "mem_id", "expect_ram"):
+                        item.pop(k, None)
+                    target = engine.plan(item['queue'], db_p, cursor=cursor)
+                    if target is None:
+                        results[item['request_id']] = {"request_id": item['request_id'], "result": "NO_CAPACITY", "node_id": None}
+                        continue
+                    item.update(target)
+                    planned[item['request_id']] = (item, db_p)
+                if not planned:
+                    continue
+
+                try:
+                    cursor.callproc('sp_approve_batch', [json.dumps([it for it, _ in planned.values()])])
+                    rows = [row for result in cursor.stored_results() for row in result.fetchall()]
+                except Error as err:
+                    conn.rollback()
+                    rows = []
+                    for item, _ in planned.values():
+                        engine.refresh_rows(cursor, item['npu_id'], item['mem_id'])
+                        results[item['request_id']] = {"request_id": item['request_id'], "result": "SQL_ERROR",
+                                                       "node_id": None, "error": str(err)}
+
+                for req_id, res, node_id in rows:
+                    item, db_p = planned[req_id]
+                    if res != "APPROVED":
+                        # 撤销索引中的预扣，以数据库真实值为准
+                        engine.refresh_rows(cursor, item['npu_id'], item['mem_id'])
+                    if res in ("CONFLICT", "DEADLOCK") and attempt < placement.MAX_CAS_RETRIES:
+                        retry.append((item, db_p))
+                        continue
+                    results[req_id] = {"request_id": req_id, "result": res, "node_id": node_id}
+            if not retry:
+                break
+            items = retry
+    finally:
+        cursor.close()
+        conn.close()
+        cache.invalidate(*ALLOCATION_TABLES)
+        replica.note_write(db_config, READ_SCOPE)
+    return [results[r] for r in order]
+
+
+def approve_queue(db_config, queue_name, limit=None, batch_size=BATCH_APPROVE_SIZE):
+    """
+    按队列批量批准：按提交时间顺序尝试该队列所有 pending 请求，
+    放得下的全部分配，放不下的保留 pending 并在报告中标记 NO_CAPACITY。
+    """
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        sql = """
+            SELECT request_id, parameters FROM requests
+            WHERE status = 'pending' AND req_queue = %s
+            ORDER BY submit_time ASC
+        """
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        cursor.execute(sql, (queue_name,))
+        pending = cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.close()
+    return approve_requests(db_config, pending, batch_size=batch_size)
+
+
+def reject_requests(db_config, req_ids):
+    """批量拒绝：一条 UPDATE 完成，只作用于仍处于 pending 的请求，返回实际拒绝条数"""
+    req_ids = [int(r) for r in req_ids]
+    if not req_ids:
+        return 0
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        placeholders = ", ".join(["%s"] * len(req_ids))
+        cursor.execute(
+            f"UPDATE requests SET status='rejected' WHERE status='pending' AND request_id IN ({placeholders})",
+            req_ids)
+        conn.commit()
+        cache.invalidate("requests")
+        replica.note_write(db_config, READ_SCOPE)
+        return cursor.rowcount
+    finally:
+        cursor.close()
+        conn.close()
+
+
+# 批量释放每次存储过程调用处理的实例数
+RELEASE_BATCH_SIZE = 200
+
+# 运行中实例 (批量释放的选择范围)，按 node_id 排序使各批加锁顺序一致
+SQL_RUNNING_NODES = """
+    SELECT vc.node_id
+    FROM virtualcomputers vc
+    JOIN requests r ON vc.request_id = r.request_id
+    JOIN virtualcpu vcpu ON vc.vir_NPU_id = vcpu.vir_NPU_id
+    JOIN npus np ON vcpu.NPU_id = np.NPU_id
+    WHERE vc.status = 'running'
+"""
+
+
+def running_nodes(db_config, queue=None, user_id=None, npu_serial=None):
+    """按队列 / 用户 / 物理 NPU 序列号 (可组合) 选出运行中的节点，返回 node_id 列表"""
+    where, params = [], []
+    if queue is not None:
+        where.append("vc.queue_name = %s")
+        params.append(queue)
+    if user_id is not None:
+        where.append("r.user_id = %s")
+        params.append(int(user_id))
+    if npu_serial is not None:
+        where.append("np.npu_serial = %s")
+        params.append(npu_serial)
+    sql = SQL_RUNNING_NODES + "".join(f" AND {w}" for w in where) + " ORDER BY vc.node_id"
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def release_nodes(db_config, node_ids, action_type, batch_size=RELEASE_BATCH_SIZE):
+    """
+    集合式释放 (sp_release_batch，迁移 0011)：每批一次调用、一个事务，
+    归还容量、出账单、写 use_log 一起提交。
+    action_type='complete': 正常完成 (状态 completed)
+    action_type='terminate': 强制终止 (状态 terminated)
+    返回逐条结果 [{'node_id', 'request_id', 'result'}, ...]，出错的批次整批记为 SQL_ERROR
+    """
+    final_status = 'completed' if action_type == 'complete' else 'terminated'
+    node_ids = sorted({int(n) for n in node_ids})
+    report = []
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        for i in range(0, len(node_ids), batch_size):
+            chunk = node_ids[i:i + batch_size]
+            try:
+                cursor.callproc('sp_release_batch', [json.dumps(chunk), final_status])
+                rows = [row for result in cursor.stored_results() for row in result.fetchall()]
+            except Error as err:
+                if err.errno == 1305:  # PROCEDURE does not exist
+                    raise
+                conn.rollback()
+                report.extend({"node_id": n, "request_id": None, "result": "SQL_ERROR", "error": str(err)}
+                              for n in chunk)
+                continue
+            report.extend({"node_id": int(node_id), "request_id": None if req_id is None else int(req_id),
+                           "result": result} for node_id, req_id, result in rows)
+    finally:
+        cursor.close()
+        conn.close()
+        cache.invalidate(*ALLOCATION_TABLES, "bills")
+        replica.note_write(db_config, READ_SCOPE)
+    return report
+
+
+def stop_instances(db_config, nodes, action_type):
+    """批量停止：nodes 为 [(node_id, req_id), ...]，返回逐条结果 (见 release_nodes)"""
+    return release_nodes(db_config, [node_id for node_id, _ in nodes], action_type)
+
+
+def drain(db_config, action_type, queue=None, user_id=None, npu_serial=None):
+    """释放一个队列 / 用户 / 物理 NPU 上的全部运行中实例 (维护排空、按用户终止)"""
+    return release_nodes(db_config, running_nodes(db_config, queue, user_id, npu_serial), action_type)
@@ -0,0 +1,36 @@
+# ================= 套餐定义 =================
+#
+# 资源申请页 (fore.py / user.py) 展示的套餐，同时供碎片整理 (consolidate.py)、
+# 可用量估算 (catalog.py) 与压测脚本使用。放在独立模块中，
+# 非页面代码不必 import fore (那会执行整个 Streamlit 页面)。
+
+# 硬件节点配置 - 必须与 init.sql 中的资源池匹配
+VM_PACKAGES = {
+    "gpu": {
+        "v100_std": {
+            "name": "V100 标准计算节点",
+            "queue": "gpu_v100",
+            "desc": "适用于深度学习训练，单卡独占",
+            "specs": {"显卡": "V100 32GB", "CPU": "24 Cores", "内存": "512 GB", "磁盘": "200 GB"},
+            "db_params": {"req_cores": 24, "req_gpu_mem": 32, "req_ram": 512, "req_disk": 200},
+            "price": 15.0
+        },
+        "a100_ultra": {
+            "name": "A100 高性能集群",
+            "queue": "gpuB",
+            "desc": "全节点独占，超大显存模型训练",
+            "specs": {"显卡": "A100 80GB x 8", "CPU": "96 Cores", "内存": "1 TB", "磁盘": "2 TB"},
+            "db_params": {"req_cores": 96, "req_gpu_mem": 640, "req_ram": 1024, "req_disk": 2000},
+            "price": 50.0
+        }
+    },
+    "cpu": {
+        "cpu_general": {
+            "name": "通用计算节点 (6126)",
+            "queue": "cpu_6126",
+            "specs": {"CPU": "Xeon 6126 (24核)", "内存": "192 GB", "磁盘": "100 GB"},
+            "db_params": {"req_cores": 24, "req_gpu_mem": 0, "req_ram": 192, "req_disk": 100},
+            "price": 3.0
+        }
+    }
+}
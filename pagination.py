@@ -0,0 +1,81 @@
+import streamlit as st
+
+import cache
+import queries
+
+# ================= 键集分页 (Keyset Pagination) =================
+#
+# 用 "上一页最后一行的排序键" 作为游标：WHERE (k1, k2) < (游标) ORDER BY k1 DESC, k2 DESC LIMIT n，
+# 配合以排序键结尾的复合索引，翻到任何深度都只读 n+1 行，代价与 OFFSET 无关。
+# 游标栈保存在 st.session_state 中，"上一页" 直接弹栈，无需反向查询。
+# SQL 的拼接 (keyset_condition / page_sql) 在 queries.py，供不加载页面的 migrate.py check 复用。
+
+PAGE_SIZES = [20, 50, 100, 200]
+DEFAULT_PAGE_SIZE = queries.DEFAULT_PAGE_SIZE
+
+
+def fetch_page(db_config, cursor, select_sql, where, params, key_cols, key_fields, after, page_size,
+               descending=True, ttl=5.0, tags=()):
+    """
+    取一页数据 (需配合 dictionary=True 的游标)。
+    select_sql: 不含 WHERE / ORDER BY / LIMIT 的 SELECT ... FROM ... JOIN ...
+    where:      额外过滤条件列表，如 ["r.user_id = %s"]
+    key_cols:   SQL 中的排序键列，如 ("b.created_at", "b.bill_id")
+    key_fields: 结果行中对应的字段名，如 ("created_at", "bill_id")
+    返回 (rows, next_cursor)；没有下一页时 next_cursor 为 None。
+    """
+    sql, sql_params = queries.page_sql(select_sql, where, params, key_cols, after, page_size, descending)
+    rows = cache.fetch_all(db_config, cursor, sql, sql_params, ttl=ttl, tags=tags)
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return rows, tuple(rows[-1][f] for f in key_fields)
+    return rows, None
+
+
+# ================= 分页控件 =================
+
+def _state(state_key):
+    state = st.session_state.get(state_key)
+    if state is None:
+        state = st.session_state[state_key] = {"stack": [None], "page_size": DEFAULT_PAGE_SIZE}
+    return state
+
+
+def reset(state_key):
+    st.session_state.pop(state_key, None)
+
+
+def current(state_key):
+    """
+    不渲染控件，返回 (page_size, 当前页游标)：每页条数取选择框本次重跑的值，
+    供页面在渲染到分页区块之前预取这一页
+    """
+    state = _state(state_key)
+    size = st.session_state.get(f"{state_key}_size", state["page_size"])
+    if size != state["page_size"]:
+        state["page_size"] = size
+        state["stack"] = [None]
+    return state["page_size"], state["stack"][-1]
+
+
+def page_size_selector(state_key, label="每页条数"):
+    """渲染每页条数选择框，返回 (page_size, 当前页游标)"""
+    state = _state(state_key)
+    st.selectbox(label, PAGE_SIZES, index=PAGE_SIZES.index(state["page_size"]), key=f"{state_key}_size")
+    return current(state_key)
+
+
+def pager(state_key, next_cursor):
+    """渲染 上一页 / 下一页 按钮"""
+    state = _state(state_key)
+    c1, c2, c3 = st.columns([1, 2, 1])
+    with c1:
+        if st.button("上一页", key=f"{state_key}_prev", disabled=len(state["stack"]) <= 1, use_container_width=True):
+            state["stack"].pop()
+            st.rerun()
+    with c2:
+        st.caption(f"第 {len(state['stack'])} 页")
+    with c3:
+        if st.button("下一页", key=f"{state_key}_next", disabled=next_cursor is None, use_container_width=True):
+            state["stack"].append(next_cursor)
+            st.rerun()
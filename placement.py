@@ -0,0 +1,338 @@
+import threading
+import time
+from bisect import bisect_left, insort
+
+import mysql.connector
+
+import db
+
+# ================= 放置策略 =================
+#
+# sp_create_instance 原本用 "... LIMIT 1 FOR UPDATE" 做首次适配 (first-fit)：
+# 并发请求都挤到同一个第一条匹配行上排队，而且会把节点切得很碎。
+# 这里在应用层维护每个队列的剩余容量有序索引，用二分查找 O(log n) 选出目标行，
+# 然后交给 sp_allocate_at 以 compare-and-set 方式落库，冲突时只刷新冲突行并重试。
+
+BEST_FIT = "best_fit"    # 选剩余量最小但放得下的节点：尽量填满已用节点，保留整机给大套餐
+WORST_FIT = "worst_fit"  # 选剩余量最大的节点：负载摊开，单节点争用最小
+POLICIES = (BEST_FIT, WORST_FIT)
+
+DEFAULT_POLICY = BEST_FIT
+
+# 索引整体刷新周期 (秒)；释放资源不经过引擎，靠周期刷新和 "放不下时刷新一次" 追上
+INDEX_MAX_AGE = 60.0
+
+# CAS 冲突后的最大重试次数
+MAX_CAS_RETRIES = 3
+
+# sp_allocate_at 的返回码
+RESULT_NO_CAPACITY = -1
+RESULT_NPU_CONFLICT = -2
+RESULT_MEM_CONFLICT = -3
+
+
+class QueueIndex:
+    """
+    单个队列的容量索引：
+    NPU 按剩余核数分桶 (npu_cores 为有节点的剩余核数，升序)，桶内按 (available_memory, NPU_id) 升序；
+    mem_keys 按 (available_size, memory_id) 升序。
+    剩余核数的不同取值最多 "单节点核数 + 1" 个，选点时每桶一次 bisect，与节点数无关。
+    """
+
+    def __init__(self):
+        self.npu_cores = []
+        self.npu_buckets = {}  # available_cores -> [(available_memory, NPU_id), ...]
+        self.npu_rows = {}  # NPU_id -> (available_cores, available_memory)
+        self.mem_keys = []
+        self.mem_rows = {}  # memory_id -> available_size
+
+    def set_npu(self, npu_id, free_cores, free_gpu_mem):
+        self.drop_npu(npu_id)
+        self.npu_rows[npu_id] = (free_cores, free_gpu_mem)
+        bucket = self.npu_buckets.get(free_cores)
+        if bucket is None:
+            bucket = self.npu_buckets[free_cores] = []
+            insort(self.npu_cores, free_cores)
+        insort(bucket, (free_gpu_mem, npu_id))
+
+    def drop_npu(self, npu_id):
+        old = self.npu_rows.pop(npu_id, None)
+        if old is None:
+            return
+        bucket = self.npu_buckets[old[0]]
+        del bucket[bisect_left(bucket, (old[1], npu_id))]
+        if not bucket:
+            del self.npu_buckets[old[0]]
+            del self.npu_cores[bisect_left(self.npu_cores, old[0])]
+
+    def set_mem(self, mem_id, free_size):
+        old = self.mem_rows.get(mem_id)
+        if old is not None:
+            del self.mem_keys[bisect_left(self.mem_keys, (old, mem_id))]
+        self.mem_rows[mem_id] = free_size
+        insort(self.mem_keys, (free_size, mem_id))
+
+    def drop_mem(self, mem_id):
+        old = self.mem_rows.pop(mem_id, None)
+        if old is not None:
+            del self.mem_keys[bisect_left(self.mem_keys, (old, mem_id))]
+
+    def pick_npu(self, cores, gpu_mem, policy):
+        first = bisect_left(self.npu_cores, cores)
+        if policy == WORST_FIT:
+            # worst-fit：从剩余核数最多的桶往下，取桶内显存最多的
+            for j in range(len(self.npu_cores) - 1, first - 1, -1):
+                bucket = self.npu_buckets[self.npu_cores[j]]
+                if bucket[-1][0] >= gpu_mem:
+                    return bucket[-1][1]
+            return None
+        # best-fit：从核数够用的最小桶往上，桶内二分到第一个显存够用的节点
+        for j in range(first, len(self.npu_cores)):
+            bucket = self.npu_buckets[self.npu_cores[j]]
+            k = bisect_left(bucket, (gpu_mem, -1))
+            if k < len(bucket):
+                return bucket[k][1]
+        return None
+
+    def pick_mem(self, ram, policy):
+        keys = self.mem_keys
+        if not keys:
+            return None
+        if policy == WORST_FIT:
+            return keys[-1][1] if keys[-1][0] >= ram else None
+        j = bisect_left(keys, (ram, -1))
+        return keys[j][1] if j < len(keys) else None
+
+
+class CapacityIndex:
+    """
+    所有队列的容量索引 (线程安全)。
+    choose() 选出目标行后立即在索引中预扣，使同进程内的并发分配自然分散到不同的行。
+    """
+
+    def __init__(self):
+        self._queues = {}
+        self._lock = threading.Lock()
+        self.loaded_at = 0.0
+
+    def _queue(self, queue):
+        q = self._queues.get(queue)
+        if q is None:
+            q = self._queues[queue] = QueueIndex()
+        return q
+
+    def load(self, npu_rows, mem_rows, queue=None):
+        """
+        npu_rows: [(NPU_id, queue_type, available_cores, available_memory, status), ...]
+        mem_rows: [(memory_id, queue_type, available_size, status), ...]
+        queue 不为空时只重建该队列。
+        """
+        with self._lock:
+            if queue is None:
+                self._queues = {}
+            else:
+                self._queues[queue] = QueueIndex()
+            for npu_id, q, free_cores, free_gpu, status in npu_rows:
+                if status == 'online':
+                    self._queue(q).set_npu(npu_id, free_cores, free_gpu)
+            for mem_id, q, free_size, status in mem_rows:
+                if status == 'online':
+                    self._queue(q).set_mem(mem_id, free_size)
+            self.loaded_at = time.monotonic()
+
+    def update_npu(self, queue, npu_id, free_cores, free_gpu_mem, status='online'):
+        with self._lock:
+            if status == 'online':
+                self._queue(queue).set_npu(npu_id, free_cores, free_gpu_mem)
+            else:
+                self._queue(queue).drop_npu(npu_id)
+
+    def update_mem(self, queue, mem_id, free_size, status='online'):
+        with self._lock:
+            if status == 'online':
+                self._queue(queue).set_mem(mem_id, free_size)
+            else:
+                self._queue(queue).drop_mem(mem_id)
+
+    def choose(self, queue, cores, gpu_mem, ram, policy=DEFAULT_POLICY):
+        """
+        选出 (npu_id, expect_cores, expect_gpu_mem, mem_id, expect_ram) 并在索引中预扣；
+        放不下时返回 None。expect_* 是 CAS 比对用的快照值。
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"未知的放置策略: {policy}")
+        with self._lock:
+            q = self._queues.get(queue)
+            if q is None:
+                return None
+            npu_id = q.pick_npu(cores, gpu_mem, policy)
+            mem_id = q.pick_mem(ram, policy)
+            if npu_id is None or mem_id is None:
+                return None
+            exp_cores, exp_gpu = q.npu_rows[npu_id]
+            exp_ram = q.mem_rows[mem_id]
+            q.set_npu(npu_id, exp_cores - cores, exp_gpu - gpu_mem)
+            q.set_mem(mem_id, exp_ram - ram)
+            return npu_id, exp_cores, exp_gpu, mem_id, exp_ram
+
+    def snapshot(self, queue):
+        """返回 (npu_rows, mem_rows) 副本，供报表/基准测试计算碎片率"""
+        with self._lock:
+            q = self._queues.get(queue)
+            if q is None:
+                return {}, {}
+            return dict(q.npu_rows), dict(q.mem_rows)
+
+
+# ================= 放置引擎 =================
+
+class PlacementEngine:
+    """
+    基于 CapacityIndex 的放置引擎：
+    1. 从索引中按策略选出目标 NPU / 内存行 (O(log n))
+    2. 调用 sp_create_instance_at 以 compare-and-set 落库
+    3. CAS 冲突时只重新读取冲突的行，再选一次
+    """
+
+    def __init__(self, db_config, policy=DEFAULT_POLICY, max_age=INDEX_MAX_AGE):
+        if policy not in POLICIES:
+            raise ValueError(f"未知的放置策略: {policy}")
+        self.db_config = db_config
+        self.policy = policy
+        self.max_age = max_age
+        self.index = CapacityIndex()
+        self._reload_lock = threading.Lock()
+        self.stats = {"allocations": 0, "conflicts": 0, "no_capacity": 0, "reloads": 0, "row_refreshes": 0}
+
+    def _count(self, key):
+        # 引擎为所有会话共享，计数与索引共用一把锁
+        with self.index._lock:
+            self.stats[key] += 1
+
+    # ---------- 索引维护 ----------
+
+    def reload(self, queue=None, cursor=None):
+        """从 npus / memory 表重建索引 (可只重建一个队列)"""
+        own = cursor is None
+        if own:
+            conn = db.get_connection(self.db_config)
+            cursor = conn.cursor()
+        try:
+            where, args = ("WHERE queue_type = %s", (queue,)) if queue else ("", ())
+            cursor.execute(f"SELECT NPU_id, queue_type, available_cores, available_memory, status FROM npus {where}", args)
+            npu_rows = cursor.fetchall()
+            cursor.execute(f"SELECT memory_id, queue_type, available_size, status FROM memory {where}", args)
+            mem_rows = cursor.fetchall()
+        finally:
+            if own:
+                cursor.close()
+                conn.close()
+        self.index.load(npu_rows, mem_rows, queue=queue)
+        self._count("reloads")
+
+    def ensure_fresh(self):
+        if time.monotonic() - self.index.loaded_at > self.max_age:
+            with self._reload_lock:
+                if time.monotonic() - self.index.loaded_at > self.max_age:
+                    self.reload()
+
+    def refresh_rows(self, cursor, npu_id=None, mem_id=None):
+        """CAS 失败或放弃一次预扣后，用数据库中的真实值覆盖索引中的这一行"""
+        if npu_id is not None:
+            cursor.execute("SELECT queue_type, available_cores, available_memory, status FROM npus WHERE NPU_id = %s", (npu_id,))
+            row = cursor.fetchone()
+            if row:
+                self.index.update_npu(row[0], npu_id, row[1], row[2], row[3])
+        if mem_id is not None:
+            cursor.execute("SELECT queue_type, available_size, status FROM memory WHERE memory_id = %s", (mem_id,))
+            row = cursor.fetchone()
+            if row:
+                self.index.update_mem(row[0], mem_id, row[1], row[2])
+        self._count("row_refreshes")
+
+    # ---------- 分配 ----------
+
+    def plan(self, queue, db_params, cursor=None):
+        """
+        为一条请求选出目标行并预扣索引；放不下时先刷新该队列再试一次。
+        返回 dict(npu_id, expect_cores, expect_gpu_mem, mem_id, expect_ram) 或 None
+        """
+        cores = db_params.get('req_cores', 1)
+        gpu_mem = db_params.get('req_gpu_mem', 0)
+        ram = db_params.get('req_ram', 1)
+        self.ensure_fresh()
+        pick = self.index.choose(queue, cores, gpu_mem, ram, self.policy)
+        if pick is None:
+            # 索引可能落后于最近的释放，按队列刷新后再试
+            self.reload(queue=queue, cursor=cursor)
+            pick = self.index.choose(queue, cores, gpu_mem, ram, self.policy)
+        if pick is None:
+            return None
+        npu_id, exp_cores, exp_gpu, mem_id, exp_ram = pick
+        return {"npu_id": npu_id, "expect_cores": exp_cores, "expect_gpu_mem": exp_gpu,
+                "mem_id": mem_id, "expect_ram": exp_ram}
+
+    def allocate(self, req_id, queue, db_params, conn=None):
+        """
+        为 req_id 分配资源并提交 (sp_create_instance_at 自带事务)。
+        返回新节点 ID；资源不足返回 -1。
+        """
+        own = conn is None
+        if own:
+            conn = db.get_connection(self.db_config)
+        cursor = conn.cursor()
+        try:
+            for _ in range(MAX_CAS_RETRIES + 1):
+                target = self.plan(queue, db_params, cursor=cursor)
+                if target is None:
+                    self._count("no_capacity")
+                    return RESULT_NO_CAPACITY
+
+                args = [
+                    req_id, queue,
+                    db_params.get('req_cores', 1),
+                    db_params.get('req_gpu_mem', 0),
+                    db_params.get('req_ram', 1),
+                    db_params.get('req_disk', 10),
+                    target['npu_id'], target['expect_cores'], target['expect_gpu_mem'],
+                    target['mem_id'], target['expect_ram'],
+                    0
+                ]
+                try:
+                    node_id = cursor.callproc('sp_create_instance_at', args)[-1]
+                except mysql.connector.Error:
+                    self.refresh_rows(cursor, target['npu_id'], target['mem_id'])
+                    raise
+
+                if node_id and node_id > 0:
+                    self._count("allocations")
+                    return node_id
+
+                # 失败时撤销预扣：以数据库真实值为准
+                self.refresh_rows(cursor, target['npu_id'], target['mem_id'])
+                if node_id == RESULT_NO_CAPACITY:
+                    # 计算资源够但存储池不足，换节点也没用
+                    self._count("no_capacity")
+                    return RESULT_NO_CAPACITY
+                self._count("conflicts")
+
+            self._count("no_capacity")
+            return RESULT_NO_CAPACITY
+        finally:
+            cursor.close()
+            if own:
+                conn.close()
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(db_config, policy=DEFAULT_POLICY):
+    """进程级单例：同一数据库、同一策略共享一份容量索引"""
+    key = (db.config_key(db_config), policy)
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = _engines[key] = PlacementEngine(db_config, policy=policy)
+    return engine
@@ -0,0 +1,137 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import streamlit as st
+
+import replica
+
+# ================= 仪表盘读查询并行预取 =================
+#
+# 仪表盘各区块的读查询互不依赖，原来在页面的一个游标上依次执行，页面耗时是各查询耗时之和。
+# 这里在页面渲染前把它们一起提交到进程级线程池，每条查询从连接池单独借一个连接 (dictionary=True 游标)，
+# 渲染到对应区块时再取结果：页面耗时约等于最慢的一条。
+# - 每条查询有自己的超时 (从提交时算起)，超时或出错时该区块拿到默认值并记入 failed，其他区块照常显示；
+#   超时的查询仍在后台执行完并写入查询缓存，下一次重跑通常直接命中
+# - 线程池全进程共享，WORKERS 应小于连接池 pool_size，给页面自己的连接和写操作留出余量
+# - 被提交的函数签名为 fn(db_config, cursor, ...)，与 cache.fetch_all / pagination.fetch_page 一致，
+#   不能调用 st.* (不在 Streamlit 脚本线程中)
+# - 这些查询都是只读的，经 replica.read 执行：配置了读副本时分流到副本 (scope 用于读己之写，见 replica.py)，
+#   此时传给 fn 的 db_config 是实际连接的库的配置，查询缓存按库分开
+
+WORKERS = 4
+DEFAULT_TIMEOUT = 5.0  # 秒
+PARALLEL = True        # False 时在提交处串行执行 (对比 / 排查用)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="prefetch")
+        return _executor
+
+
+def _run(db_config, scope, fn, args, kwargs):
+    t0 = time.perf_counter()
+
+    def work(source_config, conn):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            return fn(source_config, cursor, *args, **kwargs)
+        finally:
+            cursor.close()
+
+    value = replica.read(db_config, scope, work)
+    return value, t0, time.perf_counter()
+
+
+class PageQueries:
+    """
+    一个页面的一组独立读查询：
+        page = PageQueries(db_config)
+        page.submit("pending", cache.fetch_all, SQL_PENDING, ttl=3, tags=("requests",))
+        ...
+        rows = page.result("pending", [])
+    """
+
+    def __init__(self, db_config, timeout=DEFAULT_TIMEOUT, parallel=None, scope=None):
+        self.db_config = db_config
+        self.scope = scope  # 读己之写的范围 (与写操作处 replica.note_write 的 scope 一致)
+        self.timeout = timeout
+        self.parallel = PARALLEL if parallel is None else parallel
+        self.timings = {}   # 名称 -> 单条查询耗时 (秒，含借连接)
+        self.failed = {}    # 名称 -> 失败原因 ("timeout" 或异常信息)
+        self._started = time.perf_counter()
+        self._pending = {}  # 名称 -> (future, 截止时间)
+        self._results = {}
+        self._done = self._started  # 最后一条结果就绪的时刻
+
+    def _finish(self, name, value, started, finished):
+        self._results[name] = value
+        self.timings[name] = finished - started
+        self._done = max(self._done, finished)
+
+    def submit(self, name, fn, *args, timeout=None, **kwargs):
+        if not self.parallel:
+            try:
+                self._finish(name, *_run(self.db_config, self.scope, fn, args, kwargs))
+            except Exception as err:
+                self.failed[name] = str(err)
+                self._done = time.perf_counter()
+            return
+        deadline = time.perf_counter() + (self.timeout if timeout is None else timeout)
+        self._pending[name] = (_get_executor().submit(_run, self.db_config, self.scope, fn, args, kwargs), deadline)
+
+    def result(self, name, default=None):
+        """取结果；超时或出错返回 default"""
+        if name in self._pending:
+            future, deadline = self._pending.pop(name)
+            try:
+                self._finish(name, *future.result(max(deadline - time.perf_counter(), 0)))
+            except FutureTimeout:
+                self.failed[name] = "timeout"
+                self._done = max(self._done, deadline)
+            except Exception as err:
+                self.failed[name] = str(err)
+                self._done = max(self._done, time.perf_counter())
+        return self._results.get(name, default)
+
+    def wait_all(self):
+        for name in list(self._pending):
+            self.result(name)
+
+    def summary(self):
+        """
+        elapsed_ms: 从创建到最后一条结果就绪 (不含渲染)；serial_ms: 各查询耗时之和，即串行执行时的等待时间
+        """
+        self.wait_all()
+        return {
+            "parallel": self.parallel,
+            "queries": len(self.timings) + len(self.failed),
+            "elapsed_ms": round((self._done - self._started) * 1000, 1),
+            "serial_ms": round(sum(self.timings.values()) * 1000, 1),
+            "slowest": max(self.timings, key=self.timings.get) if self.timings else None,
+            "failed": dict(self.failed),
+        }
+
+
+# ================= 页面辅助 =================
+
+def section(page, name, default):
+    """在区块中取预取结果；该区块超时 / 出错时提示并返回 default，不影响其他区块"""
+    value = page.result(name, default)
+    if name in page.failed:
+        reason = "超时" if page.failed[name] == "timeout" else f"失败 ({page.failed[name]})"
+        st.warning(f"本区块数据加载{reason}，请稍后刷新重试。")
+    return value
+
+
+def timing_caption(page):
+    summary = page.summary()
+    st.caption(f"页面数据加载 {summary['elapsed_ms']} ms："
+               f"{summary['queries']} 条查询{'并行' if summary['parallel'] else '串行'}执行，"
+               f"单条耗时合计 {summary['serial_ms']} ms，最慢 {summary['slowest']}")
@@ -0,0 +1,167 @@
+# ================= 固定查询 =================
+#
+# 仪表盘、准入控制、调度器与利用率图表使用的 SQL，以及键集分页的 SQL 拼接。
+# migrate.py check 会对它们逐条 EXPLAIN，确认没有退化成全表扫描 / filesort；
+# 放在独立模块中 (不 import streamlit / 页面模块)，检查时不必加载 admin / user 页面。
+
+DEFAULT_PAGE_SIZE = 20
+
+# 管理员页面 (admin.py)
+
+# 排队作业：JSON 参数在 SQL 中一次性展开成列，不在渲染循环里逐行 json.loads
+# 走 idx_req_status_submit (status, submit_time)
+SQL_PENDING = """
+    SELECT request_id, user_id, submit_time,
+           JSON_UNQUOTE(JSON_EXTRACT(parameters, '$.name')) AS spec_name,
+           JSON_UNQUOTE(JSON_EXTRACT(parameters, '$.queue')) AS queue,
+           CAST(JSON_EXTRACT(parameters, '$.db_params.req_cores') AS SIGNED) AS req_cores,
+           CAST(JSON_EXTRACT(parameters, '$.db_params.req_gpu_mem') AS SIGNED) AS req_gpu_mem,
+           CAST(JSON_EXTRACT(parameters, '$.db_params.req_ram') AS SIGNED) AS req_ram,
+           parameters
+    FROM requests WHERE status='pending' ORDER BY submit_time ASC
+"""
+
+# 运行中实例：状态为 approved 且在 virtualcomputers 表中有对应记录
+SQL_ACTIVE = """
+    SELECT r.request_id, r.user_id, u.user_name, r.submit_time, 
+           vc.node_id, vc.node_name, vc.queue_name, vc.hourly_price
+    FROM requests r
+    JOIN users u ON r.user_id = u.user_id
+    JOIN virtualcomputers vc ON r.request_id = vc.request_id
+    WHERE r.status = 'approved'
+    ORDER BY r.submit_time DESC
+"""
+
+# 全部请求 (键集分页的 SELECT 部分，WHERE / ORDER BY / LIMIT 由 page_sql 拼接)
+SQL_HISTORY = """
+    SELECT r.request_id, u.user_name, r.status, r.submit_time, r.complete_time, r.node_id
+    FROM requests r
+    LEFT JOIN users u ON r.user_id = u.user_id
+"""
+
+# 全系统运行实例，走 idx_vc_status (status)
+SQL_ALL_INSTANCES = """
+    SELECT vc.node_id, vc.node_name, vc.queue_name, vc.status, vc.hourly_price, 
+           u.user_name, np.npu_serial
+    FROM virtualcomputers vc
+    JOIN requests r ON vc.request_id = r.request_id
+    JOIN users u ON r.user_id = u.user_id
+    JOIN virtualcpu vcpu ON vc.vir_NPU_id = vcpu.vir_NPU_id
+    JOIN npus np ON vcpu.NPU_id = np.NPU_id
+    WHERE vc.status='running'
+"""
+
+# 用户页面 (user.py)
+
+# 我的任务 (键集分页的 SELECT 部分)：按 request_id 倒序 (自增主键，与提交时间顺序一致)，
+# 走 idx_req_user (user_id, request_id)
+SQL_JOBS = """
+    SELECT 
+        r.request_id, r.request_type, r.status as req_status, r.submit_time, r.error_message,
+        vc.node_name, vc.queue_name, vc.status as vc_status
+    FROM requests r
+    LEFT JOIN virtualcomputers vc ON r.request_id = vc.request_id
+"""
+
+# 我的账单 (键集分页的 SELECT 部分)，[修复] 增加查询 r.status as job_status
+# 按 (created_at, bill_id) 倒序，走 idx_bill_user_created (user_id, created_at, bill_id)；
+# created_at 为 NULL 的行会被键集条件跳过，迁移 0015 已把该列改为 NOT NULL
+SQL_BILLS = """
+    SELECT 
+        b.bill_id, b.cost_amount, b.payment_status, b.usage_hours, b.end_time, b.created_at,
+        r.request_type, r.request_id, r.status as job_status,
+        vc.node_name
+    FROM bills b
+    JOIN requests r ON b.request_id = r.request_id
+    LEFT JOIN virtualcomputers vc ON b.node_id = vc.node_id
+"""
+
+# 待支付总额覆盖全部账单而非当前页：读 bills / requests 触发器维护的 user_bill_summary (迁移 0008 / 0019)，
+# 不再每次求和；没有汇总行时聚合结果为 0。accruing 为运行中任务的计量账单，任务结束后才可支付
+SQL_UNPAID_TOTAL = """
+    SELECT COALESCE(MAX(unpaid_amount), 0) AS unpaid_total, COALESCE(MAX(unpaid_bills), 0) AS unpaid_bills,
+           COALESCE(MAX(accruing_amount), 0) AS accruing_total, COALESCE(MAX(accruing_bills), 0) AS accruing_bills
+    FROM user_bill_summary
+    WHERE user_id = %s
+"""
+
+# 批量结算时锁定的账单：可支付 (未付，任务已结束且未异常终止；运行中任务的计量账单要等释放后)，
+# 从旧到新，只锁 bills 行
+SQL_PAYABLE_BILLS = """
+    SELECT b.bill_id, b.cost_amount
+    FROM bills b
+    JOIN requests r ON b.request_id = r.request_id
+    WHERE b.user_id = %s AND b.payment_status = 'unpaid' AND r.status NOT IN ('approved', 'terminated')
+"""
+
+# 余额风险 (metering.py 周期刷新的 user_balance_risk，主键查询)
+SQL_BALANCE_RISK = """
+    SELECT available, burn_rate, hours_left, exhausted_at, risk_level
+    FROM user_balance_risk
+    WHERE user_id = %s
+"""
+
+# 准入控制 (admission.py)：排队中的请求按 用户 / 队列 / 套餐 计数，age 为最近一次提交距今秒数 (走 idx_req_status)
+SQL_PENDING_COUNTS = """
+    SELECT user_id, parameters->>'$.queue' AS queue, parameters->>'$.package_key' AS package_key,
+           COUNT(*) AS pending, TIMESTAMPDIFF(SECOND, MAX(submit_time), NOW()) AS age
+    FROM requests
+    WHERE status = 'pending'
+    GROUP BY user_id, queue, package_key
+"""
+
+# 调度器领取请求 (scheduler.py)
+SQL_CLAIM = """
+    SELECT request_id, parameters FROM requests
+    WHERE status = 'pending' AND req_queue = %s
+      AND (sched_not_before IS NULL OR sched_not_before <= NOW())
+    ORDER BY submit_time ASC
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+"""
+
+# 利用率历史 (timeseries.py)
+SQL_UTIL_SERIES = """
+    SELECT bucket, samples,
+           cores_total, cores_used_sum / samples AS cores_used_avg, cores_used_max,
+           gpu_mem_total, gpu_mem_used_sum / samples AS gpu_mem_used_avg, gpu_mem_used_max,
+           ram_total, ram_used_sum / samples AS ram_used_avg, ram_used_max,
+           instances_sum / samples AS instances_avg, instances_max,
+           revenue_sum / samples AS revenue_avg, revenue_max
+    FROM util_series
+    WHERE resolution = %s AND scope = %s AND entity = %s AND bucket >= %s AND bucket < %s
+    ORDER BY bucket
+"""
+
+
+# ================= 键集分页 SQL =================
+# 游标与分页控件见 pagination.py
+
+def keyset_condition(key_cols, after, descending=True):
+    """
+    生成展开形式的行比较条件 (MySQL 对 (a, b) < (x, y) 这种行构造器比较无法走范围扫描)：
+        a < x OR (a = x AND b < y)
+    """
+    if after is None:
+        return "", ()
+    op = "<" if descending else ">"
+    parts, params = [], []
+    for i, col in enumerate(key_cols):
+        conds = [f"{c} = %s" for c in key_cols[:i]] + [f"{col} {op} %s"]
+        parts.append("(" + " AND ".join(conds) + ")")
+        params.extend(after[:i])
+        params.append(after[i])
+    return "(" + " OR ".join(parts) + ")", tuple(params)
+
+
+def page_sql(select_sql, where, params, key_cols, after, page_size, descending=True):
+    """拼出一页的 SQL (多取 1 行用于判断是否有下一页)，返回 (sql, params)"""
+    cond, cond_params = keyset_condition(key_cols, after, descending)
+    clauses = list(where) + ([cond] if cond else [])
+    direction = "DESC" if descending else "ASC"
+    sql = select_sql
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += " ORDER BY " + ", ".join(f"{c} {direction}" for c in key_cols)
+    sql += f" LIMIT {int(page_size) + 1}"
+    return sql, tuple(params) + cond_params
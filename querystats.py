@@ -0,0 +1,301 @@
+import json
+import re
+import threading
+import time
+
+from mysql.connector import Error
+
+# ================= 查询耗时统计 =================
+#
+# db.PooledConnection.cursor() 返回的游标会经过这里的 InstrumentedCursor：
+# 每条语句按 "指纹" (字面量与占位符替换为 ?、IN 列表折叠、空白归一) 归类，记录
+# 调用次数、耗时直方图、返回 / 影响行数、错误数 (按 errno)、锁等待超时 / 死锁耗时，
+# 以及连接上 rollback() 的次数 (记在回滚前最后执行的语句上)。
+# 耗时包含 execute 与取完结果集 (fetchall / fetchone 读到末尾 / close) 的时间；
+# callproc 的指纹为 "CALL 过程名"。
+# 统计是进程级的 (所有会话共享)，内存有界：指纹数超过 MAX_FINGERPRINTS 后新语句计入 "<other>"。
+# 应用 SQL 在服务端的锁等待时间见 server_digests() (performance_schema)。
+
+MAX_FINGERPRINTS = 1000
+OVERFLOW = "<other>"
+# 直方图桶上界 (毫秒)，最后一个桶为 +inf
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+LOCK_ERRNOS = (1205, 1213)  # 锁等待超时 / 死锁
+
+_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"")
+_NUMBER = re.compile(r"(?<![\w.`])-?\d+(?:\.\d+)?(?![\w`])")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s")
+_IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.I)
+_VALUES_LIST = re.compile(r"\b(VALUES\s*\([?,\s]*\))(?:\s*,\s*\([?,\s]*\))+", re.I)
+_COMMENT = re.compile(r"/\*.*?\*/|--[^\n]*", re.S)
+_SPACE = re.compile(r"\s+")
+
+_fingerprints = {}
+_fingerprints_lock = threading.Lock()
+
+
+def fingerprint(sql):
+    """语句归一化后的指纹，同一条查询不同参数得到同一个指纹"""
+    if isinstance(sql, (bytes, bytearray)):
+        sql = sql.decode("utf-8", "replace")
+    fp = _fingerprints.get(sql)
+    if fp is not None:
+        return fp
+    fp = _COMMENT.sub(" ", sql)
+    fp = _STRING.sub("?", fp)
+    fp = _PLACEHOLDER.sub("?", fp)
+    fp = _NUMBER.sub("?", fp)
+    fp = _SPACE.sub(" ", fp).strip().rstrip(";").strip()
+    fp = _IN_LIST.sub("IN (?+)", fp)
+    fp = _VALUES_LIST.sub(r"\1+", fp)
+    with _fingerprints_lock:
+        if len(_fingerprints) >= MAX_FINGERPRINTS * 4:
+            _fingerprints.clear()
+        _fingerprints[sql] = fp
+    return fp
+
+
+class QueryStats:
+
+    def __init__(self, max_fingerprints=MAX_FINGERPRINTS):
+        self.max_fingerprints = max_fingerprints
+        self._data = {}
+        self._lock = threading.Lock()
+        self._since = time.time()
+
+    def _entry(self, fp):
+        entry = self._data.get(fp)
+        if entry is None:
+            if len(self._data) >= self.max_fingerprints:
+                fp = OVERFLOW
+                entry = self._data.get(fp)
+            if entry is None:
+                entry = self._data[fp] = {
+                    "calls": 0, "errors": 0, "rollbacks": 0, "rows": 0,
+                    "total_s": 0.0, "max_s": 0.0, "lock_errors": 0, "lock_wait_s": 0.0,
+                    "errnos": {}, "histogram": [0] * (len(BUCKETS_MS) + 1),
+                }
+        return entry
+
+    def record(self, fp, elapsed, rows=0, errno=None):
+        ms = elapsed * 1000
+        bucket = next((i for i, bound in enumerate(BUCKETS_MS) if ms <= bound), len(BUCKETS_MS))
+        with self._lock:
+            entry = self._entry(fp)
+            entry["calls"] += 1
+            entry["rows"] += rows
+            entry["total_s"] += elapsed
+            entry["max_s"] = max(entry["max_s"], elapsed)
+            entry["histogram"][bucket] += 1
+            if errno is not None:
+                entry["errors"] += 1
+                entry["errnos"][errno] = entry["errnos"].get(errno, 0) + 1
+                if errno in LOCK_ERRNOS:
+                    entry["lock_errors"] += 1
+                    entry["lock_wait_s"] += elapsed
+
+    def rollback(self, fp):
+        with self._lock:
+            self._entry(fp or OVERFLOW)["rollbacks"] += 1
+
+    def reset(self):
+        with self._lock:
+            self._data.clear()
+            self._since = time.time()
+
+    def snapshot(self):
+        """[{fingerprint, calls, avg_ms, p50_ms, p95_ms, p99_ms, max_ms, ...}, ...]"""
+        with self._lock:
+            items = [(fp, dict(e, errnos=dict(e["errnos"]), histogram=list(e["histogram"])))
+                     for fp, e in self._data.items()]
+        return [_summarize(fp, e) for fp, e in items]
+
+    def since(self):
+        return self._since
+
+
+def _percentile_ms(histogram, max_s, pct):
+    """直方图估计的分位数：落在哪个桶就取该桶上界 (最后一个桶取最大值)"""
+    total = sum(histogram)
+    if not total:
+        return None
+    target, seen = pct / 100.0 * total, 0
+    for i, count in enumerate(histogram):
+        seen += count
+        if seen >= target:
+            return float(BUCKETS_MS[i]) if i < len(BUCKETS_MS) else round(max_s * 1000, 2)
+    return round(max_s * 1000, 2)
+
+
+def _summarize(fp, e):
+    return {
+        "fingerprint": fp,
+        "calls": e["calls"],
+        "total_ms": round(e["total_s"] * 1000, 2),
+        "avg_ms": round(e["total_s"] / e["calls"] * 1000, 2) if e["calls"] else None,
+        "p50_ms": _percentile_ms(e["histogram"], e["max_s"], 50),
+        "p95_ms": _percentile_ms(e["histogram"], e["max_s"], 95),
+        "p99_ms": _percentile_ms(e["histogram"], e["max_s"], 99),
+        "max_ms": round(e["max_s"] * 1000, 2),
+        "rows": e["rows"],
+        "errors": e["errors"],
+        "errnos": e["errnos"],
+        "rollbacks": e["rollbacks"],
+        "lock_errors": e["lock_errors"],
+        "lock_wait_ms": round(e["lock_wait_s"] * 1000, 2),
+        "histogram": dict(zip([f"<={b}ms" for b in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}ms"], e["histogram"])),
+    }
+
+
+class InstrumentedCursor:
+    """包装 mysql.connector 游标；未覆盖的属性 (rowcount、lastrowid、with_rows 等) 直接透传"""
+
+    def __init__(self, raw, conn):
+        self._raw = raw
+        self._conn = conn
+        self._pending = None  # 结果集尚未取完的语句: [指纹, 耗时, 行数]
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __iter__(self):
+        row = self.fetchone()
+        while row is not None:
+            yield row
+            row = self.fetchone()
+
+    def _finish(self):
+        if self._pending is not None:
+            fp, elapsed, rows = self._pending
+            self._pending = None
+            _stats.record(fp, elapsed, rows)
+
+    def _run(self, fp, fn, *args, **kwargs):
+        self._finish()
+        self._conn._last_fingerprint = fp
+        t0 = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Error as err:
+            _stats.record(fp, time.perf_counter() - t0, 0, err.errno)
+            raise
+        elapsed = time.perf_counter() - t0
+        if getattr(self._raw, "with_rows", False):
+            self._pending = [fp, elapsed, 0]
+        else:
+            _stats.record(fp, elapsed, max(self._raw.rowcount or 0, 0))
+        return result
+
+    def execute(self, operation, *args, **kwargs):
+        return self._run(fingerprint(operation), self._raw.execute, operation, *args, **kwargs)
+
+    def executemany(self, operation, *args, **kwargs):
+        return self._run(fingerprint(operation), self._raw.executemany, operation, *args, **kwargs)
+
+    def callproc(self, procname, *args, **kwargs):
+        return self._run(f"CALL {procname}", self._raw.callproc, procname, *args, **kwargs)
+
+    def _fetch(self, fn, *args):
+        t0 = time.perf_counter()
+        result = fn(*args)
+        if self._pending is not None:
+            self._pending[1] += time.perf_counter() - t0
+        return result
+
+    def fetchall(self):
+        rows = self._fetch(self._raw.fetchall)
+        if self._pending is not None:
+            self._pending[2] += len(rows)
+            self._finish()
+        return rows
+
+    def fetchmany(self, *args):
+        rows = self._fetch(self._raw.fetchmany, *args)
+        if self._pending is not None:
+            self._pending[2] += len(rows)
+            if not rows:
+                self._finish()
+        return rows
+
+    def fetchone(self):
+        row = self._fetch(self._raw.fetchone)
+        if self._pending is not None:
+            if row is None:
+                self._finish()
+            else:
+                self._pending[2] += 1
+        return row
+
+    def close(self):
+        self._finish()
+        return self._raw.close()
+
+
+# ================= 模块级接口 =================
+
+_stats = QueryStats()
+ENABLED = True
+
+
+def wrap_cursor(raw_cursor, conn):
+    return InstrumentedCursor(raw_cursor, conn) if ENABLED else raw_cursor
+
+
+def record_rollback(fp):
+    if ENABLED:
+        _stats.rollback(fp)
+
+
+def snapshot():
+    return _stats.snapshot()
+
+
+def top(by="total_ms", n=20):
+    """按某一列 (total_ms / calls / p95_ms / max_ms / errors / lock_wait_ms ...) 从大到小取前 n 条"""
+    return sorted(snapshot(), key=lambda s: s[by] or 0, reverse=True)[:n]
+
+
+def reset():
+    _stats.reset()
+
+
+def since():
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(_stats.since()))
+
+
+def dump(n=None):
+    """可序列化为 JSON 的完整统计，供压测脚本汇总；n 不为 None 时只保留总耗时前 n 条"""
+    statements = top("total_ms", n) if n is not None else sorted(
+        snapshot(), key=lambda s: s["total_ms"], reverse=True)
+    return {
+        "since": since(),
+        "buckets_ms": list(BUCKETS_MS),
+        "statements": statements,
+    }
+
+
+def write(path, n=None):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(dump(n), f, ensure_ascii=False, indent=2)
+
+
+# 服务端视角：performance_schema 按语句摘要累计的执行 / 锁等待时间 (皮秒)
+SQL_SERVER_DIGESTS = """
+    SELECT DIGEST_TEXT AS digest, COUNT_STAR AS calls,
+           ROUND(SUM_TIMER_WAIT / 1e9, 2) AS total_ms,
+           ROUND(AVG_TIMER_WAIT / 1e9, 2) AS avg_ms,
+           ROUND(MAX_TIMER_WAIT / 1e9, 2) AS max_ms,
+           ROUND(SUM_LOCK_TIME / 1e9, 2) AS lock_ms,
+           SUM_ROWS_EXAMINED AS rows_examined, SUM_ROWS_SENT AS rows_sent,
+           SUM_NO_INDEX_USED AS no_index_used
+    FROM performance_schema.events_statements_summary_by_digest
+    WHERE SCHEMA_NAME = DATABASE()
+    ORDER BY SUM_LOCK_TIME DESC
+    LIMIT %s
+"""
+
+
+def server_digests(cursor, n=20):
+    """锁等待时间最长的 n 类语句 (需要 performance_schema 的读权限)"""
+    cursor.execute(SQL_SERVER_DIGESTS, (int(n),))
+    return cursor.fetchall()
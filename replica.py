@@ -0,0 +1,284 @@
+import itertools
+import logging
+import threading
+import time
+
+from mysql.connector import Error
+from mysql.connector.errors import PoolError
+
+import db
+
+log = logging.getLogger("replica")
+
+# ================= 读副本路由 =================
+#
+# 仪表盘、报表与高级查询里的大 SELECT 原来和 sp_create_instance / sp_release_resource / 结算的
+# FOR UPDATE 事务挤在同一个主库上。这里把只读查询分流到一个或多个复制副本：
+# - 只有显式走 read() / read_connection() 的查询才会被分流 (prefetch 的仪表盘查询、高级查询中的只读语句)，
+#   写操作、存储过程、事务照旧用 db.get_connection 连主库
+# - 延迟容忍：副本按 SHOW REPLICA STATUS 的 Seconds_Behind_Source 计延迟，超过 MAX_LAG 秒、
+#   复制线程停止或连不上的副本不参与分流；每 CHECK_INTERVAL 秒由恰好遇到过期状态的读请求顺带检查一次
+# - 读己之写：写操作后调用 note_write(db_config, scope)，同一 scope (用户 id、"admin") 的读请求
+#   只会分到 "检查时刻 - 延迟" 已经晚于该写入的副本，否则回到主库
+# - 故障回退：副本借连接失败或执行中断线时标记为不可用 (RETRY_DOWN 秒后再检查)，本次读请求在主库上重试
+# 副本的 db_config 是主库配置加上覆盖项 (通常只是 host / port)，连接池与查询缓存都按副本各自独立。
+# 检查延迟需要副本账号有 REPLICATION CLIENT 权限。
+
+MAX_LAG = 5.0          # 秒，允许读到的最大复制延迟
+CHECK_INTERVAL = 2.0   # 秒
+RETRY_DOWN = 15.0      # 秒，不可用的副本多久后再检查
+WRITE_MARGIN = 1.0     # 秒，Seconds_Behind_Source 只精确到秒
+CONNECT_TIMEOUT = 2    # 秒，副本未指定 connection_timeout 时使用，避免宕机的副本拖住页面
+
+# 借连接 / 执行时这些错误说明副本本身不可用 (而不是语句有问题)
+CONNECTION_ERRNOS = (2003, 2005, 2006, 2013, 2055)
+
+_routers = {}
+_routers_lock = threading.Lock()
+
+
+def replica_config(db_config, override):
+    config = dict(db_config)
+    config.update(override)
+    config.setdefault("connection_timeout", CONNECT_TIMEOUT)
+    return config
+
+
+def is_connection_error(err):
+    return isinstance(err, PoolError) or getattr(err, "errno", None) in CONNECTION_ERRNOS
+
+
+def replication_lag(cursor):
+    """副本当前延迟 (秒)；不是副本或复制线程未运行时返回 None (dictionary=True 游标)"""
+    try:
+        cursor.execute("SHOW REPLICA STATUS")
+    except Error as err:
+        if err.errno != 1064:
+            raise
+        # 8.0.22 之前只有旧语法与旧列名
+        cursor.execute("SHOW SLAVE STATUS")
+    rows = cursor.fetchall()
+    if not rows:
+        return None
+    row = rows[0]
+    io = row.get("Replica_IO_Running", row.get("Slave_IO_Running"))
+    sql = row.get("Replica_SQL_Running", row.get("Slave_SQL_Running"))
+    lag = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+    if io != "Yes" or sql != "Yes" or lag is None:
+        return None
+    return float(lag)
+
+
+class _Replica:
+
+    def __init__(self, config):
+        self.config = config
+        self.name = f"{config.get('host')}:{config.get('port', 3306)}"
+        self.lock = threading.Lock()
+        self.state = None       # 最近一次检查成功时的 (检查时刻, 延迟)，不可用时为 None；整体替换，读取无需加锁
+        self.down_until = 0.0
+        self.error = None
+        self.reads = 0
+        self.failures = 0
+
+    def mark_down(self, err):
+        self.state = None
+        self.down_until = time.monotonic() + RETRY_DOWN
+        self.error = str(err)
+        self.failures += 1
+
+
+class Router:
+
+    def __init__(self, db_config, replicas, max_lag=None):
+        self.db_config = db_config
+        self.max_lag = MAX_LAG if max_lag is None else max_lag
+        self.replicas = [_Replica(replica_config(db_config, r)) for r in replicas]
+        self._lock = threading.Lock()
+        self._rr = itertools.count()
+        self._writes = {}  # scope -> 最近一次写入时刻
+        self._stats = {"replica_reads": 0, "primary_reads": 0, "read_your_writes": 0, "fallbacks": 0}
+
+    # ---- 状态检查 ----
+
+    def _check(self, rep):
+        try:
+            conn = db.get_connection(rep.config)
+        except Error as err:
+            log.warning("replica %s unreachable: %s", rep.name, err)
+            rep.mark_down(err)
+            return
+        cursor = conn.cursor(dictionary=True)
+        try:
+            checked_at = time.monotonic()
+            lag = replication_lag(cursor)
+        except Error as err:
+            log.warning("replica %s check failed: %s", rep.name, err)
+            rep.mark_down(err)
+            conn.discard()
+            return
+        finally:
+            cursor.close()
+        conn.close()
+        if lag is None:
+            rep.mark_down("复制未运行")
+            return
+        rep.state, rep.error = (checked_at, lag), None
+
+    def _maybe_check(self, rep, now):
+        state = rep.state
+        due = rep.down_until <= now if state is None else now - state[0] >= CHECK_INTERVAL
+        # 其他线程正在检查时直接沿用旧状态
+        if due and rep.lock.acquire(blocking=False):
+            try:
+                self._check(rep)
+            finally:
+                rep.lock.release()
+
+    # ---- 路由 ----
+
+    def note_write(self, scope):
+        now = time.monotonic()
+        with self._lock:
+            self._writes[scope] = now
+            if len(self._writes) > 1024:
+                # 早于任何可用副本新鲜度下限的写入已不再影响路由
+                horizon = now - self.max_lag - CHECK_INTERVAL - WRITE_MARGIN
+                self._writes = {s: t for s, t in self._writes.items() if t > horizon}
+
+    def candidates(self, scope=None):
+        """按轮转顺序返回当前可用于该 scope 的副本"""
+        now = time.monotonic()
+        for rep in self.replicas:
+            self._maybe_check(rep, now)
+        with self._lock:
+            wrote = self._writes.get(scope) if scope is not None else None
+        states = [(r, r.state) for r in self.replicas]
+        usable = [(r, st) for r, st in states if st is not None and st[1] <= self.max_lag]
+        # 副本至少已经应用了 "检查时刻 - 延迟" 之前提交的写入
+        fresh = [r for r, (checked_at, lag) in usable if wrote is None or checked_at - lag - WRITE_MARGIN >= wrote]
+        if usable and not fresh:
+            with self._lock:
+                self._stats["read_your_writes"] += 1
+        if not fresh:
+            return []
+        start = next(self._rr) % len(fresh)
+        return fresh[start:] + fresh[:start]
+
+    def read_connection(self, scope=None):
+        """(conn, 副本)；没有可用副本时借主库连接，副本为 None"""
+        for rep in self.candidates(scope):
+            try:
+                conn = db.get_connection(rep.config)
+            except Error as err:
+                if not is_connection_error(err):
+                    raise
+                self._fail(rep, err)
+                continue
+            with self._lock:
+                rep.reads += 1
+                self._stats["replica_reads"] += 1
+            return conn, rep
+        with self._lock:
+            self._stats["primary_reads"] += 1
+        return db.get_connection(self.db_config), None
+
+    def read(self, scope, work):
+        conn, rep = self.read_connection(scope)
+        try:
+            return work(rep.config if rep else self.db_config, conn)
+        except Error as err:
+            if rep is None or not is_connection_error(err):
+                raise
+            conn.discard()
+            self._fail(rep, err)
+        finally:
+            conn.close()
+        # 副本在执行中断线：在主库上重试一次
+        conn = db.get_connection(self.db_config)
+        try:
+            return work(self.db_config, conn)
+        finally:
+            conn.close()
+
+    def _fail(self, rep, err):
+        log.warning("replica %s failed, falling back: %s", rep.name, err)
+        with self._lock:
+            rep.mark_down(err)
+            self._stats["fallbacks"] += 1
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            s = dict(self._stats)
+            s["max_lag"] = self.max_lag
+            s["replicas"] = [{
+                "replica": r.name,
+                "state": "up" if st is not None else "down",
+                "lag_s": st[1] if st is not None else None,
+                "checked_ago_s": round(now - st[0], 1) if st is not None else None,
+                "reads": r.reads,
+                "failures": r.failures,
+                "error": r.error,
+            } for r, st in ((r, r.state) for r in self.replicas)]
+        return s
+
+
+# ================= 模块级接口 =================
+
+def configure(db_config, replicas=(), max_lag=None):
+    """
+    为主库 db_config 登记读副本；replicas 为覆盖项列表，如 [{"host": "10.0.0.2"}, {"port": 3307}]。
+    不登记 (或传空列表) 时所有读请求走主库。
+    """
+    key = db.config_key(db_config)
+    with _routers_lock:
+        if replicas:
+            _routers[key] = Router(dict(db_config), list(replicas), max_lag)
+        else:
+            _routers.pop(key, None)
+
+
+def _router(db_config):
+    return _routers.get(db.config_key(db_config))
+
+
+def note_write(db_config, scope):
+    """记录 scope 刚提交了写入：之后该 scope 的读请求只分到已追上这次写入的副本"""
+    router = _router(db_config)
+    if router is not None:
+        router.note_write(scope)
+
+
+def read(db_config, scope, work):
+    """
+    执行只读工作 work(source_config, conn)：优先在可用副本上执行，否则在主库上执行。
+    source_config 是实际连接的库的配置，应作为查询缓存的键 (各库的结果分开缓存)；
+    conn 用完由这里归还，work 中不要 close。
+    """
+    router = _router(db_config)
+    if router is None:
+        conn = db.get_connection(db_config)
+        try:
+            return work(db_config, conn)
+        finally:
+            conn.close()
+    return router.read(scope, work)
+
+
+def read_connection(db_config, scope=None):
+    """
+    借一个只读连接，返回 (conn, source_config)，调用方负责 close()；
+    用于需要自己掌控连接的长查询 (如高级查询)，只在借连接时回退，执行中断线不会重试。
+    """
+    router = _router(db_config)
+    if router is None:
+        return db.get_connection(db_config), db_config
+    conn, rep = router.read_connection(scope)
+    return conn, rep.config if rep else db_config
+
+
+def stats(db_config):
+    """路由统计；未登记副本时返回 None"""
+    router = _router(db_config)
+    return router.stats() if router is not None else None
@@ -0,0 +1,246 @@
+"""
+后台自动调度器：在 Streamlit 之外持续消化 pending 队列
+
+    python scheduler.py --host localhost --user root --password xxx --database cloud \\
+        --workers 4 --priority gpuB=3,gpu_v100=2,cpu_6126=1 --manual gpuB
+
+- 每个工作线程按队列优先级从高到低，用 SELECT ... FOR UPDATE SKIP LOCKED 领取一小批请求，
+  写入租约 (sched_not_before) 后立即提交；多个线程 / 多个进程可以同时运行，互相跳过对方正在领取的行，
+  租约期内也不会重复领取
+- 领到的请求交给 ops.approve_requests，与管理后台 "批量通过" 完全相同的路径：
+  放置引擎选点 + sp_approve_batch 内对请求行加锁并复核 status='pending'，
+  因此即使与管理员手工审批同时发生也不会重复分配
+- 暂时放不下的请求按指数退避推迟下次尝试；超过队列中单个节点上限、永远放不下的请求标记为 failed
+- 锁等待超时 / 死锁 (1205 / 1213) 带抖动退避后重试
+- --manual 中列出的队列不自动调度，仍由管理员在页面上审批
+
+需要迁移 0005 (python migrate.py ... up)。
+"""
+import argparse
+import logging
+import os
+import random
+import socket
+import threading
+import time
+
+import mysql.connector
+
+import cache
+import db
+import ops
+import queries
+
+log = logging.getLogger("scheduler")
+
+# 队列优先级：数值越大越先领取；未列出的队列优先级为 0
+QUEUE_PRIORITY = {"gpuB": 3, "gpu_v100": 2, "cpu_6126": 1}
+# 保持人工审批的队列
+MANUAL_QUEUES = ()
+
+CLAIM_BATCH = 20         # 每次每个队列领取的请求数
+CLAIM_LEASE = 60         # 领取租约 (秒)，超过后未处理完的请求可被其他调度进程重新领取
+POLL_INTERVAL = 2.0      # 没有可领取请求时的休眠 (秒)
+BACKOFF_BASE = 5         # 放不下时的退避：BACKOFF_BASE * 2^(尝试次数-1) 秒，封顶 BACKOFF_MAX
+BACKOFF_MAX = 600
+TRANSIENT_ERRNOS = (1205, 1213)  # 锁等待超时 / 死锁
+TRANSIENT_RETRIES = 5
+
+# 队列中单个节点的最大规格；超过它的请求无论何时都放不下
+QUEUE_LIMITS_SQL = """
+    SELECT (SELECT MAX(cores) FROM npus WHERE queue_type = %s AND status = 'online'),
+           (SELECT MAX(NPU_memory) FROM npus WHERE queue_type = %s AND status = 'online'),
+           (SELECT MAX(memory_size) FROM memory WHERE queue_type = %s AND status = 'online'),
+           (SELECT MAX(size_gb) FROM storagevolume WHERE status = 'online')
+"""
+
+
+def with_retry(fn, *args):
+    """遇到锁等待超时 / 死锁时带抖动指数退避重试"""
+    for attempt in range(TRANSIENT_RETRIES + 1):
+        try:
+            return fn(*args)
+        except mysql.connector.Error as err:
+            if err.errno not in TRANSIENT_ERRNOS or attempt == TRANSIENT_RETRIES:
+                raise
+            delay = min(0.05 * 2 ** attempt, 2.0) * (0.5 + random.random())
+            log.warning("transient error %s, retry in %.2fs", err.errno, delay)
+            time.sleep(delay)
+
+
+def claim(db_config, queue, limit, lease=CLAIM_LEASE):
+    """领取最多 limit 条请求并写入租约，返回 [(request_id, parameters), ...]"""
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        # READ COMMITTED 下，扫描到但被 sched_not_before 过滤掉的行不会一直持有锁
+        conn.start_transaction(isolation_level="READ COMMITTED")
+        cursor.execute(queries.SQL_CLAIM, (queue, int(limit)))
+        rows = cursor.fetchall()
+        if rows:
+            placeholders = ", ".join(["%s"] * len(rows))
+            cursor.execute(f"""
+                UPDATE requests SET sched_not_before = NOW() + INTERVAL %s SECOND, sched_attempts = sched_attempts + 1
+                WHERE request_id IN ({placeholders})
+            """, (int(lease), *[r[0] for r in rows]))
+        conn.commit()
+        return rows
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def queue_limits(db_config, queue):
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(QUEUE_LIMITS_SQL, (queue, queue, queue))
+        return tuple(v or 0 for v in cursor.fetchone())
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def never_fits(params, limits):
+    db_p = (params or {}).get('db_params', {})
+    max_cores, max_gpu, max_ram, max_disk = limits
+    return (db_p.get('req_cores', 1) > max_cores or db_p.get('req_gpu_mem', 0) > max_gpu
+            or db_p.get('req_ram', 1) > max_ram or db_p.get('req_disk', 10) > max_disk)
+
+
+def settle(db_config, failed, deferred):
+    """failed: {request_id: 原因} 标记为 failed；deferred: 放不下的请求，按尝试次数退避"""
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        for req_id, reason in failed.items():
+            cursor.execute(
+                "UPDATE requests SET status='failed', error_message=%s, complete_time=NOW() "
+                "WHERE request_id=%s AND status='pending'", (reason, req_id))
+        if deferred:
+            placeholders = ", ".join(["%s"] * len(deferred))
+            cursor.execute(f"""
+                UPDATE requests
+                SET sched_not_before = NOW() + INTERVAL LEAST(%s, %s * POW(2, GREATEST(sched_attempts - 1, 0))) SECOND
+                WHERE request_id IN ({placeholders}) AND status = 'pending'
+            """, (BACKOFF_MAX, BACKOFF_BASE, *deferred))
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    if failed:
+        cache.invalidate("requests")
+
+
+def schedule_queue(db_config, queue, batch_size=CLAIM_BATCH):
+    """领取并处理一批请求，返回 {result: count}"""
+    rows = with_retry(claim, db_config, queue, batch_size)
+    if not rows:
+        return {}
+    params = {req_id: ops.parse_params(raw) for req_id, raw in rows}
+    report = ops.approve_requests(db_config, rows)
+
+    summary, failed, deferred = {}, {}, []
+    limits = None
+    for item in report:
+        req_id, result = item['request_id'], item['result']
+        if result == "INVALID_PARAMS":
+            failed[req_id] = "Invalid request parameters"
+        elif result == "NO_CAPACITY":
+            if limits is None:
+                limits = queue_limits(db_config, queue)
+            if never_fits(params[req_id], limits):
+                result = "NEVER_FITS"
+                failed[req_id] = "Request exceeds the largest node in queue"
+            else:
+                deferred.append(req_id)
+        elif result in ("CONFLICT", "DEADLOCK", "SQL_ERROR"):
+            deferred.append(req_id)
+        summary[result] = summary.get(result, 0) + 1
+    with_retry(settle, db_config, failed, deferred)
+    return summary
+
+
+def auto_queues(db_config, priority, manual):
+    """参与自动调度的队列，按优先级从高到低"""
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT DISTINCT queue_type FROM npus")
+        queues = {r[0] for r in cursor.fetchall()} | set(priority)
+    finally:
+        cursor.close()
+        conn.close()
+    return sorted((q for q in queues if q not in manual), key=lambda q: (-priority.get(q, 0), q))
+
+
+def worker_loop(db_config, queues, stop, batch_size, poll_interval):
+    while not stop.is_set():
+        busy = False
+        for queue in queues:
+            try:
+                summary = schedule_queue(db_config, queue, batch_size)
+            except mysql.connector.Error as err:
+                log.error("queue %s: %s", queue, err)
+                continue
+            if summary:
+                busy = True
+                log.info("queue %s: %s", queue, summary)
+                # 有进展时从最高优先级重新开始，保证高优先级队列先被清空
+                break
+        if not busy:
+            stop.wait(poll_interval * (0.5 + random.random()))
+
+
+def run(db_config, workers=1, priority=None, manual=MANUAL_QUEUES, batch_size=CLAIM_BATCH, poll_interval=POLL_INTERVAL):
+    priority = QUEUE_PRIORITY if priority is None else priority
+    queues = auto_queues(db_config, priority, set(manual))
+    log.info("%s: scheduling %s with %d worker(s), manual: %s",
+             f"{socket.gethostname()}:{os.getpid()}", queues, workers, sorted(manual) or "-")
+    stop = threading.Event()
+    threads = [threading.Thread(target=worker_loop, args=(db_config, queues, stop, batch_size, poll_interval),
+                                daemon=True) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    try:
+        while any(t.is_alive() for t in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop.set()
+        for t in threads:
+            t.join()
+
+
+def parse_priority(text):
+    priority = {}
+    for part in filter(None, text.split(",")):
+        queue, _, value = part.partition("=")
+        priority[queue] = int(value or 0)
+    return priority
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--user", default="root")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--database", default="cloud")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--priority", default=None, help="队列=优先级，逗号分隔，如 gpuB=3,gpu_v100=2")
+    parser.add_argument("--manual", default=",".join(MANUAL_QUEUES), help="保持人工审批的队列，逗号分隔")
+    parser.add_argument("--batch-size", type=int, default=CLAIM_BATCH)
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(threadName)s %(levelname)s %(message)s")
+    db_config = {"host": args.host, "user": args.user, "password": args.password,
+                 "database": args.database, "charset": "utf8mb4", "collation": "utf8mb4_0900_ai_ci"}
+    db.configure(pool_size=args.workers + 1)
+
+    priority = parse_priority(args.priority) if args.priority is not None else None
+    manual = [q for q in args.manual.split(",") if q]
+    run(db_config, args.workers, priority, manual, args.batch_size, args.poll_interval)
+
+
+if __name__ == "__main__":
+    main()
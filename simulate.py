@@ -0,0 +1,681 @@
+"""
+调度策略离线仿真 (离散事件，无需数据库)
+
+    python simulate.py run --days 30 --scale 20 --load 0.85
+    python simulate.py run --trace requests.jsonl --policies fifo/first_fit,fifo/best_fit/backfill
+    python simulate.py export --host localhost --user root --password xxx --database cloud --since 2025-01-01 \\
+        --out requests.jsonl
+
+在 init.sql 9.2 节的资源池模型上 (--scale 倍节点数) 回放一条作业轨迹，比较不同的调度策略：
+- 轨迹：export 从 requests 表导出的历史请求 (submit_time、parameters，运行时长取实例创建到 complete_time)，
+  或按 --load 目标利用率生成的合成轨迹 (泊松到达叠加日周期，时长指数分布，套餐比例见 TRACE_MIX)
+- 排队顺序：fifo 按提交时间；priority 先按套餐优先级 (--priority，默认整机套餐优先) 再按提交时间
+- 放置：first_fit 取编号最小的可用行 (sp_create_instance 的行为)，best_fit / worst_fit 同放置引擎
+  (placement.QueueIndex)
+- backfill：EASY 回填。队首作业放不下时为它预留 "最早能放下它的" NPU 行与内存行 (按运行中作业的结束时间推算)，
+  其后至多 BACKFILL_DEPTH 个作业可以先行启动，只要不占用预留行，或在预留时刻之前结束
+- 超过队列中单个节点规格的作业直接拒绝 (与 scheduler.py 一致)；--max-wait-hours 之外仍未启动的作业视为放弃
+
+报告每个策略的排队等待分位数、按队列的平均 / 峰值利用率、碎片化节点数与整机套餐可放数量、被拒绝的需求 (核时)。
+--curves 另将按 --sample-minutes 采样的利用率曲线写成 CSV。输出为一行 JSON。
+
+各队列的资源池互不相交 (存储卷除外)，调度按队列分别进行；资源变化只触发所在队列的一次调度，
+到达的作业只在队列无人等待 (或可回填) 时尝试放置，因此一个月的轨迹在几千个节点上也只需数十秒以内。
+"""
+import argparse
+import csv
+import heapq
+import json
+import math
+import random
+import time
+from bisect import bisect_left, insort
+from collections import deque
+from datetime import datetime
+
+import placement
+
+# 与 init.sql 9.2 节保持一致 (每队列节点数、单节点规格)
+POOL = {
+    "gpu_v100": {"nodes": 51, "cores": 24, "gpu_mem": 128, "ram": 512},
+    "gpuB": {"nodes": 11, "cores": 96, "gpu_mem": 640, "ram": 1024},
+    "cpu_6126": {"nodes": 101, "cores": 24, "gpu_mem": 0, "ram": 192},
+}
+VOLUMES = (1000000, 100000)  # 存储卷容量 (GB)，所有队列共用
+
+# 合成轨迹：每个队列的套餐 (名称, (核数, 显存, 内存, 磁盘), 占比, 平均时长小时)；
+# 整机套餐来自 packages.VM_PACKAGES，小套餐来自 sp_init_mock_load
+TRACE_MIX = {
+    "gpu_v100": [("v100_std", (24, 32, 512, 200), 0.3, 24.0), ("v100_small", (4, 16, 32, 100), 0.7, 8.0)],
+    "gpuB": [("a100_ultra", (96, 640, 1024, 2000), 0.3, 48.0), ("a100_small", (12, 80, 128, 500), 0.7, 12.0)],
+    "cpu_6126": [("cpu_general", (24, 0, 192, 100), 0.3, 12.0), ("cpu_small", (2, 0, 4, 50), 0.7, 8.0)],
+}
+DIURNAL_AMPLITUDE = 0.5  # 到达率在一天内按 1 ± 该值的正弦变化
+
+# 默认优先级：整机套餐 (最容易被碎片挡住而饿死)
+DEFAULT_PRIORITY = {"v100_std": 1, "a100_ultra": 1, "cpu_general": 1}
+
+ORDERINGS = ("fifo", "priority")
+PLACEMENTS = ("first_fit", placement.BEST_FIT, placement.WORST_FIT)
+DEFAULT_POLICIES = ("fifo/first_fit", "fifo/best_fit", "priority/best_fit", "fifo/best_fit/backfill",
+                    "priority/best_fit/backfill")
+
+BACKFILL_DEPTH = 50   # 每次调度最多检查的回填候选数 (同 Slurm 的 bf_max_job_test)
+SAMPLE_MINUTES = 60
+
+# 作业字段下标
+J_ID, J_SUBMIT, J_QUEUE, J_SIZE, J_DURATION, J_PRIORITY, J_PACKAGE = range(7)
+
+
+# ================= 轨迹 =================
+
+def synthetic_trace(days, scale, load, seed):
+    """按目标核数利用率 load 推算每个队列的到达率，生成 [(id, 提交小时, 队列, 大小, 时长小时, 0, 套餐), ...]"""
+    rng = random.Random(seed)
+    horizon = days * 24.0
+    jobs = []
+    for queue, mix in TRACE_MIX.items():
+        capacity = POOL[queue]["nodes"] * scale * POOL[queue]["cores"]
+        weights = [w for _, _, w, _ in mix]
+        core_hours_per_job = sum(w * size[0] * hours for _, size, w, hours in mix)
+        rate = load * capacity / core_hours_per_job  # 每小时到达数
+        peak = rate * (1 + DIURNAL_AMPLITUDE)
+        t = 0.0
+        while True:
+            t += rng.expovariate(peak)
+            if t >= horizon:
+                break
+            # 稀疏化 (thinning) 得到按日周期变化的到达率
+            if rng.random() * peak > rate * (1 + DIURNAL_AMPLITUDE * math.sin(2 * math.pi * t / 24)):
+                continue
+            name, size, _, hours = rng.choices(mix, weights)[0]
+            jobs.append([0, t, queue, size, rng.expovariate(1 / hours), 0, name])
+    jobs.sort(key=lambda j: j[J_SUBMIT])
+    for i, job in enumerate(jobs):
+        job[J_ID] = i + 1
+    return jobs
+
+
+def _parse_time(value):
+    if not value:
+        return None
+    return datetime.fromisoformat(str(value))
+
+
+def load_trace(path):
+    """
+    读取 export 导出的 JSONL；没有运行时长的请求 (被拒绝 / 失败 / 仍在运行) 取同套餐已知时长的中位数，
+    没有队列信息的请求 (如 sp_init_mock_load 的 mock 请求) 跳过
+    """
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                rows.append(json.loads(line))
+    parsed, durations = [], {}
+    for row in rows:
+        params = row.get("parameters") or {}
+        if isinstance(params, str):
+            params = json.loads(params)
+        if "queue" not in params or "db_params" not in params:
+            continue
+        p = params["db_params"]
+        size = (p.get("req_cores", 1), p.get("req_gpu_mem", 0), p.get("req_ram", 1), p.get("req_disk", 0))
+        submit = _parse_time(row["submit_time"])
+        start, end = _parse_time(row.get("start_time")) or submit, _parse_time(row.get("complete_time"))
+        duration = (end - start).total_seconds() / 3600 if end and start and end > start else None
+        key = params.get("package_key") or params["queue"]
+        if duration is not None:
+            durations.setdefault(key, []).append(duration)
+        parsed.append((submit, params["queue"], size, duration, key))
+    if not parsed:
+        return []
+    every = sorted(d for ds in durations.values() for d in ds) or [1.0]
+    median = {k: sorted(v)[len(v) // 2] for k, v in durations.items()}
+    t0 = min(p[0] for p in parsed)
+    jobs = []
+    for i, (submit, queue, size, duration, key) in enumerate(sorted(parsed, key=lambda p: p[0])):
+        if duration is None:
+            duration = median.get(key, every[len(every) // 2])
+        jobs.append([i + 1, (submit - t0).total_seconds() / 3600, queue, size, duration, 0, key])
+    return jobs
+
+
+# ================= 资源池模型 =================
+
+class _FirstFit:
+    """
+    按行号取第一条放得下的行：线段树保存区间内各维度 (一维或两维) 的最大剩余量，从左向右剪枝下降，
+    取代 sp_create_instance 的顺序扫描
+    """
+
+    def __init__(self, free):
+        self.size = 1
+        while self.size < max(len(free), 1):
+            self.size *= 2
+        self.a = [-1] * (2 * self.size)
+        self.b = [-1] * (2 * self.size) if free and len(free[0]) > 1 else None
+        for pos, f in enumerate(free):
+            self.update(pos, f)
+
+    def update(self, pos, free):
+        a, b = self.a, self.b
+        i = pos + self.size
+        a[i] = free[0]
+        if b is not None:
+            b[i] = free[1]
+        i //= 2
+        while i:
+            l, r = 2 * i, 2 * i + 1
+            va = a[l] if a[l] > a[r] else a[r]
+            if b is None:
+                if a[i] == va:
+                    break
+                a[i] = va
+            else:
+                vb = b[l] if b[l] > b[r] else b[r]
+                if a[i] == va and b[i] == vb:
+                    break
+                a[i], b[i] = va, vb
+            i //= 2
+
+    def find(self, need, exclude=None):
+        a, b, size = self.a, self.b, self.size
+        na = need[0]
+        nb = need[1] if b is not None else 0
+        stack = [1]
+        pop, push = stack.pop, stack.append
+        while stack:
+            i = pop()
+            if a[i] < na or (b is not None and b[i] < nb):
+                continue
+            if i >= size:
+                if i - size != exclude:
+                    return i - size
+                continue
+            push(2 * i + 1)
+            push(2 * i)
+        return None
+
+
+class QueuePool:
+    """单个队列的 NPU 行与内存行：剩余量、运行中作业、利用率与碎片计数 (增量维护)"""
+
+    def __init__(self, queue, nodes, policy):
+        spec = POOL[queue]
+        self.spec = spec
+        self.policy = policy
+        self.npu_free = [[spec["cores"], spec["gpu_mem"]] for _ in range(nodes)]
+        self.mem_free = [spec["ram"] for _ in range(nodes)]
+        self.total = (spec["cores"] * nodes, spec["gpu_mem"] * nodes, spec["ram"] * nodes)
+        self.used = [0, 0, 0]
+        self.npu_idle = self.mem_idle = nodes
+        self.npu_full = 0
+        if policy == "first_fit":
+            self.npu_index = _FirstFit(self.npu_free)
+            self.mem_index = _FirstFit([(f,) for f in self.mem_free])
+        else:
+            self.index = placement.QueueIndex()
+            for i in range(nodes):
+                self.index.set_npu(i, spec["cores"], spec["gpu_mem"])
+                self.index.set_mem(i, spec["ram"])
+
+    def fits_ever(self, size):
+        return size[0] <= self.spec["cores"] and size[1] <= self.spec["gpu_mem"] and size[2] <= self.spec["ram"]
+
+    def pick_npu(self, cores, gpu):
+        if self.policy == "first_fit":
+            return self.npu_index.find((cores, gpu))
+        return self.index.pick_npu(cores, gpu, self.policy)
+
+    def pick_mem(self, ram):
+        if self.policy == "first_fit":
+            return self.mem_index.find((ram,))
+        return self.index.pick_mem(ram, self.policy)
+
+    def pick(self, size, exclude_npu=None, exclude_mem=None):
+        cores, gpu, ram = size[0], size[1], size[2]
+        if self.policy == "first_fit":
+            npu = self.npu_index.find((cores, gpu), exclude_npu)
+            mem = self.mem_index.find((ram,), exclude_mem) if npu is not None else None
+        else:
+            q = self.index
+            if exclude_npu is not None:
+                q.drop_npu(exclude_npu)
+            if exclude_mem is not None:
+                q.drop_mem(exclude_mem)
+            npu = q.pick_npu(cores, gpu, self.policy)
+            mem = q.pick_mem(ram, self.policy) if npu is not None else None
+            if exclude_npu is not None:
+                q.set_npu(exclude_npu, *self.npu_free[exclude_npu])
+            if exclude_mem is not None:
+                q.set_mem(exclude_mem, self.mem_free[exclude_mem])
+        if npu is None or mem is None:
+            return None
+        return npu, mem
+
+    def _set(self, npu, mem, dc, dg, dr):
+        spec = self.spec
+        f = self.npu_free[npu]
+        self.npu_idle -= f[0] == spec["cores"]
+        self.npu_full -= f[0] == 0
+        f[0] += dc
+        f[1] += dg
+        self.npu_idle += f[0] == spec["cores"]
+        self.npu_full += f[0] == 0
+        self.mem_idle -= self.mem_free[mem] == spec["ram"]
+        self.mem_free[mem] += dr
+        self.mem_idle += self.mem_free[mem] == spec["ram"]
+        self.used[0] -= dc
+        self.used[1] -= dg
+        self.used[2] -= dr
+        if self.policy == "first_fit":
+            self.npu_index.update(npu, f)
+            self.mem_index.update(mem, (self.mem_free[mem],))
+        else:
+            self.index.set_npu(npu, f[0], f[1])
+            self.index.set_mem(mem, self.mem_free[mem])
+
+    def allocate(self, npu, mem, size):
+        self._set(npu, mem, -size[0], -size[1], -size[2])
+
+    def release(self, npu, mem, size):
+        self._set(npu, mem, size[0], size[1], size[2])
+
+    def fragmented(self):
+        return len(self.npu_free) - self.npu_idle - self.npu_full
+
+
+class _Storage:
+    """存储卷：按编号取第一个放得下的卷"""
+
+    def __init__(self):
+        self.free = list(VOLUMES)
+
+    def pick(self, disk):
+        for i, f in enumerate(self.free):
+            if f >= disk:
+                return i
+        return None
+
+
+# ================= 仿真 =================
+
+def _percentiles(values):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pct(p):
+        return round(values[max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))], 3)
+
+    return {"count": len(values), "mean": round(sum(values) / len(values), 3),
+            "p50": pct(50), "p95": pct(95), "p99": pct(99), "max": round(values[-1], 3)}
+
+
+def parse_policy(text):
+    parts = text.split("/")
+    ordering, place = parts[0], parts[1] if len(parts) > 1 else "first_fit"
+    backfill = len(parts) > 2 and parts[2] == "backfill"
+    if ordering not in ORDERINGS or place not in PLACEMENTS or (len(parts) > 2 and not backfill):
+        raise ValueError(f"未知的策略: {text} (格式 排队顺序/放置[/backfill])")
+    return ordering, place, backfill
+
+
+class Simulation:
+
+    def __init__(self, jobs, policy, scale=1, priority=None, max_wait=None, sample_minutes=SAMPLE_MINUTES,
+                 horizon=None):
+        self.name = policy
+        self.ordering, place, self.backfill = parse_policy(policy)
+        self.jobs = jobs
+        self.priority = DEFAULT_PRIORITY if priority is None else priority
+        self.max_wait = max_wait
+        self.sample_every = sample_minutes / 60
+        self.horizon = horizon if horizon is not None else (jobs[-1][J_SUBMIT] if jobs else 0.0)
+        self.pools = {q: QueuePool(q, spec["nodes"] * scale, place) for q, spec in POOL.items()}
+        self.storage = _Storage()
+        # 等待队列：每个队列按优先级从高到低的若干 deque，已启动 / 放弃的作业惰性删除
+        self.waiting = {q: {} for q in POOL}
+        self.waiting_count = {q: 0 for q in POOL}
+        self.level_count = {}  # (队列, 优先级) -> 等待数
+        self.done = set()
+        # 运行中作业：(结束时刻, 作业 id) 的堆 (推进时间) 与按队列的有序列表 (推算预留)
+        self.completions = []
+        self.running = {q: [] for q in POOL}
+        self.placed = {}   # 作业 id -> (npu, mem, volume)
+        self.reservation = {q: None for q in POOL}  # (队首作业 id, npu, mem, 预留时刻)
+        self.waits = {q: [] for q in POOL}
+        self.rejected = {"oversize": 0, "abandoned": 0, "core_hours": 0.0}
+        self.samples = []
+
+    # ---------- 等待队列 ----------
+
+    def _level(self, job):
+        return self.priority.get(job[J_PACKAGE], 0) if self.ordering == "priority" else 0
+
+    def _enqueue(self, job):
+        levels = self.waiting[job[J_QUEUE]]
+        level = self._level(job)
+        if level not in levels:
+            # 优先级从高到低
+            self.waiting[job[J_QUEUE]] = levels = dict(sorted({**levels, level: deque()}.items(), reverse=True))
+        levels[level].append(job)
+        self.waiting_count[job[J_QUEUE]] += 1
+        key = (job[J_QUEUE], level)
+        self.level_count[key] = self.level_count.get(key, 0) + 1
+
+    def _waiting(self, queue):
+        """按调度顺序遍历仍在等待的作业 (顺带弹出各 deque 头部已处理的作业)"""
+        for dq in self.waiting[queue].values():
+            while dq and dq[0][J_ID] in self.done:
+                self.done.discard(dq.popleft()[J_ID])
+            for job in dq:
+                if job[J_ID] not in self.done:
+                    yield job
+
+    def _finish_waiting(self, job):
+        self.done.add(job[J_ID])
+        self.waiting_count[job[J_QUEUE]] -= 1
+        self.level_count[(job[J_QUEUE], self._level(job))] -= 1
+
+    # ---------- 启动 / 结束 ----------
+
+    def _start(self, job, now, pick, volume):
+        pool = self.pools[job[J_QUEUE]]
+        npu, mem = pick
+        pool.allocate(npu, mem, job[J_SIZE])
+        self.storage.free[volume] -= job[J_SIZE][3]
+        end = now + job[J_DURATION]
+        self.placed[job[J_ID]] = (npu, mem, volume)
+        heapq.heappush(self.completions, (end, job[J_ID], job))
+        insort(self.running[job[J_QUEUE]], (end, job[J_ID], npu, mem, job[J_SIZE]))
+        self.waits[job[J_QUEUE]].append(now - job[J_SUBMIT])
+
+    def _try_start(self, job, now, reservation=None):
+        pool = self.pools[job[J_QUEUE]]
+        volume = self.storage.pick(job[J_SIZE][3])
+        if volume is None:
+            return False
+        pick = pool.pick(job[J_SIZE])
+        if pick is None:
+            return False
+        if reservation is not None:
+            _, r_npu, r_mem, r_time = reservation
+            if (pick[0] == r_npu or pick[1] == r_mem) and now + job[J_DURATION] > r_time:
+                # 会推迟队首作业的预留：换一个不占预留行的位置
+                pick = pool.pick(job[J_SIZE], r_npu, r_mem)
+                if pick is None:
+                    return False
+        self._start(job, now, pick, volume)
+        return True
+
+    def _complete(self, end, job):
+        npu, mem, volume = self.placed.pop(job[J_ID])
+        queue = job[J_QUEUE]
+        self.pools[queue].release(npu, mem, job[J_SIZE])
+        self.storage.free[volume] += job[J_SIZE][3]
+        running = self.running[queue]
+        del running[bisect_left(running, (end, job[J_ID]))]
+
+    # ---------- 预留 (EASY backfill) ----------
+
+    def _reserve(self, job, now):
+        """按运行中作业的结束顺序推算最早能放下 job 的 NPU 行与内存行"""
+        pool = self.pools[job[J_QUEUE]]
+        cores, gpu, ram = job[J_SIZE][:3]
+        npu_at = mem_at = None
+        npu, mem = pool.pick_npu(cores, gpu), pool.pick_mem(ram)
+        if npu is not None:
+            npu_at = now
+        if mem is not None:
+            mem_at = now
+        freed_npu, freed_mem = {}, {}
+        for end, _, n, m, size in self.running[job[J_QUEUE]]:
+            if npu_at is not None and mem_at is not None:
+                break
+            if npu_at is None:
+                c, g = freed_npu.get(n, pool.npu_free[n])
+                c, g = c + size[0], g + size[1]
+                freed_npu[n] = (c, g)
+                if c >= cores and g >= gpu:
+                    npu, npu_at = n, end
+            if mem_at is None:
+                r = freed_mem.get(m, pool.mem_free[m]) + size[2]
+                freed_mem[m] = r
+                if r >= ram:
+                    mem, mem_at = m, end
+        if npu_at is None or mem_at is None:
+            return None
+        return job[J_ID], npu, mem, max(npu_at, mem_at)
+
+    # ---------- 调度 ----------
+
+    def _schedule(self, queue, now):
+        head = None
+        scanned = 0
+        failed = set()  # 本轮已放不下的大小 (套餐种类很少)：同样大小的候选不必再试
+        for job in self._waiting(queue):
+            if self.max_wait is not None and now - job[J_SUBMIT] > self.max_wait:
+                self._finish_waiting(job)
+                self.rejected["abandoned"] += 1
+                self.rejected["core_hours"] += job[J_SIZE][0] * job[J_DURATION]
+                continue
+            if head is None:
+                if self._try_start(job, now):
+                    self._finish_waiting(job)
+                    continue
+                if not self.backfill:
+                    return
+                head = job
+                res = self.reservation[queue]
+                if res is None or res[0] != job[J_ID]:
+                    res = self.reservation[queue] = self._reserve(job, now)
+                continue
+            scanned += 1
+            if scanned > BACKFILL_DEPTH:
+                return
+            size = job[J_SIZE]
+            if size in failed:
+                continue
+            if self._try_start(job, now, res):
+                self._finish_waiting(job)
+            else:
+                failed.add(size)
+
+    def _arrive(self, job, now):
+        queue = job[J_QUEUE]
+        pool = self.pools[queue]
+        if not pool.fits_ever(job[J_SIZE]):
+            self.rejected["oversize"] += 1
+            self.rejected["core_hours"] += job[J_SIZE][0] * job[J_DURATION]
+            return
+        level = self._level(job)
+        ahead = any(n for (q, lvl), n in self.level_count.items() if q == queue and lvl >= level)
+        if not ahead:
+            if self._try_start(job, now):
+                return
+        elif self.backfill:
+            res = self.reservation[queue]
+            if res is not None and self._try_start(job, now, res):
+                return
+        self._enqueue(job)
+
+    def _sample(self, t):
+        row = {"hour": round(t, 3), "policy": self.name}
+        for q, pool in self.pools.items():
+            for dim, used, total in zip(("cores", "gpu_mem", "ram"), pool.used, pool.total):
+                if total:
+                    row[f"{q}_{dim}_util"] = round(used / total, 4)
+            row[f"{q}_fragmented"] = pool.fragmented()
+            row[f"{q}_full_node_fits"] = min(pool.npu_idle, pool.mem_idle)
+            row[f"{q}_waiting"] = self.waiting_count[q]
+        self.samples.append(row)
+
+    def run(self):
+        t0 = time.perf_counter()
+        next_sample = 0.0
+        arrivals = iter(self.jobs)
+        job = next(arrivals, None)
+        while job is not None or self.completions:
+            if job is not None and (not self.completions or job[J_SUBMIT] <= self.completions[0][0]):
+                now, event = job[J_SUBMIT], None
+            else:
+                now, _, event = self.completions[0]
+            if now > self.horizon:
+                break
+            while next_sample <= now:
+                self._sample(next_sample)
+                next_sample += self.sample_every
+            if event is None:
+                self._arrive(job, now)
+                job = next(arrivals, None)
+                continue
+            heapq.heappop(self.completions)
+            self._complete(now, event)
+            # 同一时刻结束的作业一起释放后再调度
+            touched = {event[J_QUEUE]}
+            while self.completions and self.completions[0][0] == now:
+                _, _, other = heapq.heappop(self.completions)
+                self._complete(now, other)
+                touched.add(other[J_QUEUE])
+            for queue in touched:
+                if self.waiting_count[queue]:
+                    self._schedule(queue, now)
+        return self.report(time.perf_counter() - t0)
+
+    def report(self, elapsed):
+        samples = self.samples
+        util, frag = {}, {}
+        for q, pool in self.pools.items():
+            util[q] = {}
+            for dim, total in zip(("cores", "gpu_mem", "ram"), pool.total):
+                if total and samples:
+                    values = [s[f"{q}_{dim}_util"] for s in samples]
+                    util[q][f"{dim}_avg"] = round(sum(values) / len(values), 4)
+                    util[q][f"{dim}_peak"] = max(values)
+            if samples:
+                fragmented = [s[f"{q}_fragmented"] for s in samples]
+                fits = [s[f"{q}_full_node_fits"] for s in samples]
+                frag[q] = {"nodes": len(pool.npu_free), "fragmented_avg": round(sum(fragmented) / len(fragmented), 1),
+                           "full_node_fits_avg": round(sum(fits) / len(fits), 1), "full_node_fits_min": min(fits)}
+        all_waits = [w for ws in self.waits.values() for w in ws]
+        self.rejected["core_hours"] = round(self.rejected["core_hours"], 1)
+        return {
+            "policy": self.name,
+            "elapsed_s": round(elapsed, 2),
+            "jobs": len(self.jobs),
+            "started": len(all_waits),
+            "unfinished": sum(self.waiting_count.values()),
+            "rejected": dict(self.rejected),
+            "wait_hours": _percentiles(all_waits),
+            "wait_hours_by_queue": {q: _percentiles(ws) for q, ws in self.waits.items()},
+            "utilization": util,
+            "fragmentation": frag,
+        }
+
+
+# ================= 导出历史请求 (需要数据库) =================
+
+SQL_EXPORT = """
+    SELECT r.request_id, r.user_id, r.status, r.submit_time, vc.created_at AS start_time, r.complete_time,
+           r.parameters
+    FROM requests r
+    LEFT JOIN virtualcomputers vc ON vc.request_id = r.request_id
+    WHERE r.submit_time >= %s
+    ORDER BY r.request_id
+"""
+
+
+def export(db_config, since, out):
+    import db
+
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor(dictionary=True)
+    count = 0
+    try:
+        cursor.execute(SQL_EXPORT, (since,))
+        with open(out, "w", encoding="utf-8") as f:
+            for row in cursor:
+                f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+                count += 1
+    finally:
+        cursor.close()
+        conn.close()
+    return count
+
+
+def parse_priority(text):
+    priority = {}
+    for part in filter(None, (text or "").split(",")):
+        key, _, value = part.partition("=")
+        priority[key.strip()] = int(value)
+    return priority
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="仿真并比较策略")
+    run.add_argument("--trace", help="export 导出的 JSONL；不给则生成合成轨迹")
+    run.add_argument("--days", type=float, default=30, help="合成轨迹的天数")
+    run.add_argument("--load", type=float, default=0.85, help="合成轨迹的目标核数利用率")
+    run.add_argument("--seed", type=int, default=42)
+    run.add_argument("--scale", type=int, default=20, help="资源池节点数相对 init.sql 的倍数")
+    run.add_argument("--policies", default=",".join(DEFAULT_POLICIES),
+                     help="逗号分隔，每项为 排队顺序/放置[/backfill]，如 fifo/first_fit、priority/best_fit/backfill")
+    run.add_argument("--priority", default=None, help="套餐优先级，如 a100_ultra=2,v100_std=1 (priority 排队时使用)")
+    run.add_argument("--max-wait-hours", type=float, default=None, help="等待超过该时长视为放弃")
+    run.add_argument("--sample-minutes", type=float, default=SAMPLE_MINUTES)
+    run.add_argument("--curves", help="把采样的利用率 / 碎片曲线写入该 CSV")
+
+    exp = sub.add_parser("export", help="从数据库导出历史请求 (JSONL)")
+    exp.add_argument("--host", default="localhost")
+    exp.add_argument("--user", default="root")
+    exp.add_argument("--password", default="")
+    exp.add_argument("--database", default="cloud")
+    exp.add_argument("--since", default="2000-01-01")
+    exp.add_argument("--out", default="requests.jsonl")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        db_config = {"host": args.host, "user": args.user, "password": args.password,
+                     "database": args.database, "charset": "utf8mb4", "collation": "utf8mb4_0900_ai_ci"}
+        print(json.dumps({"exported": export(db_config, args.since, args.out), "out": args.out}, ensure_ascii=False))
+        return
+
+    policies = [p.strip() for p in args.policies.split(",") if p.strip()]
+    for p in policies:
+        parse_policy(p)
+    if args.trace:
+        jobs = load_trace(args.trace)
+        horizon = jobs[-1][J_SUBMIT] if jobs else 0.0
+    else:
+        jobs = synthetic_trace(args.days, args.scale, args.load, args.seed)
+        horizon = args.days * 24.0
+    priority = parse_priority(args.priority) if args.priority is not None else None
+
+    results, samples = [], []
+    for policy in policies:
+        # 每个策略从同一份轨迹的副本开始
+        sim = Simulation([list(j) for j in jobs], policy, args.scale, priority, args.max_wait_hours,
+                         args.sample_minutes, horizon)
+        results.append(sim.run())
+        samples.extend(sim.samples)
+    if args.curves and samples:
+        with open(args.curves, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=list(samples[0]))
+            writer.writeheader()
+            writer.writerows(samples)
+    print(json.dumps({
+        "trace": args.trace or "synthetic",
+        "jobs": len(jobs),
+        "nodes": sum(spec["nodes"] * args.scale for spec in POOL.values()),
+        "horizon_hours": round(horizon, 1),
+        "results": results,
+    }, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
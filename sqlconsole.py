@@ -0,0 +1,261 @@
+import csv
+import gzip
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+import weakref
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from mysql.connector import Error
+
+import db
+import replica
+
+# ================= 管理后台 "高级查询 (SQL)" 的执行 =================
+#
+# 原来在页面共用的连接上 execute + fetchall，整个结果集进 DataFrame：一条 SELECT * FROM use_log
+# 就能占满 Streamlit 进程内存，没有超时的大联表会一直占着连接。这里：
+# - 每条语句单独借一个连接，在后台线程里用无缓冲游标执行，按块 fetchmany，
+#   结果块经有界队列交给页面，读得慢时后台线程停在队列上，内存中最多 QUEUE_CHUNKS 块
+# - SET SESSION MAX_EXECUTION_TIME 限制 SELECT 的执行时间；其他语句由页面侧的看门狗
+#   超时后 KILL QUERY
+# - cancel() 从另一个连接 KILL QUERY；页面重跑 (点击 "取消" 或任何其他组件) 打断读取循环时，
+#   close() 同样会终止查询
+# - 执行过会话设置 / 可能被 KILL 的连接用完直接丢弃，不放回连接池
+# - 传入 replica_scope 时，只读语句 (SELECT / EXPLAIN 等；SHOW 的结果与所连的库有关，不含 FOR UPDATE 之类的写意图) 经
+#   replica.read_connection 分流到读副本，advanced.sql 里的大报表不再和分配事务抢主库；其他语句照旧走主库
+
+DEFAULT_TIMEOUT = 30.0       # 秒
+FETCH_CHUNK = 500            # 每次 fetchmany 的行数
+QUEUE_CHUNKS = 4             # 后台线程最多预读的块数
+EXPORT_ROW_CAP = 2000000     # 导出文件的行数上限
+# 导出文件的大小上限：st.download_button 会把整个文件读入内存 (每次页面重跑都会重新读取)
+EXPORT_BYTE_CAP = 200 * 1024 * 1024
+EXPORT_PREFIX = "query_"
+EXPORT_STALE_AGE = 24 * 3600  # 秒，超过这个时间的导出文件视为遗留文件
+EXPORT_FORMATS = {"csv.gz": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+_DONE = object()
+
+_LEADING_COMMENTS = re.compile(r"^(?:\s+|/\*.*?\*/|(?:--|#)[^\n]*)*", re.S)
+_READ_ONLY = re.compile(r"^(?:SELECT|EXPLAIN|DESCRIBE|DESC|WITH)\b", re.I)
+_WRITE_INTENT = re.compile(r"\b(?:INSERT|UPDATE|DELETE|REPLACE|INTO|LOCK|SHARE)\b", re.I)
+
+
+def is_read_only(sql):
+    """保守判断：拿不准的语句都按写语句处理 (走主库)"""
+    sql = _LEADING_COMMENTS.sub("", sql)
+    return bool(_READ_ONLY.match(sql)) and not _WRITE_INTENT.search(sql)
+
+
+class StatementTimeout(Exception):
+    pass
+
+
+class StatementRun:
+    """
+    后台执行一条语句：
+        run = StatementRun(db_config, sql, timeout)
+        try:
+            for rows in run.chunks():   # None 表示暂无新数据 (供调用方刷新进度)
+                ...
+        finally:
+            run.close()
+    语句不返回结果集时 chunks() 不产出数据，结束后 run.rowcount 为影响行数 (已提交)。
+    """
+
+    def __init__(self, db_config, sql, timeout=DEFAULT_TIMEOUT, chunk_rows=FETCH_CHUNK, replica_scope=None):
+        self.sql = sql
+        self.timeout = timeout
+        self.chunk_rows = chunk_rows
+        self.columns = None
+        self.rowcount = None
+        self.rows_read = 0
+        self.cancelled = False
+        self._error = None
+        self._queue = queue.Queue(maxsize=QUEUE_CHUNKS)
+        self._stop = threading.Event()
+        if replica_scope is not None and is_read_only(sql):
+            # cancel() 的 KILL QUERY 要发到同一个库，db_config 记实际连接的库
+            self._conn, self.db_config = replica.read_connection(db_config, replica_scope)
+        else:
+            self._conn, self.db_config = db.get_connection(db_config), db_config
+        self.on_replica = self.db_config is not db_config
+        self._conn_id = self._conn.connection_id
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._started = None
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _work(self):
+        cursor = self._conn.cursor()
+        try:
+            cursor.execute(f"SET SESSION MAX_EXECUTION_TIME = {int(self.timeout * 1000)}")
+            cursor.execute(self.sql)
+            if cursor.with_rows:
+                self.columns = list(cursor.column_names)
+                while not self._stop.is_set():
+                    rows = cursor.fetchmany(self.chunk_rows)
+                    if not rows or not self._put(rows):
+                        break
+            else:
+                self._conn.commit()
+                self.rowcount = cursor.rowcount
+        except Error as err:
+            self._error = err
+        finally:
+            self._put(_DONE)
+
+    def elapsed(self):
+        return time.monotonic() - self._started if self._started else 0.0
+
+    def chunks(self, poll=0.25):
+        self._started = time.monotonic()
+        self._thread.start()
+        while True:
+            try:
+                item = self._queue.get(timeout=poll)
+            except queue.Empty:
+                if not self._thread.is_alive() and self._queue.empty():
+                    break
+                if self.elapsed() > self.timeout:
+                    self.cancel()
+                    raise StatementTimeout(f"执行超过 {self.timeout:.0f} 秒，已终止")
+                yield None
+                continue
+            if item is _DONE:
+                break
+            self.rows_read += len(item)
+            yield item
+        if self._error is not None:
+            if self._error.errno == 3024:  # MAX_EXECUTION_TIME 到期
+                raise StatementTimeout(f"执行超过 {self.timeout:.0f} 秒，已终止")
+            if not (self.cancelled and self._error.errno == 1317):  # 1317: 被 KILL QUERY 中断
+                raise self._error
+
+    def cancel(self):
+        """从另一个连接终止正在执行的语句"""
+        self._stop.set()
+        if not self._thread.is_alive():
+            return
+        self.cancelled = True
+        conn = db.get_connection(self.db_config)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"KILL QUERY {int(self._conn_id)}")
+        except Error:
+            pass
+        finally:
+            cursor.close()
+            conn.close()
+
+    def close(self):
+        """停止读取 (必要时终止语句) 并丢弃连接"""
+        if self._started is not None:
+            self.cancel()
+            self._thread.join(timeout=5)
+        self._conn.discard()
+
+
+class _CsvGzWriter:
+
+    def __init__(self, path, columns):
+        self._file = gzip.open(path, "wt", encoding="utf-8", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(columns)
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetWriter:
+    """按块写 row group；列类型取自第一块 (第一块中全为 NULL 的列按字符串处理)"""
+
+    def __init__(self, path, columns):
+        self._path = path
+        self._columns = columns
+        self._schema = None
+        self._writer = None
+
+    def write(self, rows):
+        data = [[row[i] for row in rows] for i in range(len(self._columns))]
+        if self._schema is None:
+            arrays = [pa.array(col) for col in data]
+            self._schema = pa.schema([
+                pa.field(name, pa.string() if arr.type == pa.null() else arr.type)
+                for name, arr in zip(self._columns, arrays)])
+            self._writer = pq.ParquetWriter(self._path, self._schema)
+        self._writer.write_table(pa.Table.from_arrays(
+            [pa.array(col, type=field.type) for col, field in zip(data, self._schema)], schema=self._schema))
+
+    def close(self):
+        if self._writer is None:
+            pq.write_table(pa.Table.from_arrays([pa.array([], pa.string()) for _ in self._columns],
+                                                names=self._columns), self._path)
+        else:
+            self._writer.close()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class ExportFile:
+    """
+    导出结果的临时文件，放在 session_state 中：被新的导出替换时调用 remove()；
+    会话结束 (Streamlit 回收会话状态) 或进程正常退出时由 weakref.finalize 删除文件
+    """
+
+    def __init__(self, path, fmt, rows):
+        self.path = path
+        self.fmt = fmt
+        self.rows = rows
+        self._finalizer = weakref.finalize(self, _remove, path)
+
+    def remove(self):
+        self._finalizer()
+
+
+def sweep_exports(max_age=EXPORT_STALE_AGE):
+    """删除进程被强杀时遗留的导出文件 (按修改时间)"""
+    cutoff = time.time() - max_age
+    with os.scandir(tempfile.gettempdir()) as entries:
+        for entry in entries:
+            try:
+                if entry.name.startswith(EXPORT_PREFIX) and entry.is_file() and entry.stat().st_mtime < cutoff:
+                    _remove(entry.path)
+            except OSError:
+                continue
+
+
+def new_export_path(fmt):
+    """新建一个导出临时文件，顺带清理遗留文件"""
+    sweep_exports()
+    fd, path = tempfile.mkstemp(prefix=EXPORT_PREFIX, suffix=f".{fmt}")
+    os.close(fd)
+    return path
+
+
+def open_writer(path, fmt, columns):
+    if fmt == "csv.gz":
+        return _CsvGzWriter(path, columns)
+    if fmt == "parquet":
+        return _ParquetWriter(path, columns)
+    raise ValueError(f"unknown export format: {fmt}")
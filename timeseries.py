@@ -0,0 +1,153 @@
+"""
+利用率时间序列 (util_series，迁移 0009) 的采样、降采样与查询
+
+    python timeseries.py --host localhost --user root --password xxx --database cloud --interval 60
+
+每轮：sp_util_sample 采一次按队列 / 按物理 NPU 的原始样本；sp_util_rollup 把已结束的桶
+汇总为 5 分钟、1 小时两级；再按 RETENTION 分批删除过期数据。输出为每轮一行 JSON。
+
+series() 按时间范围自动选择精度：能覆盖起点、且点数不超过 max_points 的最细精度，
+长时间范围读的是预先汇总好的桶，不扫原始样本。
+"""
+import argparse
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+
+import cache
+import db
+import queries
+
+log = logging.getLogger("timeseries")
+
+SAMPLE_INTERVAL = 60
+RAW = 0
+# 降采样链：(源精度, 目标精度)，秒
+ROLLUPS = ((RAW, 300), (300, 3600))
+# 各精度的保留期
+RETENTION = {
+    RAW: timedelta(days=2),
+    300: timedelta(days=30),
+    3600: timedelta(days=400),
+}
+PURGE_BATCH = 10000
+MAX_POINTS = 500
+
+METRICS = {
+    "cores": "核数",
+    "gpu_mem": "显存",
+    "ram": "内存",
+    "instances": "运行实例数",
+    "revenue": "每小时营收",
+}
+
+
+
+def sample(db_config, interval=SAMPLE_INTERVAL):
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        cursor.callproc('sp_util_sample', [int(interval)])
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def rollup(db_config):
+    """依次执行降采样链，返回 {目标精度: 影响行数}"""
+    result = {}
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        for src, dst in ROLLUPS:
+            result[dst] = cursor.callproc('sp_util_rollup', [src, dst, 0])[2]
+            conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    return result
+
+
+def purge(db_config, now=None):
+    """按 RETENTION 分批删除过期数据，返回 {精度: 删除行数}"""
+    now = now or datetime.now()
+    deleted = {}
+    conn = db.get_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        for resolution, keep in RETENTION.items():
+            deleted[resolution] = 0
+            while True:
+                cursor.execute("DELETE FROM util_series WHERE resolution = %s AND bucket < %s LIMIT %s",
+                               (resolution, now - keep, PURGE_BATCH))
+                conn.commit()
+                deleted[resolution] += cursor.rowcount
+                if cursor.rowcount < PURGE_BATCH:
+                    break
+    finally:
+        cursor.close()
+        conn.close()
+    return deleted
+
+
+def pick_resolution(start, end, now=None, max_points=MAX_POINTS):
+    """能覆盖 start 且点数不超过 max_points 的最细精度；都超过时取最粗的一级"""
+    now = now or datetime.now()
+    span = (end - start).total_seconds()
+    resolutions = sorted(RETENTION)
+    for resolution in resolutions:
+        width = resolution or SAMPLE_INTERVAL
+        if start >= now - RETENTION[resolution] and span / width <= max_points:
+            return resolution
+    return resolutions[-1]
+
+
+def series(db_config, cursor, scope, entity, start, end=None, resolution=None, ttl=30.0):
+    """
+    一个队列 / NPU 在 [start, end) 内的序列 (需配合 dictionary=True 的游标)，
+    每行为一个桶的平均值与最大值；resolution 为 None 时自动选择
+    """
+    end = end or datetime.now()
+    if resolution is None:
+        resolution = pick_resolution(start, end)
+    # 边界对齐到桶宽，同一桶内的重复查询命中同一个缓存键
+    width = resolution or SAMPLE_INTERVAL
+    start = datetime.fromtimestamp(start.timestamp() // width * width)
+    end = datetime.fromtimestamp((end.timestamp() // width + 1) * width)
+    return cache.fetch_all(db_config, cursor, queries.SQL_UTIL_SERIES, (resolution, scope, str(entity), start, end),
+                           ttl=ttl, tags=("util_series",))
+
+
+def run_once(db_config, interval=SAMPLE_INTERVAL):
+    sample(db_config, interval)
+    rolled = rollup(db_config)
+    deleted = purge(db_config)
+    cache.invalidate("util_series")
+    return {"rollup": rolled, "purged": deleted}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--user", default="root")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--database", default="cloud")
+    parser.add_argument("--interval", type=float, default=SAMPLE_INTERVAL, help="采样间隔 (秒)，0 表示只运行一次")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    db_config = {"host": args.host, "user": args.user, "password": args.password,
+                 "database": args.database, "charset": "utf8mb4", "collation": "utf8mb4_0900_ai_ci"}
+    interval = int(args.interval) or SAMPLE_INTERVAL
+    while True:
+        result = run_once(db_config, interval)
+        print(json.dumps({"at": time.strftime("%Y-%m-%d %H:%M:%S"), **result}, ensure_ascii=False), flush=True)
+        if args.interval <= 0:
+            break
+        time.sleep(args.interval - time.time() % args.interval)
+
+
+if __name__ == "__main__":
+    main()
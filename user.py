@@ -5,13 +5,38 @@ import json
 from datetime import datetime
 from decimal import Decimal
 
+import admission
+import archive
+import cache
+import catalog
+import db
+import pagination
+import prefetch
+import queries
+import replica
+
+# 仪表盘读查询的缓存 TTL (秒)；submit_resource_request / pay_bill 会按表名主动失效
+CACHE_TTL = {
+    "user_info": 5,
+    "jobs": 5,
+    "bills": 10,
+    "unpaid_total": 10,
+    "balance_risk": 30,
+    "catalog": catalog.SNAPSHOT_TTL,
+}
+
+# 批量结算策略
+SETTLE_POLICIES = {
+    "all_or_nothing": "全部支付 (余额不足则不支付)",
+    "partial": "余额内尽量支付 (从最早的账单开始)",
+}
+
 def get_connection(db_config):
-    return mysql.connector.connect(**db_config)
+    return db.get_connection(db_config)
 
-def submit_resource_request(db_config, user_id, pkg_key, pkg_data, category):
-    conn = get_connection(db_config)
-    cursor = conn.cursor()
-    params = {
+def request_params(pkg_key, pkg_data, category):
+    """写入 requests.parameters 的 JSON 内容，审批时 (admin.approve_request) 按同样的结构读取"""
+    return {
         "category": category,
         "package_key": pkg_key,
         "name": pkg_data['name'],
@@ -19,58 +44,209 @@ def submit_resource_request(db_config, user_id, pkg_key, pkg_data, category):
         "price": pkg_data['price'],
         "db_params": pkg_data['db_params'] 
     }
+
+def submit_resource_request(db_config, user_id, pkg_key, pkg_data, category):
+    """提交申请，返回新请求的 request_id；未通过准入检查时抛出 admission.Rejected"""
+    admission.admit(db_config, user_id, pkg_key, pkg_data)
+    conn = get_connection(db_config)
+    cursor = conn.cursor()
+    params = request_params(pkg_key, pkg_data, category)
     sql = """
     INSERT INTO requests (user_id, request_type, parameters, status, submit_time) 
     VALUES (%s, %s, %s, 'pending', NOW())
     """
-    cursor.execute(sql, (user_id, f"申请-{pkg_data['name']}", json.dumps(params)))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    try:
+        cursor.execute(sql, (user_id, f"申请-{pkg_data['name']}", json.dumps(params)))
+        conn.commit()
+        cache.invalidate("requests")
+        replica.note_write(db_config, user_id)
+        return cursor.lastrowid
+    except Exception:
+        admission.cancel(db_config, user_id, pkg_key, pkg_data)
+        raise
+    finally:
+        cursor.close()
+        conn.close()
 
-def pay_bill(db_config, user_id, bill_id, amount):
+def _submit(db_config, user_id, pkg_key, pkg_data, category, success_message):
+    try:
+        submit_resource_request(db_config, user_id, pkg_key, pkg_data, category)
+    except admission.Rejected as err:
+        st.warning(str(err) + (f" (约 {err.retry_after:.0f} 秒后可重试)" if err.retry_after else ""))
+    else:
+        st.success(success_message)
+
+def _availability(avail):
+    """套餐卡片上的实时可用量提示；返回是否可提交 (估算不可用时不拦截)"""
+    if avail is None:
+        return True
+    if avail["fits"] > 0:
+        st.caption(f"当前约可再分配 {avail['fits']} 个")
+        return True
+    st.caption(f":red[当前资源不足 ({catalog.LIMITS[avail['limited_by']]})，暂无可容纳该套餐的节点]")
+    return False
+
+def settle_bills(db_config, user_id, bill_ids=None, policy="all_or_nothing"):
+    """
+    在一个事务内结算账单：对用户行加一次锁、一次扣款、一次提交。
+    bill_ids 为 None 时结算全部可支付账单 (queries.SQL_PAYABLE_BILLS：任务运行中的计量账单要等释放后才可支付)；
+    policy 见 SETTLE_POLICIES，
+    partial 按从旧到新的顺序支付余额够付的账单 (付不起的跳过，继续看后面更小的)。
+    返回 {'status', 'paid', 'amount', 'balance', 'unpaid'}，status 为
+    SUCCESS / PARTIAL / INSUFFICIENT_BALANCE / NOTHING_TO_PAY / USER_NOT_FOUND
+    """
+    if policy not in SETTLE_POLICIES:
+        raise ValueError(f"unknown settle policy: {policy}")
     conn = get_connection(db_config)
     cursor = conn.cursor()
     try:
-        amount_decimal = Decimal(str(amount))
+        # READ COMMITTED：锁定读只锁命中的账单行，不对该用户的账单索引区间加间隙锁，
+        # 结算期间计量任务仍可为该用户写入新账单
+        conn.start_transaction(isolation_level="READ COMMITTED")
         cursor.execute("SELECT balance FROM users WHERE user_id=%s FOR UPDATE", (user_id,))
         result = cursor.fetchone()
         if not result:
-            st.error("用户不存在")
-            return False
-        current_balance = result[0]
-        
-        if current_balance < amount_decimal:
-            st.error(f"余额不足！当前余额: ¥{current_balance}, 需要: ¥{amount_decimal}")
-            return False
-            
-        new_balance = current_balance - amount_decimal
-        cursor.execute("UPDATE users SET balance=%s WHERE user_id=%s", (new_balance, user_id))
-        cursor.execute("UPDATE bills SET payment_status='paid' WHERE bill_id=%s", (bill_id,))
+            conn.rollback()
+            return {"status": "USER_NOT_FOUND", "paid": [], "amount": Decimal(0), "balance": None, "unpaid": []}
+        balance = Decimal(result[0] or 0)
+
+        sql, params = queries.SQL_PAYABLE_BILLS, [user_id]
+        if bill_ids is not None:
+            if not bill_ids:
+                conn.rollback()
+                return {"status": "NOTHING_TO_PAY", "paid": [], "amount": Decimal(0), "balance": balance, "unpaid": []}
+            sql += f" AND b.bill_id IN ({', '.join(['%s'] * len(bill_ids))})"
+            params += [int(b) for b in bill_ids]
+        cursor.execute(sql + " ORDER BY b.created_at, b.bill_id FOR UPDATE OF b", params)
+        bills = cursor.fetchall()
+        if not bills:
+            conn.rollback()
+            return {"status": "NOTHING_TO_PAY", "paid": [], "amount": Decimal(0), "balance": balance, "unpaid": []}
+
+        paid, unpaid, amount = [], [], Decimal(0)
+        if policy == "all_or_nothing":
+            total = sum((Decimal(cost) for _, cost in bills), Decimal(0))
+            if total <= balance:
+                paid, amount = [bill_id for bill_id, _ in bills], total
+            else:
+                unpaid = [bill_id for bill_id, _ in bills]
+        else:
+            for bill_id, cost in bills:
+                if amount + Decimal(cost) <= balance:
+                    paid.append(bill_id)
+                    amount += Decimal(cost)
+                else:
+                    unpaid.append(bill_id)
+
+        if not paid:
+            conn.rollback()
+            return {"status": "INSUFFICIENT_BALANCE", "paid": [], "amount": Decimal(0), "balance": balance,
+                    "unpaid": unpaid}
+
+        cursor.execute("UPDATE users SET balance = balance - %s WHERE user_id=%s", (amount, user_id))
+        cursor.execute(f"""
+            UPDATE bills SET payment_status='paid'
+            WHERE bill_id IN ({', '.join(['%s'] * len(paid))}) AND payment_status='unpaid'
+        """, paid)
         conn.commit()
-        st.success(f"支付成功！扣除 ¥{amount_decimal}，剩余余额 ¥{new_balance}")
-        return True
-    except mysql.connector.Error as err:
+    except mysql.connector.Error:
         conn.rollback()
-        st.error(f"支付交易失败: {err}")
-        return False
+        raise
     finally:
         cursor.close()
         conn.close()
+    cache.invalidate("users", "bills")
+    replica.note_write(db_config, user_id)
+    return {"status": "PARTIAL" if unpaid else "SUCCESS", "paid": paid, "amount": amount,
+            "balance": balance - amount, "unpaid": unpaid}
+
+def pay_bill(db_config, user_id, bill_id, amount):
+    try:
+        result = settle_bills(db_config, user_id, [bill_id])
+    except mysql.connector.Error as err:
+        st.error(f"支付交易失败: {err}")
+        return False
+    if result['status'] == "USER_NOT_FOUND":
+        st.error("用户不存在")
+        return False
+    if result['status'] == "NOTHING_TO_PAY":
+        st.error("账单已支付或不可支付")
+        return False
+    if result['status'] == "INSUFFICIENT_BALANCE":
+        st.error(f"余额不足！当前余额: ¥{result['balance']}, 需要: ¥{Decimal(str(amount))}")
+        return False
+    st.success(f"支付成功！扣除 ¥{result['amount']}，剩余余额 ¥{result['balance']}")
+    return True
+
+def _settle_message(result):
+    """批量结算结果 -> (级别, 提示文字)，rerun 后在账单页顶部显示"""
+    status = result['status']
+    if status == "SUCCESS":
+        return "success", f"已支付 {len(result['paid'])} 张账单，共 ¥{result['amount']:.2f}，剩余余额 ¥{result['balance']:.2f}"
+    if status == "PARTIAL":
+        return "warning", (f"已支付 {len(result['paid'])} 张账单，共 ¥{result['amount']:.2f}；"
+                           f"余额不足，{len(result['unpaid'])} 张未支付，剩余余额 ¥{result['balance']:.2f}")
+    if status == "INSUFFICIENT_BALANCE":
+        return "error", f"余额不足 (当前 ¥{result['balance']:.2f})，未支付任何账单"
+    if status == "NOTHING_TO_PAY":
+        return "info", "没有可支付的账单"
+    return "error", "用户不存在"
+
+SQL_USER_INFO = "SELECT balance, status FROM users WHERE user_id=%s"
+
+def submit_dashboard_queries(page, db_config, user_id, jobs_page=(pagination.DEFAULT_PAGE_SIZE, None),
+                             bills_page=(pagination.DEFAULT_PAGE_SIZE, None), ttl=CACHE_TTL):
+    """把用户页各区块互不依赖的读查询提交给 prefetch.PageQueries 并行执行"""
+    page.submit("user_info", cache.fetch_one, SQL_USER_INFO, (user_id,), ttl=ttl["user_info"], tags=("users",))
+    page.submit("balance_risk", cache.fetch_one, queries.SQL_BALANCE_RISK, (user_id,), ttl=ttl["balance_risk"],
+                tags=("user_balance_risk",))
+    page_size, after = jobs_page
+    page.submit("jobs", pagination.fetch_page, queries.SQL_JOBS, ["r.user_id = %s"], [user_id],
+                key_cols=("r.request_id",), key_fields=("request_id",), after=after, page_size=page_size,
+                ttl=ttl["jobs"], tags=("requests", "virtualcomputers"))
+    page_size, after = bills_page
+    page.submit("bills", pagination.fetch_page, queries.SQL_BILLS, ["b.user_id = %s"], [user_id],
+                key_cols=("b.created_at", "b.bill_id"), key_fields=("created_at", "bill_id"),
+                after=after, page_size=page_size, ttl=ttl["bills"], tags=("bills", "requests", "virtualcomputers"))
+    page.submit("unpaid_total", cache.fetch_one, queries.SQL_UNPAID_TOTAL, (user_id,), ttl=ttl["unpaid_total"],
+                tags=("bills", "requests"))
+    page.submit("catalog", catalog.snapshot, ttl=ttl["catalog"])
 
 def render_user_dashboard(db_config, user, vm_packages):
     st.markdown(f"### 欢迎, {user['user_name']}")
     
-    conn = get_connection(db_config)
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("SELECT balance, status FROM users WHERE user_id=%s", (user['user_id'],))
-    user_info = cursor.fetchone()
+    # 各区块的读查询先一起提交 (分页取控件在本次重跑的值)，渲染到对应区块时再取结果
+    jobs_page_key = f"jobs_page_{user['user_id']}"
+    bills_page_key = f"bills_page_{user['user_id']}" + ("_archive" if st.session_state.get("bills_archive") else "")
+    # 用户自己的写入 (提交申请 / 付款) 之后，读查询在副本追上之前走主库
+    page = prefetch.PageQueries(db_config, scope=user['user_id'])
+    submit_dashboard_queries(page, db_config, user['user_id'],
+                             pagination.current(jobs_page_key), pagination.current(bills_page_key))
+
+    user_info = page.result("user_info")
+    if user_info is None:
+        # 余额与状态是页面的前提，预取失败时同步重试一次
+        conn = get_connection(db_config)
+        cursor = conn.cursor(dictionary=True)
+        try:
+            user_info = cache.fetch_one(db_config, cursor, SQL_USER_INFO, (user['user_id'],),
+                                        ttl=CACHE_TTL["user_info"], tags=("users",))
+        finally:
+            cursor.close()
+            conn.close()
     
     c1, c2, c3 = st.columns(3)
     c1.metric("账户余额", f"¥ {user_info['balance']:.2f}")
     c2.metric("账户状态", "正常" if user_info['status'] == 'active' else "受限")
     c3.metric("当前时间", datetime.now().strftime("%H:%M"))
 
+    risk = page.result("balance_risk")
+    if risk and risk['risk_level'] == 'exhausted':
+        st.error(f"可用余额已耗尽 (¥{risk['available']:.2f})，运行中的实例可能被终止，请尽快充值并支付账单。")
+    elif risk and risk['risk_level'] == 'critical':
+        st.warning(f"按当前消耗 (¥{risk['burn_rate']:.2f}/小时)，可用余额预计在 {risk['hours_left']:.1f} 小时后"
+                   f" ({risk['exhausted_at']}) 耗尽。")
+
     st.markdown("---")
 
     tab_apply, tab_jobs, tab_bills = st.tabs(["资源申请", "我的任务", "账单管理"])
@@ -81,6 +257,8 @@ def render_user_dashboard(db_config, user, vm_packages):
     with tab_apply:
         st.caption("作业提交系统 (Slurm Queue Mode)")
         type_gpu, type_cpu = st.tabs(["GPU 加速计算", "CPU 高性能计算"])
+        snap = prefetch.section(page, "catalog", None)
+        availability = catalog.estimates(snap, vm_packages) if snap is not None else {}
         
         with type_gpu:
             cols = st.columns(2)
@@ -98,13 +276,14 @@ def render_user_dashboard(db_config, user, vm_packages):
                             st.markdown(f"**CPU**: {pkg['specs']['CPU']}")
                             st.markdown(f"**磁盘**: {pkg['specs']['磁盘']}")
                         st.markdown("---")
+                        can_submit = _availability(availability.get(key))
                         b1, b2 = st.columns([1, 1])
                         with b1:
                             st.markdown(f"### ¥{pkg['price']} <span style='color:grey;font-size:0.8em'>/时</span>", unsafe_allow_html=True)
                         with b2:
-                            if st.button("提交作业", key=f"btn_gpu_{key}", use_container_width=True):
-                                submit_resource_request(db_config, user['user_id'], key, pkg, 'gpu')
-                                st.success("作业已提交到调度队列，等待审批")
+                            if st.button("提交作业", key=f"btn_gpu_{key}", use_container_width=True,
+                                         disabled=not can_submit):
+                                _submit(db_config, user['user_id'], key, pkg, 'gpu', "作业已提交到调度队列，等待审批")
 
         with type_cpu:
             cols = st.columns(2)
@@ -115,13 +294,14 @@ def render_user_dashboard(db_config, user, vm_packages):
                         st.caption(f"队列: `{pkg['queue']}`")
                         st.markdown(f"- **CPU**: {pkg['specs']['CPU']}\n- **内存**: {pkg['specs']['内存']}\n- **磁盘**: {pkg['specs']['磁盘']}")
                         st.markdown("---")
+                        can_submit = _availability(availability.get(key))
                         b1, b2 = st.columns([1, 1])
                         with b1:
                             st.markdown(f"### ¥{pkg['price']} <span style='color:grey;font-size:0.8em'>/时</span>", unsafe_allow_html=True)
                         with b2:
-                            if st.button("提交作业", key=f"btn_cpu_{key}", use_container_width=True):
-                                submit_resource_request(db_config, user['user_id'], key, pkg, 'cpu')
-                                st.success("作业已提交")
+                            if st.button("提交作业", key=f"btn_cpu_{key}", use_container_width=True,
+                                         disabled=not can_submit):
+                                _submit(db_config, user['user_id'], key, pkg, 'cpu', "作业已提交")
 
     # ==========================================
     # Tab 2: 我的任务 (修复：区分 completed 和 terminated)
@@ -129,17 +309,9 @@ def render_user_dashboard(db_config, user, vm_packages):
     with tab_jobs:
         st.caption("查看任务的生命周期状态")
         
-        sql_jobs = """
-        SELECT 
-            r.request_id, r.request_type, r.status as req_status, r.submit_time,
-            vc.node_name, vc.queue_name, vc.status as vc_status
-        FROM requests r
-        LEFT JOIN virtualcomputers vc ON r.request_id = vc.request_id
-        WHERE r.user_id = %s
-        ORDER BY r.submit_time DESC
-        """
-        cursor.execute(sql_jobs, (user['user_id'],))
-        jobs = pd.DataFrame(cursor.fetchall())
+        pagination.page_size_selector(jobs_page_key)
+        job_rows, jobs_next = prefetch.section(page, "jobs", ([], None))
+        jobs = pd.DataFrame(job_rows)
 
         if jobs.empty:
             st.info("暂无任务记录")
@@ -180,8 +352,12 @@ def render_user_dashboard(db_config, user, vm_packages):
                         elif status == 'terminated':
                             st.error("异常终止")
                             st.caption("任务非正常结束")
+                        elif status == 'failed':
+                            st.error("调度失败")
+                            st.caption(row['error_message'] or "")
                         else:
                             st.text(status)
+        pagination.pager(jobs_page_key, jobs_next)
 
     # ==========================================
     # Tab 3: 账单管理 (修复：显示任务原始状态，警示异常账单)
@@ -189,34 +365,63 @@ def render_user_dashboard(db_config, user, vm_packages):
     with tab_bills:
         st.caption("查看已完成作业的账单并进行支付")
         
-        # [修复] 增加查询 r.status as job_status
-        sql_bills = """
-        SELECT 
-            b.bill_id, b.cost_amount, b.payment_status, b.usage_hours, b.end_time,
-            r.request_type, r.request_id, r.status as job_status,
-            vc.node_name
-        FROM bills b
-        JOIN requests r ON b.request_id = r.request_id
-        LEFT JOIN virtualcomputers vc ON b.node_id = vc.node_id
-        WHERE b.user_id = %s
-        ORDER BY b.created_at DESC
-        """
-        cursor.execute(sql_bills, (user['user_id'],))
-        bills_data = pd.DataFrame(cursor.fetchall())
+        with_archive = st.checkbox("包含已归档账单", key="bills_archive",
+                                   help="已付清且早于归档期限的账单移到了归档文件中")
+        bills_page_size, bills_after = pagination.page_size_selector(bills_page_key)
+        bill_rows, bills_next = prefetch.section(page, "bills", ([], None))
+        if with_archive:
+            bill_rows, bills_next = archive.merge_page(
+                bill_rows, bills_next, archive.read_bills(user['user_id'], bills_after, bills_page_size + 1),
+                ("created_at", "bill_id"), bills_page_size)
+        bills_data = pd.DataFrame(bill_rows)
         
         if bills_data.empty:
             st.info("暂无账单记录")
         else:
-            unpaid_total = Decimal('0.00')
-            for _, row in bills_data.iterrows():
-                if row['payment_status'] == 'unpaid' and row['job_status'] != 'terminated':
-                     # 仅统计非异常终止的金额，或者全部统计看业务需求
-                     unpaid_total += row['cost_amount']
+            # 待支付总额覆盖全部账单而非当前页，由数据库聚合
+            # 仅统计非异常终止的金额，或者全部统计看业务需求
+            unpaid_row = prefetch.section(page, "unpaid_total", None) or {"unpaid_total": 0, "unpaid_bills": 0,
+                                                                          "accruing_total": 0, "accruing_bills": 0}
+            unpaid_total = Decimal(unpaid_row['unpaid_total'])
             
+            settle_key = f"settle_result_{user['user_id']}"
+            if settle_key in st.session_state:
+                level, message = st.session_state.pop(settle_key)
+                getattr(st, level)(message)
+
             if unpaid_total > 0:
-                st.warning(f"当前待支付总额 (正常作业): ¥{unpaid_total:.2f}")
+                st.warning(f"当前待支付总额 (正常作业): ¥{unpaid_total:.2f}，共 {unpaid_row['unpaid_bills']} 张")
             else:
                 st.success("所有正常账单已结清")
+            if unpaid_row['accruing_bills']:
+                st.info(f"运行中任务的计量账单 ¥{Decimal(unpaid_row['accruing_total']):.2f}，共 {unpaid_row['accruing_bills']} 张，"
+                        "任务结束后才能支付")
+
+            # 批量结算：一次加锁、一次扣款、一次提交
+            payable_ids = [int(r['bill_id']) for _, r in bills_data.iterrows()
+                           if r['payment_status'] == 'unpaid' and r['job_status'] not in ('approved', 'terminated')]
+            s1, s2, s3 = st.columns([2, 3, 1.5])
+            with s1:
+                policy = st.radio("结算策略", list(SETTLE_POLICIES), format_func=SETTLE_POLICIES.get,
+                                  key=f"settle_policy_{user['user_id']}")
+            with s2:
+                # 结算后换一个 key，已支付的账单不会残留在选择框里
+                selected_ids = st.multiselect("选择本页账单", payable_ids, format_func=lambda b: f"#{b}",
+                                              key=f"settle_ids_{user['user_id']}_{st.session_state.get(settle_key + '_n', 0)}")
+            with s3:
+                settle_selected = st.button(f"支付所选 ({len(selected_ids)})", disabled=not selected_ids,
+                                            use_container_width=True)
+                settle_all = st.button("全部结清", disabled=unpaid_total <= 0, type="primary",
+                                       use_container_width=True)
+            if settle_selected or settle_all:
+                try:
+                    result = settle_bills(db_config, user['user_id'], selected_ids if settle_selected else None, policy)
+                except mysql.connector.Error as err:
+                    st.error(f"支付交易失败: {err}")
+                else:
+                    st.session_state[settle_key] = _settle_message(result)
+                    st.session_state[settle_key + '_n'] = st.session_state.get(settle_key + '_n', 0) + 1
+                    st.rerun()
             
             st.markdown("---")
 
@@ -252,12 +457,15 @@ def render_user_dashboard(db_config, user, vm_packages):
                             if row['job_status'] == 'terminated':
                                 st.error("异常账单")
                                 st.caption("请联系管理员核实")
+                            elif row['job_status'] == 'approved':
+                                st.info("任务运行中")
+                                st.caption("任务结束后可支付")
                             else:
                                 if st.button("立即支付", key=f"pay_bill_btn_{row['bill_id']}", type="primary", use_container_width=True):
                                     if pay_bill(db_config, user['user_id'], row['bill_id'], row['cost_amount']):
                                         st.rerun()
                         else:
                             st.success("已支付")
+        pagination.pager(bills_page_key, bills_next)
 
-    cursor.close()
-    conn.close()
+    prefetch.timing_caption(page)